@@ -0,0 +1,99 @@
+# core/llm_clients/backends.py
+"""
+Pluggable LLM caller backend (env LLM_BACKEND):
+- openai (default): openai_caller / async_openai_caller
+- fake:   FakeLLM (LLM_FAKE_LATENCY_MS, LLM_FAKE_JITTER_MS, LLM_FAKE_ERROR_RATE,
+          LLM_FAKE_429_RATE, LLM_FAKE_SEED)
+- record: real OpenAI calls, answers appended to LLM_CASSETTE_PATH
+- replay: answers from LLM_CASSETTE_PATH only (no network)
+
+Views call llm_caller / async_llm_caller; the backend is resolved lazily
+and can be switched at runtime with set_backend() (benchmarks, tests).
+"""
+import logging
+import os
+import tempfile
+import threading
+from typing import Awaitable, Callable, Optional, Tuple
+
+from .openai_client import async_openai_caller, openai_caller
+
+LLMCaller = Callable[..., str]
+AsyncLLMCaller = Callable[..., Awaitable[str]]
+
+BACKENDS = ("openai", "fake", "record", "replay")
+
+_lock = threading.Lock()
+_callers: Optional[Tuple[LLMCaller, AsyncLLMCaller]] = None
+_backend_name = "openai"
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)).strip())
+    except Exception:
+        return default
+
+
+def default_cassette_path() -> str:
+    return os.getenv("LLM_CASSETTE_PATH") or os.path.join(tempfile.gettempdir(), "ibla_llm_cassette.jsonl")
+
+
+def build_callers(backend: Optional[str] = None) -> Tuple[LLMCaller, AsyncLLMCaller]:
+    """(sync caller, async caller) for `backend` (default: env LLM_BACKEND)."""
+    name = (backend or os.getenv("LLM_BACKEND", "openai")).strip().lower()
+    if name == "fake":
+        from .fake_client import FakeLLM
+
+        fake = FakeLLM(
+            latency_ms=_env_float("LLM_FAKE_LATENCY_MS", 300.0),
+            jitter_ms=_env_float("LLM_FAKE_JITTER_MS", 200.0),
+            error_rate=_env_float("LLM_FAKE_ERROR_RATE", 0.0),
+            rate_limit_rate=_env_float("LLM_FAKE_429_RATE", 0.0),
+            seed=int(_env_float("LLM_FAKE_SEED", 0)),
+        )
+        return fake.caller, fake.acaller
+    if name in ("record", "replay"):
+        from .cassette import Cassette
+
+        cassette = Cassette(
+            default_cassette_path(),
+            mode=name,
+            replay_latency=os.getenv("LLM_CASSETTE_REPLAY_LATENCY", "0").strip() in ("1", "true", "yes"),
+        )
+        return cassette.wrap(openai_caller), cassette.wrap_async(async_openai_caller)
+    if name != "openai":
+        logging.getLogger("core.llm").warning("unknown LLM_BACKEND=%r; using openai", name)
+    return openai_caller, async_openai_caller
+
+
+def set_backend(backend: Optional[str] = None) -> str:
+    """Switch the process-wide backend (None → re-read LLM_BACKEND). Returns its name."""
+    global _callers, _backend_name
+    name = (backend or os.getenv("LLM_BACKEND", "openai")).strip().lower()
+    callers = build_callers(name)
+    with _lock:
+        _callers = callers
+        _backend_name = name if name in BACKENDS else "openai"
+        return _backend_name
+
+
+def current_backend() -> str:
+    _get()
+    return _backend_name
+
+
+def _get() -> Tuple[LLMCaller, AsyncLLMCaller]:
+    if _callers is None:
+        set_backend(None)
+    return _callers  # type: ignore[return-value]
+
+
+def llm_caller(prompt: str, **kwargs) -> str:
+    """Sync caller for the configured backend (same signature as openai_caller)."""
+    return _get()[0](prompt, **kwargs)
+
+
+async def async_llm_caller(prompt: str, **kwargs) -> str:
+    """Async caller for the configured backend (same signature as async_openai_caller)."""
+    return await _get()[1](prompt, **kwargs)
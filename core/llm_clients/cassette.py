@@ -0,0 +1,167 @@
+# core/llm_clients/cassette.py
+"""
+Record/replay of LLM responses ("cassettes") for reproducible benchmarks.
+
+- record: wrap the real caller; every answer is appended to a JSONL file
+- replay: answer from the file only (no network); a miss raises CassetteMiss
+- auto:   replay when recorded, otherwise call through and record
+
+Replayed calls still pass through the rate limiter (optionally sleeping the
+recorded latency), so limiter/concurrency behaviour stays measurable. The
+recorded latency is the provider call only (limiter.attempt_timings), not the
+time spent queueing for budget — replay queues again on its own.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from .limiter import (
+    AsyncRateLimiter,
+    RateLimiter,
+    attempt_timings,
+    estimate_tokens,
+    global_async_limiter,
+    global_limiter,
+)
+from .openai_client import LLMError
+
+LLMCaller = Callable[..., str]
+AsyncLLMCaller = Callable[..., Awaitable[str]]
+
+MODES = ("record", "replay", "auto")
+
+
+class CassetteMiss(LLMError):
+    """No recorded answer for this prompt (replay mode)."""
+    pass
+
+
+def cassette_key(prompt: str, *, model_name: str = "", temperature: float = 0.2, max_tokens: int = 512) -> str:
+    payload = json.dumps([model_name, round(float(temperature), 3), int(max_tokens), prompt], ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class Cassette:
+    def __init__(
+        self,
+        path: str,
+        mode: str = "replay",
+        *,
+        replay_latency: bool = False,
+        limiter: Optional[RateLimiter] = None,
+        async_limiter: Optional[AsyncRateLimiter] = None,
+    ) -> None:
+        if mode not in MODES:
+            raise ValueError(f"cassette mode must be one of {MODES}, got {mode!r}")
+        self.path = path
+        self.mode = mode
+        self.replay_latency = bool(replay_latency)
+        self.limiter = limiter or global_limiter
+        self.async_limiter = async_limiter or (
+            global_async_limiter if limiter is None else AsyncRateLimiter(self.limiter)
+        )
+        self._lock = threading.Lock()
+        self._entries: Dict[str, dict] = {}
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as fh:
+            for line in fh:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = json.loads(line)
+                    self._entries[row["key"]] = row
+                except (ValueError, KeyError):
+                    continue
+
+    def _lookup(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._entries.get(key) if self.mode != "record" else None
+            if row is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return row
+
+    def _store(self, key: str, model_name: str, response: str, latency_sec: float) -> None:
+        row = {"key": key, "model": model_name, "response": response, "latency_sec": round(latency_sec, 4)}
+        with self._lock:
+            self._entries[key] = row
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as fh:
+                fh.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    @staticmethod
+    def _provider_latency(timings: List[float], total_sec: float) -> float:
+        # last successful attempt through a limiter; a caller without one → wall time
+        return timings[-1] if timings else total_sec
+
+    def _miss(self, key: str) -> CassetteMiss:
+        return CassetteMiss(f"no recorded LLM response for key {key[:12]} in {self.path}")
+
+    def wrap(self, caller: Optional[LLMCaller] = None) -> LLMCaller:
+        """Sync caller; `caller` is the real backend (not needed for pure replay)."""
+
+        def _cassette_caller(prompt: str, *, model_name: str = "", temperature: float = 0.2,
+                             max_tokens: int = 512, timeout: int = 60) -> str:
+            key = cassette_key(prompt, model_name=model_name, temperature=temperature, max_tokens=max_tokens)
+            row = self._lookup(key)
+            if row is not None:
+                def _replay():
+                    if self.replay_latency:
+                        time.sleep(float(row.get("latency_sec") or 0.0))
+                    return row["response"]
+
+                cost = estimate_tokens(prompt, int(max_tokens))
+                return self.limiter.execute(cost, _replay, model=model_name)  # type: ignore[return-value]
+            if self.mode == "replay" or caller is None:
+                raise self._miss(key)
+            t0 = time.monotonic()
+            with attempt_timings() as timings:
+                out = caller(prompt, model_name=model_name, temperature=temperature,
+                             max_tokens=max_tokens, timeout=timeout)
+            self._store(key, model_name, out, self._provider_latency(timings, time.monotonic() - t0))
+            return out
+
+        return _cassette_caller
+
+    def wrap_async(self, caller: Optional[AsyncLLMCaller] = None) -> AsyncLLMCaller:
+        """Async counterpart of wrap()."""
+
+        async def _cassette_acaller(prompt: str, *, model_name: str = "", temperature: float = 0.2,
+                                    max_tokens: int = 512, timeout: int = 60) -> str:
+            key = cassette_key(prompt, model_name=model_name, temperature=temperature, max_tokens=max_tokens)
+            row = self._lookup(key)
+            if row is not None:
+                async def _replay():
+                    if self.replay_latency:
+                        await asyncio.sleep(float(row.get("latency_sec") or 0.0))
+                    return row["response"]
+
+                cost = estimate_tokens(prompt, int(max_tokens))
+                return await self.async_limiter.execute(cost, _replay, model=model_name)  # type: ignore[return-value]
+            if self.mode == "replay" or caller is None:
+                raise self._miss(key)
+            t0 = time.monotonic()
+            with attempt_timings() as timings:
+                out = await caller(prompt, model_name=model_name, temperature=temperature,
+                                   max_tokens=max_tokens, timeout=timeout)
+            self._store(key, model_name, out, self._provider_latency(timings, time.monotonic() - t0))
+            return out
+
+        return _cassette_acaller
@@ -0,0 +1,255 @@
+# core/llm_clients/fake_client.py
+"""
+Offline stand-in for OpenAI: deterministic answers for the prompts built by
+core/services/llm_ingest, with configurable latency, error rate and 429s.
+
+Calls go through the same RateLimiter/AsyncRateLimiter as the real caller
+(budgets, retries, usage + latency stats), so throughput, limiter behaviour
+and concurrency settings can be benchmarked without network or quota.
+"""
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+
+from .limiter import (
+    AsyncRateLimiter,
+    CircuitOpenError,
+    LLMCancelled,
+    RateLimiter,
+    estimate_tokens,
+    global_async_limiter,
+    global_limiter,
+)
+from .openai_client import LLMError, LLMRateLimit, LLMUnavailable
+
+
+class _FakeResponse:
+    def __init__(self, status_code: int, headers: Dict[str, str]) -> None:
+        self.status_code = status_code
+        self.headers = headers
+
+
+class FakeRateLimitError(Exception):
+    """Injected 429; carries retry-after like openai.RateLimitError."""
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__("fake 429: rate limit reached")
+        self.response = _FakeResponse(429, {"retry-after": f"{retry_after:.3f}"})
+        self.status_code = 429
+
+
+class FakeServerError(Exception):
+    """Injected 5xx."""
+
+    def __init__(self) -> None:
+        super().__init__("fake 500: internal server error")
+        self.response = _FakeResponse(500, {})
+        self.status_code = 500
+
+
+# term -> letter codes (enough to make the fake answers look like real ones)
+_FAKE_CODES = {
+    "mehl": "A", "brot": "A", "teig": "A", "nudel": "A", "pasta": "A", "pizza": "A", "weizen": "A",
+    "bulgur": "A", "couscous": "A", "panier": "A", "bun": "A", "wrap": "A",
+    "garnele": "B", "shrimp": "B", "krabbe": "B",
+    "ei": "C", "mayo": "C", "aioli": "C", "remoulade": "C",
+    "fisch": "D", "lachs": "D", "thunfisch": "D",
+    "erdnuss": "E",
+    "soja": "F", "tofu": "F", "miso": "F",
+    "milch": "G", "kaese": "G", "joghurt": "G", "butter": "G", "sahne": "G", "quark": "G",
+    "nuss": "H", "mandel": "H", "pistazie": "H", "nougat": "H",
+    "senf": "J",
+    "sesam": "K", "tahini": "K",
+    "sellerie": "L",
+    "lupine": "N",
+}
+_STOP = {
+    "mit", "und", "oder", "vom", "dazu", "hausgemacht", "frisch", "lecker", "portion",
+    "teller", "klassisch", "serviert", "beilage", "gericht",
+}
+_WORD_RE = re.compile(r"[a-zäöüß][a-zäöüß\-]+")
+
+
+def _norm(text: str) -> str:
+    x = (text or "").lower()
+    for a, b in (("ß", "ss"), ("ä", "ae"), ("ö", "oe"), ("ü", "ue")):
+        x = x.replace(a, b)
+    return x
+
+
+def _codes_for(text: str) -> str:
+    words = _WORD_RE.findall(_norm(text).replace("beschreibung:", " "))
+    found = {
+        code
+        for key, code in _FAKE_CODES.items()
+        for w in words
+        if (key in w if len(key) >= 4 else w.startswith(key))
+    }
+    return ",".join(sorted(found))
+
+
+def _line_after(prompt: str, label: str) -> str:
+    m = re.search(rf"^{label}\s*(.*)$", prompt, re.MULTILINE)
+    return m.group(1).strip() if m else ""
+
+
+def fake_response_for(prompt: str) -> str:
+    """Deterministic answer shaped like the real model's for each llm_ingest prompt."""
+    if "Return ONLY JSON array" in prompt:
+        text = f"{_line_after(prompt, 'NAME:')} {_line_after(prompt, 'DESC:')}"
+        m = re.search(r"Output <= (\d+) items", prompt)
+        limit = int(m.group(1)) if m else 12
+        terms: List[str] = []
+        for w in _WORD_RE.findall(_norm(text)):
+            if len(w) >= 3 and w not in _STOP and w not in terms:
+                terms.append(w)
+        return json.dumps(terms[:limit], ensure_ascii=False)
+
+    if "Return ONLY JSON object" in prompt:
+        m = re.search(r"Terms \(language=[^)]*\):\s*(\[.*?\])", prompt, re.DOTALL)
+        try:
+            terms = json.loads(m.group(1)) if m else []
+        except ValueError:
+            terms = []
+        out = {}
+        for term in terms:
+            codes = _codes_for(str(term))
+            out[str(term)] = {
+                "codes": codes,
+                "confidence": 0.8 if codes else 0.0,
+                "reason": "fake" if codes else "none",
+            }
+        return json.dumps(out, ensure_ascii=False)
+
+    if "Gerichte:" in prompt:
+        body = prompt.split("Gerichte:", 1)[1].split("Antwort-Format", 1)[0]
+        blocks = re.split(r"^\[(\d+)\]", body, flags=re.MULTILINE)[1:]
+        lines = [f"{num}: codes: {_codes_for(text)}" for num, text in zip(blocks[::2], blocks[1::2])]
+        return "\n".join(lines)
+
+    if "Gericht:" in prompt:
+        dish = prompt.split("Gericht:", 1)[1].split("Antwort-Format", 1)[0]
+        return f"codes: {_codes_for(dish)}"
+
+    return "OK"
+
+
+class FakeLLM:
+    """
+    Configurable fake backend.
+    - latency_ms + uniform jitter_ms per call
+    - error_rate: share of calls failing with a 5xx
+    - rate_limit_rate: share of calls failing with a 429 (retry-after = retry_after_sec)
+    - seed: same seed → same sequence of latencies/failures
+    """
+
+    def __init__(
+        self,
+        *,
+        latency_ms: float = 300.0,
+        jitter_ms: float = 200.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after_sec: float = 0.2,
+        seed: int = 0,
+        limiter: Optional[RateLimiter] = None,
+        async_limiter: Optional[AsyncRateLimiter] = None,
+    ) -> None:
+        self.latency_ms = max(0.0, float(latency_ms))
+        self.jitter_ms = max(0.0, float(jitter_ms))
+        self.error_rate = min(1.0, max(0.0, float(error_rate)))
+        self.rate_limit_rate = min(1.0, max(0.0, float(rate_limit_rate)))
+        self.retry_after_sec = max(0.0, float(retry_after_sec))
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.limiter = limiter or global_limiter
+        self.async_limiter = async_limiter or (
+            global_async_limiter if limiter is None else AsyncRateLimiter(self.limiter)
+        )
+        self.calls = 0
+
+    def _next_attempt(self, prompt: str):
+        """(latency_sec, error or None, response text) for one attempt."""
+        with self._lock:
+            self.calls += 1
+            latency = (self.latency_ms + self._rng.uniform(0, self.jitter_ms)) / 1000.0
+            roll = self._rng.random()
+        if roll < self.rate_limit_rate:
+            return latency, FakeRateLimitError(self.retry_after_sec), ""
+        if roll < self.rate_limit_rate + self.error_rate:
+            return latency, FakeServerError(), ""
+        return latency, None, fake_response_for(prompt)
+
+    @staticmethod
+    def _usage(model_name: str, prompt: str, out: str) -> dict:
+        return {
+            "model": model_name,
+            "prompt_tokens": estimate_tokens(prompt, 0),
+            "completion_tokens": estimate_tokens(out, 0),
+        }
+
+    def caller(
+        self,
+        prompt: str,
+        *,
+        model_name: str = "fake",
+        temperature: float = 0.2,
+        max_tokens: int = 512,
+        timeout: int = 60,
+    ) -> str:
+        def _do_call():
+            latency, err, out = self._next_attempt(prompt)
+            time.sleep(latency)
+            if err is not None:
+                raise err
+            return out
+
+        token_cost = estimate_tokens(prompt, int(max_tokens))
+        try:
+            out = self.limiter.execute(token_cost, _do_call, model=model_name)
+        except LLMCancelled:
+            raise
+        except Exception as e:
+            raise _translate_fake_error(e) from e
+        self.limiter.reconcile(token_cost, **self._usage(model_name, prompt, str(out)))
+        return str(out)
+
+    async def acaller(
+        self,
+        prompt: str,
+        *,
+        model_name: str = "fake",
+        temperature: float = 0.2,
+        max_tokens: int = 512,
+        timeout: int = 60,
+    ) -> str:
+        async def _do_call():
+            latency, err, out = self._next_attempt(prompt)
+            await asyncio.sleep(latency)
+            if err is not None:
+                raise err
+            return out
+
+        token_cost = estimate_tokens(prompt, int(max_tokens))
+        try:
+            out = await self.async_limiter.execute(
+                token_cost, _do_call, model=model_name, prompt_tokens=estimate_tokens(prompt, 0),
+            )
+        except LLMCancelled:
+            raise
+        except Exception as e:
+            raise _translate_fake_error(e) from e
+        await self.async_limiter.reconcile(token_cost, **self._usage(model_name, prompt, str(out)))
+        return str(out)
+
+
+def _translate_fake_error(e: Exception) -> LLMError:
+    if isinstance(e, CircuitOpenError):
+        return LLMUnavailable(f"Fake backend unavailable: {e}")
+    if isinstance(e, FakeRateLimitError):
+        return LLMRateLimit("Rate limit for fake backend")
+    return LLMError(f"Fake LLM error: {e}")
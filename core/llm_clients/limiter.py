@@ -1,54 +1,532 @@
 import os
+import asyncio
+import contextvars
 import threading
 import time
 import math
 import random
+import re
 import logging
-from typing import Callable, Optional, Tuple
+import sqlite3
+import tempfile
+import weakref
+from collections import deque
+from contextlib import closing, contextmanager
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        v = int(os.getenv(name, str(default)).strip())
+        return v if v >= 0 else default
+    except Exception:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        v = float(os.getenv(name, str(default)).strip())
+        return v if v >= 0 else default
+    except Exception:
+        return default
+
+
+# How many seconds of budget may be spent in one burst (LLM_BURST_SECONDS)
+_DEFAULT_BURST_SECONDS = _env_float("LLM_BURST_SECONDS", 10.0)
 
 
 class _Budget:
-    def __init__(self, capacity: int):
+    """
+    Continuous-refill token bucket for a per-minute budget.
+    - refills at capacity/60 tokens per second (fractional accounting)
+    - holds at most `burst` tokens (capacity * burst_seconds / 60, at least 1)
+    - a single request larger than the burst is admitted once the bucket is full
+      and leaves it in debt, so oversized prompts cannot starve forever.
+    State is (level, stamp) = (tokens, last refill) in wall-clock seconds so it
+    can be persisted and shared between processes.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        level: Optional[float] = None,
+        stamp: Optional[float] = None,
+        burst_seconds: Optional[float] = None,
+    ):
+        seconds = _DEFAULT_BURST_SECONDS if burst_seconds is None else float(burst_seconds)
+        self.burst_seconds = min(60.0, max(0.0, seconds))
+        self._set_rate(capacity)
+        self.level = self.burst if level is None else min(self.burst, float(level))
+        self.stamp = time.time() if stamp is None else float(stamp)
+
+    def _set_rate(self, capacity: int) -> None:
         self.capacity = max(0, int(capacity))
-        self.remaining = max(0, int(capacity))
-        self.reset_at = time.monotonic() + 60.0
+        self.rate = self.capacity / 60.0  # tokens per second
+        self.burst = max(1.0, self.capacity * self.burst_seconds / 60.0) if self.capacity > 0 else 0.0
+
+    def set_capacity(self, capacity: int) -> None:
+        """Change the per-minute capacity (e.g. learned from provider headers)."""
+        self.refresh_if_needed()
+        self._set_rate(capacity)
+        self.level = min(self.level, self.burst)
+
+    def refund(self, amount: float) -> None:
+        """Give back unused reservation (negative amount = charge the shortfall)."""
+        self.refresh_if_needed()
+        self.level = min(self.burst, self.level + float(amount))
+
+    def observe_remaining(self, remaining: float) -> None:
+        """Provider says only `remaining` is left: never hold more than that."""
+        self.refresh_if_needed()
+        self.level = min(self.level, float(remaining))
+
+    def state(self) -> Tuple[float, float]:
+        return float(self.level), float(self.stamp)
+
+    @property
+    def remaining(self) -> int:
+        return int(max(0.0, self.level))
 
     def refresh_if_needed(self) -> None:
-        now = time.monotonic()
-        if now >= self.reset_at:
-            # Align to next whole minute window to avoid drift
-            # but simple +60 is fine for our purpose
-            self.remaining = self.capacity
-            self.reset_at = now + 60.0
-
-    def take(self, amount: int) -> bool:
+        now = time.time()
+        if now > self.stamp:
+            self.level = min(self.burst, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def _admits(self, amount: float) -> bool:
+        return amount <= self.level or (amount > self.burst and self.level >= self.burst)
+
+    def can_take(self, amount: float) -> bool:
         self.refresh_if_needed()
-        if amount <= self.remaining:
-            self.remaining -= amount
+        return self._admits(amount)
+
+    def take(self, amount: float) -> bool:
+        self.refresh_if_needed()
+        if self._admits(amount):
+            self.level -= amount
             return True
         return False
 
-    def time_until_reset(self) -> float:
+    def time_until_available(self, amount: float) -> float:
+        """Seconds until `amount` (capped at the burst size) can be taken."""
         self.refresh_if_needed()
-        return max(0.0, self.reset_at - time.monotonic())
+        if self.rate <= 0:
+            return 0.0
+        need = min(float(amount), self.burst) - self.level
+        return max(0.0, need / self.rate)
 
+    def time_until_reset(self) -> float:
+        """Seconds until the bucket is full again."""
+        return self.time_until_available(self.burst)
 
-def _env_int(name: str, default: int) -> int:
+
+def _percentile(sorted_vals, q: float) -> float:
+    """Nearest-rank percentile of an already sorted sequence (0.0 when empty)."""
+    if not sorted_vals:
+        return 0.0
+    k = max(0, min(len(sorted_vals) - 1, int(math.ceil(q * len(sorted_vals))) - 1))
+    return float(sorted_vals[k])
+
+
+class _LatencyWindow:
+    """
+    Rolling window of the last N samples for one model:
+    (wait_sec, call_sec) per completed call (call = all attempts incl. retry backoff)
+    and attempt_sec per successful single provider request (what hedging races against).
+    """
+
+    def __init__(self, size: int) -> None:
+        self.waits: deque = deque(maxlen=max(1, int(size)))
+        self.calls: deque = deque(maxlen=max(1, int(size)))
+        self.attempts: deque = deque(maxlen=max(1, int(size)))
+        self.total = 0
+
+    def add(self, wait_sec: float, call_sec: float) -> None:
+        self.waits.append(max(0.0, float(wait_sec)))
+        self.calls.append(max(0.0, float(call_sec)))
+        self.total += 1
+
+    def add_attempt(self, attempt_sec: float) -> None:
+        self.attempts.append(max(0.0, float(attempt_sec)))
+
+    def snapshot(self) -> dict:
+        calls = sorted(self.calls)
+        waits = sorted(self.waits)
+        n = len(calls)
+        return {
+            "calls": self.total,
+            "window": n,
+            "call_p50_sec": round(_percentile(calls, 0.50), 3),
+            "call_p95_sec": round(_percentile(calls, 0.95), 3),
+            "call_avg_sec": round(sum(calls) / n, 3) if n else 0.0,
+            "wait_p50_sec": round(_percentile(waits, 0.50), 3),
+            "wait_p95_sec": round(_percentile(waits, 0.95), 3),
+            "wait_avg_sec": round(sum(waits) / n, 3) if n else 0.0,
+            "attempt_p95_sec": round(_percentile(sorted(self.attempts), 0.95), 3),
+        }
+
+
+class CircuitOpenError(Exception):
+    """Provider error rate is above the breaker threshold: fail fast, don't call."""
+    pass
+
+
+class LLMCancelled(Exception):
+    """The caller's job was cancelled while the call waited for a slot/budget: nothing was sent."""
+    pass
+
+
+# should_cancel() of the job the current task/thread works for (see cancel_scope)
+_cancel_check: "contextvars.ContextVar[Optional[Callable[[], bool]]]" = contextvars.ContextVar(
+    "llm_cancel_check", default=None
+)
+
+
+@contextmanager
+def cancel_scope(should_cancel: Optional[Callable[[], bool]]) -> Iterator[None]:
+    """
+    Calls made inside this scope (and asyncio tasks created in it) re-check
+    should_cancel() once they hold a concurrency slot and again once their budget
+    is reserved, and raise LLMCancelled instead of calling the provider.
+    """
+    token = _cancel_check.set(should_cancel)
     try:
-        v = int(os.getenv(name, str(default)).strip())
-        return v if v >= 0 else default
+        yield
+    finally:
+        _cancel_check.reset(token)
+
+
+_attempt_sink: "contextvars.ContextVar[Optional[List[float]]]" = contextvars.ContextVar(
+    "llm_attempt_sink", default=None
+)
+
+
+@contextmanager
+def attempt_timings() -> Iterator[List[float]]:
+    """
+    Collects the duration of every successful provider attempt made inside this
+    scope (sync calls and asyncio tasks created in it) — the time in fn() only,
+    without concurrency/budget waits or retry backoff. Used by cassettes to record
+    provider latency rather than queueing.
+    """
+    sink: List[float] = []
+    token = _attempt_sink.set(sink)
+    try:
+        yield sink
+    finally:
+        _attempt_sink.reset(token)
+
+
+def _cancel_requested() -> bool:
+    check = _cancel_check.get()
+    if check is None:
+        return False
+    try:
+        return bool(check())
     except Exception:
-        return default
+        return False
+
+
+class _CircuitBreaker:
+    """
+    Error-rate circuit breaker over the last `window` attempt outcomes.
+    closed → open when >= min_calls outcomes and error rate >= threshold;
+    open → half_open after cooldown_sec (a single probe call is let through);
+    half_open → closed on success, back to open on failure.
+    """
+
+    def __init__(self, threshold: float = 0.5, window: int = 20, min_calls: int = 10,
+                 cooldown_sec: float = 30.0) -> None:
+        self.threshold = min(1.0, max(0.0, float(threshold)))
+        self.min_calls = max(1, int(min_calls))
+        self.cooldown_sec = max(0.0, float(cooldown_sec))
+        self._outcomes: deque = deque(maxlen=max(1, int(window)))
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+        self.trips = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def allow(self) -> bool:
+        if not self.enabled:
+            return True
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.cooldown_sec:
+                self.state = "half_open"
+                self._probe_in_flight = False
+            if self.state == "half_open":
+                # one probe at a time (a probe that never reported is replaced after cooldown)
+                now = time.monotonic()
+                if not self._probe_in_flight or now - self._probe_started >= self.cooldown_sec:
+                    self._probe_in_flight = True
+                    self._probe_started = now
+                    return True
+            return False
+
+    def record(self, ok: bool) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == "half_open":
+                self._probe_in_flight = False
+                if ok:
+                    self.state = "closed"
+                    self._outcomes.clear()
+                else:
+                    self._trip()
+                return
+            if self.state == "open":
+                return
+            self._outcomes.append(bool(ok))
+            n = len(self._outcomes)
+            errors = n - sum(self._outcomes)
+            if n >= self.min_calls and errors / n >= self.threshold:
+                self._trip()
+
+    def _trip(self) -> None:
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self.trips += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            n = len(self._outcomes)
+            errors = n - sum(self._outcomes)
+            snap = {
+                "state": self.state,
+                "error_rate": round(errors / n, 3) if n else 0.0,
+                "window": n,
+                "trips": self.trips,
+            }
+            if self.state == "open":
+                snap["retry_in_sec"] = round(max(0.0, self.cooldown_sec - (time.monotonic() - self._opened_at)), 3)
+            return snap
+
+
+def _status_of(e: Exception) -> Optional[int]:
+    status = getattr(e, "status_code", None)
+    if status is None:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+# transport errors without an HTTP status (openai / httpx), matched by name to avoid importing them here
+_TRANSPORT_ERROR_NAMES = frozenset({"APIConnectionError", "APITimeoutError", "TransportError", "TimeoutException"})
+
+
+def _is_provider_failure(e: Exception) -> bool:
+    """
+    What the breaker counts as the provider being unhealthy: 5xx, timeouts, connection errors.
+    429s are pacing (handled by budgets/retry-after); other 4xx (auth, prompt too long) and
+    the caller's own exceptions say nothing about the provider and must not open it for everyone.
+    """
+    status = _status_of(e)
+    if status is not None:
+        return status >= 500
+    if isinstance(e, (TimeoutError, ConnectionError, asyncio.TimeoutError)):
+        return True
+    return any(cls.__name__ in _TRANSPORT_ERROR_NAMES for cls in type(e).__mro__)
+
+
+# ---------- budget stores (where RPM/TPM state lives) ----------
+class LocalBudgetStore:
+    """In-process store: every process has its own RPM/TPM reservoirs."""
+
+    name = "local"
+    shared = False
+
+    def __init__(self, rpm: int, tpm: int, burst_seconds: Optional[float] = None) -> None:
+        self._lock = threading.Lock()
+        self._budgets = {
+            "rpm": _Budget(rpm, burst_seconds=burst_seconds),
+            "tpm": _Budget(tpm, burst_seconds=burst_seconds),
+        }
+        self._counters: Dict[str, int] = {}
+
+    @contextmanager
+    def transaction(self) -> Iterator[Dict[str, _Budget]]:
+        with self._lock:
+            yield self._budgets
+
+    def peek(self) -> Dict[str, _Budget]:
+        """Read-only copies of the reservoirs (for status; nothing is written back)."""
+        with self._lock:
+            return {
+                name: _Budget(b.capacity, level=b.level, stamp=b.stamp, burst_seconds=b.burst_seconds)
+                for name, b in self._budgets.items()
+            }
+
+    def set_capacity(self, name: str, capacity: int) -> None:
+        with self._lock:
+            self._budgets[name].set_capacity(capacity)
+
+    def incr(self, counter: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + int(amount)
+
+    def counter(self, counter: str) -> int:
+        with self._lock:
+            return self._counters.get(counter, 0)
+
+
+class SQLiteBudgetStore:
+    """
+    Cross-process store backed by a small SQLite file.
+    Every gunicorn worker / management command on the host opens the same file;
+    `BEGIN IMMEDIATE` serializes the read-modify-write of the reservoirs, so the
+    configured RPM/TPM is the budget for the whole host, not per process.
+    The capacity lives in the row too: a limit learned from provider headers in
+    one process is the refill rate/burst of every process. `configured` remembers
+    the env value it started from, so a changed LLM_RPM/LLM_TPM still wins.
+    """
+
+    name = "sqlite"
+    shared = True
+
+    def __init__(
+        self,
+        path: str,
+        rpm: int,
+        tpm: int,
+        timeout: float = 10.0,
+        burst_seconds: Optional[float] = None,
+    ) -> None:
+        self.path = path
+        self._capacities = {"rpm": max(0, int(rpm)), "tpm": max(0, int(tpm))}
+        self._burst_seconds = burst_seconds
+        self._timeout = float(timeout)
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_budget ("
+                " name TEXT PRIMARY KEY, capacity INTEGER NOT NULL,"
+                " level REAL NOT NULL, stamp REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_counter (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+            try:  # files created before capacities were shared
+                conn.execute("ALTER TABLE llm_budget ADD COLUMN configured INTEGER")
+            except sqlite3.OperationalError:
+                pass
+            for name, cap in self._capacities.items():
+                conn.execute(
+                    "UPDATE llm_budget SET capacity = ?, configured = ? "
+                    "WHERE name = ? AND (configured IS NULL OR configured != ?)",
+                    (cap, cap, name, cap),
+                )
+
+    def _connect(self) -> sqlite3.Connection:
+        # autocommit mode; we issue BEGIN IMMEDIATE ourselves
+        return sqlite3.connect(self.path, timeout=self._timeout, isolation_level=None)
+
+    @contextmanager
+    def transaction(self) -> Iterator[Dict[str, _Budget]]:
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                budgets = self._budgets(conn)
+                yield budgets
+                for name, b in budgets.items():
+                    level, stamp = b.state()
+                    conn.execute(
+                        "INSERT INTO llm_budget(name, capacity, level, stamp, configured) VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT(name) DO UPDATE SET capacity=excluded.capacity, "
+                        "level=excluded.level, stamp=excluded.stamp",
+                        (name, b.capacity, level, stamp, self._capacities[name]),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def peek(self) -> Dict[str, _Budget]:
+        """Read-only copies of the reservoirs: a plain SELECT, no write lock taken."""
+        with closing(self._connect()) as conn:
+            return self._budgets(conn)
+
+    def _budgets(self, conn: sqlite3.Connection) -> Dict[str, _Budget]:
+        # capacity from the shared row; the configured value until a row exists
+        rows = {
+            name: (capacity, level, stamp)
+            for name, capacity, level, stamp in conn.execute("SELECT name, capacity, level, stamp FROM llm_budget")
+        }
+        out: Dict[str, _Budget] = {}
+        for name, configured in self._capacities.items():
+            cap, level, stamp = rows.get(name, (configured, None, None))
+            out[name] = _Budget(cap, level=level, stamp=stamp, burst_seconds=self._burst_seconds)
+        return out
+
+    def set_capacity(self, name: str, capacity: int) -> None:
+        """Persist a learned capacity so every process refills at the same rate."""
+        with self.transaction() as budgets:
+            budgets[name].set_capacity(capacity)
+
+    def incr(self, counter: str, amount: int = 1) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO llm_counter(name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (counter, int(amount)),
+            )
+
+    def counter(self, counter: str) -> int:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT value FROM llm_counter WHERE name = ?", (counter,)).fetchone()
+            return int(row[0]) if row else 0
+
+
+BudgetStore = Union[LocalBudgetStore, SQLiteBudgetStore]
+
+
+def build_budget_store(rpm: int, tpm: int, backend: Optional[str] = None) -> BudgetStore:
+    """
+    LLM_LIMITER_BACKEND=local (default) | sqlite
+    LLM_LIMITER_SQLITE_PATH: shared file for the sqlite backend (default: <tmp>/ibla_llm_limiter.sqlite3)
+    Falls back to the local store if the shared one cannot be opened.
+    """
+    backend = (backend or os.getenv("LLM_LIMITER_BACKEND", "local")).strip().lower()
+    if backend == "sqlite":
+        path = os.getenv("LLM_LIMITER_SQLITE_PATH") or os.path.join(
+            tempfile.gettempdir(), "ibla_llm_limiter.sqlite3"
+        )
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            return SQLiteBudgetStore(path, rpm, tpm)
+        except Exception:
+            logging.getLogger("core.llm.limiter").warning(
+                "limiter: cannot open shared store at %s; falling back to local", path, exc_info=True
+            )
+    return LocalBudgetStore(rpm, tpm)
 
 
 class RateLimiter:
     """
-    Simple in-process limiter for RPM + TPM + concurrency.
-    - RPM: requests per minute (integer reservoir)
-    - TPM: tokens per minute (integer reservoir)
-    - concurrency: max simultaneous calls
+    Limiter for RPM + TPM + concurrency.
+    - RPM: requests per minute (continuous-refill token bucket)
+    - TPM: tokens per minute (continuous-refill token bucket)
+    - concurrency: max simultaneous calls (per process)
+    - waiters are admitted in FIFO order, so a large request is not starved
+      by a stream of small ones and refill is spread smoothly over the minute.
+
+    RPM/TPM live in a BudgetStore: LocalBudgetStore limits one process only,
+    SQLiteBudgetStore makes the budget shared by all workers on the host.
 
-    Not a silver bullet for multi-process deployments, but effective in a single process.
+    Adaptive mode (LLM_ADAPTIVE_LIMITS=1): every response's x-ratelimit-* headers
+    are fed to observe_headers(); the provider's limit becomes the capacity and
+    its remaining budget caps what we hand out, so we run at the real ceiling.
+
+    Circuit breaker: when the provider error rate crosses the threshold, calls
+    fail fast with CircuitOpenError (no budget wait, no retries) until a probe
+    succeeds. Hedging (async path, opt-in LLM_HEDGE=1): an attempt slower than the
+    observed single-attempt p95 gets a second concurrent request if spare budget
+    exists and nobody is queued for it; the first answer wins.
     """
 
     def __init__(
@@ -57,90 +535,360 @@ class RateLimiter:
         tpm: int = 300_000,
         concurrency: int = 10,
         max_retries: int = 6,
+        store: Optional[BudgetStore] = None,
+        adaptive: bool = True,
+        latency_window: int = 200,
+        breaker: Optional[_CircuitBreaker] = None,
+        hedge: bool = False,
+        hedge_min_samples: int = 20,
     ) -> None:
-        self._rpm_budget = _Budget(max(0, rpm))
-        self._tpm_budget = _Budget(max(0, tpm))
-        self._sem = threading.Semaphore(max(1, concurrency))
+        self._store: BudgetStore = store if store is not None else LocalBudgetStore(max(0, rpm), max(0, tpm))
+        self._rpm = max(0, int(rpm))
+        self._tpm = max(0, int(tpm))
+        self._adaptive = bool(adaptive)
+        self._provider: Dict[str, object] = {}
+        self._concurrency = max(1, int(concurrency))
+        self._sem = threading.Semaphore(self._concurrency)
         self._lock = threading.Lock()
         self._max_retries = max(1, int(max_retries))
 
+        # FIFO ticket queue for threads waiting on budgets
+        self._fifo_cond = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+
         # stats for throughput estimation
         self._started_at = time.monotonic()
         self._completed = 0
+        # per-model token usage (running averages from resp.usage)
+        self._usage: Dict[str, Dict[str, int]] = {}
+        # per-model rolling wait/call latencies (feeds p95 into estimate_eta)
+        self._latency_window = max(1, int(latency_window))
+        self._latency: Dict[str, _LatencyWindow] = {}
+        # failure handling: breaker (default: disabled) + hedged requests
+        self._breaker = breaker if breaker is not None else _CircuitBreaker(threshold=0)
+        self._hedge = bool(hedge)
+        self._hedge_min_samples = max(1, int(hedge_min_samples))
+        self._hedges = {"fired": 0, "won": 0}
 
     # ---------- public config/stat helpers ----------
     def config(self) -> dict:
+        rpm, tpm, concurrency = self.limits()
         return {
-            "rpm": self._rpm_budget.capacity,
-            "tpm": self._tpm_budget.capacity,
-            "concurrency": self._sem._value + self._sem._waiters if hasattr(self._sem, "_value") else None,  # best-effort
+            "rpm": rpm,
+            "tpm": tpm,
+            "concurrency": concurrency,
             "max_retries": self._max_retries,
+            "backend": self._store.name,
+            "shared": self._store.shared,
+            "adaptive": self._adaptive,
+            "hedge": self._hedge,
+            "breaker_threshold": self._breaker.threshold,
         }
 
+    def limits(self) -> Tuple[int, int, int]:
+        """(rpm, tpm, concurrency) in effect now: configured, or learned from x-ratelimit-limit-* headers. 0 = no limit."""
+        if self._store.shared:
+            # learned by any process → read from the shared store, not this process's copy
+            try:
+                b = self._store.peek()
+                return b["rpm"].capacity, b["tpm"].capacity, self._concurrency
+            except Exception:
+                pass
+        with self._lock:
+            return self._rpm, self._tpm, self._concurrency
+
     def budgets(self) -> dict:
-        # best-effort snapshot
+        # best-effort snapshot (aggregate across processes when the store is shared); read-only
+        b = self._store.peek()
+        rpm_b, tpm_b = b["rpm"], b["tpm"]
+        rpm_b.refresh_if_needed()
+        tpm_b.refresh_if_needed()
+        snap = {
+            "rpm_remaining": rpm_b.remaining,
+            "rpm_resets_in_sec": round(rpm_b.time_until_reset(), 3),
+            "rpm_refill_per_sec": round(rpm_b.rate, 4),
+            "rpm_burst": round(rpm_b.burst, 3),
+            "tpm_remaining": tpm_b.remaining,
+            "tpm_resets_in_sec": round(tpm_b.time_until_reset(), 3),
+            "tpm_refill_per_sec": round(tpm_b.rate, 4),
+            "tpm_burst": round(tpm_b.burst, 3),
+        }
         with self._lock:
-            self._rpm_budget.refresh_if_needed()
-            self._tpm_budget.refresh_if_needed()
-            return {
-                "rpm_remaining": self._rpm_budget.remaining,
-                "rpm_resets_in_sec": round(self._rpm_budget.time_until_reset(), 3),
-                "tpm_remaining": self._tpm_budget.remaining,
-                "tpm_resets_in_sec": round(self._tpm_budget.time_until_reset(), 3),
-                "completed": self._completed,
-                "uptime_sec": round(time.monotonic() - self._started_at, 3),
-            }
+            snap["completed"] = self._completed
+            snap["uptime_sec"] = round(time.monotonic() - self._started_at, 3)
+            if self._provider:
+                snap["provider"] = dict(self._provider)
+            snap["hedges"] = dict(self._hedges)
+        snap["breaker"] = self._breaker.snapshot()
+        if self._store.shared:
+            snap["completed_all_processes"] = self._store.counter("completed")
+        return snap
 
     def stats(self) -> dict:
+        b = self.budgets()
+        elapsed_min = max(1e-6, b["uptime_sec"] / 60.0)
+        rate = b["completed"] / elapsed_min
+        return {
+            "throughput_per_min": rate,
+            **b,
+            "usage": self.usage_stats(),
+            "latency": self.latency_stats(),
+        }
+
+    def latency_stats(self) -> Dict[str, dict]:
+        """Per-model p50/p95 of call latency and budget wait over the rolling window."""
+        with self._lock:
+            return {model: w.snapshot() for model, w in self._latency.items()}
+
+    def latency_p95(self, model: Optional[str] = None, default: float = 2.5) -> float:
+        """
+        Observed p95 call latency for `model` (all models pooled if None or unseen);
+        `default` until a call has completed.
+        """
+        with self._lock:
+            if model and model in self._latency:
+                samples = sorted(self._latency[model].calls)
+            else:
+                samples = sorted(v for w in self._latency.values() for v in w.calls)
+        if not samples:
+            return float(default)
+        return max(0.001, _percentile(samples, 0.95))
+
+    def usage_stats(self) -> Dict[str, dict]:
+        """Per-model averages of real token usage vs. what was reserved."""
+        out: Dict[str, dict] = {}
+        with self._lock:
+            items = [(m, dict(u)) for m, u in self._usage.items()]
+        for model, u in items:
+            calls = max(1, u["calls"])
+            out[model] = {
+                "calls": u["calls"],
+                "avg_prompt_tokens": round(u["prompt_tokens"] / calls, 1),
+                "avg_completion_tokens": round(u["completion_tokens"] / calls, 1),
+                "avg_total_tokens": round((u["prompt_tokens"] + u["completion_tokens"]) / calls, 1),
+                "reserved_tokens": u["reserved_tokens"],
+                "refunded_tokens": u["reserved_tokens"] - u["prompt_tokens"] - u["completion_tokens"],
+                # share of prompt tokens served from the provider's prompt cache
+                "cached_prompt_ratio": round(u["cached_tokens"] / u["prompt_tokens"], 3) if u["prompt_tokens"] else 0.0,
+            }
+        return out
+
+    def hedge_delay(self, model: str = "") -> Optional[float]:
+        """
+        Seconds after which an attempt is hedged (p95 of single-attempt latency, so
+        retry backoff does not inflate it), or None when off / too few samples.
+        """
+        if not self._hedge:
+            return None
+        with self._lock:
+            window = self._latency.get(model or "default")
+            if window is None or len(window.attempts) < self._hedge_min_samples:
+                return None
+            samples = sorted(window.attempts)
+        return max(0.05, _percentile(samples, 0.95))
+
+    def _note_hedge(self, won: bool = False) -> None:
+        with self._lock:
+            self._hedges["won" if won else "fired"] += 1
+
+    def avg_tokens_per_call(self, model: Optional[str] = None, default: int = 1500) -> int:
+        """
+        Observed average tokens per call for `model` (all models if None or unseen);
+        `default` until the first call has been reconciled.
+        """
+        with self._lock:
+            rows = [self._usage[model]] if model and model in self._usage else list(self._usage.values())
+            calls = sum(u["calls"] for u in rows)
+            total = sum(u["prompt_tokens"] + u["completion_tokens"] for u in rows)
+        if calls <= 0:
+            return int(default)
+        return max(1, int(math.ceil(total / calls)))
+
+    def settle(self, reserved_tokens: int, used_tokens: int) -> None:
+        """Refund reserved - used TPM tokens (negative = charge the shortfall); no usage stats."""
+        try:
+            with self._store.transaction() as b:
+                if b["tpm"].capacity > 0:
+                    b["tpm"].refund(max(0, int(reserved_tokens)) - max(0, int(used_tokens)))
+        except Exception:
+            logging.getLogger("core.llm.limiter").debug("limiter: cannot settle reservation", exc_info=True)
+
+    def reconcile(
+        self,
+        reserved_tokens: int,
+        *,
+        model: str = "",
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+        cached_tokens: Optional[int] = None,
+    ) -> None:
+        """
+        Settle a TPM reservation against resp.usage: unused tokens go back to the
+        bucket (an underestimate is charged), and per-model averages are updated.
+        cached_tokens (prompt-cache hits) are only tracked, not refunded.
+        No-op when the provider did not report usage.
+        """
+        if prompt_tokens is None and completion_tokens is None:
+            return
+        prompt = max(0, int(prompt_tokens or 0))
+        completion = max(0, int(completion_tokens or 0))
+        reserved = max(0, int(reserved_tokens))
+        self.settle(reserved, prompt + completion)
+        with self._lock:
+            u = self._usage.setdefault(
+                model or "default",
+                {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "reserved_tokens": 0, "cached_tokens": 0},
+            )
+            u["calls"] += 1
+            u["prompt_tokens"] += prompt
+            u["cached_tokens"] += min(prompt, max(0, int(cached_tokens or 0)))
+            u["completion_tokens"] += completion
+            u["reserved_tokens"] += reserved
+
+    def observe_headers(self, headers) -> None:
+        """
+        Feed x-ratelimit-* response headers back into the budgets.
+        - limit-requests / limit-tokens -> new RPM / TPM capacity
+        - remaining-requests / remaining-tokens -> cap on the local level
+        Missing or malformed headers are ignored.
+        """
+        if not self._adaptive or not headers:
+            return
+        info = parse_ratelimit_headers(headers)
+        if not info:
+            return
+        try:
+            for name, key in (("rpm", "requests"), ("tpm", "tokens")):
+                limit = info.get(f"limit_{key}")
+                if limit is not None and limit > 0:
+                    self._store.set_capacity(name, int(limit))
+                    with self._lock:
+                        setattr(self, f"_{name}", int(limit))
+            with self._store.transaction() as b:
+                for name, key in (("rpm", "requests"), ("tpm", "tokens")):
+                    remaining = info.get(f"remaining_{key}")
+                    if remaining is not None and b[name].capacity > 0:
+                        b[name].observe_remaining(remaining)
+        except Exception:
+            logging.getLogger("core.llm.limiter").debug("limiter: cannot apply headers", exc_info=True)
+            return
         with self._lock:
-            elapsed_min = max(1e-6, (time.monotonic() - self._started_at) / 60.0)
-            rate = self._completed / elapsed_min
-            b = self.budgets()
-        return {"throughput_per_min": rate, **b}
+            self._provider = {**info, "observed_at": round(time.time(), 3)}
 
     # ---------- core execution ----------
-    def _await_budgets(self, token_cost: int) -> None:
+    def _try_take(self, token_cost: int) -> float:
+        """
+        Non-blocking reservation of 1 request + token_cost tokens.
+        Returns 0.0 when both budgets were taken, otherwise the seconds to wait
+        before trying again (nothing is consumed in that case).
+        """
         token_cost = max(0, int(token_cost))
-        while True:
-            with self._lock:
-                ok_req = self._rpm_budget.take(1) if self._rpm_budget.capacity > 0 else True
-                ok_tok = self._tpm_budget.take(token_cost) if self._tpm_budget.capacity > 0 else True
-                if ok_req and ok_tok:
+        with self._store.transaction() as b:
+            rpm_b, tpm_b = b["rpm"], b["tpm"]
+            rpm_b.refresh_if_needed()
+            tpm_b.refresh_if_needed()
+            ok_req = rpm_b.capacity <= 0 or rpm_b.can_take(1)
+            ok_tok = tpm_b.capacity <= 0 or tpm_b.can_take(token_cost)
+            if ok_req and ok_tok:
+                if rpm_b.capacity > 0:
+                    rpm_b.take(1)
+                if tpm_b.capacity > 0:
+                    tpm_b.take(token_cost)
+                return 0.0
+            # both must be available: wait for the slower bucket
+            wait_r = rpm_b.time_until_available(1) if not ok_req else 0.0
+            wait_t = tpm_b.time_until_available(token_cost) if not ok_tok else 0.0
+            return max(0.01, wait_r, wait_t)
+
+    def _refund(self, token_cost: int) -> None:
+        """Give back a reservation that was never used (cancelled before the call)."""
+        try:
+            with self._store.transaction() as b:
+                if b["rpm"].capacity > 0:
+                    b["rpm"].refund(1)
+                if b["tpm"].capacity > 0:
+                    b["tpm"].refund(max(0, int(token_cost)))
+        except Exception:
+            logging.getLogger("core.llm.limiter").debug("limiter: cannot refund reservation", exc_info=True)
+
+    def _await_budgets(self, token_cost: int) -> None:
+        # take a ticket; only the head of the queue polls the buckets
+        with self._fifo_cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while self._serving != ticket:
+                self._fifo_cond.wait()
+        try:
+            while True:
+                wait = self._try_take(token_cost)
+                if wait <= 0:
                     return
-                # if not enough budget, figure out minimal time to wait
-                self._rpm_budget.refresh_if_needed()
-                self._tpm_budget.refresh_if_needed()
-                wait_r = self._rpm_budget.time_until_reset() if not ok_req else 0.0
-                wait_t = self._tpm_budget.time_until_reset() if not ok_tok else 0.0
-                wait = max(0.05, min(w for w in (wait_r, wait_t) if w > 0) if (not ok_req or not ok_tok) else 0.05)
-            time.sleep(wait)
-
-    def _call_with_retries(self, fn: Callable[[], object]) -> object:
+                time.sleep(wait)
+        finally:
+            with self._fifo_cond:
+                self._serving += 1
+                self._fifo_cond.notify_all()
+
+    def _record_completion(self, wait_sec: float, call_sec: float, model: str = "") -> None:
+        with self._lock:
+            self._completed += 1
+            self._window(model).add(wait_sec, call_sec)
+        if self._store.shared:
+            try:
+                self._store.incr("completed")
+            except Exception:
+                pass
+        # Lightweight timing log to help spot bottlenecks
+        try:
+            logger = logging.getLogger("core.llm.limiter")
+            logger.debug("limiter_execute: model=%s wait_sec=%.3f call_sec=%.3f", model, wait_sec, call_sec)
+        except Exception:
+            pass
+
+    def _window(self, model: str) -> _LatencyWindow:
+        # caller holds self._lock
+        window = self._latency.get(model or "default")
+        if window is None:
+            window = self._latency[model or "default"] = _LatencyWindow(self._latency_window)
+        return window
+
+    def _record_attempt_latency(self, attempt_sec: float, model: str = "") -> None:
+        with self._lock:
+            self._window(model).add_attempt(attempt_sec)
+        sink = _attempt_sink.get()
+        if sink is not None:
+            sink.append(attempt_sec)
+
+    def _has_waiters(self) -> bool:
+        """Threads queued (or polling) for budget in the FIFO ticket queue."""
+        with self._fifo_cond:
+            return self._next_ticket != self._serving
+
+    def _record_attempt(self, error: Optional[Exception]) -> None:
+        if error is None:
+            self._breaker.record(True)
+        elif _is_provider_failure(error):
+            self._breaker.record(False)
+
+    def _call_with_retries(self, fn: Callable[[], object], model: str = "") -> object:
         backoff = 0.5
         last: Optional[Exception] = None
         for attempt in range(self._max_retries):
+            if attempt and not self._breaker.allow():
+                raise CircuitOpenError("LLM circuit open; giving up retries") from last
             try:
-                return fn()
+                t0 = time.monotonic()
+                result = fn()
+                self._record_attempt_latency(time.monotonic() - t0, model)
+                self._record_attempt(None)
+                return result
             except Exception as e:  # handle OpenAI transient errors & 429
                 last = e
-                # Extract retry-after if present
-                retry_after: Optional[float] = None
-                try:
-                    headers = None
-                    # openai>=1.0 exceptions often have .response.headers
-                    resp = getattr(e, "response", None)
-                    if resp is not None:
-                        headers = getattr(resp, "headers", None)
-                    if headers:
-                        ra = headers.get("retry-after") or headers.get("Retry-After")
-                        if ra is not None:
-                            retry_after = float(ra)
-                except Exception:
-                    retry_after = None
-
-                wait = retry_after if (retry_after is not None) else min(backoff, 10)
-                wait = float(wait) + random.uniform(0, 0.25)
-                time.sleep(max(0.05, wait))
+                self._record_attempt(e)
+                self.observe_headers(_error_headers(e))
+                wait = _retry_wait(e, backoff)
+                time.sleep(wait)
                 backoff = min(backoff * 2, 10)
         # if we exhausted retries, re-raise the last
         if last is not None:
@@ -148,27 +896,26 @@ class RateLimiter:
         # Should not reach here
         return fn()
 
-    def execute(self, token_cost: int, fn: Callable[[], object]) -> object:
+    def execute(self, token_cost: int, fn: Callable[[], object], model: str = "") -> object:
+        # Fail fast while the provider is unhealthy
+        if not self._breaker.allow():
+            raise CircuitOpenError("LLM circuit open (provider error rate above threshold)")
         # Concurrency gate first to avoid over-queuing
         self._sem.acquire()
         try:
+            if _cancel_requested():
+                raise LLMCancelled("job cancelled before the LLM call")
             # Wait until budgets allow
             t0 = time.monotonic()
             self._await_budgets(token_cost)
             t1 = time.monotonic()
+            if _cancel_requested():
+                self._refund(token_cost)
+                raise LLMCancelled("job cancelled before the LLM call")
             # Perform call with retries
-            result = self._call_with_retries(fn)
+            result = self._call_with_retries(fn, model)
             t2 = time.monotonic()
-            with self._lock:
-                self._completed += 1
-            # Lightweight timing log to help spot bottlenecks
-            try:
-                logger = logging.getLogger("core.llm.limiter")
-                logger.debug(
-                    "limiter_execute: wait_sec=%.3f call_sec=%.3f", (t1 - t0), (t2 - t1)
-                )
-            except Exception:
-                pass
+            self._record_completion(t1 - t0, t2 - t1, model)
             return result
         finally:
             try:
@@ -177,6 +924,273 @@ class RateLimiter:
                 pass
 
 
+def _error_headers(e: Exception):
+    # openai>=1.0 exceptions often have .response.headers
+    resp = getattr(e, "response", None)
+    return getattr(resp, "headers", None) if resp is not None else None
+
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def _parse_duration(value) -> Optional[float]:
+    """'6m0s' / '1.5s' / '20ms' / '1h2m' / '12' -> seconds."""
+    if value is None:
+        return None
+    text = str(value).strip().lower()
+    if not text:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(text)
+    if not parts:
+        return None
+    mult = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+    return sum(float(num) * mult[unit] for num, unit in parts)
+
+
+def parse_ratelimit_headers(headers) -> Dict[str, float]:
+    """
+    Extract OpenAI x-ratelimit-* headers (same set printed by `manage.py llm_status`).
+    Returns only the keys that were present and parseable:
+    limit_requests, remaining_requests, reset_requests_sec,
+    limit_tokens, remaining_tokens, reset_tokens_sec.
+    """
+    out: Dict[str, float] = {}
+    if not headers:
+        return out
+    try:
+        get = headers.get
+    except AttributeError:
+        return out
+    for key in ("requests", "tokens"):
+        for kind in ("limit", "remaining"):
+            raw = get(f"x-ratelimit-{kind}-{key}")
+            if raw is None:
+                continue
+            try:
+                out[f"{kind}_{key}"] = float(str(raw).strip())
+            except ValueError:
+                continue
+        reset = _parse_duration(get(f"x-ratelimit-reset-{key}"))
+        if reset is not None:
+            out[f"reset_{key}_sec"] = reset
+    return out
+
+
+def _retry_after_seconds(e: Exception) -> Optional[float]:
+    """Extract retry-after (seconds) from an OpenAI exception, if present."""
+    try:
+        headers = _error_headers(e)
+        if headers:
+            ra = headers.get("retry-after") or headers.get("Retry-After")
+            if ra is not None:
+                return float(ra)
+    except Exception:
+        return None
+    return None
+
+
+def _retry_wait(e: Exception, backoff: float) -> float:
+    retry_after = _retry_after_seconds(e)
+    wait = retry_after if (retry_after is not None) else min(backoff, 10)
+    wait = float(wait) + random.uniform(0, 0.25)
+    return max(0.05, wait)
+
+
+class AsyncRateLimiter:
+    """
+    asyncio counterpart of RateLimiter for AsyncOpenAI calls.
+    - RPM/TPM budgets and completion stats are shared with the wrapped RateLimiter,
+      so sync and async callers in one process draw from the same reservoir.
+    - concurrency is an asyncio.Semaphore (one per event loop), so many calls
+      can be in flight on a single thread while waiting on the network.
+    """
+
+    def __init__(self, limiter: RateLimiter, concurrency: int = 50) -> None:
+        self._limiter = limiter
+        self._concurrency = max(1, int(concurrency))
+        self._sems: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+            weakref.WeakKeyDictionary()
+        )
+        # asyncio.Lock wakes waiters in FIFO order -> fair admission to the buckets
+        self._fifo: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._sems_lock = threading.Lock()
+
+    @property
+    def concurrency(self) -> int:
+        return self._concurrency
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self._sems_lock:
+            sem = self._sems.get(loop)
+            if sem is None:
+                sem = asyncio.Semaphore(self._concurrency)
+                self._sems[loop] = sem
+            return sem
+
+    def _fifo_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        with self._sems_lock:
+            lock = self._fifo.get(loop)
+            if lock is None:
+                lock = asyncio.Lock()
+                self._fifo[loop] = lock
+            return lock
+
+    async def _store_op(self, fn: Callable[..., object], *args, **kwargs) -> object:
+        """
+        Run budget-store work off the event loop when the store is shared: a sqlite
+        BEGIN IMMEDIATE may block up to its busy timeout and would stall every
+        coroutine of the batch. The in-process store is a short lock: called inline.
+        """
+        if self._limiter._store.shared:
+            return await asyncio.to_thread(fn, *args, **kwargs)
+        return fn(*args, **kwargs)
+
+    async def observe_headers(self, headers) -> None:
+        """Async RateLimiter.observe_headers (store write off the event loop)."""
+        if headers:
+            await self._store_op(self._limiter.observe_headers, headers)
+
+    async def reconcile(self, reserved_tokens: int, **usage) -> None:
+        """Async RateLimiter.reconcile (store write off the event loop)."""
+        await self._store_op(self._limiter.reconcile, reserved_tokens, **usage)
+
+    async def _await_budgets(self, token_cost: int) -> None:
+        async with self._fifo_lock():
+            while True:
+                wait = await self._store_op(self._limiter._try_take, token_cost)
+                if wait <= 0:
+                    return
+                await asyncio.sleep(wait)
+
+    async def _timed(self, fn: Callable[[], Awaitable[object]], model: str) -> object:
+        t0 = time.monotonic()
+        result = await fn()
+        self._limiter._record_attempt_latency(time.monotonic() - t0, model)
+        return result
+
+    async def _reserve_hedge(self, token_cost: int) -> bool:
+        """
+        Budget for a hedge, only if nobody is queued for budget (async FIFO or sync
+        ticket queue): a speculative duplicate must never overtake a real request.
+        """
+        fifo = self._fifo_lock()
+        if fifo.locked() or self._limiter._has_waiters():
+            return False
+        async with fifo:
+            return await self._store_op(self._limiter._try_take, token_cost) <= 0
+
+    async def _hedged_attempt(
+        self,
+        fn: Callable[[], Awaitable[object]],
+        token_cost: int,
+        model: str,
+        prompt_tokens: Optional[int] = None,
+    ) -> object:
+        """
+        One attempt; if it is still running after the observed p95 and spare budget
+        exists, a second request is fired and the first successful answer wins.
+        The caller reconciles one reservation against the winner's usage; the extra
+        reservation is settled here: the losing request was sent (its request stays
+        spent) but cancelled, so only its prompt estimate is charged.
+        """
+        lim = self._limiter
+        delay = lim.hedge_delay(model)
+        if delay is None:
+            return await self._timed(fn, model)
+        primary = asyncio.ensure_future(self._timed(fn, model))
+        pending = {primary}
+        hedged = False
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return primary.result()
+            if not await self._reserve_hedge(token_cost):
+                return await primary
+            hedged = True
+            lim._note_hedge()
+            hedge = asyncio.ensure_future(self._timed(fn, model))
+            pending = {primary, hedge}
+            last: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            lim._note_hedge(won=True)
+                        return task.result()
+                    last = task.exception()
+            raise last  # type: ignore[misc]
+        finally:
+            for task in pending:
+                task.cancel()
+            if hedged:
+                used = token_cost if prompt_tokens is None else max(0, int(prompt_tokens))
+                await self._store_op(lim.settle, token_cost, used)
+
+    async def _call_with_retries(
+        self,
+        fn: Callable[[], Awaitable[object]],
+        token_cost: int = 0,
+        model: str = "",
+        prompt_tokens: Optional[int] = None,
+    ) -> object:
+        lim = self._limiter
+        backoff = 0.5
+        last: Optional[Exception] = None
+        for attempt in range(lim._max_retries):
+            if attempt and not lim._breaker.allow():
+                raise CircuitOpenError("LLM circuit open; giving up retries") from last
+            try:
+                result = await self._hedged_attempt(fn, token_cost, model, prompt_tokens)
+                lim._record_attempt(None)
+                return result
+            except Exception as e:
+                last = e
+                lim._record_attempt(e)
+                await self.observe_headers(_error_headers(e))
+                await asyncio.sleep(_retry_wait(e, backoff))
+                backoff = min(backoff * 2, 10)
+        if last is not None:
+            raise last
+        return await fn()
+
+    async def execute(
+        self,
+        token_cost: int,
+        fn: Callable[[], Awaitable[object]],
+        model: str = "",
+        prompt_tokens: Optional[int] = None,
+    ) -> object:
+        """
+        prompt_tokens: prompt share of token_cost; a losing hedge is charged only
+        that much (None → the whole reservation stays spent).
+        """
+        if not self._limiter._breaker.allow():
+            raise CircuitOpenError("LLM circuit open (provider error rate above threshold)")
+        async with self._semaphore():
+            # all tasks of a batch start at once: re-check cancellation once a slot is ours
+            if _cancel_requested():
+                raise LLMCancelled("job cancelled before the LLM call")
+            t0 = time.monotonic()
+            await self._await_budgets(token_cost)
+            t1 = time.monotonic()
+            if _cancel_requested():
+                await self._store_op(self._limiter._refund, token_cost)
+                raise LLMCancelled("job cancelled before the LLM call")
+            result = await self._call_with_retries(fn, token_cost, model, prompt_tokens)
+            t2 = time.monotonic()
+            await self._store_op(self._limiter._record_completion, t1 - t0, t2 - t1, model)
+            return result
+
+
 def estimate_tokens(text: str, max_output_tokens: int = 512) -> int:
     """Rough estimation: ~4 chars per token + output cap."""
     n = len(text or "")
@@ -185,23 +1199,35 @@ def estimate_tokens(text: str, max_output_tokens: int = 512) -> int:
 
 def estimate_eta(
     items: int,
-    avg_tokens_per_call: int = 1500,
+    avg_tokens_per_call: Optional[int] = None,
     calls_per_item: float = 2.0,
-    p95_latency_sec: float = 2.5,
+    p95_latency_sec: Optional[float] = None,
+    model: Optional[str] = None,
+    concurrency: Optional[int] = None,
 ) -> Tuple[float, float]:
     """
     Returns (effective_rate_req_per_min, minutes) for processing `items`.
+    avg_tokens_per_call=None uses the observed per-model average (1500 until known),
+    p95_latency_sec=None the observed rolling p95 call latency (2.5s until known).
+    RPM/TPM are the limiter's current limits (learned from provider headers when
+    adaptive); concurrency=None uses the sync limiter's slots (pass the async
+    in-flight cap for asyncio batches).
     """
     items = max(0, int(items))
+    if avg_tokens_per_call is None:
+        avg_tokens_per_call = global_limiter.avg_tokens_per_call(model)
+    if p95_latency_sec is None:
+        p95_latency_sec = global_limiter.latency_p95(model)
     calls = max(0.0, float(calls_per_item)) * items
-    rpm = max(1, int(os.getenv("LLM_RPM", str(_DEFAULT_RPM))))
-    tpm = max(1, int(os.getenv("LLM_TPM", str(_DEFAULT_TPM))))
-    conc = max(1, int(os.getenv("LLM_CONCURRENCY", str(_DEFAULT_CONCURRENCY))))
-
-    r1 = rpm
-    r2 = max(1, int(tpm // max(1, int(avg_tokens_per_call))))
-    r3 = max(1, int((conc * 60) // max(1, int(p95_latency_sec))))
-    effective_rate = max(1, min(r1, r2, r3))  # requests per minute
+    rpm, tpm, conc = global_limiter.limits()
+    conc = max(1, int(concurrency or conc))
+
+    rates = [max(1, int((conc * 60) / max(0.05, float(p95_latency_sec))))]
+    if rpm > 0:
+        rates.append(rpm)
+    if tpm > 0:
+        rates.append(max(1, int(tpm // max(1, int(avg_tokens_per_call)))))
+    effective_rate = max(1, min(rates))  # requests per minute
     minutes = (calls / effective_rate) if calls > 0 else 0.0
     return float(effective_rate), float(minutes)
 
@@ -211,12 +1237,31 @@ _DEFAULT_RPM = _env_int("LLM_RPM", 60)
 _DEFAULT_TPM = _env_int("LLM_TPM", 300_000)
 _DEFAULT_CONCURRENCY = _env_int("LLM_CONCURRENCY", 10)
 _DEFAULT_RETRIES = _env_int("LLM_MAX_RETRIES", 6)
+_DEFAULT_ASYNC_CONCURRENCY = _env_int("LLM_ASYNC_CONCURRENCY", 50)
+_DEFAULT_ADAPTIVE = os.getenv("LLM_ADAPTIVE_LIMITS", "1").strip().lower() not in ("0", "false", "no", "off")
+# hedging sends speculative duplicate (paid) requests: opt-in
+_DEFAULT_HEDGE = os.getenv("LLM_HEDGE", "0").strip().lower() in ("1", "true", "yes", "on")
 
 
-# Global limiter instance
+# Global limiter instance (LLM_LIMITER_BACKEND=sqlite shares RPM/TPM across workers)
 global_limiter = RateLimiter(
     rpm=_DEFAULT_RPM,
     tpm=_DEFAULT_TPM,
     concurrency=_DEFAULT_CONCURRENCY,
     max_retries=_DEFAULT_RETRIES,
+    store=build_budget_store(_DEFAULT_RPM, _DEFAULT_TPM),
+    adaptive=_DEFAULT_ADAPTIVE,
+    breaker=_CircuitBreaker(
+        threshold=_env_float("LLM_BREAKER_ERROR_RATE", 0.5),
+        window=_env_int("LLM_BREAKER_WINDOW", 20),
+        min_calls=_env_int("LLM_BREAKER_MIN_CALLS", 10),
+        cooldown_sec=_env_float("LLM_BREAKER_COOLDOWN_SEC", 30.0),
+    ),
+    hedge=_DEFAULT_HEDGE,
+)
+
+# Async facade over the same budgets (used by async_openai_caller)
+global_async_limiter = AsyncRateLimiter(
+    global_limiter,
+    concurrency=_DEFAULT_ASYNC_CONCURRENCY,
 )
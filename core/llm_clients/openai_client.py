@@ -1,9 +1,11 @@
 # core/llm_clients/openai_client.py
+import asyncio
 import os
 import re
-from typing import Optional
-from openai import OpenAI, RateLimitError, APIError, APIConnectionError, AuthenticationError
-from .limiter import global_limiter, estimate_tokens
+import weakref
+from typing import Dict, Optional, Tuple
+from openai import OpenAI, AsyncOpenAI, RateLimitError, APIError, APIConnectionError, AuthenticationError
+from .limiter import global_limiter, global_async_limiter, estimate_tokens, CircuitOpenError, LLMCancelled
 
 MODEL_ALIAS = {
     "gpt-4.1": "gpt-4o",
@@ -19,6 +21,10 @@ class LLMRateLimit(LLMError):
     """تخطي السقف (429)."""
     pass
 
+class LLMUnavailable(LLMError, CircuitOpenError):
+    """الـcircuit breaker مفتوح: نسبة أخطاء المزوّد مرتفعة، نفشل فورًا دون نداء."""
+    pass
+
 def _resolve_model(name: str) -> str:
     if not name:
         return "gpt-4o-mini"
@@ -37,6 +43,7 @@ def openai_caller(
     - يأخذ الـAPI Key من OPENAI_API_KEY (متغير البيئة).
     - يعمل alias للأسماء الحديثة.
     - يرمي LLMRateLimit عند 429 حتى تتعامل الواجهة معه برِفق.
+    - يمرّر هيدرز x-ratelimit-* لكل رد إلى global_limiter (ميزانية متكيّفة).
     """
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
@@ -45,37 +52,135 @@ def openai_caller(
     client = OpenAI(api_key=api_key, timeout=timeout)
     model = _resolve_model(model_name)
 
+    usage: dict = {}
+
     def _do_call():
-        resp = client.chat.completions.create(
+        # with_raw_response: نحتاج x-ratelimit-* لتغذية الـlimiter بالميزانية الحقيقية
+        raw = client.chat.completions.with_raw_response.create(
             model=model,
             messages=[{"role": "user", "content": prompt}],
             temperature=float(temperature),
             max_tokens=int(max_tokens),
         )
+        global_limiter.observe_headers(raw.headers)
+        resp = raw.parse()
+        usage.update(_usage_of(resp))
         return (resp.choices[0].message.content or "").strip()
 
     # Schedule via global rate limiter with retries
     token_cost = estimate_tokens(prompt, int(max_tokens))
     try:
-        return global_limiter.execute(token_cost, _do_call)  # type: ignore[return-value]
+        out = global_limiter.execute(token_cost, _do_call, model=model_name or model)
+    except LLMCancelled:
+        raise
+    except Exception as e:
+        raise _translate_error(e, model) from e
+    # refund the unused part of the TPM reservation
+    global_limiter.reconcile(token_cost, model=model_name or model, **usage)
+    return out  # type: ignore[return-value]
+
+
+# AsyncOpenAI واحد لكل event loop (+ api_key/timeout): نفس connection pool و TLS
+# لكل النداءات بدل عميل جديد لكل نداء. مربوط بالـloop لأن اتصالات httpx لا تنتقل بين
+# loops (كل asyncio.run في job جديد يبني عميله)، ويُحرَّر مع الـloop (weak key).
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, int], AsyncOpenAI]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _async_client(api_key: str, timeout: int) -> AsyncOpenAI:
+    loop = asyncio.get_running_loop()
+    per_loop = _async_clients.setdefault(loop, {})
+    key = (api_key, int(timeout))
+    client = per_loop.get(key)
+    if client is None:
+        client = per_loop[key] = AsyncOpenAI(api_key=api_key, timeout=timeout)
+    return client
+
+
+async def async_openai_caller(
+    prompt: str,
+    *,
+    model_name: str,
+    temperature: float = 0.2,
+    max_tokens: int = 512,
+    timeout: int = 60,
+) -> str:
+    """
+    نسخة async من openai_caller مبنية على AsyncOpenAI.
+    - تمر عبر global_async_limiter (نفس ميزانيات RPM/TPM للنسخة المتزامنة).
+    - تسمح بإبقاء مئات الطلبات قيد التنفيذ على خيط واحد (batch jobs / ASGI).
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise LLMError("OPENAI_API_KEY is not set in environment.")
 
-    except RateLimitError as e:
+    model = _resolve_model(model_name)
+
+    usage: dict = {}
+
+    client = _async_client(api_key, timeout)
+
+    async def _do_call():
+        raw = await client.chat.completions.with_raw_response.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=float(temperature),
+            max_tokens=int(max_tokens),
+        )
+        await global_async_limiter.observe_headers(raw.headers)
+        resp = await raw.parse()
+        usage.update(_usage_of(resp))
+        return (resp.choices[0].message.content or "").strip()
+
+    token_cost = estimate_tokens(prompt, int(max_tokens))
+    try:
+        out = await global_async_limiter.execute(
+            token_cost, _do_call, model=model_name or model, prompt_tokens=estimate_tokens(prompt, 0),
+        )
+    except LLMCancelled:
+        raise
+    except Exception as e:
+        raise _translate_error(e, model) from e
+    await global_async_limiter.reconcile(token_cost, model=model_name or model, **usage)
+    return out  # type: ignore[return-value]
+
+
+def _usage_of(resp) -> dict:
+    """resp.usage -> {prompt_tokens, completion_tokens, cached_tokens} (فارغ إن لم يرسلها المزوّد)."""
+    u = getattr(resp, "usage", None)
+    if u is None:
+        return {}
+    # cached_tokens: جزء البرومبت المقروء من prompt cache لدى المزوّد (البادئة الثابتة)
+    details = getattr(u, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": getattr(u, "prompt_tokens", None),
+        "completion_tokens": getattr(u, "completion_tokens", None),
+        "cached_tokens": getattr(details, "cached_tokens", None),
+    }
+
+
+def _translate_error(e: Exception, model: str) -> LLMError:
+    """تحويل أخطاء OpenAI إلى LLMError/LLMRateLimit برسائل مفيدة."""
+    if isinstance(e, CircuitOpenError):
+        return LLMUnavailable(f"LLM temporarily unavailable for {model}: {e}")
+
+    if isinstance(e, RateLimitError):
         # نستخرج تلميح "try again in XmYs" إن وجد
         msg = str(e)
         wait_hint = ""
         m = re.search(r"in\s+(\d+)m(\d+)s", msg)
         if m:
             wait_hint = f" (try again in ~{m.group(1)}m {m.group(2)}s)"
-        raise LLMRateLimit(f"Rate limit for {model}{wait_hint}") from e
+        return LLMRateLimit(f"Rate limit for {model}{wait_hint}")
 
-    except AuthenticationError as e:
-        raise LLMError("Invalid OPENAI_API_KEY or auth error.") from e
+    if isinstance(e, AuthenticationError):
+        return LLMError("Invalid OPENAI_API_KEY or auth error.")
 
-    except APIConnectionError as e:
-        raise LLMError(f"Network error contacting OpenAI: {e}") from e
+    if isinstance(e, APIConnectionError):
+        return LLMError(f"Network error contacting OpenAI: {e}")
 
-    except APIError as e:
-        raise LLMError(f"OpenAI API error: {e}") from e
+    if isinstance(e, APIError):
+        return LLMError(f"OpenAI API error: {e}")
 
-    except Exception as e:
-        raise LLMError(f"Unexpected LLM error: {e}") from e
+    return LLMError(f"Unexpected LLM error: {e}")
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.llm_clients.backends import BACKENDS, build_callers, default_cassette_path
+from core.llm_clients.cassette import Cassette
+from core.llm_clients.fake_client import FakeLLM
+from core.llm_clients.limiter import AsyncRateLimiter, RateLimiter
+from core.services.llm_ingest import LLMConfig, allm_process_dishes
+
+# أطباق اصطناعية (تتكرر بحسب --unique لمحاكاة السلاسل/الفروع)
+_SAMPLE_DISHES = [
+    ("Falafel Teller", "Falafel mit Tahini, Salat, Tomaten"),
+    ("Chicken Wrap", "mit Joghurtsoße und Sesam"),
+    ("Döner Teller", "Dönerfleisch, Soße, Salat, Kraut, Zwiebeln"),
+    ("Pizza Margherita", "Tomatensoße, Mozzarella, Basilikum"),
+    ("Lachs Bowl", "Lachs, Reis, Edamame, Sojasauce"),
+    ("Schnitzel", "paniert, mit Pommes und Senf"),
+    ("Käsespätzle", "Spätzle, Bergkäse, Röstzwiebeln"),
+    ("Nougat Crêpe", "mit Haselnuss und Sahne"),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the async LLM pipeline (allm_process_dishes) against a fake or "
+        "cassette backend: throughput, errors and limiter stats — no quota needed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--backend", default="fake", choices=BACKENDS)
+        parser.add_argument("--dishes", type=int, default=100)
+        parser.add_argument("--unique", type=int, default=0, help="distinct dishes (0 = all distinct)")
+        parser.add_argument("--guess-codes", action="store_true", help="also run the term→codes call")
+        parser.add_argument("--model", default="gpt-4o-mini")
+        # limiter under test (independent of the global one)
+        parser.add_argument("--rpm", type=int, default=600)
+        parser.add_argument("--tpm", type=int, default=1_000_000)
+        parser.add_argument("--concurrency", type=int, default=50)
+        parser.add_argument("--retries", type=int, default=6)
+        # fake backend knobs
+        parser.add_argument("--latency-ms", type=float, default=300.0)
+        parser.add_argument("--jitter-ms", type=float, default=200.0)
+        parser.add_argument("--error-rate", type=float, default=0.0)
+        parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+        parser.add_argument("--seed", type=int, default=0)
+        # cassette backends
+        parser.add_argument("--cassette", default="", help="JSONL path (default: LLM_CASSETTE_PATH)")
+        parser.add_argument("--replay-latency", action="store_true")
+        parser.add_argument("--json", action="store_true", help="print a machine-readable report")
+
+    def handle(self, *args, **opts):
+        n = max(1, int(opts["dishes"]))
+        unique = int(opts["unique"]) or n
+        limiter = RateLimiter(
+            rpm=opts["rpm"], tpm=opts["tpm"], concurrency=opts["concurrency"], max_retries=opts["retries"],
+        )
+        async_limiter = AsyncRateLimiter(limiter, concurrency=opts["concurrency"])
+
+        backend = opts["backend"]
+        if backend == "fake":
+            fake = FakeLLM(
+                latency_ms=opts["latency_ms"],
+                jitter_ms=opts["jitter_ms"],
+                error_rate=opts["error_rate"],
+                rate_limit_rate=opts["rate_limit_rate"],
+                seed=opts["seed"],
+                limiter=limiter,
+                async_limiter=async_limiter,
+            )
+            acaller = fake.acaller
+        elif backend in ("record", "replay"):
+            cassette = Cassette(
+                opts["cassette"] or default_cassette_path(),
+                mode=backend,
+                replay_latency=opts["replay_latency"],
+                limiter=limiter,
+                async_limiter=async_limiter,
+            )
+            acaller = cassette.wrap_async(build_callers("openai")[1])
+        else:
+            raise CommandError("--backend openai spends real quota; use llm_status for a single live call")
+
+        dishes = []
+        for i in range(n):
+            k = i % unique
+            name, desc = _SAMPLE_DISHES[k % len(_SAMPLE_DISHES)]
+            suffix = f" #{k // len(_SAMPLE_DISHES)}" if k >= len(_SAMPLE_DISHES) else ""
+            dishes.append((i, name + suffix, desc))
+
+        cfg = LLMConfig(model_name=opts["model"])
+        t0 = time.monotonic()
+        results = asyncio.run(allm_process_dishes(acaller, cfg, dishes, guess_codes=opts["guess_codes"]))
+        elapsed = time.monotonic() - t0
+
+        stats = limiter.stats()
+        errors = sum(1 for r in results if r.error)
+        report = {
+            "backend": backend,
+            "dishes": n,
+            "errors": errors,
+            "elapsed_sec": round(elapsed, 3),
+            "dishes_per_min": round(n / max(elapsed, 1e-6) * 60.0, 1),
+            "llm_calls": stats["completed"],
+            "calls_per_min": round(stats["completed"] / max(elapsed, 1e-6) * 60.0, 1),
+            "latency": stats.get("latency", {}),
+            "usage": stats.get("usage", {}),
+            "config": limiter.config(),
+        }
+        if opts["json"]:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+            return
+
+        self.stdout.write(f"[Bench] backend={backend} dishes={n} unique={unique} errors={errors}")
+        self.stdout.write(
+            f"  elapsed={report['elapsed_sec']}s  dishes/min={report['dishes_per_min']}  "
+            f"calls/min={report['calls_per_min']}"
+        )
+        for model, lat in report["latency"].items():
+            self.stdout.write(
+                f"  [{model}] call p50={lat['call_p50_sec']}s p95={lat['call_p95_sec']}s  "
+                f"wait p50={lat['wait_p50_sec']}s p95={lat['wait_p95_sec']}s"
+            )
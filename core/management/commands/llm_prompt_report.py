@@ -0,0 +1,83 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from core.llm_clients.limiter import estimate_tokens
+from core.management.commands.llm_bench import _SAMPLE_DISHES
+from core.models import Allergen
+from core.services.llm_ingest import (
+    LLMConfig,
+    _build_extract_prompt,
+    _build_map_prompt,
+    _finish_extract,
+    extract_prompt_prefix,
+    map_prompt_prefix,
+)
+
+# نفس سقوف الإخراج التي يحجزها llm_extract_terms / llm_map_terms_to_codes من ميزانية TPM
+_OUTPUT_CAP = {"extract": 256, "map": 512}
+
+
+class Command(BaseCommand):
+    help = (
+        "Token report per LLM prompt template (extract / map × full / compact): static prefix, "
+        "variable part and TPM reservation per call, using the limiter's own token estimate."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-terms", type=int, default=12)
+        parser.add_argument("--no-db", action="store_true", help="compact: built-in labels instead of the Allergen table")
+        parser.add_argument("--json", action="store_true", help="print a machine-readable report")
+
+    def handle(self, *args, **opts):
+        labels = None
+        if not opts["no_db"]:
+            rows = Allergen.objects.filter(kind=Allergen.Kind.ALLERGEN).values_list("code", "label_de")
+            labels = {code: label for code, label in rows if code and label} or None
+
+        rows = []
+        for style in ("full", "compact"):
+            cfg = LLMConfig(max_terms=opts["max_terms"], prompt_style=style, allergen_labels=labels)
+            extract, mapping = [], []
+            for name, desc in _SAMPLE_DISHES:
+                extract.append(estimate_tokens(_build_extract_prompt(cfg, name, desc), 0))
+                terms = _finish_extract(cfg, name, desc, [])
+                mapping.append(estimate_tokens(_build_map_prompt(terms, cfg.lang, cfg), 0))
+            for template, prefix, sizes in (
+                ("extract", extract_prompt_prefix(cfg), extract),
+                ("map", map_prompt_prefix(cfg), mapping),
+            ):
+                avg = sum(sizes) / len(sizes)
+                prefix_tokens = estimate_tokens(prefix, 0)
+                rows.append({
+                    "template": template,
+                    "style": style,
+                    "prefix_tokens": prefix_tokens,
+                    "avg_variable_tokens": round(avg - prefix_tokens, 1),
+                    "avg_prompt_tokens": round(avg, 1),
+                    "avg_reserved_tokens": round(avg + _OUTPUT_CAP[template], 1),
+                    "static_share": round(prefix_tokens / avg, 3) if avg else 0.0,
+                })
+
+        full = {r["template"]: r["avg_prompt_tokens"] for r in rows if r["style"] == "full"}
+        for r in rows:
+            base = full.get(r["template"]) or 0
+            r["saving_vs_full"] = round(1.0 - r["avg_prompt_tokens"] / base, 3) if base else 0.0
+
+        report = {
+            "samples": len(_SAMPLE_DISHES),
+            "allergen_labels": "db" if labels else "default",
+            "templates": rows,
+        }
+        if opts["json"]:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+            return
+
+        self.stdout.write(f"[Prompts] samples={report['samples']} compact labels={report['allergen_labels']}")
+        for r in rows:
+            self.stdout.write(
+                f"  {r['template']:<8}{r['style']:<8} prefix={r['prefix_tokens']:>4}  "
+                f"variable≈{r['avg_variable_tokens']:>6}  prompt≈{r['avg_prompt_tokens']:>6}  "
+                f"reserved≈{r['avg_reserved_tokens']:>6}  static={r['static_share']:.0%}  "
+                f"saving={r['saving_vs_full']:.0%}"
+            )
@@ -0,0 +1,265 @@
+import fcntl
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from core.dictionary_models import KeywordLexeme, normalize_text
+from core.models import Dish, Menu, OwnerRegenState
+from core.services.allergen_rules import _GLOBAL_OWNER_ID, generate_for_dishes
+
+_CHUNK = 500
+
+
+def _global_lexemes_q() -> Q:
+    # نفس تعريف القاموس العام في allergen_rules._resolve_lexemes
+    q = Q(owner__isnull=True) | Q(owner__is_superuser=True)
+    if _GLOBAL_OWNER_ID is not None:
+        q |= Q(owner_id=_GLOBAL_OWNER_ID)
+    return q
+
+
+def _repair_lexemes(qs) -> int:
+    """صيانة القاموس: normalized_term قديم (تغيّر التطبيع/استيراد خام) يُعاد حسابه؛ التعارض يُترك كما هو."""
+    repaired = 0
+    for lx in qs.only("id", "term", "normalized_term").iterator():
+        norm = normalize_text(lx.term or "")
+        if lx.normalized_term == norm:
+            continue
+        lx.normalized_term = norm
+        try:
+            with transaction.atomic():
+                lx.save(update_fields=["normalized_term"])
+            repaired += 1
+        except IntegrityError:
+            pass
+    return repaired
+
+
+def _init_worker(nice: int) -> None:
+    if nice:
+        try:
+            os.nice(nice)
+        except OSError:
+            pass
+
+
+def _process_owner(owner_id: int, since: Optional[str], full: bool, reason: str) -> Dict:
+    """مالك واحد (في عملية فرعية أو inline): صيانة قاموسه ثم القواعد (dry_run=False) للأطباق المتأثرة."""
+    t0, cpu0 = time.monotonic(), time.process_time()
+    counter = {"queries": 0}
+
+    def _count(execute, sql, params, many, context):
+        counter["queries"] += 1
+        return execute(sql, params, many, context)
+
+    row = {"owner_id": owner_id, "mode": "full" if full else "incremental", "reason": reason,
+           "dishes_scanned": 0, "changed": 0, "skipped": 0, "missing_after_rules": 0,
+           "lexemes_repaired": 0, "error": None}
+    try:
+        with connection.execute_wrapper(_count):
+            row["lexemes_repaired"] = _repair_lexemes(KeywordLexeme.objects.filter(owner_id=owner_id))
+            if row["lexemes_repaired"] and not full:
+                full, row["mode"], row["reason"] = True, "full", "lexemes repaired"
+            qs = Dish.objects.select_related("section__menu").filter(section__menu__user_id=owner_id)
+            if not full and since:
+                qs = qs.filter(updated_at__gt=datetime.fromisoformat(since))
+            ids = list(qs.order_by("id").values_list("id", flat=True))
+            for i in range(0, len(ids), _CHUNK):
+                res = generate_for_dishes(
+                    list(qs.filter(id__in=ids[i:i + _CHUNK]).order_by("id")), owner_id=owner_id, dry_run=False,
+                )
+                row["dishes_scanned"] += res.get("processed", 0)
+                for key in ("changed", "skipped", "missing_after_rules"):
+                    row[key] += res.get(key, 0)
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if multiprocessing.parent_process() is not None:
+            connections.close_all()
+    row["queries"] = counter["queries"]
+    row["seconds"] = round(time.monotonic() - t0, 3)
+    row["cpu_seconds"] = round(time.process_time() - cpu0, 3)
+    return row
+
+
+class Command(BaseCommand):
+    help = (
+        "Nightly incremental regeneration: for every owner whose dishes or lexicon (own or global) "
+        "changed since their last run, repair lexicon normalization and re-run the rules engine "
+        "(write mode; manual codes untouched). Owners run in parallel processes under a CPU budget; "
+        "a JSON run report (dishes scanned/changed/skipped, seconds, queries) goes to --report. "
+        "Cron: see deploy/nightly_regen.cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cpu-budget", type=float,
+                            default=float(os.getenv("NIGHTLY_REGEN_CPU_BUDGET", "0.5")),
+                            help="share of the CPU cores to use (env NIGHTLY_REGEN_CPU_BUDGET)")
+        parser.add_argument("--workers", type=int, default=0, help="worker processes (overrides --cpu-budget)")
+        parser.add_argument("--nice", type=int, default=10, help="niceness of the worker processes")
+        parser.add_argument("--max-minutes", type=float, default=0.0,
+                            help="stop starting owners after N minutes; the rest stay pending (0 = no limit)")
+        parser.add_argument("--owner", type=int, action="append", default=[], help="only these owners (repeatable)")
+        parser.add_argument("--full", action="store_true", help="ignore the change markers: all dishes of all owners")
+        parser.add_argument("--dry-run", action="store_true", help="only report which owners would run")
+        parser.add_argument("--report", default=os.getenv("NIGHTLY_REGEN_REPORT", ""),
+                            help="write the JSON run report to this file (env NIGHTLY_REGEN_REPORT)")
+        parser.add_argument("--json", action="store_true", help="print the JSON run report")
+        parser.add_argument("--lock-file", default=os.path.join(tempfile.gettempdir(), "ibla-nightly-regen.lock"))
+
+    def handle(self, *args, **opts):
+        lock = open(opts["lock_file"], "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise CommandError("another nightly_regen run holds the lock")
+        try:
+            report = self._run(opts)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+        if opts["report"]:
+            os.makedirs(os.path.dirname(os.path.abspath(opts["report"])), exist_ok=True)
+            with open(opts["report"], "w", encoding="utf-8") as fh:
+                json.dump(report, fh, ensure_ascii=False, indent=2)
+        if opts["json"]:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+            return
+        o, t = report["owners"], report["totals"]
+        self.stdout.write(
+            f"[Regen] owners={o['total']} dirty={o['dirty']} done={o['done']} failed={o['failed']} "
+            f"deferred={o['deferred']} workers={report['workers']} dishes={t['dishes_scanned']} "
+            f"changed={t['changed']} skipped={t['skipped']} queries={t['queries']} in {report['seconds']}s"
+        )
+
+    def _plan(self, opts) -> List[tuple]:
+        """(owner_id, since, full, reason) لكل مالك تغيّر شيء عنده منذ آخر تشغيل."""
+        owners = set(Menu.objects.values_list("user_id", flat=True).distinct())
+        if opts["owner"]:
+            owners &= set(opts["owner"])
+        states = dict(OwnerRegenState.objects.filter(owner_id__in=owners).values_list("owner_id", "last_run_at"))
+        dish_max = dict(
+            Dish.objects.filter(section__menu__user_id__in=owners)
+            .order_by().values_list("section__menu__user_id").annotate(m=Max("updated_at"))
+        )
+        lex_max = dict(
+            KeywordLexeme.objects.filter(owner_id__in=owners)
+            .order_by().values_list("owner_id").annotate(m=Max("updated_at"))
+        )
+        global_max = KeywordLexeme.objects.filter(_global_lexemes_q()).aggregate(m=Max("updated_at"))["m"]
+
+        plan = []
+        for owner_id in sorted(owners):
+            since = states.get(owner_id)
+            if opts["full"] or since is None:
+                reason = "forced" if opts["full"] else "first run"
+                plan.append((owner_id, None, True, reason))
+            elif (lex_max.get(owner_id) and lex_max[owner_id] > since) or (global_max and global_max > since):
+                plan.append((owner_id, since.isoformat(), True, "lexicon changed"))
+            elif dish_max.get(owner_id) and dish_max[owner_id] > since:
+                plan.append((owner_id, since.isoformat(), False, "dishes changed"))
+        return plan
+
+    def _run(self, opts) -> Dict:
+        started = timezone.now()
+        t0, cpu0 = time.monotonic(), time.process_time()
+        counter = {"queries": 0}
+
+        def _count(execute, sql, params, many, context):
+            counter["queries"] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(_count):
+            global_repaired = 0 if opts["dry_run"] else _repair_lexemes(KeywordLexeme.objects.filter(owner__isnull=True))
+            if global_repaired:
+                opts = dict(opts, full=True)  # تغيّر التطبيع العام → كل المالكين
+            total_owners = Menu.objects.values("user_id").distinct().count()
+            plan = self._plan(opts)
+
+        cpus = os.cpu_count() or 1
+        workers = opts["workers"] or max(1, int(cpus * max(0.0, min(1.0, opts["cpu_budget"]))))
+        workers = max(1, min(workers, len(plan) or 1))
+        deadline = time.monotonic() + opts["max_minutes"] * 60 if opts["max_minutes"] > 0 else None
+
+        rows: List[Dict] = []
+        deferred: List[int] = []
+        if opts["dry_run"]:
+            rows = [{"owner_id": o, "mode": "full" if full else "incremental", "reason": reason}
+                    for o, _, full, reason in plan]
+        elif workers == 1 or "fork" not in multiprocessing.get_all_start_methods():
+            for item in plan:
+                if deadline is not None and time.monotonic() > deadline:
+                    deferred.append(item[0])
+                    continue
+                rows.append(self._record(_process_owner(*item), started))
+        else:
+            connections.close_all()  # لا نورّث اتصال DB المفتوح للعمليات الفرعية
+            ctx = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker,
+                                     initargs=(opts["nice"],)) as pool:
+                pending = list(plan)
+                futures = {}
+                # لا نقدّم أكثر من workers مهمة مسبقًا: الموعد النهائي يُحترم عند بدء كل مالك
+                while pending or futures:
+                    while pending and len(futures) < workers:
+                        item = pending.pop(0)
+                        if deadline is not None and time.monotonic() > deadline:
+                            deferred.append(item[0])
+                            continue
+                        futures[pool.submit(_process_owner, *item)] = item
+                    if not futures:
+                        break
+                    fut = next(as_completed(futures))
+                    item = futures.pop(fut)
+                    try:
+                        row = fut.result()
+                    except Exception as e:  # العملية الفرعية ماتت (OOM/kill)
+                        row = {"owner_id": item[0], "mode": "full" if item[2] else "incremental",
+                               "reason": item[3], "error": f"{type(e).__name__}: {e}"}
+                    rows.append(self._record(row, started))
+
+        totals = {k: sum(r.get(k, 0) or 0 for r in rows)
+                  for k in ("dishes_scanned", "changed", "skipped", "missing_after_rules",
+                            "lexemes_repaired", "queries", "cpu_seconds")}
+        totals["lexemes_repaired"] += global_repaired
+        totals["queries"] += counter["queries"]
+        totals["cpu_seconds"] = round(totals["cpu_seconds"] + time.process_time() - cpu0, 3)
+        finished = timezone.now()
+        return {
+            "started_at": started.isoformat(),
+            "finished_at": finished.isoformat(),
+            "seconds": round(time.monotonic() - t0, 3),
+            "dry_run": bool(opts["dry_run"]),
+            "cpu_budget": opts["cpu_budget"],
+            "workers": workers,
+            "owners": {
+                "total": total_owners,
+                "dirty": len(plan),
+                "done": sum(1 for r in rows if not r.get("error") and not opts["dry_run"]),
+                "failed": sum(1 for r in rows if r.get("error")),
+                "deferred": len(deferred),
+            },
+            "totals": totals,
+            "deferred_owner_ids": deferred,
+            "per_owner": sorted(rows, key=lambda r: r["owner_id"]),
+        }
+
+    @staticmethod
+    def _record(row: Dict, started) -> Dict:
+        # العلامة = بداية التشغيل: ما عُدّل أثناءه يُلتقط في المرة القادمة؛ الفاشل يبقى معلّقًا
+        if not row.get("error"):
+            OwnerRegenState.objects.update_or_create(
+                owner_id=row["owner_id"], defaults={"last_run_at": started, "last_report": row},
+            )
+        return row
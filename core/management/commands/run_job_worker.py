@@ -0,0 +1,139 @@
+import logging
+import os
+import signal
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+
+from core.utils.jobs import (
+    JOB_HEARTBEAT_SEC,
+    JOB_LEASE_SEC,
+    default_worker_id,
+    job_manager,
+)
+
+logger = logging.getLogger("core.jobs")
+
+# خطأ في الحلقة نفسها (DB غير متاحة، اتصال مقطوع...) → انتظار يتضاعف حتى هذا الحد ثم نحاول مجددًا
+_ERROR_BACKOFF_MAX_SEC = 30.0
+
+
+class Command(BaseCommand):
+    help = (
+        "Consume the BackgroundJob queue (JOB_BACKEND=db): claim jobs with a lease, renew it by "
+        "heartbeat, retry failures with backoff, drop finished jobs after JOB_RESULT_TTL_SEC. "
+        "Jobs start in fair order (priority, then per-owner share; see core.utils.jobs). "
+        "Run one or more next to gunicorn."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--worker-id", default="", help="lease owner name (default: host:pid)")
+        parser.add_argument("--once", action="store_true", help="drain the ready jobs, then exit")
+        parser.add_argument("--max-jobs", type=int, default=0, help="exit after N jobs (0 = no limit)")
+        parser.add_argument("--poll-interval", type=float, default=1.0)
+        parser.add_argument("--lease-sec", type=float, default=JOB_LEASE_SEC)
+        parser.add_argument("--heartbeat-sec", type=float, default=JOB_HEARTBEAT_SEC)
+        parser.add_argument("--concurrency", type=int, default=int(os.getenv("JOB_WORKER_CONCURRENCY", "2")),
+                            help="jobs run at once by this worker (env JOB_WORKER_CONCURRENCY)")
+        parser.add_argument("--purge-every", type=float, default=300.0,
+                            help="seconds between retention sweeps when idle (0 = never)")
+
+    def handle(self, *args, **opts):
+        if job_manager.backend != "db":
+            job_manager.set_backend("db")
+        store = job_manager.store
+        worker_id = opts["worker_id"] or default_worker_id()
+        lease_sec = max(1.0, float(opts["lease_sec"]))
+        heartbeat_sec = float(opts["heartbeat_sec"])
+        if heartbeat_sec > 0 and heartbeat_sec >= lease_sec:
+            raise CommandError("--heartbeat-sec must be shorter than --lease-sec")
+
+        stopping = {"flag": False}
+
+        def _stop(signum, frame):
+            # نُنهي المهمة الحالية ثم نخرج (الـlease يُحرَّر بنهايتها)
+            stopping["flag"] = True
+            self.stdout.write(f"[Worker] {worker_id}: signal {signum}, stopping after current job")
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                signal.signal(sig, _stop)
+            except ValueError:  # not the main thread (tests)
+                pass
+
+        concurrency = max(1, int(opts["concurrency"]))
+        purge_every = float(opts["purge_every"])
+        state = {"processed": 0, "last_purge": float("-inf")}
+        lock = threading.Lock()
+
+        def _slot(slot_id: str) -> None:
+            # كل slot يلتقط مهمة واحدة في كل مرة؛ أكثر من slot → مهمة تفاعلية لا تنتظر دفعة كبيرة
+            poll = max(0.05, float(opts["poll_interval"]))
+            errors = 0
+            try:
+                while not stopping["flag"]:
+                    try:
+                        close_old_connections()
+                        row = store.claim(slot_id, lease_sec=lease_sec)
+                        if row is None:
+                            with lock:
+                                due = purge_every > 0 and time.monotonic() - state["last_purge"] >= purge_every
+                                if due:
+                                    state["last_purge"] = time.monotonic()
+                            if due:
+                                purged = job_manager.purge()
+                                if purged:
+                                    self.stdout.write(f"[Worker] purged {purged} finished job(s)")
+                            errors = 0
+                            if opts["once"]:
+                                break
+                            time.sleep(poll)
+                            continue
+
+                        t0 = time.monotonic()
+                        final = store.run_claimed(row, slot_id, heartbeat_sec=heartbeat_sec, lease_sec=lease_sec)
+                        errors = 0
+                    except Exception as e:
+                        # الـslot لا يموت بسبب خطأ عابر؛ مهمة التُقطت ولم تكتمل تعود للطابور بعد انتهاء الـlease
+                        errors += 1
+                        delay = min(_ERROR_BACKOFF_MAX_SEC, poll * 2 ** errors)
+                        logger.exception("worker slot %s: loop error #%d, retrying in %.1fs", slot_id, errors, delay)
+                        self.stderr.write(f"[Worker] {slot_id}: {e.__class__.__name__}: {e} (retry in {delay:.1f}s)")
+                        close_old_connections()
+                        if opts["once"] and errors >= 3:
+                            break
+                        time.sleep(delay)
+                        continue
+
+                    self.stdout.write(
+                        f"[Worker] job={row.id} task={row.task} owner={row.owner or '-'} "
+                        f"priority={row.priority} attempt={row.attempts}/{row.max_attempts} "
+                        f"→ {final} in {time.monotonic() - t0:.1f}s"
+                    )
+                    with lock:
+                        state["processed"] += 1
+                        if opts["max_jobs"] and state["processed"] >= opts["max_jobs"]:
+                            stopping["flag"] = True
+            finally:
+                if concurrency > 1:
+                    connection.close()
+
+        self.stdout.write(
+            f"[Worker] {worker_id}: lease={lease_sec}s heartbeat={heartbeat_sec}s concurrency={concurrency}"
+        )
+        if concurrency == 1:
+            _slot(worker_id)
+        else:
+            threads = [
+                threading.Thread(target=_slot, args=(f"{worker_id}/{i}",), daemon=True, name=f"job-slot-{i}")
+                for i in range(concurrency)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                while t.is_alive():
+                    t.join(timeout=1.0)  # يبقي الخيط الرئيسي قادرًا على استقبال الإشارات
+
+        self.stdout.write(f"[Worker] {worker_id}: processed={state['processed']}")
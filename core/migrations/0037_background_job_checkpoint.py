@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 03:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0036_background_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backgroundjob',
+            name='checkpoint',
+            field=models.JSONField(blank=True, help_text='تقدّم/نتائج وسيطة؛ المحاولة التالية أو الاستئناف تكمل منها.', null=True),
+        ),
+    ]
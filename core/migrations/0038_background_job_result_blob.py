@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 03:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0037_background_job_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backgroundjob',
+            name='result_blob',
+            field=models.BinaryField(blank=True, help_text='النتيجة الكاملة gzip(JSON) إذا كانت كبيرة؛ result عندها ملخّص فقط (result_summary).', null=True),
+        ),
+    ]
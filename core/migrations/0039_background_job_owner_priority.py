@@ -0,0 +1,35 @@
+# Generated by Django 5.2.4 on 2026-10-19 03:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0038_background_job_result_blob'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='backgroundjob',
+            name='core_backgr_status_24aba0_idx',
+        ),
+        migrations.AddField(
+            model_name='backgroundjob',
+            name='owner',
+            field=models.CharField(blank=True, default='', help_text='صاحب المهمة (user id)؛ أساس العدالة وسقف التوازي لكل مالك.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='backgroundjob',
+            name='priority',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Interactive'), (10, 'Bulk')], default=0),
+        ),
+        migrations.AddIndex(
+            model_name='backgroundjob',
+            index=models.Index(fields=['status', 'priority', 'run_after'], name='core_backgr_status_df1358_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='backgroundjob',
+            index=models.Index(fields=['status', 'owner'], name='core_backgr_status_2b7488_idx'),
+        ),
+    ]
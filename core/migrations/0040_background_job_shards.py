@@ -0,0 +1,19 @@
+# Generated by Django 5.2.4 on 2026-10-19 03:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0039_background_job_owner_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backgroundjob',
+            name='parent',
+            field=models.ForeignKey(blank=True, help_text='مهمة مقسّمة: الأب يجمع تقدّم/نتائج شظاياه ولا يُنفَّذ بنفسه.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='core.backgroundjob'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.4 on 2026-10-19 05:12
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0040_background_job_shards'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dish',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='OwnerRegenState',
+            fields=[
+                ('owner', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='regen_state', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('last_run_at', models.DateTimeField(blank=True, help_text='بداية آخر تشغيل ناجح لهذا المالك.', null=True)),
+                ('last_report', models.JSONField(blank=True, default=dict)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-19 06:05
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0041_dish_updated_at_owner_regen_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackgroundJobCheckpointDelta',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=50)),
+                ('data', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoint_deltas', to='core.backgroundjob')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -208,6 +208,8 @@ class Dish(models.Model):
         help_text="DEPRECATED: Merge into 'codes' instead"
     )
     codes_updated_at = models.DateTimeField(null=True, blank=True)
+    # آخر حفظ كامل (تعديل المستخدم)؛ حفظ الأكواد بـupdate_fields لا يغيّره → nightly_regen يعرف الأطباق المعدّلة
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     sort_order = models.PositiveIntegerField(default=0)
     
     # Favorite flag for recommended dishes section
@@ -229,8 +231,16 @@ class Dish(models.Model):
             models.Index(fields=["is_favorite"]),
         ]
 
+    def _prefetched(self, name: str):
+        """القائمة المجلوبة مسبقًا (prefetch_related) إن وُجدت، وإلا None → استعلام عادي."""
+        return getattr(self, "_prefetched_objects_cache", {}).get(name)
+
     def default_price_value(self):
-        dp = self.prices.filter(is_default=True).first()
+        prices = self._prefetched("prices")
+        if prices is not None:
+            dp = next((p for p in prices if p.is_default), None)
+        else:
+            dp = self.prices.filter(is_default=True).first()
         return dp.price if dp else None
 
     @property
@@ -241,7 +251,9 @@ class Dish(models.Model):
     # --- قراءة الأكواد من السجلات التفصيلية إن وُجدت (مع توافق خلفي) ---
     def _codes_from_allergen_rows(self) -> str:
         try:
-            rows = self.allergen_rows.select_related("allergen").only("allergen__code")
+            rows = self._prefetched("allergen_rows")
+            if rows is None:
+                rows = self.allergen_rows.select_related("allergen").only("allergen__code")
             codes = sorted({(r.allergen.code or "").strip().upper()
                             for r in rows if r.allergen_id and r.allergen and r.allergen.code})
             return ",".join(c for c in codes if c)
@@ -673,3 +685,119 @@ class DishExtraGroup(models.Model):
     def __str__(self):
         return f"{self.dish.name} -> {self.extra_group.name}"
 
+
+
+class BackgroundJob(models.Model):
+    """
+    مهمة خلفية مخزّنة في DB (JOB_BACKEND=db): حالة/تقدّم/نتيجة مشتركة بين كل العمليات.
+    - ينفّذها `manage.py run_job_worker` عبر lease (lease_owner + lease_expires_at) مع heartbeat.
+    - lease منتهٍ = العامل مات → تُعاد المهمة للطابور حتى max_attempts.
+    """
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_ERROR = "error"
+    STATUS_CANCELLED = "cancelled"
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_DONE, "Done"),
+        (STATUS_ERROR, "Error"),
+        (STATUS_CANCELLED, "Cancelled"),
+    )
+    FINAL_STATUSES = (STATUS_DONE, STATUS_ERROR, STATUS_CANCELLED)
+
+    # الأصغر أولًا: المهام التفاعلية (أطباق قليلة) تسبق الدفعات الكبيرة
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_BULK = 10
+    PRIORITY_CHOICES = (
+        (PRIORITY_INTERACTIVE, "Interactive"),
+        (PRIORITY_BULK, "Bulk"),
+    )
+
+    id = models.CharField(max_length=36, primary_key=True)  # uuid4 (نفس JobState.id)
+    task = models.CharField(max_length=100, blank=True, default='', help_text="اسم المهمة في core.utils.jobs.JOB_TASKS.")
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    owner = models.CharField(
+        max_length=64, blank=True, default='', help_text="صاحب المهمة (user id)؛ أساس العدالة وسقف التوازي لكل مالك."
+    )
+    priority = models.PositiveSmallIntegerField(choices=PRIORITY_CHOICES, default=PRIORITY_INTERACTIVE)
+    parent = models.ForeignKey(
+        "self", null=True, blank=True, on_delete=models.CASCADE, related_name="shards",
+        help_text="مهمة مقسّمة: الأب يجمع تقدّم/نتائج شظاياه ولا يُنفَّذ بنفسه.",
+    )
+
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    message = models.CharField(max_length=255, blank=True, default='')
+    total = models.PositiveIntegerField(default=0)
+    completed = models.PositiveIntegerField(default=0)
+    percent = models.FloatField(default=0.0)
+    eta_minutes = models.FloatField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    result_blob = models.BinaryField(
+        null=True, blank=True, editable=False,
+        help_text="النتيجة الكاملة gzip(JSON) إذا كانت كبيرة؛ result عندها ملخّص فقط (result_summary).",
+    )
+    error = models.TextField(null=True, blank=True)
+    cancel_requested = models.BooleanField(default=False)
+    checkpoint = models.JSONField(
+        null=True, blank=True, help_text="تقدّم/نتائج وسيطة؛ المحاولة التالية أو الاستئناف تكمل منها."
+    )
+
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now, help_text="لا تُلتقط قبل هذا الوقت (backoff بين المحاولات).")
+    lease_owner = models.CharField(max_length=100, blank=True, default='')
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    cancelled_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["created_at"]
+        indexes = [
+            models.Index(fields=["status", "priority", "run_after"]),
+            models.Index(fields=["status", "owner"]),
+            models.Index(fields=["status", "lease_expires_at"]),
+            models.Index(fields=["created_at"]),
+        ]
+
+    def __str__(self):
+        return f"Job({self.id}, {self.task or '-'}, {self.status})"
+
+
+class BackgroundJobCheckpointDelta(models.Model):
+    """
+    إضافة إلى checkpoint مهمة (job_manager.append_checkpoint): data تُدمج فوق checkpoint[key]
+    عند load_checkpoint بترتيب id. كتابة دفعة نتائج جديدة لا تعيد كتابة كل ما سبقها؛
+    save_checkpoint يكتب checkpoint كاملًا ويحذف الإضافات السابقة. id يصلح مؤشرًا (SSE).
+    """
+    job = models.ForeignKey(BackgroundJob, on_delete=models.CASCADE, related_name="checkpoint_deltas")
+    key = models.CharField(max_length=50)
+    data = models.JSONField(default=dict)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self):
+        return f"CheckpointDelta({self.job_id}, {self.key}, #{self.pk})"
+
+
+class OwnerRegenState(models.Model):
+    """
+    علامة آخر إعادة توليد ليلية لكل مالك (`manage.py nightly_regen`): يُعالَج المالك مجددًا
+    فقط إن تغيّرت أطباقه أو قاموسه (أو القاموس العام) بعد last_run_at.
+    """
+    owner = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name="regen_state"
+    )
+    last_run_at = models.DateTimeField(null=True, blank=True, help_text="بداية آخر تشغيل ناجح لهذا المالك.")
+    last_report = models.JSONField(default=dict, blank=True)
+
+    def __str__(self):
+        return f"RegenState(user={self.owner_id}, {self.last_run_at})"
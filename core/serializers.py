@@ -26,6 +26,7 @@ from .dictionary_models import KeywordLexeme, NegationCue
 
 # ✅ تنظيف/التحقق من الصور
 from core.utils.images import validate_and_clean_image
+from core.services import allergen_registry, auto_regen
 
 
 # ===================== أدوات مساعدة عامة =====================
@@ -92,7 +93,7 @@ def _build_explanation_de_from_codes(codes: list[str], labels_by_code: dict = No
     Args:
         codes: List of allergen codes, e.g. ['A', 'G']
         labels_by_code: Optional dict mapping code -> German label.
-                       If None, fetches from database.
+                       If None, uses the Allergen registry.
     
     Returns:
         German explanation string, e.g. "Enthält Glutenhaltiges Getreide und Milch."
@@ -108,26 +109,9 @@ def _build_explanation_de_from_codes(codes: list[str], labels_by_code: dict = No
     
     # If labels_by_code provided, use it (for testing)
     if labels_by_code is not None:
-        labels = [labels_by_code.get(code, '') for code in codes]
-        labels = [str(x).strip() for x in labels if str(x).strip()]
-    else:
-        # Otherwise fetch from database (production use)
-        labels = list(
-            Allergen.objects.filter(code__in=codes)
-            .order_by("code")
-            .values_list("label_de", flat=True)
-        )
-        labels = [str(x).strip() for x in labels if str(x).strip()]
-    
-    if not labels:
-        return ""
-    if len(labels) == 1:
-        body = labels[0]
-    elif len(labels) == 2:
-        body = f"{labels[0]} und {labels[1]}"
-    else:
-        body = ", ".join(labels[:-1]) + f" und {labels[-1]}"
-    return f"Enthält {body}."
+        return allergen_registry.join_de(labels_by_code.get(code, '') for code in codes)
+    # Otherwise the in-process registry (no query per dish; memoized per code set)
+    return allergen_registry.registry.explanation_de(codes)
 
 
 # ----------------------------- Profile -----------------------------
@@ -664,6 +648,8 @@ class DishSerializer(serializers.ModelSerializer):
         validated_data = self._clean_images_in_data(validated_data)
         prices_data = validated_data.pop("prices", None)
         ingredients = validated_data.pop("ingredients", None)
+        # AUTO_REGEN_ON_EDIT: نقارن قبل الحفظ، والمهمة تُجدول بعد commit (مؤجّلة ومدموجة)
+        regen = auto_regen.AUTO_REGEN_ON_EDIT and auto_regen.dish_needs_regen(instance, validated_data, ingredients)
 
         dish = super().update(instance, validated_data)
 
@@ -673,6 +659,9 @@ class DishSerializer(serializers.ModelSerializer):
         if prices_data is not None:
             self._upsert_prices(dish, prices_data)
 
+        if regen:
+            auto_regen.queue_dish_regen(dish)
+
         return dish
 
     def _upsert_prices(self, dish, prices_data):
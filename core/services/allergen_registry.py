@@ -0,0 +1,133 @@
+# core/services/allergen_registry.py
+# -----------------------------------------------------------
+# سجلّ Allergen داخل العملية: code → (label_de, label_en, label_ar, kind)
+#   - يُحمَّل باستعلام واحد لكل عملية بدل استعلام لكل طبق يُسلسَل
+#     (DishSerializer / PublicDishSerializer / MenuAggregateDishSerializer / allergen_rules)
+#   - نسخة السجلّ في الكاش (ALLERGEN_REGISTRY_VERSION_KEY): signals على Allergen ترفعها،
+#     وكل عملية تقارنها بنسختها مرة كل ALLERGEN_REGISTRY_CHECK_SEC على الأكثر
+#   - الكاش الافتراضي locmem (محلي لكل عملية) → ALLERGEN_REGISTRY_TTL_SEC حدّ أقصى لعمر السجلّ
+#     حتى لا تبقى عملية أخرى (gunicorn worker/job_worker) على تسميات قديمة للأبد
+#   - نصوص "Enthält …" محفوظة لكل frozenset أكواد وتُمسح مع كل إعادة تحميل
+# -----------------------------------------------------------
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, NamedTuple, Optional
+
+from django.core.cache import cache
+
+from core.models import Allergen
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "allergen_registry:version"
+CHECK_SEC = max(0.0, float(os.getenv("ALLERGEN_REGISTRY_CHECK_SEC", "5")))
+TTL_SEC = max(0.0, float(os.getenv("ALLERGEN_REGISTRY_TTL_SEC", "300")))
+_MAX_EXPLANATIONS = 4096
+
+
+class AllergenEntry(NamedTuple):
+    code: str
+    label_de: str
+    label_en: str
+    label_ar: str
+    kind: str
+
+
+def join_de(labels: Iterable[str]) -> str:
+    """"Enthält A." / "Enthält A und B." / "Enthält A, B und C." — فارغ إن لم توجد تسميات."""
+    labels = [str(x).strip() for x in labels if str(x or "").strip()]
+    if not labels:
+        return ""
+    if len(labels) == 1:
+        body = labels[0]
+    elif len(labels) == 2:
+        body = f"{labels[0]} und {labels[1]}"
+    else:
+        body = ", ".join(labels[:-1]) + f" und {labels[-1]}"
+    return f"Enthält {body}."
+
+
+class AllergenRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Optional[Dict[str, AllergenEntry]] = None
+        self._version = None
+        self._loaded_at = 0.0
+        self._checked_at = 0.0
+        self._explanations: Dict[frozenset, str] = {}
+
+    # ---- loading / invalidation ----
+    def _shared_version(self):
+        try:
+            return cache.get(VERSION_KEY, 0)
+        except Exception:
+            return self._version
+
+    def _current(self) -> Dict[str, AllergenEntry]:
+        now = time.monotonic()
+        entries = self._entries
+        if entries is not None and now - self._checked_at < CHECK_SEC and now - self._loaded_at < TTL_SEC:
+            return entries
+        with self._lock:
+            version = self._shared_version()
+            if self._entries is None or version != self._version or now - self._loaded_at >= TTL_SEC:
+                rows = Allergen.objects.values_list("code", "label_de", "label_en", "label_ar", "kind")
+                self._entries = {
+                    code: AllergenEntry(code, label_de or "", label_en or "", label_ar or "", kind)
+                    for code, label_de, label_en, label_ar, kind in rows
+                    if code
+                }
+                self._explanations = {}
+                self._version = version
+                self._loaded_at = now
+            self._checked_at = now
+            return self._entries
+
+    def invalidate(self, *, broadcast: bool = True) -> None:
+        """تُسقط نسخة هذه العملية؛ broadcast يرفع النسخة المشتركة لبقية العمليات."""
+        with self._lock:
+            self._entries = None
+            self._explanations = {}
+        if not broadcast:
+            return
+        try:
+            try:
+                cache.incr(VERSION_KEY)
+            except ValueError:
+                cache.set(VERSION_KEY, 1, None)
+        except Exception:
+            logger.exception("allergen registry: could not bump the shared version")
+
+    # ---- lookups ----
+    def get(self, code: str) -> Optional[AllergenEntry]:
+        return self._current().get(code)
+
+    def labels(self, lang: str = "de", kind: Optional[str] = None) -> Dict[str, str]:
+        """code → label (فارغة تُستبعد)؛ kind اختياري (Allergen.Kind)."""
+        field = f"label_{lang}"
+        return {
+            e.code: getattr(e, field)
+            for e in self._current().values()
+            if getattr(e, field) and (kind is None or e.kind == kind)
+        }
+
+    def explanation_de(self, codes: Iterable[str]) -> str:
+        key = frozenset(c for c in codes if c)
+        if not key:
+            return ""
+        entries = self._current()
+        explanations = self._explanations
+        text = explanations.get(key)
+        if text is None:
+            text = join_de(entries[c].label_de for c in sorted(key) if c in entries)
+            if len(explanations) >= _MAX_EXPLANATIONS:
+                explanations.clear()
+            explanations[key] = text
+        return text
+
+
+registry = AllergenRegistry()
@@ -21,6 +21,8 @@ from django.conf import settings
 
 from core.models import Dish, Ingredient, Allergen, DishAllergen  # ⬅️ جديد: كتابة سجلات تتبّع
 from core.dictionary_models import KeywordLexeme  # النموذج الصحيح (dictionary_models.py)
+from core.services.allergen_registry import registry as allergen_registry
+from core.services.public_menu import batched_rebuilds
 
 # -----------------------
 # تنسيق/تطبيع نص قوي
@@ -169,21 +171,7 @@ def _build_de_explanation(letter_codes: Set[str]) -> str:
     if not letter_codes:
         return ""
     try:
-        labels = list(
-            Allergen.objects.filter(code__in=letter_codes)
-            .order_by("code")
-            .values_list("label_de", flat=True)
-        )
-        labels = [str(x).strip() for x in labels if str(x).strip()]
-        if not labels:
-            return ""
-        if len(labels) == 1:
-            body = labels[0]
-        elif len(labels) == 2:
-            body = f"{labels[0]} und {labels[1]}"
-        else:
-            body = ", ".join(labels[:-1]) + f" und {labels[-1]}"
-        return f"Enthält {body}."
+        return allergen_registry.explanation_de(letter_codes)
     except Exception:
         return ""
 
@@ -401,6 +389,24 @@ def generate_for_dishes(
     dry_run: bool = True,
     include_details: bool = False,
     extra_owner_ids: Iterable[int] | None = None,
+) -> Dict:
+    kwargs = dict(owner_id=owner_id, lang=lang, force=force, dry_run=dry_run,
+                  include_details=include_details, extra_owner_ids=extra_owner_ids)
+    if dry_run:
+        return _generate_for_dishes(dishes, **kwargs)
+    # الكتابة طبقًا طبقًا: signals اللقطات العامة تسجّل فقط، وتُجدول إعادة بناء واحدة لكل قائمة متأثرة
+    with batched_rebuilds():
+        return _generate_for_dishes(dishes, **kwargs)
+
+
+def _generate_for_dishes(
+    dishes: Iterable[Dish],
+    owner_id: int | None,
+    lang: str,
+    force: bool,
+    dry_run: bool,
+    include_details: bool,
+    extra_owner_ids: Iterable[int] | None,
 ) -> Dict:
     lexemes = _resolve_lexemes(owner_id=owner_id, lang=lang, extra_owner_ids=extra_owner_ids)
 
@@ -0,0 +1,81 @@
+# core/services/auto_regen.py
+# -----------------------------------------------------------
+# إعادة توليد الأكواد تلقائيًا بعد تعديل الطبق (اختياري: AUTO_REGEN_ON_EDIT=1)
+#   - DishSerializer.update يستدعي queue_dish_regen() عند تغيّر الاسم/الوصف/المكوّنات
+#   - بعد commit فقط، ولا ينتظر الطلب شيئًا: مهمة "dish_auto_regen" عبر job_manager
+#   - تعديلات نفس المالك خلال AUTO_REGEN_DEBOUNCE_SEC تُدمج في مهمة واحدة
+#     (spawn_coalesced)، وتبدأ بعد AUTO_REGEN_MAX_DELAY_SEC على الأكثر من أول تعديل
+#   - محرك القواعد فقط (dry_run=False)؛ الأطباق اليدوية (codes_source=manual) لا تُلمس
+# -----------------------------------------------------------
+from __future__ import annotations
+
+import logging
+import os
+from typing import Dict, Iterable, List
+
+from django.db import transaction
+
+from core.models import Dish
+from core.services.allergen_rules import generate_for_dishes
+from core.utils.jobs import JobState, job_manager
+
+logger = logging.getLogger("core.jobs")
+
+AUTO_REGEN_ON_EDIT = os.getenv("AUTO_REGEN_ON_EDIT", "0").strip() not in {"", "0", "false", "False", "no"}
+AUTO_REGEN_DEBOUNCE_SEC = max(0.0, float(os.getenv("AUTO_REGEN_DEBOUNCE_SEC", "5")))
+AUTO_REGEN_MAX_DELAY_SEC = max(0.0, float(os.getenv("AUTO_REGEN_MAX_DELAY_SEC", "60")))
+
+# الحقول التي تغيّر ناتج القواعد (النص المطابَق + المكوّنات)
+REGEN_FIELDS = ("name", "description")
+
+
+def dish_needs_regen(dish: Dish, validated_data: Dict, ingredients=None) -> bool:
+    """هل يغيّر هذا التعديل مدخلات محرك القواعد؟ (يُستدعى قبل حفظ التعديل)"""
+    for name in REGEN_FIELDS:
+        if name in validated_data and (validated_data[name] or "") != (getattr(dish, name) or ""):
+            return True
+    if ingredients is not None:
+        before = set(dish.ingredients.values_list("id", flat=True))
+        if {getattr(i, "pk", i) for i in ingredients} != before:
+            return True
+    return False
+
+
+def queue_dish_regen(dish: Dish) -> None:
+    """يجدول إعادة التوليد بعد commit؛ أي خطأ هنا يُسجَّل ولا يكسر حفظ الطبق."""
+    owner_id = dish.section.menu.user_id
+
+    def _enqueue():
+        try:
+            job_manager.spawn_coalesced(
+                run_dish_auto_regen,
+                [dish.pk],
+                owner=str(owner_id),
+                delay=AUTO_REGEN_DEBOUNCE_SEC,
+                max_delay=AUTO_REGEN_MAX_DELAY_SEC,
+                owner_id=owner_id,
+            )
+        except Exception:
+            logger.exception("auto regen: could not queue dish %s", dish.pk)
+
+    transaction.on_commit(_enqueue)
+
+
+def run_dish_auto_regen(job: JobState, dish_ids: Iterable[int], owner_id: int) -> Dict:
+    """Job target (JOB_TASKS "dish_auto_regen"): rules in write mode for the coalesced dishes."""
+    ids: List[int] = [int(x) for x in dish_ids]
+    dishes = list(
+        Dish.objects.select_related("section__menu")
+        .filter(id__in=ids, section__menu__user_id=owner_id)
+        .order_by("id")
+    )
+    job_manager.update(job.id, total=len(dishes), completed=0, message="rules")
+    res = generate_for_dishes(dishes, owner_id=owner_id, dry_run=False)
+    job_manager.update(job.id, completed=len(dishes), message="done")
+    return {
+        "dish_ids": [d.id for d in dishes],
+        "processed": res.get("processed", 0),
+        "changed": res.get("changed", 0),
+        "skipped": res.get("skipped", 0),
+        "missing_after_rules": res.get("missing_after_rules", 0),
+    }
@@ -7,13 +7,20 @@
 
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import Callable, Dict, Iterable, List, Tuple
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+import asyncio
+import hashlib
 import json
+import os
 import re
 
+from core.llm_clients.limiter import CircuitOpenError, LLMCancelled, cancel_scope
+
 # نوع الدالة التي تستدعي نموذج OpenAI (نمررها من الخارج)
 LLMCaller = Callable[..., str]
+# النسخة async (مثل core/llm_clients/openai_client.async_openai_caller)
+AsyncLLMCaller = Callable[..., Awaitable[str]]
 
 
 # ------------------------------------------------------------
@@ -28,6 +35,10 @@ class LLMConfig:
     dry_run: bool = True
     max_output_tokens: int = 512
     timeout: int = 60
+    # "full" = التعليمات + few-shot + خريطة الأكواد؛ "compact" = نسخة مختصرة (env LLM_PROMPT_STYLE)
+    prompt_style: str = field(default_factory=lambda: os.getenv("LLM_PROMPT_STYLE", "full").strip().lower())
+    # code → label من جدول Allergen (للنسخة compact: تسميات فقط، الحروف تبقى DEFAULT_ALLERGEN_LABELS)
+    allergen_labels: Optional[Dict[str, str]] = None
 
 
 # ------------------------------------------------------------
@@ -55,6 +66,14 @@ def normalize_de(s: str) -> str:
     x = x.replace("œ", "oe").replace("æ", "ae")
     return x
 
+def dish_fingerprint(name: str, description: str = "") -> str:
+    """
+    بصمة ثابتة للطبق (الاسم + الوصف بعد normalize_de).
+    أطباق السلاسل/الفروع المتطابقة تعطي نفس البصمة → نداء LLM واحد لها.
+    """
+    key = normalize_de(name or "") + "\n" + normalize_de(description or "")
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
 def _dedup_keep_order(items: Iterable[str]) -> List[str]:
     seen, out = set(), []
     for it in items:
@@ -95,29 +114,15 @@ def _parse_json_object_or_array(txt: str):
 # ------------------------------------------------------------
 # LLM: Extract candidate terms
 # ------------------------------------------------------------
-def llm_extract_terms(
-    caller: LLMCaller,
-    cfg: LLMConfig,
-    dish_name: str,
-    dish_description: str,
-    *,
-    return_raw: bool = False,
-) -> Tuple[List[str], str] | List[str]:
-    """
-    يرجّع قائمة مصطلحات Zutaten (ألمانية) بطول لا يتجاوز cfg.max_terms.
-    إن فشل LLM نستخدم fallback محلي بسيط باستخراج كلمات وأسماء شائعة.
-    """
-    name = dish_name or ""
-    desc = dish_description or ""
-    lang = (cfg.lang or "de").lower()
-
-    # برومبت موجّه مع أمثلة قصيرة (few-shot) لزيادة الدقة.
-    prompt = f"""
+# البرومبت = بادئة ثابتة (تعليمات + أمثلة) ثم الجزء المتغيّر (الطبق/المصطلحات) في النهاية:
+# البادئة متطابقة حرفيًا بين كل النداءات → prompt caching لدى المزوّد يعيد استخدامها
+# (OpenAI: تلقائيًا ابتداءً من ~1024 token)، والجزء المتغيّر قصير.
+_EXTRACT_PREFIX_FULL = """
 You are a precise German culinary term extractor.
 Task: Given a dish name/description, return ONLY JSON array of distinct German ingredient-like terms (nouns/compounds). No translations, no explanations.
 
 Rules:
-- Output <= {cfg.max_terms} items, lowercased, concise single tokens if possible (compound allowed, e.g., "joghurtsose", "sesampaste", "doenerfleisch", "brioche-bun").
+- Lowercased, concise single tokens if possible (compound allowed, e.g., "joghurtsose", "sesampaste", "doenerfleisch", "brioche-bun").
 - Skip generic fillers that aren't ingredients (e.g., "gericht", "hausgemacht", "frisch", "lecker", "portion", "klassisch").
 - If ingredient is ambiguous ("sose", "salat"), keep it but prefer more specific forms if present ("joghurtsose", "mayonnaise", "senf", "kaese").
 - Return ONLY a JSON array (no code blocks).
@@ -131,8 +136,29 @@ OUTPUT: ["chicken","joghurtsose","sesam","wrap"]
 
 INPUT: "Falafel mit Tahini (Sesampaste), Salat, Tomaten"
 OUTPUT: ["falafel","tahini","sesampaste","salat","tomaten"]
+""".strip()
+
+_EXTRACT_PREFIX_COMPACT = """
+Extract distinct German ingredient terms from the dish. Lowercase nouns/compounds, no fillers (frisch, hausgemacht, portion), no translations.
+Example: "Chicken Wrap mit Joghurtsoße und Sesam" → ["chicken","joghurtsose","sesam","wrap"]
+""".strip()
+
+
+def _is_compact(cfg: Optional[LLMConfig]) -> bool:
+    return cfg is not None and (cfg.prompt_style or "").lower() == "compact"
+
+
+def extract_prompt_prefix(cfg: LLMConfig) -> str:
+    """البادئة الثابتة لبرومبت الاستخراج (لا تعتمد على الطبق)."""
+    return _EXTRACT_PREFIX_COMPACT if _is_compact(cfg) else _EXTRACT_PREFIX_FULL
+
+
+def _build_extract_prompt(cfg: LLMConfig, name: str, desc: str) -> str:
+    lang = (cfg.lang or "de").lower()
+    return f"""
+{extract_prompt_prefix(cfg)}
 
-Now extract for language={lang}:
+Now extract for language={lang}. Output <= {cfg.max_terms} items.
 
 NAME: {name}
 DESC: {desc}
@@ -140,22 +166,15 @@ DESC: {desc}
 Return ONLY JSON array:
 """.strip()
 
-    raw = ""
-    terms: List[str] = []
-    try:
-        raw = caller(
-            prompt,
-            model_name=cfg.model_name,
-            temperature=cfg.temperature,
-            max_tokens=min(cfg.max_output_tokens, 256),
-            timeout=cfg.timeout,
-        )
-        data = _parse_json_object_or_array(raw)
-        if isinstance(data, list):
-            terms = [normalize_de(str(x)) for x in data if isinstance(x, (str, int, float))]
-    except Exception:
-        terms = []
 
+def _parse_extract_response(raw: str) -> List[str]:
+    data = _parse_json_object_or_array(raw)
+    if isinstance(data, list):
+        return [normalize_de(str(x)) for x in data if isinstance(x, (str, int, float))]
+    return []
+
+
+def _finish_extract(cfg: LLMConfig, name: str, desc: str, terms: List[str]) -> List[str]:
     # Fallback محلي إذا فشل LLM أو النتيجة فارغة
     if not terms:
         text = normalize_de(f"{name} {desc}")
@@ -171,7 +190,76 @@ Return ONLY JSON array:
         terms = cand[: cfg.max_terms]
 
     # تمييز موحد
-    terms = _dedup_keep_order([t for t in terms if t])
+    return _dedup_keep_order([t for t in terms if t])
+
+
+def llm_extract_terms(
+    caller: LLMCaller,
+    cfg: LLMConfig,
+    dish_name: str,
+    dish_description: str,
+    *,
+    return_raw: bool = False,
+) -> Tuple[List[str], str] | List[str]:
+    """
+    يرجّع قائمة مصطلحات Zutaten (ألمانية) بطول لا يتجاوز cfg.max_terms.
+    إن فشل LLM نستخدم fallback محلي بسيط باستخراج كلمات وأسماء شائعة.
+    """
+    name = dish_name or ""
+    desc = dish_description or ""
+    prompt = _build_extract_prompt(cfg, name, desc)
+
+    raw = ""
+    terms: List[str] = []
+    try:
+        raw = caller(
+            prompt,
+            model_name=cfg.model_name,
+            temperature=cfg.temperature,
+            max_tokens=min(cfg.max_output_tokens, 256),
+            timeout=cfg.timeout,
+        )
+        terms = _parse_extract_response(raw)
+    except Exception:
+        terms = []
+
+    terms = _finish_extract(cfg, name, desc, terms)
+
+    if return_raw:
+        return terms, raw or ""
+    return terms
+
+
+async def allm_extract_terms(
+    caller: AsyncLLMCaller,
+    cfg: LLMConfig,
+    dish_name: str,
+    dish_description: str,
+    *,
+    return_raw: bool = False,
+) -> Tuple[List[str], str] | List[str]:
+    """نسخة async من llm_extract_terms (نفس البرومبت ونفس الـfallback)."""
+    name = dish_name or ""
+    desc = dish_description or ""
+    prompt = _build_extract_prompt(cfg, name, desc)
+
+    raw = ""
+    terms: List[str] = []
+    try:
+        raw = await caller(
+            prompt,
+            model_name=cfg.model_name,
+            temperature=cfg.temperature,
+            max_tokens=min(cfg.max_output_tokens, 256),
+            timeout=cfg.timeout,
+        )
+        terms = _parse_extract_response(raw)
+    except LLMCancelled:
+        raise
+    except Exception:
+        terms = []
+
+    terms = _finish_extract(cfg, name, desc, terms)
 
     if return_raw:
         return terms, raw or ""
@@ -307,22 +395,11 @@ def _heuristic_map(term: str) -> Tuple[str, float, str]:
 # ------------------------------------------------------------
 # LLM: map terms → codes (with heuristics + few-shot)
 # ------------------------------------------------------------
-def llm_map_terms_to_codes(
-    caller: LLMCaller,
-    cfg: LLMConfig,
-    terms: Iterable[str],
-    *,
-    lang: str = "de",
-) -> Dict[str, Dict[str, object]]:
-    """
-    يرجّع قاموسًا: term(lower) → {codes: 'A,G', confidence: float, reason: str}
-    - يبدأ بهيورستك قوية (قاموس/أنماط).
-    - يكمل بما تبقى عبر LLM مع few-shot.
-    """
+def _split_heuristic_terms(terms: Iterable[str]) -> Tuple[Dict[str, Dict[str, object]], List[str]]:
+    """يطبّق الهيورستك ويعيد (نتائج محسومة، مصطلحات متبقية للـLLM)."""
     out: Dict[str, Dict[str, object]] = {}
     terms_list = _dedup_keep_order([normalize_de(t) for t in terms if t])
 
-    # 1) هيورستك أولية
     remaining: List[str] = []
     for t in terms_list:
         codes, conf, why = _heuristic_map(t)
@@ -330,13 +407,21 @@ def llm_map_terms_to_codes(
             out[t] = {"codes": _clean_codes_str(codes), "confidence": round(float(conf), 3), "reason": why}
         else:
             remaining.append(t)
+    return out, remaining
 
-    if not remaining:
-        return out
 
-    # 2) LLM mapping (few-shot)
-    # نزوّده بخريطة الأكواد + أمثلة لقرارات مؤكدة/مرفوضة
-    allergen_map_hint = """
+# fallback عندما لا يُمرَّر جدول Allergen: نفس حروف خريطة النسخة full و HEURISTIC_LEXICON
+DEFAULT_ALLERGEN_LABELS: Dict[str, str] = {
+    "A": "Gluten", "B": "Krebstiere", "C": "Eier", "D": "Fisch", "E": "Erdnüsse", "F": "Soja",
+    "G": "Milch/Laktose", "H": "Schalenfrüchte", "J": "Senf", "K": "Sesam", "L": "Sellerie", "N": "Lupine",
+}
+
+_MAP_PREFIX_FULL = """
+You are an expert allergen labeler for German menus.
+Map each term to EU-style allergen LETTER codes used by this system (A..Z subset), using the hint map below.
+Return ONLY JSON object: keys = terms (lowercased), values = {"codes": "A,C", "confidence": 0.0..1.0, "reason": "short"}
+
+Allergen hint:
 A = glutenhaltiges Getreide (Weizen, Dinkel, Roggen, Gerste, Mehl, Teig, Brot, Panier, Nudeln, Pasta, Couscous, Bulgur)
 B = Krebstiere (Garnelen, Shrimps, Krabben, Hummer, Scampi)
 C = Eier (Ei, Eier, Mayonnaise, Mayo, Remoulade, Aioli, Baiser/Meringue)
@@ -349,9 +434,7 @@ J = Senf (Senf, Dijon)
 K = Sesam (Sesam, Tahini, Sesampaste)
 L = Sellerie (Sellerie)
 N = Lupine (Lupine, Lupinenmehl)
-""".strip()
 
-    examples = """
 Examples (decide codes; if uncertain, return empty codes with low confidence):
 - "joghurtsose" → G (dairy sauce) conf≈0.9
 - "mayonnaise" → C (egg-based) conf≈0.9
@@ -369,17 +452,6 @@ Examples (decide codes; if uncertain, return empty codes with low confidence):
 - "nougat" → H conf≈0.8
 - "salat" → (empty) conf≈0.0 (not an allergen per se)
 - "dönerfleisch" → (empty) conf≈0.0 (no inherent allergen)
-""".strip()
-
-    prompt = f"""
-You are an expert allergen labeler for German menus.
-Map each term to EU-style allergen LETTER codes used by this system (A..Z subset), using the hint map below.
-Return ONLY JSON object: keys = terms (lowercased), values = {{"codes": "A,C", "confidence": 0.0..1.0, "reason": "short"}}
-
-Allergen hint:
-{allergen_map_hint}
-
-{examples}
 
 Rules:
 - Use letters only, comma-separated (no spaces). Example: "A,G" or "" for none.
@@ -387,6 +459,43 @@ Rules:
 - Be conservative: Only assign a code if the term strongly implies that allergen.
 - Confidence: 0.7–0.95 when strong; 0.3–0.6 when plausible but not guaranteed; 0 for none.
 - Reason must be short ("dairy", "egg-based", "sesame", "gluten cereal", "tree nuts", ...).
+""".strip()
+
+
+def _label_key(label: str) -> str:
+    """'Milch/Laktose' / 'Lupinen' / 'Glutenhaltiges Getreide' → 'milch' / 'lupin' / 'glute' (مطابقة تسميات)."""
+    words = normalize_de(str(label or "")).replace("/", " ").split()
+    return words[0][:5] if words else ""
+
+
+def _compact_allergen_hint(labels: Optional[Dict[str, str]]) -> str:
+    """
+    'A=Gluten; B=Krebstiere; …' بحروف DEFAULT_ALLERGEN_LABELS — نفس حروف البرومبت الكامل
+    والـheuristics والبرومبت المجمّع — مرتّبة حسب الكود حتى تبقى البادئة ثابتة.
+    تسميات جدول Allergen تحلّ محل التسمية الافتراضية لنفس الحساسية فقط؛ حروف الجدول لا تُعرض
+    (بذور الجدول تستعمل I=Sellerie / M=Lupinen، فعرضها يجعل نفس الحرف يعني حساسية أخرى).
+    """
+    by_key = {_label_key(label): label for label in (labels or {}).values() if label}
+    return "; ".join(
+        f"{code}={by_key.get(_label_key(default), default)}"
+        for code, default in sorted(DEFAULT_ALLERGEN_LABELS.items())
+    )
+
+
+def map_prompt_prefix(cfg: Optional[LLMConfig] = None) -> str:
+    """البادئة الثابتة لبرومبت term → codes (compact: تسميات جدول Allergen بدل النص الثابت)."""
+    if not _is_compact(cfg):
+        return _MAP_PREFIX_FULL
+    return f"""
+Map each German food term to allergen letter codes: {_compact_allergen_hint(cfg.allergen_labels)}.
+Conservative: only strongly implied codes; generic terms (salat, zwiebeln, fleisch) → "".
+Return ONLY JSON object: {{"term": {{"codes": "A,G", "confidence": 0..1, "reason": "short"}}}}
+""".strip()
+
+
+def _build_map_prompt(remaining: List[str], lang: str, cfg: Optional[LLMConfig] = None) -> str:
+    return f"""
+{map_prompt_prefix(cfg)}
 
 Terms (language={lang}):
 {json.dumps(remaining, ensure_ascii=False)}
@@ -394,6 +503,50 @@ Terms (language={lang}):
 Return ONLY JSON object:
 """.strip()
 
+
+def _apply_map_response(out: Dict[str, Dict[str, object]], remaining: List[str], raw: str) -> None:
+    data = _parse_json_object_or_array(raw)
+    if isinstance(data, dict):
+        for k, v in data.items():
+            term = normalize_de(k)
+            if term not in remaining:
+                continue
+            codes = ""
+            conf = 0.0
+            reason = ""
+            if isinstance(v, dict):
+                codes = _clean_codes_str(v.get("codes", ""))
+                try:
+                    conf = float(v.get("confidence", 0.0))
+                except Exception:
+                    conf = 0.0
+                reason = str(v.get("reason", "") or "")
+            out[term] = {"codes": codes, "confidence": round(conf, 3), "reason": reason or "llm"}
+    else:
+        # لو رجع شيء غير متوقع، لا نكسر التنفيذ
+        for term in remaining:
+            out.setdefault(term, {"codes": "", "confidence": 0.0, "reason": "llm_unparsed"})
+
+
+def llm_map_terms_to_codes(
+    caller: LLMCaller,
+    cfg: LLMConfig,
+    terms: Iterable[str],
+    *,
+    lang: str = "de",
+) -> Dict[str, Dict[str, object]]:
+    """
+    يرجّع قاموسًا: term(lower) → {codes: 'A,G', confidence: float, reason: str}
+    - يبدأ بهيورستك قوية (قاموس/أنماط).
+    - يكمل بما تبقى عبر LLM مع few-shot.
+    """
+    # 1) هيورستك أولية
+    out, remaining = _split_heuristic_terms(terms)
+    if not remaining:
+        return out
+
+    # 2) LLM mapping (few-shot)
+    prompt = _build_map_prompt(remaining, lang, cfg)
     try:
         raw = caller(
             prompt,
@@ -402,27 +555,11 @@ Return ONLY JSON object:
             max_tokens=min(cfg.max_output_tokens, 512),
             timeout=cfg.timeout,
         )
-        data = _parse_json_object_or_array(raw)
-        if isinstance(data, dict):
-            for k, v in data.items():
-                term = normalize_de(k)
-                if term not in remaining:
-                    continue
-                codes = ""
-                conf = 0.0
-                reason = ""
-                if isinstance(v, dict):
-                    codes = _clean_codes_str(v.get("codes", ""))
-                    try:
-                        conf = float(v.get("confidence", 0.0))
-                    except Exception:
-                        conf = 0.0
-                    reason = str(v.get("reason", "") or "")
-                out[term] = {"codes": codes, "confidence": round(conf, 3), "reason": reason or "llm"}
-        else:
-            # لو رجع شيء غير متوقع، لا نكسر التنفيذ
-            for term in remaining:
-                out.setdefault(term, {"codes": "", "confidence": 0.0, "reason": "llm_unparsed"})
+        _apply_map_response(out, remaining, raw)
+    except CircuitOpenError:
+        # المزوّد معطّل (breaker مفتوح): نكتفي بنتيجة الهيورستك
+        for term in remaining:
+            out.setdefault(term, {"codes": "", "confidence": 0.0, "reason": "llm_unavailable"})
     except Exception:
         # في حال فشل نعيد الباقي كـ unknown
         for term in remaining:
@@ -431,13 +568,143 @@ Return ONLY JSON object:
     return out
 
 
+async def allm_map_terms_to_codes(
+    caller: AsyncLLMCaller,
+    cfg: LLMConfig,
+    terms: Iterable[str],
+    *,
+    lang: str = "de",
+) -> Dict[str, Dict[str, object]]:
+    """نسخة async من llm_map_terms_to_codes (الهيورستك أولًا ثم LLM للباقي)."""
+    out, remaining = _split_heuristic_terms(terms)
+    if not remaining:
+        return out
+
+    prompt = _build_map_prompt(remaining, lang, cfg)
+    try:
+        raw = await caller(
+            prompt,
+            model_name=cfg.model_name,
+            temperature=cfg.temperature,
+            max_tokens=min(cfg.max_output_tokens, 512),
+            timeout=cfg.timeout,
+        )
+        _apply_map_response(out, remaining, raw)
+    except LLMCancelled:
+        raise
+    except CircuitOpenError:
+        for term in remaining:
+            out.setdefault(term, {"codes": "", "confidence": 0.0, "reason": "llm_unavailable"})
+    except Exception:
+        for term in remaining:
+            out.setdefault(term, {"codes": "", "confidence": 0.0, "reason": "llm_error"})
+
+    return out
+
+
+# ------------------------------------------------------------
+# Async batch: extract (+ map) لعدة أطباق بالتوازي على خيط واحد
+# ------------------------------------------------------------
+@dataclass
+class DishLLMResult:
+    key: object
+    terms: List[str]
+    raw: str = ""
+    codes_lookup: Dict[str, Dict[str, object]] | None = None
+    error: str = ""
+
+
+async def allm_process_dishes(
+    caller: AsyncLLMCaller,
+    cfg: LLMConfig,
+    dishes: Iterable[Tuple[object, str, str]],
+    *,
+    guess_codes: bool = True,
+    return_raw: bool = False,
+    should_cancel: Optional[Callable[[], bool]] = None,
+    on_result: Optional[Callable[[DishLLMResult], None]] = None,
+    max_in_flight: Optional[int] = None,
+) -> List[DishLLMResult]:
+    """
+    يشغّل extract (+ map اختياريًا) لكل (key, name, description) بشكل متزامن.
+    - التوازي الفعلي يضبطه المُحدِّد (AsyncRateLimiter) داخل caller.
+    - should_cancel: يُفحص قبل بدء كل طبق، وبعد حجز المُحدِّد لمقعد/ميزانية النداء (cancel_scope)،
+      وبين extract و map؛ الأطباق التي لم تكتمل عند الإلغاء تُتجاهل ولا تكلّف نداءات LLM إضافية.
+    - on_result: يُستدعى فور انتهاء كل طبق (لتحديث التقدّم).
+    - max_in_flight: سقف إضافي للأطباق الجارية معًا (مهام bulk تترك للمهام التفاعلية حصة من الحدود).
+    يعيد النتائج بترتيب الإدخال (بدون الأطباق الملغاة).
+    """
+    def _cancelled() -> bool:
+        return should_cancel is not None and bool(should_cancel())
+
+    async def _one(key, name, desc) -> Optional[DishLLMResult]:
+        if _cancelled():
+            return None
+        try:
+            if return_raw:
+                terms, raw = await allm_extract_terms(caller, cfg, name, desc, return_raw=True)  # type: ignore[misc]
+            else:
+                terms = await allm_extract_terms(caller, cfg, name, desc)  # type: ignore[assignment]
+                raw = ""
+        except LLMCancelled:
+            return None
+        except Exception as e:
+            res = DishLLMResult(key=key, terms=[], error=str(e))
+        else:
+            if _cancelled():
+                return None
+            codes_lookup: Dict[str, Dict[str, object]] = {}
+            if guess_codes and terms:
+                try:
+                    codes_lookup = await allm_map_terms_to_codes(caller, cfg, terms, lang=cfg.lang)
+                except LLMCancelled:
+                    return None
+                except Exception:
+                    codes_lookup = {}
+            res = DishLLMResult(key=key, terms=list(terms), raw=raw or "", codes_lookup=codes_lookup)
+        if on_result is not None:
+            on_result(res)
+        return res
+
+    gate = asyncio.Semaphore(max_in_flight) if max_in_flight else None
+
+    async def _gated(key, name, desc) -> Optional[DishLLMResult]:
+        if gate is None:
+            return await _one(key, name, desc)
+        async with gate:
+            return await _one(key, name, desc)
+
+    # المهام تنسخ السياق عند إنشائها → كل نداء داخلها يرى should_cancel
+    with cancel_scope(should_cancel):
+        results = await asyncio.gather(*[_gated(k, n or "", d or "") for (k, n, d) in dishes])
+    return [r for r in results if r is not None]
+
+
 # ------------------------------------------------------------
 # (اختياري) LLM مباشر لإرجاع الأكواد من الاسم/الوصف
 # ------------------------------------------------------------
+def heuristic_dish_codes(name: str, description: str = "") -> str:
+    """أكواد من الهيورستك فقط (بدون LLM) لكل كلمات الاسم+الوصف؛ fallback عند تعطل المزوّد."""
+    words = _WORD_RE.findall(normalize_de(f"{name or ''} {description or ''}"))
+    resolved, _ = _split_heuristic_terms(words)
+    codes = set()
+    for v in resolved.values():
+        codes.update(c for c in str(v.get("codes", "")).split(",") if c)
+    return ",".join(sorted(codes))
+
+
+# نسخ البرومبتات: تدخل في مفاتيح كاش الردود وبصمة IngredientSuggestion.prompt_hash (core.views) —
+# ارفعها عند تغيير نص البرومبت أو تحليل الرد حتى لا تُعاد ردود البرومبت القديم
+DIRECT_CODES_PROMPT_VERSION = "direct-v1"
+PACKED_CODES_PROMPT_VERSION = "packed-v1"
+TERMS_PROMPT_VERSION = "terms-v1"  # allm/llm_extract_terms + map_terms_to_codes (full/compact)
+
+
 def llm_map_dish_to_codes(caller: LLMCaller, cfg: LLMConfig, name: str, description: str) -> Dict[str, str]:
     """
     يطلب من LLM إرجاع الأكواد مباشرة من الاسم+الوصف.
     يعيد: {"codes": "A,C,G", "raw": "..."} — حيث codes قد تكون فارغة إن لم يجد ما يكفي من قرائن.
+    عند فتح الـcircuit breaker: {"codes": <heuristic>, "raw": "", "fallback": "heuristic"}.
     """
     text = (name or "").strip()
     if description:
@@ -456,13 +723,17 @@ codes: A,C,G
 Falls nichts sicher: gib "codes: "
 """.strip()
 
-    raw = caller(
-        prompt,
-        model_name=cfg.model_name,
-        temperature=cfg.temperature,
-        max_tokens=min(128, cfg.max_output_tokens),
-        timeout=cfg.timeout,
-    )
+    try:
+        raw = caller(
+            prompt,
+            model_name=cfg.model_name,
+            temperature=cfg.temperature,
+            max_tokens=min(128, cfg.max_output_tokens),
+            timeout=cfg.timeout,
+        )
+    except CircuitOpenError:
+        # breaker مفتوح: لا ننتظر المزوّد، نرجع لأكواد الهيورستك
+        return {"codes": heuristic_dish_codes(name, description), "raw": "", "fallback": "heuristic"}
 
     # التقاط "codes: A,C,G"
     codes = ""
@@ -475,3 +746,82 @@ Falls nichts sicher: gib "codes: "
         codes = ",".join(sorted(set(tokens)))
 
     return {"codes": codes or "", "raw": (raw or "").strip()}
+
+
+# ------------------------------------------------------------
+# LLM direct (batch): several dishes packed into one prompt
+# ------------------------------------------------------------
+_PACKED_LINE_RE = re.compile(r"^[ \t]*\[?(\d+)\]?[ \t]*[:.)\-]?[ \t]*codes:[ \t]*(.*)$", re.IGNORECASE | re.MULTILINE)
+
+
+def _build_packed_codes_prompt(dishes: List[Tuple[str, str]]) -> str:
+    blocks = []
+    for i, (name, description) in enumerate(dishes, start=1):
+        block = f"[{i}] {(name or '').strip()}"
+        if description:
+            block += f"\n    Beschreibung: {description.strip()}"
+        blocks.append(block)
+    return f"""
+Du bist ein präziser Allergen-Klassifizierer für deutsche Speisekarten.
+Bestimme für jedes nummerierte Gericht die Allergen-BUCHSTABEN (A..R) als CSV ohne Leerzeichen.
+Sei konservativ: Nur Codes, die stark impliziert sind. Keine Erklärungen.
+
+Gerichte:
+{chr(10).join(blocks)}
+
+Antwort-Format GENAU (eine Zeile pro Gericht, gleiche Nummern, nichts sonst):
+1: codes: A,C,G
+2: codes:
+""".strip()
+
+
+def _parse_packed_codes(raw: str, count: int) -> Dict[int, str]:
+    """'3: codes: A,G' → {2: 'A,G'} (0-based); Nummern außerhalb 1..count werden ignoriert."""
+    out: Dict[int, str] = {}
+    for m in _PACKED_LINE_RE.finditer(raw or ""):
+        idx = int(m.group(1)) - 1
+        if 0 <= idx < count and idx not in out:
+            letters = re.findall(r"\b[A-R]\b", m.group(2).upper())
+            out[idx] = ",".join(_dedup_keep_order(letters))
+    return out
+
+
+def llm_map_dishes_to_codes(
+    caller: LLMCaller,
+    cfg: LLMConfig,
+    dishes: List[Tuple[str, str]],
+) -> List[Dict[str, str]]:
+    """
+    مثل llm_map_dish_to_codes لكن لعدة أطباق في برومبت واحد.
+    يعيد قائمة بنفس ترتيب dishes: {"codes": "A,G", "raw": "..."}.
+    - طبق غاب عن رد النموذج يُعاد طلبه منفردًا (llm_map_dish_to_codes).
+    - breaker مفتوح: أكواد الهيورستك لكل طبق (fallback = "heuristic").
+    """
+    if not dishes:
+        return []
+    if len(dishes) == 1:
+        return [llm_map_dish_to_codes(caller, cfg, dishes[0][0], dishes[0][1])]
+
+    prompt = _build_packed_codes_prompt(dishes)
+    try:
+        raw = caller(
+            prompt,
+            model_name=cfg.model_name,
+            temperature=cfg.temperature,
+            max_tokens=min(cfg.max_output_tokens, 32 + 16 * len(dishes)),
+            timeout=cfg.timeout,
+        )
+    except CircuitOpenError:
+        return [
+            {"codes": heuristic_dish_codes(name, desc), "raw": "", "fallback": "heuristic"}
+            for name, desc in dishes
+        ]
+
+    parsed = _parse_packed_codes(raw, len(dishes))
+    results: List[Dict[str, str]] = []
+    for i, (name, desc) in enumerate(dishes):
+        if i in parsed:
+            results.append({"codes": parsed[i], "raw": (raw or "").strip()})
+        else:
+            results.append(llm_map_dish_to_codes(caller, cfg, name, desc))
+    return results
@@ -0,0 +1,231 @@
+# core/services/public_menu.py
+# -----------------------------------------------------------
+# لقطات (snapshots) جاهزة للقائمة العامة: GET /api/public/menus/<slug>/
+#   - JSON الكامل (PublicMenuSerializer) يُبنى مرة لكل قائمة منشورة ويُحفظ في
+#     PUBLIC_MENU_SNAPSHOT_DIR/<slug>.json (داخل media: مشترك بين gunicorn و job_worker)
+#   - الطلب يكلّف stat() واحدًا + كاش محلي بمفتاح mtime الملف → بلا استعلامات مهما كبرت القائمة
+#   - MenuPublishView يبني اللقطة؛ إلغاء النشر/حذف القائمة يزيلها
+#   - التعديلات (signals) تُجدول مهمة "public_menu_snapshot" مدموجة ومؤجّلة
+#     PUBLIC_MENU_SNAPSHOT_DEBOUNCE_SEC → الضيف قد يرى النسخة السابقة خلال هذه المهلة
+#   - لقطة مفقودة (قائمة نُشرت قبل هذه الميزة) تُبنى عند أول طلب
+#   - نسخة اللقطة: ETag = هاش محتواها، Last-Modified = mtime الملف → 304 قبل أي عمل
+#   - الكتابات الجماعية (generate_for_dishes) داخل batched_rebuilds(): الـsignals تسجّل فقط،
+#     وعند الخروج استعلام واحد + إعادة بناء واحدة لكل قائمة منشورة متأثرة
+# الروابط المطلقة تعتمد على host الطلب: اللقطة تحفظ ORIGIN_MARKER مكانه و render_snapshot
+# يستبدله بأصل الطلب الحالي.
+# -----------------------------------------------------------
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Prefetch, Q
+from rest_framework.renderers import JSONRenderer
+
+from core.models import Dish, Menu, Section
+from core.services.allergen_registry import registry as allergen_registry
+from core.utils.jobs import JobState, job_manager
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = os.getenv("PUBLIC_MENU_SNAPSHOT_DIR") or os.path.join(settings.MEDIA_ROOT, "_snapshots", "menus")
+SNAPSHOT_DEBOUNCE_SEC = max(0.0, float(os.getenv("PUBLIC_MENU_SNAPSHOT_DEBOUNCE_SEC", "2")))
+
+# NUL لا يمكن أن يأتي من المستخدم (DRF يرفضه و Postgres لا يخزّنه)
+ORIGIN_MARKER = "\x00origin\x00"
+_MARKER_JSON = json.dumps(ORIGIN_MARKER)[1:-1].encode()
+_CACHE_PREFIX = "public_menu_snapshot:"
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    body: bytes
+    etag: str       # weak: nginx gzip يغيّر البايتات لا المعنى
+    mtime_ns: int   # mtime الملف: مفتاح صلاحية الكاش المحلي
+
+    @property
+    def last_modified(self) -> int:
+        return self.mtime_ns // 1_000_000_000
+
+
+def _snapshot(body: bytes, mtime_ns: int) -> Snapshot:
+    return Snapshot(body=body, etag='W/"%s"' % hashlib.sha1(body).hexdigest()[:20], mtime_ns=mtime_ns)
+
+
+class _SnapshotRequest:
+    """بديل request وقت البناء: build_absolute_uri يضع ORIGIN_MARKER بدل scheme://host."""
+
+    def build_absolute_uri(self, location: Optional[str] = None) -> str:
+        location = location or "/"
+        if location.startswith(ORIGIN_MARKER) or "://" in location:
+            return location
+        return ORIGIN_MARKER + ("" if location.startswith("/") else "/") + location
+
+
+def public_menu_queryset():
+    dishes_qs = (
+        Dish.objects
+        .select_related("section__menu__user__profile")
+        .prefetch_related("prices", "allergen_rows__allergen")
+        .order_by("sort_order", "id")
+    )
+    sections_qs = Section.objects.order_by("sort_order", "id")
+    return Menu.objects.filter(is_published=True).prefetch_related(
+        Prefetch("sections", queryset=sections_qs),
+        Prefetch("sections__dishes", queryset=dishes_qs),
+    )
+
+
+def snapshot_path(slug: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, f"{slug}.json")
+
+
+def remove_snapshot(slug: Optional[str]) -> None:
+    if not slug:
+        return
+    try:
+        os.remove(snapshot_path(slug))
+    except FileNotFoundError:
+        pass
+    cache.delete(_CACHE_PREFIX + slug)
+
+
+def build_snapshot(menu_id: int) -> Optional[Snapshot]:
+    """يبني لقطة القائمة ويكتبها ذرّيًا؛ قائمة غير منشورة → تُزال لقطتها ويُعاد None."""
+    from core.serializers import PublicMenuSerializer  # local import to avoid cycles
+
+    menu = public_menu_queryset().select_related("display_settings").filter(pk=menu_id).first()
+    if menu is None or not menu.public_slug:
+        slug = Menu.objects.filter(pk=menu_id).values_list("public_slug", flat=True).first()
+        remove_snapshot(slug)
+        return None
+
+    data = PublicMenuSerializer(menu, context={"request": _SnapshotRequest()}).data
+    body = JSONRenderer().render(data)
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=SNAPSHOT_DIR, prefix=f".{menu.public_slug}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(body)
+        os.replace(tmp, snapshot_path(menu.public_slug))
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    snap = _snapshot(body, os.stat(snapshot_path(menu.public_slug)).st_mtime_ns)
+    cache.set(_CACHE_PREFIX + menu.public_slug, snap, None)
+    return snap
+
+
+def load_snapshot(slug: str) -> Optional[Snapshot]:
+    """اللقطة من الكاش المحلي إن طابق mtime الملف، وإلا من القرص (قد تكون بنتها عملية أخرى)."""
+    try:
+        mtime = os.stat(snapshot_path(slug)).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    key = _CACHE_PREFIX + slug
+    cached = cache.get(key)
+    if cached is not None and cached.mtime_ns == mtime:
+        return cached
+    try:
+        with open(snapshot_path(slug), "rb") as fh:
+            body = fh.read()
+    except FileNotFoundError:
+        return None
+    snap = _snapshot(body, mtime)
+    cache.set(key, snap, None)
+    return snap
+
+
+def render_snapshot(body: bytes, request) -> bytes:
+    if _MARKER_JSON not in body:
+        return body
+    origin = request.build_absolute_uri("/").rstrip("/")
+    return body.replace(_MARKER_JSON, json.dumps(origin)[1:-1].encode())
+
+
+def rebuild_public_snapshots(job: JobState, menu_ids: Iterable[int]) -> Dict:
+    """Job target (JOB_TASKS "public_menu_snapshot")."""
+    ids = sorted({int(x) for x in menu_ids})
+    # سجلّ Allergen في هذه العملية (job_worker) قد يتأخر حتى TTL عن تعديل تسمية → نقرأه من جديد
+    allergen_registry.invalidate(broadcast=False)
+    job_manager.update(job.id, total=len(ids), completed=0, message="snapshots")
+    built = 0
+    for i, menu_id in enumerate(ids, start=1):
+        if build_snapshot(menu_id) is not None:
+            built += 1
+        job_manager.update(job.id, completed=i)
+    return {"menus": len(ids), "built": built, "removed": len(ids) - built}
+
+
+def queue_snapshot_rebuild(menu_id: Optional[int]) -> None:
+    """بعد commit: مهمة واحدة مؤجّلة لكل دفعة تعديلات (تُدمج القوائم في نفس المهمة)."""
+    if menu_id is None:
+        return
+    queue_snapshot_rebuilds([menu_id])
+
+
+def queue_snapshot_rebuilds(menu_ids: Iterable[int]) -> None:
+    ids = sorted({int(x) for x in menu_ids if x is not None})
+    if not ids:
+        return
+
+    def _enqueue():
+        try:
+            job_manager.spawn_coalesced(
+                rebuild_public_snapshots, ids, owner="public-menu", delay=SNAPSHOT_DEBOUNCE_SEC,
+            )
+        except Exception:
+            logger.exception("public menus %s: could not queue snapshot rebuild", ids)
+
+    transaction.on_commit(_enqueue)
+
+
+# ---- batched refresh: signals داخل الكتلة تسجّل فقط (بلا استعلام لكل حفظ) ----
+_batch = threading.local()
+
+
+def defer_refresh(*, menu_id=None, section_id=None, dish_id=None) -> bool:
+    """يسجّل التغيير إن كانت batched_rebuilds() فعّالة في هذا الخيط ويعيد True؛ وإلا False."""
+    pending = getattr(_batch, "pending", None)
+    if pending is None:
+        return False
+    for key, value in (("menus", menu_id), ("sections", section_id), ("dishes", dish_id)):
+        if value is not None:
+            pending[key].add(value)
+    return True
+
+
+@contextmanager
+def batched_rebuilds() -> Iterator[None]:
+    """
+    كتابات جماعية: بدل SELECT + spawn_coalesced لكل حفظ، استعلام واحد عند الخروج يحدّد
+    القوائم المنشورة المتأثرة ثم مهمة واحدة لها. متداخلة → الخارجية فقط تُفرغ.
+    """
+    if getattr(_batch, "pending", None) is not None:
+        yield
+        return
+    _batch.pending = pending = {"menus": set(), "sections": set(), "dishes": set()}
+    try:
+        yield
+    finally:
+        _batch.pending = None
+        cond = Q(pk__in=pending["menus"]) | Q(sections__id__in=pending["sections"]) \
+            | Q(sections__dishes__id__in=pending["dishes"])
+        if any(pending.values()):
+            queue_snapshot_rebuilds(
+                Menu.objects.filter(cond, is_published=True).values_list("id", flat=True).distinct()
+            )
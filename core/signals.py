@@ -3,15 +3,21 @@
 # Django signals:
 # 1) ensure_profile: إنشاء Profile تلقائيًا للمستخدم الجديد.
 # 2) image_cleaners (pre_save): تنظيف صور Dish/Profile/MenuDisplaySettings قبل الحفظ.
+# 3) public menu snapshots: أي تعديل على قائمة منشورة يُجدول إعادة بناء لقطتها.
+# 4) allergen registry: أي تعديل على Allergen يُسقط السجلّ المحلي ويرفع نسخته المشتركة،
+#    ويُجدول إعادة بناء لقطات كل القوائم المنشورة (تحمل allergen_explanation_de).
 # -----------------------------------------------------------------------------
 
 from django.conf import settings
 from django.core.files.base import ContentFile
-from django.db.models.signals import post_save, pre_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 
 from core.utils.images import validate_and_clean_image
-from core.models import Dish, Profile, MenuDisplaySettings
+from core.models import Allergen, Dish, DishAllergen, DishPrice, Menu, MenuDisplaySettings, Profile, Section
+from core.services import public_menu
+from core.services.allergen_registry import registry as allergen_registry
 
 
 # -----------------------------------------------------------------------------
@@ -67,3 +73,68 @@ def menu_display_images_cleaner(sender, instance: MenuDisplaySettings, **kwargs)
     if getattr(instance, "hero_image", None):
         _clean_field_if_needed(instance, "hero_image")
 
+
+# -----------------------------------------------------------------------------
+# 3) Public menu snapshots (core/services/public_menu.py)
+# -----------------------------------------------------------------------------
+def _published_menu_id(**lookup):
+    # استعلام واحد يعيد id القائمة فقط إن كانت منشورة (المسودّات لا تكلّف مهمة)
+    return Menu.objects.filter(is_published=True, **lookup).values_list("id", flat=True).first()
+
+
+@receiver(post_save, sender=Dish)
+@receiver(post_delete, sender=Dish)
+def dish_snapshot_refresh(sender, instance: Dish, **kwargs):
+    if kwargs.get("raw") or public_menu.defer_refresh(section_id=instance.section_id):
+        return
+    public_menu.queue_snapshot_rebuild(_published_menu_id(sections__id=instance.section_id))
+
+
+@receiver(post_save, sender=DishPrice)
+@receiver(post_delete, sender=DishPrice)
+@receiver(post_save, sender=DishAllergen)
+@receiver(post_delete, sender=DishAllergen)
+def dish_child_snapshot_refresh(sender, instance, **kwargs):
+    if kwargs.get("raw") or public_menu.defer_refresh(dish_id=instance.dish_id):
+        return
+    public_menu.queue_snapshot_rebuild(_published_menu_id(sections__dishes__id=instance.dish_id))
+
+
+@receiver(post_save, sender=Section)
+@receiver(post_delete, sender=Section)
+@receiver(post_save, sender=MenuDisplaySettings)
+@receiver(post_delete, sender=MenuDisplaySettings)
+def menu_child_snapshot_refresh(sender, instance, **kwargs):
+    if kwargs.get("raw") or public_menu.defer_refresh(menu_id=instance.menu_id):
+        return
+    public_menu.queue_snapshot_rebuild(_published_menu_id(pk=instance.menu_id))
+
+
+@receiver(post_save, sender=Menu)
+def menu_snapshot_refresh(sender, instance: Menu, **kwargs):
+    if kwargs.get("raw"):
+        return
+    if instance.is_published:
+        public_menu.queue_snapshot_rebuild(instance.pk)
+    else:
+        public_menu.remove_snapshot(instance.public_slug)  # فورًا: لا نقدّم قائمة أُلغي نشرها
+
+
+@receiver(post_delete, sender=Menu)
+def menu_snapshot_remove(sender, instance: Menu, **kwargs):
+    public_menu.remove_snapshot(instance.public_slug)
+
+
+# -----------------------------------------------------------------------------
+# 4) Allergen registry (core/services/allergen_registry.py)
+# -----------------------------------------------------------------------------
+@receiver(post_save, sender=Allergen)
+@receiver(post_delete, sender=Allergen)
+def allergen_registry_invalidate(sender, instance: Allergen, **kwargs):
+    # raw (loaddata) أيضًا: الجدول تغيّر. فورًا لهذه العملية، وبعد commit مرة أخرى
+    # حتى لا يبقى ما حُمّل داخل المعاملة (أو ما تراجعت عنه) في السجلّ
+    allergen_registry.invalidate()
+    transaction.on_commit(allergen_registry.invalidate)
+    if not kwargs.get("raw"):
+        # اللقطات تحمل شروح "Enthält …" المبنية من التسميات → كلها قديمة الآن
+        public_menu.queue_snapshot_rebuilds(Menu.objects.filter(is_published=True).values_list("id", flat=True))
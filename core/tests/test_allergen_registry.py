@@ -0,0 +1,53 @@
+# core/tests/test_allergen_registry.py
+"""
+Tests for the in-process Allergen registry (core/services/allergen_registry.py):
+- one query per process, explanations memoized per code set
+- Allergen saves/deletes invalidate it; other processes follow the shared version
+"""
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from core.models import Allergen
+from core.serializers import _build_explanation_de_from_codes
+from core.services import allergen_registry
+from core.services.allergen_registry import registry
+
+
+class AllergenRegistryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Allergen.objects.create(code="A", label_de="Glutenhaltiges Getreide", label_en="Gluten")
+        Allergen.objects.create(code="G", label_de="Milch", label_en="Milk", label_ar="حليب")
+        Allergen.objects.create(code="1", label_de="Farbstoff", kind=Allergen.Kind.ADDITIVE)
+
+    def test_loaded_once_and_explanations_memoized(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(_build_explanation_de_from_codes(["G", "A"]), "Enthält Glutenhaltiges Getreide und Milch.")
+            for _ in range(50):
+                _build_explanation_de_from_codes(["A", "G"])
+            self.assertEqual(registry.explanation_de({"G", "X"}), "Enthält Milch.")
+        self.assertEqual(registry.explanation_de([]), "")
+        self.assertEqual(registry.get("G").label_ar, "حليب")
+        self.assertEqual(registry.labels("de", kind=Allergen.Kind.ALLERGEN), {"A": "Glutenhaltiges Getreide", "G": "Milch"})
+        self.assertEqual(registry.labels("en"), {"A": "Gluten", "G": "Milk"})
+
+    def test_allergen_changes_invalidate(self):
+        registry.explanation_de(["G"])
+        milk = Allergen.objects.get(code="G")
+        milk.label_de = "Milch (einschl. Laktose)"
+        milk.save()
+        self.assertEqual(registry.explanation_de(["G"]), "Enthält Milch (einschl. Laktose).")
+        milk.delete()
+        self.assertEqual(registry.explanation_de(["G"]), "")
+
+    def test_other_process_change_followed_via_shared_version(self):
+        registry.explanation_de(["A"])
+        # another process renamed the allergen and bumped the shared version
+        Allergen.objects.filter(code="A").update(label_de="Weizen")
+        with self.assertNumQueries(0):
+            self.assertEqual(registry.explanation_de(["A"]), "Enthält Glutenhaltiges Getreide.")
+        cache.incr(allergen_registry.VERSION_KEY)
+        with mock.patch.object(allergen_registry, "CHECK_SEC", 0):
+            self.assertEqual(registry.explanation_de(["A"]), "Enthält Weizen.")
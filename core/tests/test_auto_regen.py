@@ -0,0 +1,75 @@
+# core/tests/test_auto_regen.py
+"""
+Tests for AUTO_REGEN_ON_EDIT (core/services/auto_regen.py):
+- only name/description/ingredient changes queue a job, after commit
+- rapid edits coalesce into one rules run that writes the codes
+"""
+from unittest import mock
+
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from core.dictionary_models import KeywordLexeme
+from core.models import Allergen, Dish, Ingredient, Menu, Section, User
+from core.services import auto_regen
+from core.utils.jobs import job_manager
+
+
+@mock.patch.object(auto_regen, "AUTO_REGEN_ON_EDIT", True)
+class AutoRegenOnEditTests(TestCase):
+    def setUp(self):
+        job_manager.set_backend("memory")
+        self.user = User.objects.create_user(username="owner", password="x")
+        menu = Menu.objects.create(user=self.user, name="Karte")
+        section = Section.objects.create(name="Hauptgerichte", menu=menu, user=self.user)
+        self.dish = Dish.objects.create(section=section, name="Suppe", description="")
+        milk = Allergen.objects.create(code="G", label_de="Milch")
+        lexeme = KeywordLexeme.objects.create(term="Sahne", lang="de", is_active=True, owner=self.user)
+        lexeme.allergens.add(milk)
+        self.ingredient = Ingredient.objects.create(name="Brot", owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = f"/api/v2/dishes/{self.dish.id}/"
+
+    def _patch(self, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.patch(self.url, data, format="json")
+        self.assertEqual(res.status_code, 200, res.content)
+
+    def test_unrelated_edit_queues_nothing(self):
+        with mock.patch.object(job_manager, "spawn_coalesced") as spawn:
+            self._patch({"is_favorite": True})
+            self._patch({"name": "Suppe"})  # unchanged value
+        spawn.assert_not_called()
+
+    def test_edits_queue_after_commit(self):
+        with mock.patch.object(job_manager, "spawn_coalesced") as spawn:
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                self.client.patch(self.url, {"ingredients": [self.ingredient.id]}, format="json")
+            spawn.assert_not_called()  # the request itself never waits for the job
+            for cb in callbacks:
+                cb()
+        spawn.assert_called_once()
+        self.assertEqual(spawn.call_args.args[1], [self.dish.id])
+        self.assertEqual(spawn.call_args.kwargs["owner"], str(self.user.id))
+
+    def test_rapid_edits_coalesce_into_one_rules_run(self):
+        queued = []
+        real = job_manager.spawn_coalesced
+
+        def spy(*args, **kwargs):
+            queued.append(real(*args, **kwargs))
+            return queued[-1]
+
+        with mock.patch.object(job_manager, "spawn_coalesced", side_effect=spy):
+            self._patch({"description": "mit"})
+            self._patch({"description": "mit Sahne"})
+        self.assertEqual(len({st.id for st in queued}), 1)
+        job = job_manager.get(queued[0].id)
+        self.assertEqual((job.status, job.total), ("queued", 1))
+        job_manager.cancel(job.id)  # run the target here instead (test DB is not shared with threads)
+
+        result = auto_regen.run_dish_auto_regen(job, [self.dish.id], owner_id=self.user.id)
+        self.assertEqual(result["dish_ids"], [self.dish.id])
+        self.dish.refresh_from_db()
+        self.assertEqual(self.dish.codes, "(G)")
@@ -0,0 +1,684 @@
+# core/tests/test_jobs.py
+"""
+Tests for the DB job backend (core/utils/jobs.py, JOB_BACKEND=db):
+- spawn → queue → claim/lease → done
+- retries with backoff, expired leases, cancellation from another process
+- run_job_worker command
+- checkpoints (deferred inside an event loop) and resume()
+- the SSE progress stream (/api/llm/jobs/<id>/events)
+- retention (TTL / LRU cap), spilled results and the paged /results endpoint
+- fair scheduling: priorities, per-owner cap, bulk cap
+- sharded jobs: aggregated progress, merged result, cancel cascade
+- coalesced (debounced) jobs: merged ids, delayed start, max delay
+"""
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from core.models import BackgroundJob
+from core.utils import jobs
+from core.utils.jobs import JobManager, job_manager
+
+_CALLS = []
+
+
+def ok_task(job, n, label=""):
+    job_manager.update(job.id, total=n, completed=n, message="working")
+    _CALLS.append(("ok", job.id))
+    return {"n": n, "label": label}
+
+
+def flaky_task(job):
+    _CALLS.append(("flaky", job.id))
+    raise RuntimeError("provider down")
+
+
+def cancellable_task(job):
+    # another process cancels while we run; the heartbeat picks it up
+    BackgroundJob.objects.filter(pk=job.id).update(cancel_requested=True)
+    job_manager.store.heartbeat(job.id)
+    if job_manager.is_cancel_requested(job.id):
+        job_manager.cancelled(job.id, partial_result={"partial": True})
+    return {"finished": True}
+
+
+def shard_task(job, n):
+    if job_manager.is_cancel_requested(job.id):
+        job_manager.cancelled(job.id, partial_result={"n": 0})
+        return {"n": 0}
+    job_manager.update(job.id, total=n, completed=n)
+    return {"n": n}
+
+
+def merge_counts(results):
+    return {"n": sum(r["n"] for r in results if r), "parts": len(results)}
+
+
+_TASKS = {
+    "test_shard": "core.tests.test_jobs.shard_task",
+    "test_ok": "core.tests.test_jobs.ok_task",
+    "test_flaky": "core.tests.test_jobs.flaky_task",
+    "test_cancel": "core.tests.test_jobs.cancellable_task",
+}
+
+
+@mock.patch.dict(jobs.JOB_TASKS, _TASKS)
+class DBJobBackendTests(TestCase):
+    def setUp(self):
+        _CALLS.clear()
+        job_manager.set_backend("db")
+        self.store = job_manager.store
+
+    def tearDown(self):
+        job_manager.set_backend("memory")
+
+    def _enqueue(self, target, *args, **kwargs):
+        job = job_manager.create(total=0, message="queued")
+        job_manager.spawn(job, target, *args, **kwargs)
+        return job.id
+
+    def _run_next(self, worker="w1"):
+        row = self.store.claim(worker, lease_sec=30)
+        return row, (self.store.run_claimed(row, worker, heartbeat_sec=0) if row else None)
+
+    def test_queue_claim_and_done_visible_from_another_manager(self):
+        job_id = self._enqueue(ok_task, 3, label="x")
+        row = BackgroundJob.objects.get(pk=job_id)
+        self.assertEqual((row.task, row.args, row.kwargs), ("test_ok", [3], {"label": "x"}))
+        self.assertEqual(_CALLS, [])  # nothing runs in the web process
+
+        row, final = self._run_next()
+        self.assertEqual(final, "done")
+        other = JobManager("db")  # e.g. another gunicorn worker
+        st = other.get(job_id)
+        self.assertEqual((st.status, st.completed, st.percent), ("done", 3, 100.0))
+        self.assertEqual(st.result, {"n": 3, "label": "x"})
+        self.assertEqual(st.attempts, 1)
+        self.assertIsNone(self.store.claim("w1"))
+
+    def test_failures_are_retried_with_backoff_then_fail(self):
+        job_id = self._enqueue(flaky_task)
+        BackgroundJob.objects.filter(pk=job_id).update(max_attempts=2)
+        with self.assertLogs("core.jobs", "ERROR"):
+            _, final = self._run_next()
+        self.assertEqual(final, "queued")
+        row = BackgroundJob.objects.get(pk=job_id)
+        self.assertGreater(row.run_after, timezone.now())
+        self.assertEqual(row.error, "provider down")
+        self.assertIsNone(self.store.claim("w1"))  # still backing off
+
+        BackgroundJob.objects.filter(pk=job_id).update(run_after=timezone.now())
+        with self.assertLogs("core.jobs", "ERROR"):
+            _, final = self._run_next()
+        self.assertEqual(final, "error")
+        self.assertEqual(BackgroundJob.objects.get(pk=job_id).attempts, 2)
+
+    def test_expired_lease_is_reclaimed_and_stale_worker_loses(self):
+        job_id = self._enqueue(ok_task, 1)
+        self.store.claim("dead", lease_sec=30)
+        BackgroundJob.objects.filter(pk=job_id).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+        row, final = self._run_next("alive")
+        self.assertEqual((row.attempts, final), (2, "done"))
+        # the old owner (another process) notices on its next heartbeat and cannot overwrite the result
+        self.store._local[job_id] = jobs.JobState(id=job_id)
+        self.store._owner[job_id] = "dead"
+        self.assertFalse(self.store.heartbeat(job_id))
+        self.assertTrue(self.store._local[job_id].cancel_requested)
+        self.store.fail(job_id, "late")
+        self.assertEqual(BackgroundJob.objects.get(pk=job_id).status, "done")
+
+    def test_cancel_queued_and_running(self):
+        queued = self._enqueue(ok_task, 1)
+        job_manager.cancel(queued)
+        self.assertEqual(job_manager.get(queued).status, "cancelled")
+        self.assertIsNone(self.store.claim("w1"))
+
+        running = self._enqueue(cancellable_task)
+        _, final = self._run_next()
+        self.assertEqual(final, "cancelled")
+        self.assertEqual(job_manager.get(running).result, {"partial": True})
+
+    def test_worker_command_drains_queue(self):
+        ids = [self._enqueue(ok_task, i) for i in (1, 2)]
+        out = StringIO()
+        call_command("run_job_worker", "--once", "--concurrency", "1", "--heartbeat-sec", "0", "--worker-id", "cmd", stdout=out)
+        self.assertIn("processed=2", out.getvalue())
+        self.assertEqual([job_manager.get(i).status for i in ids], ["done", "done"])
+
+    def test_worker_slot_survives_loop_errors(self):
+        job_id = self._enqueue(ok_task, 1)
+        claim = self.store.claim
+        outcomes = iter([OperationalError("server closed the connection"), None])
+
+        def flaky_claim(*args, **kwargs):
+            err = next(outcomes, None)
+            if err is not None:
+                raise err
+            return claim(*args, **kwargs)
+
+        out, err = StringIO(), StringIO()
+        with mock.patch.object(self.store, "claim", side_effect=flaky_claim), \
+                mock.patch("core.management.commands.run_job_worker.time.sleep") as sleep, \
+                mock.patch("core.management.commands.run_job_worker.close_old_connections") as close, \
+                self.assertLogs("core.jobs", "ERROR"):
+            call_command("run_job_worker", "--once", "--concurrency", "1", "--heartbeat-sec", "0", stdout=out, stderr=err)
+        self.assertIn("OperationalError", err.getvalue())
+        sleep.assert_called_once_with(2.0)  # poll_interval × 2 backoff
+        self.assertGreaterEqual(close.call_count, 3)
+        self.assertIn("processed=1", out.getvalue())
+        self.assertEqual(job_manager.get(job_id).status, "done")
+
+    def test_checkpoint_saved_in_event_loop_is_flushed_by_heartbeat(self):
+        job_id = self._enqueue(ok_task, 1)
+        row = self.store.claim("w1", lease_sec=30)
+        self.store._local[job_id] = jobs.JobState(id=job_id, status="running")
+        self.store._owner[job_id] = "w1"
+
+        async def _save():
+            job_manager.save_checkpoint(job_id, {"llm": {"1": {"status": "ok"}}})
+
+        asyncio.run(_save())  # no ORM inside the loop
+        self.assertIsNone(BackgroundJob.objects.get(pk=row.pk).checkpoint)
+        self.assertEqual(job_manager.load_checkpoint(job_id), {"llm": {"1": {"status": "ok"}}})
+        self.assertTrue(self.store.heartbeat(job_id))
+        self.assertEqual(BackgroundJob.objects.get(pk=row.pk).checkpoint, {"llm": {"1": {"status": "ok"}}})
+
+    def test_append_checkpoint_writes_only_the_delta(self):
+        job_id = self._enqueue(ok_task, 1)
+        self.store.claim("w1", lease_sec=30)
+        self.store._local[job_id] = jobs.JobState(id=job_id, status="running")
+        self.store._owner[job_id] = "w1"
+        job_manager.save_checkpoint(job_id, {"missing_ids": [1, 2, 3], "llm": {}})
+        job_manager.append_checkpoint(job_id, "llm", {"1": {"status": "ok"}})
+
+        async def _append():
+            job_manager.append_checkpoint(job_id, "llm", {"2": {"status": "ok"}})
+
+        asyncio.run(_append())  # deferred like save_checkpoint
+        row = BackgroundJob.objects.get(pk=job_id)
+        self.assertEqual(row.checkpoint, {"missing_ids": [1, 2, 3], "llm": {}})  # base untouched
+        self.assertEqual(row.checkpoint_deltas.count(), 1)
+        self.assertEqual(job_manager.load_checkpoint(job_id)["llm"], {"1": {"status": "ok"}, "2": {"status": "ok"}})
+        self.assertTrue(self.store.heartbeat(job_id))
+        deltas = job_manager.checkpoint_deltas(job_id)
+        self.assertEqual([d[2] for d in deltas], [{"1": {"status": "ok"}}, {"2": {"status": "ok"}}])
+        self.assertEqual(job_manager.checkpoint_deltas(job_id, after=deltas[0][0]), deltas[1:])
+
+        job_manager.save_checkpoint(job_id, {"llm": {"9": {}}})  # full checkpoint replaces the deltas
+        self.assertEqual(job_manager.load_checkpoint(job_id), {"llm": {"9": {}}})
+        job_manager.append_checkpoint(job_id, "llm", {"3": {}})
+        job_manager.done(job_id, {"ok": True})
+        self.assertIsNone(job_manager.load_checkpoint(job_id))
+        self.assertFalse(row.checkpoint_deltas.exists())
+
+    def test_resume_requeues_cancelled_job_with_its_checkpoint(self):
+        job_id = self._enqueue(ok_task, 1)
+        job_manager.save_checkpoint(job_id, {"missing_ids": [1]})
+        self.assertFalse(job_manager.resume(job_id))  # still queued
+        job_manager.cancel(job_id)
+        self.assertTrue(job_manager.resume(job_id))
+        st = job_manager.get(job_id)
+        self.assertEqual((st.status, st.cancel_requested), ("queued", False))
+        _, final = self._run_next()
+        self.assertEqual(final, "done")
+        self.assertIsNone(job_manager.load_checkpoint(job_id))  # cleared on success
+
+
+def _parse_sse(body: str):
+    events = []
+    for block in body.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line and not line.startswith(":"))
+        if "event" in fields:
+            events.append((fields["event"], json.loads(fields["data"]), fields.get("id")))
+    return events
+
+
+class JobEventsStreamTests(TestCase):
+    def setUp(self):
+        job_manager.set_backend("memory")
+        self.user = get_user_model().objects.create_user(username="owner", password="x")
+        self.owner = str(self.user.pk)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_streams_progress_items_and_final_result(self):
+        job = job_manager.create(total=2, owner=self.owner)
+        job_manager.start(job.id, "llm")
+        job_manager.update(job.id, completed=1)
+        job_manager.append_checkpoint(job.id, "llm", {"5": {
+            "status": "ok", "terms": ["Käse"], "codes_lookup": {"käse": {"codes": "G", "confidence": 0.9}},
+        }})
+        steps = iter([
+            lambda: (
+                job_manager.append_checkpoint(job.id, "llm", {"6": {"status": "error", "error": "timeout"}}),
+                job_manager.update(job.id, completed=2),
+            ),
+            lambda: job_manager.done(job.id, {"count": 2}),
+        ])
+
+        with mock.patch("core.views._JOB_EVENTS_POLL_SEC", 0), \
+                mock.patch("core.views.time.sleep", side_effect=lambda _: next(steps)()):
+            res = self.client.get(f"/api/llm/jobs/{job.id}/events", HTTP_ACCEPT="text/event-stream")
+            self.assertEqual(res["Content-Type"], "text/event-stream")
+            self.assertEqual(res["Cache-Control"], "no-cache")
+            events = _parse_sse(b"".join(res.streaming_content).decode())
+
+        kinds = [e[0] for e in events]
+        self.assertEqual(kinds, ["progress", "item", "progress", "item", "progress", "done"])
+        self.assertEqual(events[0][1]["completed"], 1)
+        first_seq = int(events[1][2])
+        self.assertEqual(events[1][1]["candidates"][0]["guess_codes"], "G")
+        self.assertEqual(events[3][1], {"dish_id": 6, "status": "error", "error": "timeout", "candidates": []})
+        self.assertGreater(int(events[3][2]), first_seq)
+        self.assertEqual(events[-1][1]["result"], {"count": 2})
+
+    def test_reconnect_with_last_event_id_sends_only_newer_items(self):
+        job = job_manager.create(total=3, owner=self.owner)
+        job_manager.start(job.id, "llm")
+        for did in ("1", "2", "3"):
+            job_manager.append_checkpoint(job.id, "llm", {did: {"status": "empty", "terms": []}})
+        job_manager.cancelled(job.id, partial_result={"count": 3})
+        seqs = [seq for seq, _, _ in job_manager.checkpoint_deltas(job.id)]
+
+        res = self.client.get(f"/api/llm/jobs/{job.id}/events", HTTP_ACCEPT="text/event-stream",
+                              HTTP_LAST_EVENT_ID=str(seqs[0]))
+        events = _parse_sse(b"".join(res.streaming_content).decode())
+        self.assertEqual([e[1]["dish_id"] for e in events if e[0] == "item"], [2, 3])
+
+    def test_idle_stream_backs_off_and_reads_only_on_change(self):
+        job = job_manager.create(total=5, owner=self.owner)
+        job_manager.start(job.id, "llm")
+        clock = [0.0]
+        steps = {8: lambda: job_manager.update(job.id, completed=1), 12: lambda: job_manager.done(job.id, {})}
+
+        def _sleep(sec):
+            clock[0] += 0.5
+            step = steps.get(int(clock[0] * 2))
+            if step:
+                step()
+
+        with mock.patch("core.views._JOB_EVENTS_KEEPALIVE_SEC", 1000), \
+                mock.patch("core.views.time.monotonic", side_effect=lambda: clock[0]), \
+                mock.patch("core.views.time.sleep", side_effect=_sleep), \
+                mock.patch.object(job_manager, "get", wraps=job_manager.get) as get:
+            res = self.client.get(f"/api/llm/jobs/{job.id}/events", HTTP_ACCEPT="text/event-stream")
+            events = _parse_sse(b"".join(res.streaming_content).decode())
+        self.assertEqual([e[0] for e in events], ["progress", "progress", "progress", "done"])
+        # 6 s of stream, a revision check every 0.5 s: the view's own lookup + reads at 0, 0.5, 1.5, 3.5 s
+        # (backing off), 4 s (update notified), 4.5, 5.5 s (backing off again), 6 s (done notified)
+        self.assertEqual(get.call_count, 9)
+
+    def test_open_streams_are_capped_per_user_and_process(self):
+        job = job_manager.create(total=1, owner=self.owner)
+        job_manager.start(job.id, "llm")
+        url = f"/api/llm/jobs/{job.id}/events"
+        cache.clear()
+        with mock.patch("core.views._JOB_EVENTS_MAX_PER_USER", 1):
+            first = self.client.get(url, HTTP_ACCEPT="text/event-stream")
+            self.assertEqual(first.status_code, 200)
+            second = self.client.get(url, HTTP_ACCEPT="text/event-stream")
+            self.assertEqual(second.status_code, 429)
+            self.assertIn("Retry-After", second)
+            first.close()  # never iterated: the slot is still released
+            third = self.client.get(url, HTTP_ACCEPT="text/event-stream")
+            self.assertEqual(third.status_code, 200)
+            third.close()
+
+        with mock.patch("core.views._job_event_slots", threading.BoundedSemaphore(1)):
+            open_stream = self.client.get(url, HTTP_ACCEPT="text/event-stream")
+            other = APIClient()
+            other.force_authenticate(get_user_model().objects.create_user(username="other", password="x"))
+            self.assertEqual(other.get(url, HTTP_ACCEPT="text/event-stream").status_code, 404)  # checked first
+            self.assertEqual(self.client.get(url, HTTP_ACCEPT="text/event-stream").status_code, 429)
+            open_stream.close()
+        self.assertEqual(cache.get(f"jobs:sse:{self.user.pk}"), 0)
+
+    def test_unknown_job(self):
+        res = self.client.get("/api/llm/jobs/0000-dead/events", HTTP_ACCEPT="text/event-stream")
+        self.assertEqual(res.status_code, 404)
+        self.assertIn("event: error", res.content.decode())
+
+
+_BIG_RESULT = {
+    "rules": {"count": 30, "items": [{"dish_id": i, "codes": "A,G", "details": "x" * 40} for i in range(30)]},
+    "llm": {"count": 0, "items": []},
+    "mode": "job",
+}
+
+
+class JobRetentionTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        for name, value in (("JOB_RESULT_SPILL_BYTES", 500), ("JOB_RESULT_DIR", self.tmp), ("JOB_MAX_JOBS", 3)):
+            patcher = mock.patch.object(jobs, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        job_manager.set_backend("memory")
+
+    def test_memory_spills_large_results_and_evicts_lru_then_ttl(self):
+        mgr = JobManager("memory")
+        big = mgr.create()
+        mgr.done(big.id, _BIG_RESULT)
+        self.assertEqual(mgr.get(big.id).result["rules"], {"count": 30, "items_total": 30})
+        self.assertEqual(mgr.load_result(big.id), _BIG_RESULT)
+        self.assertEqual(len(os.listdir(self.tmp)), 1)
+
+        small = mgr.create()
+        mgr.done(small.id, {"n": 1})
+        running = mgr.create()
+        mgr.start(running.id)
+        mgr.get(big.id)  # most recently read → survives the cap
+        mgr.create()     # 4 jobs > JOB_MAX_JOBS=3 → the LRU finished one goes
+        self.assertIsNone(mgr.get(small.id))
+        self.assertIsNotNone(mgr.get(big.id))
+
+        self.assertEqual(mgr.purge(ttl_sec=0), 1)  # only finished jobs, never running ones
+        self.assertIsNone(mgr.get(big.id))
+        self.assertIsNotNone(mgr.get(running.id))
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_db_blob_and_purge(self):
+        mgr = JobManager("db")
+        job = mgr.create()
+        mgr.done(job.id, _BIG_RESULT)
+        row = BackgroundJob.objects.get(pk=job.id)
+        self.assertIsNotNone(row.result_blob)
+        self.assertEqual(row.result["rules"]["items_total"], 30)
+        self.assertEqual(mgr.load_result(job.id), _BIG_RESULT)
+
+        BackgroundJob.objects.filter(pk=job.id).update(finished_at=timezone.now() - timedelta(hours=2))
+        queued = mgr.create()
+        self.assertEqual(mgr.purge(ttl_sec=3600), 1)
+        self.assertEqual(list(BackgroundJob.objects.values_list("pk", flat=True)), [queued.id])
+
+    def test_finished_shards_of_a_running_parent_are_pinned(self):
+        for backend in ("memory", "db"):
+            with self.subTest(backend=backend):
+                mgr = JobManager(backend)
+                parent = mgr.create()
+                mgr.start(parent.id)
+                done = [mgr.store.create(parent_id=parent.id) for _ in range(4)]
+                straggler = mgr.store.create(parent_id=parent.id)
+                mgr.start(straggler.id)
+                for child in done:
+                    mgr.done(child.id, {"n": 1})
+                BackgroundJob.objects.update(finished_at=timezone.now() - timedelta(hours=2))
+                # TTL وسقف JOB_MAX_JOBS تجاوزهما كلاهما، لكن الأب ما زال يحتاج نتائجها للدمج
+                self.assertEqual(mgr.store.purge(ttl_sec=0, max_jobs=1), 0)
+                self.assertTrue(all(mgr.get(c.id) for c in done))
+
+                mgr.done(straggler.id, {"n": 1})
+                mgr.done(parent.id, {"n": 5})
+                mgr.store.purge(ttl_sec=0)
+                self.assertFalse(any(mgr.get(c.id) for c in done + [straggler, parent]))
+
+    def test_results_endpoint_pages_items(self):
+        job_manager.set_backend("memory")
+        user = get_user_model().objects.create_user(username="owner", password="x")
+        job = job_manager.create(owner=str(user.pk))
+        job_manager.done(job.id, _BIG_RESULT)
+        client = APIClient()
+        client.force_authenticate(user)
+        url = f"/api/llm/jobs/{job.id}/results/"
+
+        status_body = client.get(f"/api/llm/jobs/{job.id}/status/").json()
+        self.assertNotIn("items", status_body["result"]["rules"])
+        head = client.get(url).json()
+        self.assertEqual(head["sections"], {"rules": 30, "llm": 0})
+
+        page = client.get(url, {"section": "rules", "offset": 25, "limit": 10}).json()
+        self.assertEqual([it["dish_id"] for it in page["items"]], [25, 26, 27, 28, 29])
+        self.assertIsNone(page["next_offset"])
+        self.assertEqual(client.get(url, {"section": "nope"}).status_code, 400)
+
+        pending = job_manager.create(owner=str(user.pk))
+        self.assertEqual(client.get(f"/api/llm/jobs/{pending.id}/results/").status_code, 409)
+
+    def test_job_endpoints_are_limited_to_owner_and_staff(self):
+        job_manager.set_backend("memory")
+        owner = get_user_model().objects.create_user(username="owner", password="x")
+        job = job_manager.create(owner=str(owner.pk))
+        job_manager.cancelled(job.id, partial_result=_BIG_RESULT)
+        other, staff = APIClient(), APIClient()
+        other.force_authenticate(get_user_model().objects.create_user(username="other", password="x"))
+        staff.force_authenticate(get_user_model().objects.create_user(username="staff", password="x", is_staff=True))
+
+        for method, suffix in (("get", "status/"), ("get", "results/"), ("get", "events"),
+                               ("post", "cancel/"), ("post", "resume/")):
+            res = getattr(other, method)(f"/api/llm/jobs/{job.id}/{suffix}")
+            self.assertEqual(res.status_code, 404, suffix)
+        self.assertEqual(job_manager.get(job.id).status, "cancelled")  # untouched
+        self.assertEqual(staff.get(f"/api/llm/jobs/{job.id}/results/").status_code, 200)
+
+
+class FairSchedulingTests(TestCase):
+    def setUp(self):
+        for name, value in (("JOB_MAX_PER_OWNER", 1), ("JOB_MAX_BULK_RUNNING", 1)):
+            patcher = mock.patch.object(jobs, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        job_manager.set_backend("memory")
+
+    def test_fair_order(self):
+        order = jobs.fair_order(
+            [("bulk-a", "a", jobs.PRIORITY_BULK, 1.0, "bulk-a"), ("int-a", "a", 0, 3.0, "int-a"),
+             ("int-b", "b", 0, 4.0, "int-b"), ("int-c", "c", 0, 2.0, "int-c")],
+            [("x", "a", 0)], max_per_owner=2, max_bulk=None,
+        )
+        self.assertEqual(order, ["int-c", "int-b", "int-a", "bulk-a"])
+
+        # shards of a running sharded job skip the owner/bulk caps, up to max_shards at once
+        candidates = [("s3", "a", jobs.PRIORITY_BULK, 3.0, "p"), ("other", "a", jobs.PRIORITY_BULK, 1.0, "other")]
+        running = [("p", "a", jobs.PRIORITY_BULK)]
+        self.assertEqual(jobs.fair_order(candidates, running, max_per_owner=1, max_bulk=1, max_shards=2), ["s3"])
+        self.assertEqual(jobs.fair_order(candidates, running * 2, max_per_owner=1, max_bulk=1, max_shards=2), [])
+
+    @mock.patch.dict(jobs.JOB_TASKS, _TASKS)
+    def test_db_claim_respects_priority_owner_cap_and_bulk_cap(self):
+        job_manager.set_backend("db")
+        created = {}
+        for key, owner, prio in (("a_bulk", "a", jobs.PRIORITY_BULK), ("b_bulk", "b", jobs.PRIORITY_BULK),
+                                 ("a_int1", "a", 0), ("a_int2", "a", 0), ("c_int", "c", 0)):
+            created[key] = job_manager.create(owner=owner, priority=prio)
+            job_manager.spawn(created[key], ok_task, 1)
+        names = {st.id: key for key, st in created.items()}
+
+        claimed = []
+        for i in range(4):
+            row = job_manager.store.claim(f"w{i}")
+            claimed.append(names[row.id] if row else None)
+        self.assertEqual(claimed, ["a_int1", "c_int", "b_bulk", None])
+
+    def test_memory_keeps_a_slot_for_interactive_jobs(self):
+        mgr = JobManager("memory")
+        release = threading.Event()
+        started = []
+
+        def target(job, name):
+            started.append(name)
+            release.wait(5)
+            return {"name": name}
+
+        with mock.patch.object(jobs, "JOB_MAX_BULK_RUNNING", None), \
+                mock.patch.object(jobs, "JOB_MEMORY_CONCURRENCY", 2):
+            bulk1 = mgr.create(owner="a", priority=jobs.PRIORITY_BULK)
+            bulk2 = mgr.create(owner="b", priority=jobs.PRIORITY_BULK)
+            small = mgr.create(owner="c")
+            for job, name in ((bulk1, "bulk1"), (bulk2, "bulk2"), (small, "small")):
+                mgr.spawn(job, target, name)
+            for _ in range(200):
+                if len(started) == 2:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(sorted(started), ["bulk1", "small"])  # small did not wait for bulk1
+            self.assertEqual(mgr.get(bulk2.id).status, "queued")  # one bulk at a time, one slot kept free
+            mgr.cancel(bulk2.id)
+            self.assertEqual(mgr.get(bulk2.id).status, "cancelled")
+            release.set()
+            for job in (bulk1, small):
+                for _ in range(200):
+                    if mgr.get(job.id).status == "done":
+                        break
+                    time.sleep(0.01)
+        self.assertEqual(mgr.get(small.id).result, {"name": "small"})
+
+
+def _wait_final(mgr, job_id, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        st = mgr.get(job_id)
+        if st.status in ("done", "error", "cancelled"):
+            return st
+        time.sleep(0.01)
+    return mgr.get(job_id)
+
+
+@mock.patch.dict(jobs.JOB_TASKS, _TASKS)
+class ShardedJobTests(TestCase):
+    def tearDown(self):
+        job_manager.set_backend("memory")
+
+    def test_memory_shards_merge_into_parent(self):
+        job_manager.set_backend("memory")
+        mgr = job_manager
+        parent = mgr.create(total=6, owner="a", priority=jobs.PRIORITY_BULK)
+        shards = mgr.spawn_sharded(parent, shard_task, [(1, (1,), {}), (2, (2,), {}), (3, (3,), {})], merge_counts)
+        st = _wait_final(mgr, parent.id)
+        self.assertEqual(st.status, "done")
+        self.assertEqual(st.result, {"n": 6, "parts": 3})
+        self.assertEqual((st.total, st.completed), (6, 6))
+        self.assertTrue(all(mgr.get(x.id).parent_id == parent.id for x in shards))
+
+    def test_memory_cancel_parent_cancels_shards(self):
+        job_manager.set_backend("memory")
+        mgr = job_manager
+        release = threading.Event()
+
+        def blocking(job, n):
+            release.wait(5)
+            return shard_task(job, n)
+
+        with mock.patch.object(jobs, "JOB_MEMORY_CONCURRENCY", 1):
+            parent = mgr.create()
+            shards = mgr.spawn_sharded(parent, blocking, [(1, (1,), {}), (2, (2,), {})], merge_counts)
+            mgr.cancel(parent.id)
+            self.assertEqual(mgr.get(shards[1].id).status, "cancelled")  # never started
+            release.set()
+            st = _wait_final(mgr, parent.id)
+        self.assertEqual(st.status, "cancelled")
+        self.assertEqual(st.result, {"n": 0, "parts": 2})
+
+    def test_db_shards_run_in_worker_and_merge(self):
+        job_manager.set_backend("db")
+        parent = job_manager.create(owner="a")
+        job_manager.spawn_sharded(parent, shard_task, [(2, (2,), {}), (5, (5,), {})], merge_counts)
+        st = job_manager.get(parent.id)
+        self.assertEqual((st.status, st.total, st.message), ("running", 7, "shards: 0/2 finished, 0 running"))
+
+        call_command("run_job_worker", "--once", "--concurrency", "1", "--heartbeat-sec", "0", stdout=StringIO())
+        st = job_manager.get(parent.id)
+        self.assertEqual(st.status, "done")
+        self.assertEqual(st.result, {"n": 7, "parts": 2})
+
+    def test_db_cancel_parent_cancels_queued_shards(self):
+        job_manager.set_backend("db")
+        parent = job_manager.create()
+        shards = job_manager.spawn_sharded(parent, shard_task, [(1, (1,), {}), (1, (1,), {})], merge_counts)
+        job_manager.cancel(parent.id)
+        self.assertEqual({job_manager.get(x.id).status for x in shards}, {"cancelled"})
+        st = job_manager.get(parent.id)
+        self.assertEqual(st.status, "cancelled")
+        self.assertEqual(st.result, {"n": 0, "parts": 2})
+
+        self.assertTrue(job_manager.resume(parent.id))
+        call_command("run_job_worker", "--once", "--concurrency", "1", "--heartbeat-sec", "0", stdout=StringIO())
+        self.assertEqual(job_manager.get(parent.id).result, {"n": 2, "parts": 2})
+
+
+def collect_task(job, ids, tag=""):
+    _CALLS.append(("collect", tuple(ids), tag))
+    return {"ids": list(ids)}
+
+
+class CoalescedJobTests(TestCase):
+    def setUp(self):
+        _CALLS.clear()
+
+    def tearDown(self):
+        job_manager.set_backend("memory")
+
+    def test_memory_calls_within_delay_merge_into_one_job(self):
+        job_manager.set_backend("memory")
+        first = job_manager.spawn_coalesced(collect_task, [1, 2], owner="a", delay=0.2)
+        again = job_manager.spawn_coalesced(collect_task, [2, 3], owner="a", delay=0.2)
+        other = job_manager.spawn_coalesced(collect_task, [9], owner="b", delay=0.2)
+        tagged = job_manager.spawn_coalesced(collect_task, [1], owner="a", delay=0.2, tag="x")
+        self.assertEqual(first.id, again.id)
+        self.assertEqual(len({first.id, other.id, tagged.id}), 3)
+        self.assertEqual((job_manager.get(first.id).status, job_manager.get(first.id).total), ("queued", 3))
+
+        st = _wait_final(job_manager, first.id)
+        self.assertEqual((st.status, st.result), ("done", {"ids": [1, 2, 3]}))
+        _wait_final(job_manager, other.id)
+        _wait_final(job_manager, tagged.id)
+        self.assertEqual(sorted(_CALLS), [("collect", (1,), "x"), ("collect", (1, 2, 3), ""), ("collect", (9,), "")])
+
+        # after it started, a new call gets a new job
+        later = job_manager.spawn_coalesced(collect_task, [4], owner="a", delay=0)
+        self.assertNotEqual(later.id, first.id)
+        self.assertEqual(_wait_final(job_manager, later.id).result, {"ids": [4]})
+
+    def test_memory_cancel_during_delay(self):
+        job_manager.set_backend("memory")
+        st = job_manager.spawn_coalesced(collect_task, [1], owner="a", delay=5)
+        job_manager.cancel(st.id)
+        self.assertEqual(job_manager.get(st.id).status, "cancelled")
+        self.assertNotEqual(job_manager.spawn_coalesced(collect_task, [2], owner="a", delay=5).id, st.id)
+        self.assertEqual(_CALLS, [])
+
+    @mock.patch.dict(jobs.JOB_TASKS, {"test_collect": "core.tests.test_jobs.collect_task"})
+    def test_db_merges_into_queued_row_and_defers_run_after(self):
+        job_manager.set_backend("db")
+        first = job_manager.spawn_coalesced(collect_task, [1], owner="a", delay=30, max_delay=60)
+        again = job_manager.spawn_coalesced(collect_task, [1, 2], owner="a", delay=30, max_delay=60)
+        self.assertEqual(first.id, again.id)
+        row = BackgroundJob.objects.get(pk=first.id)
+        self.assertEqual((row.task, row.args, row.total, row.status), ("test_collect", [[1, 2]], 2, "queued"))
+        self.assertGreater(row.run_after, timezone.now() + timedelta(seconds=20))
+        self.assertIsNone(job_manager.store.claim("w1"))  # still debouncing
+
+        # the first edit was long ago: max_delay caps the start
+        BackgroundJob.objects.filter(pk=row.pk).update(created_at=timezone.now() - timedelta(seconds=120))
+        job_manager.spawn_coalesced(collect_task, [3], owner="a", delay=30, max_delay=60)
+        call_command("run_job_worker", "--once", "--concurrency", "1", "--heartbeat-sec", "0", stdout=StringIO())
+        self.assertEqual(job_manager.get(first.id).result, {"ids": [1, 2, 3]})
+
+        # started/finished jobs are never merged into
+        later = job_manager.spawn_coalesced(collect_task, [4], owner="a", delay=30)
+        self.assertNotEqual(later.id, first.id)
+
+    def test_db_requires_registered_task(self):
+        job_manager.set_backend("db")
+        with self.assertRaises(ValueError):
+            job_manager.spawn_coalesced(collect_task, [1], owner="a")
@@ -0,0 +1,109 @@
+# core/tests/test_llm_async.py
+"""
+Tests for the async LLM path:
+- AsyncRateLimiter concurrency gate + shared budgets
+- allm_extract_terms / allm_map_terms_to_codes / allm_process_dishes with a fake caller
+- one AsyncOpenAI client per event loop
+"""
+import asyncio
+import json
+
+from django.test import SimpleTestCase
+
+from core.llm_clients import openai_client
+from core.llm_clients.limiter import RateLimiter, AsyncRateLimiter
+from core.services.llm_ingest import (
+    LLMConfig,
+    allm_extract_terms,
+    allm_map_terms_to_codes,
+    allm_process_dishes,
+)
+
+
+class AsyncRateLimiterTests(SimpleTestCase):
+    def test_concurrency_cap_and_shared_stats(self):
+        core = RateLimiter(rpm=0, tpm=0, concurrency=1, max_retries=1)
+        limiter = AsyncRateLimiter(core, concurrency=3)
+        in_flight = 0
+        peak = 0
+
+        async def call():
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return "ok"
+
+        async def run():
+            return await asyncio.gather(*[limiter.execute(10, call) for _ in range(10)])
+
+        results = asyncio.run(run())
+        self.assertEqual(results, ["ok"] * 10)
+        self.assertEqual(peak, 3)
+        self.assertEqual(core.budgets()["completed"], 10)
+
+    def test_retries_transient_errors(self):
+        core = RateLimiter(rpm=0, tpm=0, concurrency=1, max_retries=3)
+        limiter = AsyncRateLimiter(core, concurrency=2)
+        attempts = 0
+
+        async def flaky():
+            nonlocal attempts
+            attempts += 1
+            if attempts < 2:
+                raise RuntimeError("boom")
+            return "ok"
+
+        self.assertEqual(asyncio.run(limiter.execute(1, flaky)), "ok")
+        self.assertEqual(attempts, 2)
+
+
+class AsyncIngestTests(SimpleTestCase):
+    def setUp(self):
+        self.cfg = LLMConfig(model_name="fake", lang="de", max_terms=5)
+
+    async def _caller(self, prompt, **kwargs):
+        await asyncio.sleep(0)
+        if "JSON array" in prompt:
+            return json.dumps(["joghurtsose", "falafel"])
+        return json.dumps({"falafel": {"codes": "", "confidence": 0.0, "reason": "none"}})
+
+    def test_extract_and_map(self):
+        terms = asyncio.run(allm_extract_terms(self._caller, self.cfg, "Falafel", "mit Joghurtsoße"))
+        self.assertEqual(terms, ["joghurtsose", "falafel"])
+
+        mapped = asyncio.run(allm_map_terms_to_codes(self._caller, self.cfg, terms))
+        self.assertEqual(mapped["joghurtsose"]["codes"], "G")
+        self.assertEqual(mapped["falafel"]["reason"], "none")
+
+    def test_process_dishes_keeps_order_and_reports_progress(self):
+        seen = []
+        dishes = [(1, "Falafel", ""), (2, "Falafel Teller", ""), (3, "Wrap", "")]
+        results = asyncio.run(allm_process_dishes(
+            self._caller, self.cfg, dishes, on_result=lambda r: seen.append(r.key),
+        ))
+        self.assertEqual([r.key for r in results], [1, 2, 3])
+        self.assertEqual(sorted(seen), [1, 2, 3])
+        self.assertIn("joghurtsose", results[0].codes_lookup)
+
+    def test_process_dishes_honours_cancel(self):
+        results = asyncio.run(allm_process_dishes(
+            self._caller, self.cfg, [(1, "Falafel", "")], should_cancel=lambda: True,
+        ))
+        self.assertEqual(results, [])
+
+
+class AsyncClientReuseTests(SimpleTestCase):
+    def test_one_client_per_loop_and_settings(self):
+        async def clients():
+            return (
+                openai_client._async_client("sk-test", 60),
+                openai_client._async_client("sk-test", 60),
+                openai_client._async_client("sk-test", 30),
+            )
+
+        a, b, other_timeout = asyncio.run(clients())
+        self.assertIs(a, b)
+        self.assertIsNot(a, other_timeout)
+        self.assertIsNot(asyncio.run(clients())[0], a)  # a new loop gets its own pool
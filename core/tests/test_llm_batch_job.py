@@ -0,0 +1,286 @@
+# core/tests/test_llm_batch_job.py
+"""
+Tests for the LLM phase helpers of the batch-generate job (core/views.py):
+- dedup of identical dishes by name+description fingerprint
+- fan-out of the representative's result to every member
+- one bulk lexeme lookup for all candidate terms of a batch
+- IngredientSuggestion persistence + reuse of unchanged pending suggestions
+- sharding a large job (per section / menu / chunk) and merging shard results
+"""
+import os
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+
+from core.dictionary_models import KeywordLexeme
+from core.llm_clients import backends
+from core.models import Dish, Ingredient, IngredientSuggestion, Menu, Section
+from core.services.llm_ingest import dish_fingerprint
+from core.utils.jobs import job_manager
+from core.views import (
+    _batch_shards,
+    _fan_out_llm_items,
+    _fill_llm_candidates,
+    _group_llm_dishes,
+    _lexeme_ingredient_ids,
+    _llm_dedup_stats,
+    _merge_batch_generate_results,
+    _run_batch_generate_job,
+)
+
+
+class DishDedupTests(SimpleTestCase):
+    def test_fingerprint_normalizes_case_space_and_umlauts(self):
+        a = dish_fingerprint("Falafel  Teller", "mit Joghurtsoße")
+        b = dish_fingerprint("falafel teller", "Mit Joghurtsosse ")
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, dish_fingerprint("Falafel Teller", "mit Hummus"))
+
+    def test_group_fan_out_and_ratio(self):
+        by_id = {
+            1: Dish(id=1, name="Falafel Teller", description="mit Hummus"),
+            2: Dish(id=2, name="Schnitzel", description=""),
+            3: Dish(id=3, name="falafel teller", description="Mit Hummus"),
+            4: Dish(id=4, name="Falafel Teller", description="mit Hummus"),
+        }
+        groups = _group_llm_dishes(by_id, [1, 2, 3, 4, 99])
+        self.assertEqual(groups, {1: [1, 3, 4], 2: [2]})
+
+        items = [
+            {"dish_id": 1, "status": "ok", "reused": False, "candidates": [{"term": "hummus"}]},
+            {"dish_id": 2, "status": "empty", "reused": False, "candidates": []},
+        ]
+        out = _fan_out_llm_items(items, groups)
+        self.assertEqual([it["dish_id"] for it in out], [1, 3, 4, 2])
+        self.assertEqual(out[1]["dedup_of"], 1)
+        self.assertNotIn("dedup_of", out[0])
+        self.assertEqual(out[2]["candidates"], [{"term": "hummus"}])
+        self.assertIsNot(out[2]["candidates"][0], out[0]["candidates"][0])
+
+        stats = _llm_dedup_stats(groups)
+        self.assertEqual(stats["unique"], 2)
+        self.assertEqual(stats["llm_calls_saved"], 2)
+        self.assertEqual(stats["dedup_ratio"], 0.5)
+
+
+class BulkLexemeLookupTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(username="owner", password="x")
+        self.hummus = Ingredient.objects.create(owner=user, name="Hummus")
+        self.sesam = Ingredient.objects.create(owner=user, name="Sesam")
+        KeywordLexeme.objects.create(lang="de", term="Hummus", ingredient=self.hummus)
+        KeywordLexeme.objects.create(lang="de", term="Sesam", ingredient=self.sesam)
+        KeywordLexeme.objects.create(lang="de", term="Joghurt")  # no ingredient
+        KeywordLexeme.objects.create(lang="en", term="Weizen", ingredient=self.sesam)
+
+    def test_single_query_for_whole_batch(self):
+        with self.assertNumQueries(1):
+            lexemes = _lexeme_ingredient_ids(["hummus", "Sesam", "joghurt", "weizen", ""], "de")
+        self.assertEqual(lexemes, {"hummus": self.hummus.id, "sesam": self.sesam.id, "joghurt": None})
+
+    def test_highest_priority_lexeme_wins(self):
+        tahini = Ingredient.objects.create(owner=self.hummus.owner, name="Tahini")
+        # newer row but higher priority → wins like the old per-term .first()
+        KeywordLexeme.objects.create(lang="de", term="sesam", ingredient=tahini, priority=5)
+        self.assertEqual(_lexeme_ingredient_ids(["sesam"], "de"), {"sesam": tahini.id})
+
+    def test_fill_candidates_for_many_items(self):
+        a = {"dish_id": 1, "candidates": []}
+        b = {"dish_id": 2, "candidates": []}
+        pending = [
+            (a, ["Hummus", "Falafel"], {"hummus": {"codes": "N", "confidence": 0.9, "reason": "sesame"}}),
+            (b, ["Sesam", "Joghurt"], {}),
+        ]
+        with self.assertNumQueries(1):
+            _fill_llm_candidates(pending, "de")
+        self.assertEqual(a["candidates"][0]["mapped_ingredient_id"], self.hummus.id)
+        self.assertEqual(a["candidates"][0]["guess_codes"], "N")
+        self.assertNotIn("mapped_ingredient_id", a["candidates"][1])
+        self.assertEqual(b["candidates"][0]["mapped_ingredient_id"], self.sesam.id)
+        self.assertNotIn("mapped_ingredient_id", b["candidates"][1])
+
+
+@mock.patch.dict(os.environ, {"LLM_FAKE_LATENCY_MS": "0", "LLM_FAKE_JITTER_MS": "0"})
+class SuggestionReuseTests(TestCase):
+    def setUp(self):
+        backends.set_backend("fake")
+        self.user = get_user_model().objects.create_user(username="owner", password="x")
+        menu = Menu.objects.create(user=self.user, name="Karte")
+        section = Section.objects.create(name="Hauptgerichte", menu=menu, user=self.user)
+        self.falafel = Dish.objects.create(section=section, name="Falafel Teller", description="mit Tahini")
+        self.copy = Dish.objects.create(section=section, name="falafel teller", description="Mit Tahini")
+        self.wrap = Dish.objects.create(section=section, name="Chicken Wrap", description="mit Sesam")
+        self.payload = {"use_llm": True, "llm_async": False, "llm_model": "fake"}
+
+    def tearDown(self):
+        backends.set_backend("openai")
+
+    def _run(self):
+        job = job_manager.create(message="test")
+        with mock.patch("core.views.llm_caller", wraps=backends.llm_caller) as caller:
+            res = _run_batch_generate_job(job, self.user.id, self.payload)
+        return res["llm"], caller.call_count
+
+    def test_persists_once_then_reuses_unchanged_dishes(self):
+        llm, calls = self._run()
+        self.assertEqual(calls, 4)  # 2 unique dishes × (extract + map)
+        self.assertEqual(llm["suggestions"], {"reused": 0, "created": 3})
+        rows = IngredientSuggestion.objects.filter(dish=self.falafel)
+        self.assertEqual(rows.count(), 1)
+        self.assertEqual(len(rows[0].prompt_hash), 40)
+        self.assertNotEqual(rows[0].prompt_hash, dish_fingerprint("Falafel Teller", "mit Tahini"))
+        self.assertIn("tahini", [c["term"] for c in rows[0].candidates])
+
+        llm, calls = self._run()
+        self.assertEqual(calls, 0)
+        self.assertEqual(llm["suggestions"], {"reused": 3, "created": 0})
+        self.assertTrue(all(it["reused"] for it in llm["items"]))
+        self.assertEqual(IngredientSuggestion.objects.count(), 3)
+
+        # changed text → new LLM call + new row; reviewed rows are not reused
+        self.wrap.description = "mit Erdnuss"
+        self.wrap.save()
+        IngredientSuggestion.objects.filter(dish=self.falafel).update(status=IngredientSuggestion.STATUS_REJECTED)
+        llm, calls = self._run()
+        self.assertEqual(calls, 4)
+        self.assertEqual(llm["suggestions"], {"reused": 1, "created": 2})
+        self.assertEqual(IngredientSuggestion.objects.filter(dish=self.wrap).count(), 2)
+        self.assertEqual(IngredientSuggestion.objects.filter(dish=self.falafel).count(), 1)  # same hash: ignored
+
+    def test_changed_prompt_is_not_reused(self):
+        self._run()
+        # another prompt style / no guess_codes → the pending rows were made by a different prompt
+        for change in ({"llm_prompt_style": "compact"}, {"llm_guess_codes": False}):
+            self.payload = {"use_llm": True, "llm_async": False, "llm_model": "fake", **change}
+            llm, calls = self._run()
+            self.assertGreater(calls, 0)
+            self.assertEqual(llm["suggestions"]["reused"], 0)
+            self.assertEqual(llm["suggestions"]["created"], 3)
+        self.assertEqual(IngredientSuggestion.objects.filter(dish=self.falafel).count(), 3)
+
+        # rows without a prompt_hash (made by an unknown prompt) are regenerated, not reused
+        IngredientSuggestion.objects.update(prompt_hash=None)
+        llm, _ = self._run()
+        self.assertEqual(llm["suggestions"]["reused"], 0)
+
+
+@mock.patch.dict(os.environ, {"LLM_FAKE_LATENCY_MS": "0", "LLM_FAKE_JITTER_MS": "0"})
+@mock.patch("core.views._JOB_CHECKPOINT_EVERY", 1)
+@mock.patch("core.views._JOB_RULES_CHUNK", 2)
+class CheckpointResumeTests(TestCase):
+    def setUp(self):
+        backends.set_backend("fake")
+        self.user = get_user_model().objects.create_user(username="owner", password="x")
+        menu = Menu.objects.create(user=self.user, name="Karte")
+        section = Section.objects.create(name="Hauptgerichte", menu=menu, user=self.user)
+        for name in ("Falafel Teller", "Chicken Wrap", "Lachs Bowl", "Quark Crêpe"):
+            Dish.objects.create(section=section, name=name, description="")
+        self.payload = {
+            "use_llm": True, "llm_async": False, "llm_model": "fake",
+            "llm_guess_codes": False, "llm_reuse": False, "llm_persist": False,
+        }
+
+    def tearDown(self):
+        backends.set_backend("openai")
+
+    def test_cancelled_job_resumes_without_repeating_work(self):
+        job = job_manager.create(message="test")
+        calls = []
+
+        def cancelling_caller(prompt, **kwargs):
+            calls.append(prompt)
+            if len(calls) == 2:
+                job_manager.cancel(job.id)
+            return backends.llm_caller(prompt, **kwargs)
+
+        with mock.patch("core.views.llm_caller", cancelling_caller):
+            partial = _run_batch_generate_job(job, self.user.id, self.payload)
+        self.assertEqual(job_manager.get(job.id).status, "cancelled")
+        self.assertEqual(partial["llm"]["count"], 2)
+        ckpt = job_manager.load_checkpoint(job.id)
+        self.assertEqual(len(ckpt["missing_ids"]), 4)
+        self.assertEqual(len(ckpt["llm"]), 2)
+
+        job_manager.get(job.id).cancel_requested = False
+        with mock.patch("core.views.llm_caller", wraps=backends.llm_caller) as caller, \
+                mock.patch("core.views.rule_generate_for_dishes") as rules:
+            res = _run_batch_generate_job(job, self.user.id, self.payload)
+        rules.assert_not_called()
+        self.assertEqual(caller.call_count, 2)  # only the two dishes not yet done
+        self.assertEqual(res["llm"]["count"], 4)
+        self.assertEqual(res["resumed"]["llm_results_restored"], 2)
+        self.assertIn("falafel", [c["term"] for c in res["llm"]["items"][0]["candidates"]])
+
+
+    def test_checkpoints_append_only_new_results(self):
+        job = job_manager.create(message="test")
+        with mock.patch("core.views._JOB_CHECKPOINT_EVERY", 1), \
+                mock.patch.object(job_manager, "append_checkpoint", wraps=job_manager.append_checkpoint) as append, \
+                mock.patch.object(job_manager, "save_checkpoint", wraps=job_manager.save_checkpoint) as save:
+            _run_batch_generate_job(job, self.user.id, self.payload)
+        llm_deltas = [c.args[2] for c in append.call_args_list if c.args[1] == "llm"]
+        self.assertEqual([len(d) for d in llm_deltas], [1, 1, 1, 1])  # never the accumulated results
+        self.assertEqual(len({k for d in llm_deltas for k in d}), 4)
+        self.assertEqual(save.call_count, 1)  # only the rules → llm hand-over
+
+
+class ShardedBatchJobTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="owner", password="x")
+        self.ids = {}
+        for menu_name, sections in (("Karte", {"A": 3, "B": 2}), ("Mittag", {"C": 2})):
+            menu = Menu.objects.create(user=self.user, name=menu_name)
+            for sec_name, n in sections.items():
+                section = Section.objects.create(name=sec_name, menu=menu, user=self.user)
+                self.ids[sec_name] = [
+                    Dish.objects.create(section=section, name=f"{sec_name} Quark {i}", description="").id
+                    for i in range(n)
+                ]
+        self.qs = Dish.objects.all()
+
+    def test_batch_shards_keep_groups_together(self):
+        a, b, c = self.ids["A"], self.ids["B"], self.ids["C"]
+        self.assertEqual(_batch_shards(self.qs, "section", 3), [a, b, c])
+        self.assertEqual(_batch_shards(self.qs, "section", 4), [a, b + c])
+        self.assertEqual(_batch_shards(self.qs, "menu", 5), [a + b, c])
+        self.assertEqual([len(x) for x in _batch_shards(self.qs, "chunk", 3)], [3, 3, 1])
+
+    def test_batch_shards_keep_duplicate_dishes_together(self):
+        # نفس الطبق في القسمين A وC → شظية واحدة حتى يُسأل LLM عنه مرة واحدة
+        section_c = Dish.objects.get(pk=self.ids["C"][0]).section
+        twin = Dish.objects.create(section=section_c, name="A Quark 0", description="").id
+        shards = _batch_shards(Dish.objects.all(), "section", 4)
+        self.assertEqual(shards[0], self.ids["A"][:1] + [twin] + self.ids["A"][1:])
+        self.assertEqual(sorted(sum(shards, [])), sorted(Dish.objects.values_list("id", flat=True)))
+
+    def test_start_endpoint_shards_and_merge_matches_one_job(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        payload = {"use_llm": False, "dry_run": True, "shard_by": "section", "shard_size": 3}
+        with mock.patch.object(job_manager, "spawn_sharded") as spawn:
+            res = client.post("/api/llm/jobs/start-batch-generate/", payload, format="json")
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(res.json()["shards"], 3)
+        parent, target, shards = spawn.call_args.args
+        self.assertEqual([total for total, _, _ in shards], [3, 2, 2])
+        self.assertEqual(shards[0][1][1]["dish_ids"], self.ids["A"])
+
+        # run the shards inline and merge like the parent does
+        results = []
+        for total, args, kwargs in shards:
+            results.append(target(job_manager.create(total=total), *args, **kwargs))
+        merged = spawn.call_args.kwargs["merge"](results + [None])
+        whole = _run_batch_generate_job(job_manager.create(), self.user.id, {"use_llm": False, "dry_run": True})
+        self.assertEqual(merged["rules"]["count"], whole["rules"]["count"])
+        self.assertEqual(merged["rules"]["processed"], whole["rules"]["processed"])
+        self.assertEqual(
+            sorted(it["dish_id"] for it in merged["rules"]["items"]),
+            sorted(it["dish_id"] for it in whole["rules"]["items"]),
+        )
+        self.assertEqual(merged["shards"], {"count": 4, "with_result": 3})
+        self.assertIs(spawn.call_args.kwargs["merge"], _merge_batch_generate_results)
+
+        bad = client.post("/api/llm/jobs/start-batch-generate/", {"shard_by": "owner"}, format="json")
+        self.assertEqual(bad.status_code, 400)
@@ -0,0 +1,127 @@
+# core/tests/test_llm_direct_codes.py
+"""
+Tests for /api/llm-direct-codes/ (+ /batch/) on the fake LLM backend:
+- packed prompt parsing
+- response cache + dedup
+- NDJSON streaming, client disconnect
+"""
+import json
+import threading
+import time
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+
+from core import views
+from core.llm_clients import backends
+from core.services.llm_ingest import LLMConfig, _parse_packed_codes, llm_map_dishes_to_codes
+
+
+class PackedPromptTests(SimpleTestCase):
+    def test_parse_lines_and_missing_dish_falls_back_to_single_call(self):
+        self.assertEqual(
+            _parse_packed_codes("1: codes: A,G\n2: codes:\n[3] codes: c, x, k\n9: codes: A", 3),
+            {0: "A,G", 1: "", 2: "C,K"},
+        )
+        calls = []
+
+        def caller(prompt, **kwargs):
+            calls.append(prompt)
+            if "Gerichte:" in prompt:
+                return "1: codes: A"
+            return "codes: G"
+
+        out = llm_map_dishes_to_codes(caller, LLMConfig(), [("Pizza", ""), ("Quark", "")])
+        self.assertEqual([r["codes"] for r in out], ["A", "G"])
+        self.assertEqual(len(calls), 2)
+
+
+class DirectCodesBatchTests(TestCase):
+    URL = "/api/llm-direct-codes/batch/"
+
+    def setUp(self):
+        cache.clear()
+        backends.set_backend("fake")
+        user = get_user_model().objects.create_user(username="owner", password="x")
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        self.dishes = [
+            {"id": 1, "name": "Pizza", "description": "mit Käse"},
+            {"id": 2, "name": "Lachs Bowl", "description": "mit Sesam"},
+            {"id": 3, "name": "pizza", "description": "Mit Käse"},  # duplicate of 1
+        ]
+
+    def tearDown(self):
+        backends.set_backend("openai")
+        cache.clear()
+
+    def test_dedup_cache_and_order(self):
+        with mock.patch("core.views.llm_map_dishes_to_codes", wraps=llm_map_dishes_to_codes) as packed:
+            res = self.client.post(self.URL, {"dishes": self.dishes, "stream": False}, format="json")
+        self.assertEqual(res.status_code, 200)
+        body = res.json()
+        self.assertEqual([r["id"] for r in body["results"]], [1, 2, 3])
+        self.assertEqual(body["results"][0]["codes"], "A,G")
+        self.assertEqual(body["results"][2]["codes"], "A,G")
+        self.assertEqual(body["summary"]["unique"], 2)
+        self.assertEqual(packed.call_count, 1)
+        self.assertEqual(len(packed.call_args.args[2]), 2)  # one prompt, two unique dishes
+
+        # second round: everything from the cache
+        again = self.client.post(self.URL, {"dishes": self.dishes, "stream": False}, format="json").json()
+        self.assertTrue(all(r["cached"] for r in again["results"]))
+        self.assertEqual(again["summary"]["llm_prompts"], 0)
+
+        # the single-dish prompt is a different prompt → its own cache entry
+        single = lambda: self.client.post("/api/llm-direct-codes/", {"name": "Pizza", "description": "mit Käse"},
+                                          format="json").json()
+        first = single()
+        self.assertNotIn("cached", first)
+        self.assertEqual(first["codes"], "A,G")
+        self.assertTrue(single()["cached"])
+
+    def test_cache_key_carries_prompt_version(self):
+        cfg = LLMConfig()
+        direct = views._direct_codes_cache_key(cfg, "Pizza", "")
+        packed = views._direct_codes_cache_key(cfg, "Pizza", "", views.PACKED_CODES_PROMPT_VERSION)
+        self.assertNotEqual(direct, packed)
+        self.assertIn(views.DIRECT_CODES_PROMPT_VERSION, direct)
+        self.assertNotEqual(packed, views._direct_codes_cache_key(cfg, "Pizza", "", "packed-v2"))
+
+    def test_disconnect_cancels_pending_packs(self):
+        release = threading.Event()
+        calls = []
+
+        def slow_pack(caller, cfg, dishes):
+            calls.append(dishes)
+            if len(calls) > 1:
+                release.wait(5)
+            return [{"codes": "A", "raw": ""} for _ in dishes]
+
+        dishes = [{"id": i, "name": f"Gericht {i}", "description": ""} for i in range(12)]
+        with mock.patch("core.views.llm_map_dishes_to_codes", side_effect=slow_pack):
+            events = views._direct_codes_batch_events(LLMConfig(), dishes, 1)
+            self.assertEqual(next(events)["codes"], "A")
+            started = time.monotonic()
+            events.close()  # client went away
+            self.assertLess(time.monotonic() - started, 1)
+            release.set()
+            time.sleep(0.2)
+        # the first pack + at most the 4 packs already running; the rest never start
+        self.assertLessEqual(len(calls), 5)
+
+    def test_streams_ndjson(self):
+        res = self.client.post(self.URL, {"dishes": self.dishes, "pack_size": 1}, format="json")
+        self.assertEqual(res["Content-Type"], "application/x-ndjson")
+        lines = [json.loads(x) for x in b"".join(res.streaming_content).decode().splitlines()]
+        self.assertEqual(sorted(ev["index"] for ev in lines[:-1]), [0, 1, 2])
+        self.assertEqual(lines[-1]["done"], True)
+        self.assertEqual(lines[-1]["llm_prompts"], 2)
+
+    def test_validation(self):
+        self.assertEqual(self.client.post(self.URL, {"dishes": []}, format="json").status_code, 400)
+        too_many = [{"name": f"d{i}"} for i in range(201)]
+        self.assertEqual(self.client.post(self.URL, {"dishes": too_many}, format="json").status_code, 400)
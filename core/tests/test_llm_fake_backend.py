@@ -0,0 +1,163 @@
+# core/tests/test_llm_fake_backend.py
+"""
+Tests for the offline LLM backends:
+- FakeLLM answers, latency/429 injection through the limiter
+- record/replay cassettes
+- LLM_BACKEND switching
+"""
+import asyncio
+import os
+import tempfile
+import time
+
+from django.test import SimpleTestCase
+
+from core.llm_clients import backends
+from core.llm_clients.cassette import Cassette, CassetteMiss
+from core.llm_clients.fake_client import FakeLLM
+from core.llm_clients.limiter import AsyncRateLimiter, RateLimiter, _CircuitBreaker
+from core.llm_clients.openai_client import LLMRateLimit, LLMUnavailable
+from core.services.llm_ingest import (
+    LLMConfig,
+    allm_process_dishes,
+    llm_extract_terms,
+    llm_map_dish_to_codes,
+    llm_map_terms_to_codes,
+)
+
+
+def _limiter(retries: int = 3) -> RateLimiter:
+    return RateLimiter(rpm=0, tpm=0, concurrency=4, max_retries=retries)
+
+
+class FakeLLMTests(SimpleTestCase):
+    def setUp(self):
+        self.cfg = LLMConfig(model_name="fake", max_terms=5)
+
+    def test_answers_ingest_prompts(self):
+        fake = FakeLLM(latency_ms=0, jitter_ms=0, limiter=_limiter())
+        terms = llm_extract_terms(fake.caller, self.cfg, "Chicken Wrap", "mit Joghurtsoße und Sesam")
+        self.assertEqual(terms, ["chicken", "wrap", "joghurtsosse", "sesam"])
+        mapped = llm_map_terms_to_codes(fake.caller, self.cfg, ["chicken", "tahinicreme"])
+        self.assertEqual(mapped["tahinicreme"]["codes"], "K")
+        self.assertEqual(mapped["chicken"]["codes"], "")
+        self.assertEqual(fake.limiter.usage_stats()["fake"]["calls"], 2)
+
+    def test_injected_429s_are_retried_then_surface(self):
+        flaky = FakeLLM(latency_ms=0, jitter_ms=0, rate_limit_rate=0.5, retry_after_sec=0.0,
+                        seed=1, limiter=_limiter(retries=10))
+        for _ in range(5):
+            self.assertEqual(flaky.caller("ping"), "OK")
+        self.assertGreater(flaky.calls, 5)
+
+        always = FakeLLM(latency_ms=0, jitter_ms=0, rate_limit_rate=1.0, retry_after_sec=0.0,
+                         limiter=_limiter(retries=2))
+        with self.assertRaises(LLMRateLimit):
+            always.caller("ping")
+        self.assertEqual(always.calls, 2)
+
+    def test_open_breaker_falls_back_to_heuristics(self):
+        lim = RateLimiter(rpm=0, tpm=0, max_retries=1,
+                          breaker=_CircuitBreaker(threshold=0.5, window=1, min_calls=1, cooldown_sec=60))
+        broken = FakeLLM(latency_ms=0, jitter_ms=0, error_rate=1.0, limiter=lim)
+        with self.assertRaises(Exception):
+            broken.caller("ping")
+        with self.assertRaises(LLMUnavailable):
+            broken.caller("ping")
+        calls = broken.calls
+
+        mapped = llm_map_terms_to_codes(broken.caller, self.cfg, ["kaese", "tahinicreme"])
+        self.assertEqual(mapped["kaese"]["codes"], "G")  # heuristic
+        self.assertEqual(mapped["tahinicreme"]["reason"], "llm_unavailable")
+        res = llm_map_dish_to_codes(broken.caller, self.cfg, "Spätzle", "mit Käse und Senf")
+        self.assertEqual(res["fallback"], "heuristic")
+        self.assertEqual(res["codes"], "G,J")
+        self.assertEqual(broken.calls, calls)  # no provider call while open
+
+    def test_same_seed_is_reproducible(self):
+        def run(seed):
+            fake = FakeLLM(latency_ms=0, jitter_ms=5, error_rate=0.3, seed=seed, limiter=_limiter(retries=1))
+            out = []
+            for _ in range(10):
+                try:
+                    out.append(fake.caller("ping"))
+                except Exception:
+                    out.append("err")
+            return out
+
+        self.assertEqual(run(7), run(7))
+
+    def test_async_pipeline(self):
+        fake = FakeLLM(latency_ms=1, jitter_ms=0, limiter=_limiter())
+        dishes = [(i, "Falafel Teller", "mit Tahini") for i in range(6)]
+        results = asyncio.run(allm_process_dishes(fake.acaller, self.cfg, dishes))
+        self.assertEqual([r.key for r in results], list(range(6)))
+        self.assertIn("tahini", results[0].terms)
+
+    def test_async_cancel_stops_queued_dishes(self):
+        # 2 slots, all 6 dishes start at once: the cancel (after the first two extract calls)
+        # must stop the dishes waiting for a slot and the map step of the running ones
+        lim = _limiter()
+        fake = FakeLLM(latency_ms=20, jitter_ms=0, limiter=lim, async_limiter=AsyncRateLimiter(lim, concurrency=2))
+        dishes = [(i, "Falafel Teller", "mit Tahini") for i in range(6)]
+        results = asyncio.run(allm_process_dishes(fake.acaller, self.cfg, dishes, should_cancel=lambda: fake.calls >= 2))
+        self.assertEqual(results, [])
+        self.assertEqual(fake.calls, 2)
+
+
+async def _async_ok():
+    return "OK"
+
+
+class CassetteTests(SimpleTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".jsonl")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_record_then_replay_without_backend(self):
+        fake = FakeLLM(latency_ms=0, jitter_ms=0, limiter=_limiter())
+        rec = Cassette(self.path, mode="record", limiter=_limiter())
+        recorded = rec.wrap(fake.caller)("ping", model_name="m")
+        self.assertEqual(recorded, "OK")
+
+        replay = Cassette(self.path, mode="replay", limiter=_limiter())
+        self.assertEqual(len(replay), 1)
+        self.assertEqual(replay.wrap()("ping", model_name="m"), "OK")
+        self.assertEqual(asyncio.run(replay.wrap_async()("ping", model_name="m")), "OK")
+        with self.assertRaises(CassetteMiss):
+            replay.wrap()("ping", model_name="other-model")
+
+    def test_records_provider_time_not_queueing(self):
+        lim = _limiter()
+
+        def queued_caller(prompt, **kwargs):
+            time.sleep(0.2)  # waiting for budget / a concurrency slot
+            return lim.execute(1, lambda: "OK")
+
+        async def queued_acaller(prompt, **kwargs):
+            await asyncio.sleep(0.2)
+            return await AsyncRateLimiter(lim).execute(1, _async_ok)
+
+        rec = Cassette(self.path, mode="record", limiter=_limiter())
+        rec.wrap(queued_caller)("ping", model_name="m")
+        asyncio.run(rec.wrap_async(queued_acaller)("pong", model_name="m"))
+        latencies = [row["latency_sec"] for row in rec._entries.values()]
+        self.assertEqual(len(latencies), 2)
+        self.assertTrue(all(x < 0.1 for x in latencies), latencies)
+
+    def test_bad_mode(self):
+        with self.assertRaises(ValueError):
+            Cassette(self.path, mode="rewind")
+
+
+class BackendSwitchTests(SimpleTestCase):
+    def tearDown(self):
+        backends.set_backend("openai")
+
+    def test_fake_backend_via_set_backend(self):
+        self.assertEqual(backends.set_backend("fake"), "fake")
+        self.assertEqual(backends.current_backend(), "fake")
+        self.assertEqual(backends.llm_caller("ping", model_name="x"), "OK")
@@ -0,0 +1,453 @@
+# core/tests/test_llm_limiter.py
+"""
+Tests for core/llm_clients/limiter:
+- token bucket refill / burst cap
+- budget stores (local vs. shared SQLite file)
+- FIFO admission of waiters
+- adaptive budgets from x-ratelimit-* headers
+- usage reconciliation / per-model averages
+- rolling latency percentiles feeding the ETA
+- circuit breaker and hedged async attempts
+- config/stats snapshots used by /api/llm/limits
+"""
+import asyncio
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from core.llm_clients.limiter import (
+    _Budget,
+    _CircuitBreaker,
+    AsyncRateLimiter,
+    CircuitOpenError,
+    RateLimiter,
+    LocalBudgetStore,
+    SQLiteBudgetStore,
+    build_budget_store,
+    estimate_eta,
+    parse_ratelimit_headers,
+)
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_refills_continuously_up_to_burst(self):
+        with mock.patch("core.llm_clients.limiter.time.time", return_value=1000.0):
+            b = _Budget(60, burst_seconds=5)  # 1 token/sec, burst 5
+            self.assertEqual(b.burst, 5.0)
+            self.assertTrue(b.take(5))
+            self.assertFalse(b.take(1))
+            self.assertAlmostEqual(b.time_until_available(1), 1.0)
+        with mock.patch("core.llm_clients.limiter.time.time", return_value=1002.5):
+            self.assertAlmostEqual(b.level, 0.0)
+            b.refresh_if_needed()
+            self.assertAlmostEqual(b.level, 2.5)  # fractional accounting
+        with mock.patch("core.llm_clients.limiter.time.time", return_value=1100.0):
+            b.refresh_if_needed()
+            self.assertEqual(b.level, 5.0)  # capped at burst
+
+    def test_oversized_request_admitted_from_full_bucket(self):
+        with mock.patch("core.llm_clients.limiter.time.time", return_value=1000.0):
+            b = _Budget(600, burst_seconds=10)  # burst 100
+            self.assertTrue(b.take(250))
+            self.assertLess(b.level, 0)  # debt is paid back by refill
+            self.assertFalse(b.take(1))
+
+
+class BudgetStoreTests(SimpleTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(fd)
+
+    def tearDown(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def test_local_store_is_per_limiter(self):
+        a = RateLimiter(rpm=2, tpm=0, store=LocalBudgetStore(2, 0, burst_seconds=60))
+        b = RateLimiter(rpm=2, tpm=0, store=LocalBudgetStore(2, 0, burst_seconds=60))
+        self.assertEqual(a._try_take(1), 0.0)
+        self.assertEqual(a._try_take(1), 0.0)
+        self.assertGreater(a._try_take(1), 0.0)
+        # b has its own reservoir
+        self.assertEqual(b._try_take(1), 0.0)
+
+    def test_sqlite_store_is_shared(self):
+        # two limiters ≈ two gunicorn workers pointing at the same file
+        a = RateLimiter(rpm=3, tpm=100, store=SQLiteBudgetStore(self.path, 3, 100, burst_seconds=60))
+        b = RateLimiter(rpm=3, tpm=100, store=SQLiteBudgetStore(self.path, 3, 100, burst_seconds=60))
+        self.assertEqual(a._try_take(10), 0.0)
+        self.assertEqual(b._try_take(10), 0.0)
+        self.assertEqual(a._try_take(10), 0.0)
+        self.assertGreater(b._try_take(10), 0.0)
+        self.assertEqual(a.budgets()["rpm_remaining"], 0)
+        self.assertEqual(b.budgets()["tpm_remaining"], 70)
+
+    def test_failed_reservation_consumes_nothing(self):
+        lim = RateLimiter(rpm=5, tpm=50, store=SQLiteBudgetStore(self.path, 5, 50, burst_seconds=60))
+        self.assertEqual(lim._try_take(40), 0.0)
+        self.assertGreater(lim._try_take(30), 0.0)
+        snap = lim.budgets()
+        self.assertEqual(snap["rpm_remaining"], 4)
+        self.assertEqual(snap["tpm_remaining"], 10)
+
+    def test_shared_completed_counter_and_config(self):
+        a = RateLimiter(rpm=0, tpm=0, store=SQLiteBudgetStore(self.path, 0, 0))
+        b = RateLimiter(rpm=0, tpm=0, store=SQLiteBudgetStore(self.path, 0, 0))
+        a.execute(1, lambda: "x")
+        b.execute(1, lambda: "y")
+        stats = a.stats()
+        self.assertEqual(stats["completed"], 1)
+        self.assertEqual(stats["completed_all_processes"], 2)
+        cfg = a.config()
+        self.assertEqual(cfg["backend"], "sqlite")
+        self.assertTrue(cfg["shared"])
+
+    def test_budgets_snapshot_takes_no_write_lock(self):
+        lim = RateLimiter(rpm=5, tpm=0, store=SQLiteBudgetStore(self.path, 5, 0, timeout=0.2, burst_seconds=60))
+        lim._try_take(0)
+        other = sqlite3.connect(self.path, isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")  # another worker is mid-reservation
+        try:
+            self.assertEqual(lim.budgets()["rpm_remaining"], 4)
+        finally:
+            other.execute("ROLLBACK")
+            other.close()
+
+    def test_async_store_ops_do_not_block_the_event_loop(self):
+        lim = RateLimiter(rpm=0, tpm=0, store=SQLiteBudgetStore(self.path, 0, 0, timeout=5))
+        alim = AsyncRateLimiter(lim)
+        other = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        other.execute("BEGIN IMMEDIATE")  # another worker holds the write lock for 0.3s
+        threading.Timer(0.3, lambda: (other.execute("ROLLBACK"), other.close())).start()
+
+        async def _call():
+            return "ok"
+
+        async def main():
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while not call.done():
+                    ticks += 1
+                    await asyncio.sleep(0.01)
+
+            call = asyncio.ensure_future(alim.execute(1, _call))
+            await asyncio.gather(call, ticker())
+            return call.result(), ticks
+
+        result, ticks = asyncio.run(main())
+        self.assertEqual(result, "ok")
+        self.assertGreater(ticks, 10)  # the loop kept running while the store was locked
+
+    def test_build_store_defaults_to_local(self):
+        self.assertIsInstance(build_budget_store(10, 10, backend="local"), LocalBudgetStore)
+
+
+class FifoAdmissionTests(SimpleTestCase):
+    def test_waiters_are_admitted_in_arrival_order(self):
+        lim = RateLimiter(rpm=600, tpm=0, store=LocalBudgetStore(600, 0, burst_seconds=0))
+        order = []
+        threads = []
+        for i in range(4):
+            t = threading.Thread(target=lambda i=i: (lim._await_budgets(1), order.append(i)))
+            threads.append(t)
+            t.start()
+            time.sleep(0.02)  # make arrival order deterministic
+        for t in threads:
+            t.join(timeout=5)
+        self.assertEqual(order, [0, 1, 2, 3])
+
+
+class AdaptiveHeaderTests(SimpleTestCase):
+    HEADERS = {
+        "x-ratelimit-limit-requests": "500",
+        "x-ratelimit-remaining-requests": "2",
+        "x-ratelimit-reset-requests": "120ms",
+        "x-ratelimit-limit-tokens": "200000",
+        "x-ratelimit-remaining-tokens": "150000",
+        "x-ratelimit-reset-tokens": "6m0s",
+    }
+
+    def test_parse_headers(self):
+        info = parse_ratelimit_headers(self.HEADERS)
+        self.assertEqual(info["limit_requests"], 500)
+        self.assertAlmostEqual(info["reset_requests_sec"], 0.12)
+        self.assertEqual(info["reset_tokens_sec"], 360.0)
+        self.assertEqual(parse_ratelimit_headers({"x-ratelimit-limit-tokens": "n/a"}), {})
+
+    def test_headers_set_capacity_and_cap_remaining(self):
+        lim = RateLimiter(rpm=60, tpm=100_000, store=LocalBudgetStore(60, 100_000, burst_seconds=60))
+        lim.observe_headers(self.HEADERS)
+        cfg = lim.config()
+        self.assertEqual((cfg["rpm"], cfg["tpm"]), (500, 200_000))
+        snap = lim.budgets()
+        self.assertEqual(snap["rpm_remaining"], 2)
+        self.assertEqual(snap["provider"]["remaining_tokens"], 150_000)
+        self.assertEqual(lim._try_take(1), 0.0)
+        self.assertEqual(lim._try_take(1), 0.0)
+        self.assertGreater(lim._try_take(1), 0.0)
+
+    def test_shared_store_learns_capacity(self):
+        fd, path = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(fd)
+        try:
+            lim = RateLimiter(rpm=10, tpm=0, store=SQLiteBudgetStore(path, 10, 0, burst_seconds=60))
+            lim.observe_headers({"x-ratelimit-limit-requests": "120"})
+            self.assertAlmostEqual(lim.budgets()["rpm_refill_per_sec"], 2.0)
+        finally:
+            os.remove(path)
+
+    def test_learned_capacity_is_shared_between_processes(self):
+        fd, path = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(fd)
+        try:
+            a = RateLimiter(rpm=10, tpm=0, store=SQLiteBudgetStore(path, 10, 0, burst_seconds=60))
+            b = RateLimiter(rpm=10, tpm=0, store=SQLiteBudgetStore(path, 10, 0, burst_seconds=60))
+            a.observe_headers({"x-ratelimit-limit-requests": "120"})
+            # b never saw the headers but refills at the learned rate
+            self.assertAlmostEqual(b.budgets()["rpm_refill_per_sec"], 2.0)
+            self.assertEqual(b.limits()[0], 120)
+            self.assertEqual(b.config()["rpm"], 120)
+            b._try_take(1)
+            self.assertEqual(a.limits()[0], 120)  # b's transaction keeps the shared value
+
+            # a restart with the same env keeps the learned limit; a changed env wins
+            self.assertEqual(SQLiteBudgetStore(path, 10, 0).peek()["rpm"].capacity, 120)
+            self.assertEqual(SQLiteBudgetStore(path, 30, 0).peek()["rpm"].capacity, 30)
+        finally:
+            os.remove(path)
+
+    def test_non_adaptive_ignores_headers(self):
+        lim = RateLimiter(rpm=60, tpm=0, adaptive=False)
+        lim.observe_headers(self.HEADERS)
+        self.assertEqual(lim.config()["rpm"], 60)
+        self.assertNotIn("provider", lim.budgets())
+
+
+class UsageReconcileTests(SimpleTestCase):
+    def test_unused_reservation_is_refunded(self):
+        lim = RateLimiter(rpm=0, tpm=1000, store=LocalBudgetStore(0, 1000, burst_seconds=60))
+        self.assertEqual(lim._try_take(600), 0.0)
+        lim.reconcile(600, model="m", prompt_tokens=100, completion_tokens=50, cached_tokens=80)
+        self.assertEqual(lim.budgets()["tpm_remaining"], 850)
+        usage = lim.usage_stats()["m"]
+        self.assertEqual(usage["avg_total_tokens"], 150.0)
+        self.assertEqual(usage["refunded_tokens"], 450)
+        self.assertEqual(usage["cached_prompt_ratio"], 0.8)
+
+    def test_missing_usage_keeps_reservation(self):
+        lim = RateLimiter(rpm=0, tpm=1000, store=LocalBudgetStore(0, 1000, burst_seconds=60))
+        lim._try_take(600)
+        lim.reconcile(600, model="m")
+        self.assertEqual(lim.budgets()["tpm_remaining"], 400)
+        self.assertEqual(lim.usage_stats(), {})
+
+    def test_running_average_per_model(self):
+        lim = RateLimiter(rpm=0, tpm=0)
+        self.assertEqual(lim.avg_tokens_per_call("m"), 1500)
+        lim.reconcile(500, model="m", prompt_tokens=100, completion_tokens=100)
+        lim.reconcile(500, model="m", prompt_tokens=300, completion_tokens=100)
+        lim.reconcile(500, model="other", prompt_tokens=1000, completion_tokens=0)
+        self.assertEqual(lim.avg_tokens_per_call("m"), 300)
+        self.assertEqual(lim.avg_tokens_per_call(None), 534)
+
+    def test_estimate_eta_uses_observed_average(self):
+        lim = RateLimiter(rpm=100000, tpm=1000, concurrency=1000)
+        lim.reconcile(500, model="tiny", prompt_tokens=5, completion_tokens=5)
+        with mock.patch("core.llm_clients.limiter.global_limiter", lim):
+            rate_obs, _ = estimate_eta(10, model="tiny", p95_latency_sec=1)
+            rate_fix, _ = estimate_eta(10, avg_tokens_per_call=1500, p95_latency_sec=1)
+        self.assertEqual(rate_obs, 100.0)  # 1000 TPM / 10 tokens
+        self.assertEqual(rate_fix, 1.0)
+
+
+class LatencyStatsTests(SimpleTestCase):
+    def test_rolling_percentiles_per_model(self):
+        lim = RateLimiter(rpm=0, tpm=0, latency_window=10)
+        for i in range(1, 21):  # only the last 10 samples (11..20) are kept
+            lim._record_completion(wait_sec=i / 100.0, call_sec=float(i), model="m")
+        snap = lim.latency_stats()["m"]
+        self.assertEqual(snap["calls"], 20)
+        self.assertEqual(snap["window"], 10)
+        self.assertEqual(snap["call_p50_sec"], 15.0)
+        self.assertEqual(snap["call_p95_sec"], 20.0)
+        self.assertEqual(snap["wait_p50_sec"], 0.15)
+        self.assertEqual(lim.latency_p95("m"), 20.0)
+        self.assertEqual(lim.latency_p95("unknown-model-pools-all"), 20.0)
+        self.assertEqual(RateLimiter(rpm=0, tpm=0).latency_p95("m"), 2.5)
+
+    def test_execute_records_model_latency(self):
+        lim = RateLimiter(rpm=0, tpm=0)
+        lim.execute(1, lambda: "ok", model="gpt-x")
+        self.assertIn("gpt-x", lim.stats()["latency"])
+
+    def test_estimate_eta_uses_observed_p95(self):
+        lim = RateLimiter(rpm=0, tpm=0, concurrency=2)
+        for _ in range(5):
+            lim._record_completion(0.0, 0.5, model="fast")
+        with mock.patch("core.llm_clients.limiter.global_limiter", lim):
+            rate_obs, _ = estimate_eta(10, model="fast")
+            rate_def, _ = estimate_eta(10, p95_latency_sec=2.5)
+            rate_async, _ = estimate_eta(10, p95_latency_sec=2.5, concurrency=20)
+        self.assertEqual(rate_obs, 240.0)  # 2 slots * 60s / 0.5s
+        self.assertEqual(rate_def, 48.0)
+        self.assertEqual(rate_async, 480.0)
+
+    def test_estimate_eta_follows_limits_learned_from_headers(self):
+        lim = RateLimiter(rpm=5000, tpm=0, concurrency=1000)
+        with mock.patch("core.llm_clients.limiter.global_limiter", lim), \
+                mock.patch.dict(os.environ, {"LLM_RPM": "5000"}):
+            self.assertEqual(estimate_eta(10, p95_latency_sec=1)[0], 5000.0)
+            lim.observe_headers({"x-ratelimit-limit-requests": "500"})
+            rate, minutes = estimate_eta(100, calls_per_item=1, p95_latency_sec=1)
+        self.assertEqual(rate, 500.0)
+        self.assertEqual(minutes, 0.2)
+
+
+class _Status(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"http {status_code}")
+        self.status_code = status_code
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def test_opens_on_error_rate_and_recovers_after_probe(self):
+        br = _CircuitBreaker(threshold=0.5, window=4, min_calls=4, cooldown_sec=0.05)
+        for ok in (True, False, True, False):
+            self.assertTrue(br.allow())
+            br.record(ok)
+        self.assertEqual(br.state, "open")
+        self.assertFalse(br.allow())
+        time.sleep(0.06)
+        self.assertTrue(br.allow())   # single half-open probe
+        self.assertFalse(br.allow())
+        br.record(True)
+        self.assertEqual(br.state, "closed")
+        self.assertEqual(br.snapshot()["trips"], 1)
+
+    def test_execute_fails_fast_and_skips_retries(self):
+        br = _CircuitBreaker(threshold=0.5, window=2, min_calls=2, cooldown_sec=60)
+        lim = RateLimiter(rpm=0, tpm=0, max_retries=6, breaker=br)
+        attempts = 0
+
+        def boom():
+            nonlocal attempts
+            attempts += 1
+            raise _Status(500)
+
+        with mock.patch("core.llm_clients.limiter._retry_wait", return_value=0.0):
+            with self.assertRaises(CircuitOpenError):
+                lim.execute(1, boom)
+        self.assertEqual(attempts, 2)  # breaker opened after two failures, no more retries
+        with self.assertRaises(CircuitOpenError):
+            lim.execute(1, boom)
+        self.assertEqual(attempts, 2)
+        self.assertEqual(lim.budgets()["breaker"]["state"], "open")
+
+    def test_rate_limits_do_not_trip(self):
+        br = _CircuitBreaker(threshold=0.5, window=2, min_calls=2)
+        lim = RateLimiter(rpm=0, tpm=0, breaker=br)
+        lim._record_attempt(_Status(429))
+        lim._record_attempt(_Status(429))
+        self.assertEqual(br.state, "closed")
+
+    def test_only_provider_failures_trip(self):
+        class APITimeoutError(Exception):  # stands in for openai.APITimeoutError
+            pass
+
+        br = _CircuitBreaker(threshold=0.5, window=2, min_calls=2)
+        lim = RateLimiter(rpm=0, tpm=0, breaker=br)
+        # auth / prompt too long / our own bugs say nothing about the provider
+        for e in (_Status(401), _Status(400), KeyError("choices"), ValueError("bad prompt")):
+            lim._record_attempt(e)
+        self.assertEqual(br.snapshot()["window"], 0)
+        lim._record_attempt(APITimeoutError())
+        lim._record_attempt(ConnectionResetError())
+        self.assertEqual(br.state, "open")
+
+        br = _CircuitBreaker(threshold=0.5, window=2, min_calls=2)
+        lim = RateLimiter(rpm=0, tpm=0, breaker=br)
+        lim._record_attempt(_Status(503))
+        lim._record_attempt(TimeoutError())
+        self.assertEqual(br.state, "open")
+
+
+class HedgingTests(SimpleTestCase):
+    def test_slow_attempt_is_hedged_and_hedge_wins(self):
+        core = RateLimiter(rpm=0, tpm=0, hedge=True, hedge_min_samples=3)
+        for _ in range(3):
+            core._record_attempt_latency(0.02, model="m")
+        limiter = AsyncRateLimiter(core, concurrency=4)
+        delays = [1.0, 0.0]  # first request hangs, hedge answers at once
+
+        async def call():
+            delay = delays.pop(0)
+            await asyncio.sleep(delay)
+            return "slow" if delay else "fast"
+
+        t0 = time.monotonic()
+        self.assertEqual(asyncio.run(limiter.execute(1, call, model="m")), "fast")
+        self.assertLess(time.monotonic() - t0, 0.5)
+        self.assertEqual(core.budgets()["hedges"], {"fired": 1, "won": 1})
+
+    def test_no_hedge_without_samples_or_budget(self):
+        core = RateLimiter(rpm=0, tpm=0, hedge=True, hedge_min_samples=3)
+        self.assertIsNone(core.hedge_delay("m"))
+        self.assertIsNone(RateLimiter(rpm=0, tpm=0).hedge_delay("m"))
+
+        tight = RateLimiter(rpm=1, tpm=0, hedge=True, hedge_min_samples=1,
+                            store=LocalBudgetStore(1, 0, burst_seconds=60))
+        tight._record_attempt_latency(0.01, model="m")
+        limiter = AsyncRateLimiter(tight)
+
+        async def call():
+            await asyncio.sleep(0.05)
+            return "ok"
+
+        self.assertEqual(asyncio.run(limiter.execute(0, call, model="m")), "ok")
+        self.assertEqual(tight.budgets()["hedges"]["fired"], 0)
+
+    def test_hedge_delay_ignores_retry_backoff(self):
+        core = RateLimiter(rpm=0, tpm=0, hedge=True, hedge_min_samples=3)
+        for _ in range(5):
+            core._record_completion(0.0, 8.0, model="m")  # calls that sat in retry backoff
+            core._record_attempt_latency(0.2, model="m")
+        self.assertAlmostEqual(core.hedge_delay("m"), 0.2)
+        self.assertFalse(RateLimiter(rpm=0, tpm=0)._hedge)
+
+    def test_losing_request_is_settled_and_waiters_are_not_overtaken(self):
+        store = LocalBudgetStore(60, 1000, burst_seconds=60)
+        core = RateLimiter(rpm=60, tpm=1000, hedge=True, hedge_min_samples=1, store=store)
+        core._record_attempt_latency(0.01, model="m")
+        limiter = AsyncRateLimiter(core)
+        delays = [1.0, 0.0]
+
+        async def call():
+            delay = delays.pop(0)
+            await asyncio.sleep(delay)
+            return "ok"
+
+        with mock.patch("core.llm_clients.limiter.time.time", return_value=1000.0):
+            asyncio.run(limiter.execute(100, call, model="m", prompt_tokens=30))
+            core.reconcile(100, model="m", prompt_tokens=30, completion_tokens=10)  # the caller's winner
+            budgets = core.budgets()
+        self.assertEqual(budgets["hedges"]["fired"], 1)
+        self.assertEqual(budgets["rpm_remaining"], 58)  # both requests were sent
+        self.assertEqual(budgets["tpm_remaining"], 1000 - 40 - 30)  # winner's usage + loser's prompt
+
+        # a request queued for budget: no hedge may jump ahead of it
+        queued = RateLimiter(rpm=0, tpm=0, hedge=True, hedge_min_samples=1)
+        queued._record_attempt_latency(0.01, model="m")
+        queued._next_ticket += 1  # a thread holds a ticket
+        delays[:] = [0.1, 0.0]
+        asyncio.run(AsyncRateLimiter(queued).execute(1, call, model="m"))
+        self.assertEqual(queued.budgets()["hedges"]["fired"], 0)
+
@@ -0,0 +1,74 @@
+# core/tests/test_llm_prompts.py
+"""
+Tests for the LLM prompt templates (core/services/llm_ingest.py):
+- stable static prefix shared by every dish (provider prompt caching)
+- compact variant driven by the Allergen table
+- llm_prompt_report command
+"""
+import json
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+
+from core.models import Allergen
+from core.services.llm_ingest import (
+    LLMConfig,
+    _build_extract_prompt,
+    _build_map_prompt,
+    extract_prompt_prefix,
+    map_prompt_prefix,
+)
+from core.views import _llm_prompt_options
+
+
+class PromptPrefixTests(SimpleTestCase):
+    def test_variable_part_comes_after_the_shared_prefix(self):
+        for style in ("full", "compact"):
+            cfg = LLMConfig(prompt_style=style, max_terms=7)
+            a = _build_extract_prompt(cfg, "Falafel Teller", "mit Tahini")
+            b = _build_extract_prompt(cfg, "Chicken Wrap", "")
+            self.assertTrue(a.startswith(extract_prompt_prefix(cfg)))
+            self.assertTrue(b.startswith(extract_prompt_prefix(cfg)))
+            self.assertIn("Output <= 7 items", a.split(extract_prompt_prefix(cfg), 1)[1])
+            m = _build_map_prompt(["tahini"], "de", cfg)
+            self.assertTrue(m.startswith(map_prompt_prefix(cfg)))
+            self.assertTrue(m.endswith('["tahini"]\n\nReturn ONLY JSON object:'))
+
+    def test_compact_is_shorter_and_uses_given_labels(self):
+        full = _build_map_prompt(["tahini"], "de", LLMConfig(prompt_style="full"))
+        labels = {"G": "Milch (einschl. Laktose)", "I": "Sellerie", "L": "Schwefeldioxid/Sulfite", "M": "Lupinen"}
+        compact = _build_map_prompt(["tahini"], "de", LLMConfig(prompt_style="compact", allergen_labels=labels))
+        self.assertLess(len(compact), len(full) / 3)
+        self.assertIn("G=Milch (einschl. Laktose);", compact)
+
+    def test_compact_uses_the_same_letters_as_the_full_prompt(self):
+        # the seeded table has I=Sellerie, M=Lupinen; full prompt/heuristics say L=Sellerie, N=Lupine
+        labels = {"I": "Sellerie", "L": "Schwefeldioxid/Sulfite", "M": "Lupinen"}
+        compact = map_prompt_prefix(LLMConfig(prompt_style="compact", allergen_labels=labels))
+        full = map_prompt_prefix(LLMConfig(prompt_style="full"))
+        self.assertIn("L=Sellerie;", compact)
+        self.assertIn("N=Lupinen", compact)
+        self.assertIn("L = Sellerie", full)
+        self.assertNotIn("I=", compact)
+        self.assertNotIn("Sulfite", compact)
+
+
+class PromptOptionsTests(TestCase):
+    def test_compact_reads_allergen_table(self):
+        Allergen.objects.create(code="A", label_de="Gluten")
+        Allergen.objects.create(code="I", label_de="Sellerie")
+        Allergen.objects.create(code="12", label_de="Antioxidationsmittel", kind=Allergen.Kind.ADDITIVE)
+        self.assertEqual(_llm_prompt_options("full"), {"prompt_style": "full"})
+        opts = _llm_prompt_options("compact")
+        self.assertEqual(opts["allergen_labels"], {"A": "Gluten", "I": "Sellerie"})
+
+    def test_report_command(self):
+        out = StringIO()
+        call_command("llm_prompt_report", "--json", stdout=out)
+        report = json.loads(out.getvalue())
+        rows = {(r["template"], r["style"]): r for r in report["templates"]}
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[("map", "full")]["saving_vs_full"], 0.0)
+        self.assertGreater(rows[("map", "compact")]["saving_vs_full"], 0.5)
+        self.assertGreater(rows[("extract", "full")]["static_share"], 0.5)
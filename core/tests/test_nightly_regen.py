@@ -0,0 +1,80 @@
+# core/tests/test_nightly_regen.py
+"""
+Tests for `manage.py nightly_regen`:
+- first run covers every owner, an unchanged owner is skipped next time
+- dish edits → incremental (only edited dishes); lexicon changes → full
+- lexicon maintenance (stale normalized_term) and the JSON run report
+"""
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from core.dictionary_models import KeywordLexeme
+from core.models import Allergen, Dish, Menu, OwnerRegenState, Section, User
+
+
+class NightlyRegenTests(TestCase):
+    def setUp(self):
+        self.milk = Allergen.objects.create(code="G", label_de="Milch")
+        self.owners = []
+        for name in ("a", "b"):
+            user = User.objects.create_user(username=name, password="x")
+            section = Section.objects.create(name="Suppen", menu=Menu.objects.create(user=user, name="Karte"), user=user)
+            Dish.objects.create(section=section, name="Sahnesuppe", description="mit Sahne")
+            Dish.objects.create(section=section, name="Brot", description="")
+            self.owners.append(user)
+        self.lexeme = KeywordLexeme.objects.create(term="Sahne", lang="de", is_active=True, owner=self.owners[0])
+        self.lexeme.allergens.add(self.milk)
+
+    def _run(self, *args):
+        fd, path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        call_command("nightly_regen", "--workers", "1", "--report", path, *args, stdout=StringIO())
+        with open(path, encoding="utf-8") as fh:
+            return json.load(fh)
+
+    def test_first_run_then_only_changed_owners(self):
+        report = self._run()
+        self.assertEqual((report["owners"]["total"], report["owners"]["dirty"], report["owners"]["done"]), (2, 2, 2))
+        self.assertEqual(report["totals"]["dishes_scanned"], 4)
+        self.assertEqual({r["reason"] for r in report["per_owner"]}, {"first run"})
+        self.assertGreater(report["totals"]["queries"], 0)
+        self.assertIn("seconds", report["per_owner"][0])
+        self.assertEqual(Dish.objects.get(section__menu__user=self.owners[0], name="Sahnesuppe").codes, "(G)")
+        self.assertEqual(OwnerRegenState.objects.count(), 2)
+
+        # nothing changed: nobody runs; the codes write above did not mark dishes as edited
+        self.assertEqual(self._run()["owners"]["dirty"], 0)
+
+        dish = Dish.objects.filter(section__menu__user=self.owners[1]).first()
+        dish.description = "mit Sahne"
+        dish.save()
+        report = self._run()
+        self.assertEqual([(r["owner_id"], r["mode"], r["dishes_scanned"]) for r in report["per_owner"]],
+                         [(self.owners[1].id, "incremental", 1)])
+
+        self.lexeme.term = "Sahnesuppe"
+        self.lexeme.save()
+        report = self._run()
+        self.assertEqual([(r["owner_id"], r["mode"], r["reason"]) for r in report["per_owner"]],
+                         [(self.owners[0].id, "full", "lexicon changed")])
+
+    def test_global_lexicon_change_and_maintenance(self):
+        self._run()
+        KeywordLexeme.objects.filter(pk=self.lexeme.pk).update(normalized_term="stale")
+        glob = KeywordLexeme.objects.create(term="Brot", lang="de", is_active=True, owner=None)
+        report = self._run("--dry-run")
+        self.assertEqual([r["reason"] for r in report["per_owner"]], ["lexicon changed", "lexicon changed"])
+        self.assertEqual(report["totals"]["lexemes_repaired"], 0)  # dry run touches nothing
+
+        report = self._run()
+        self.assertEqual(report["owners"]["done"], 2)
+        self.assertEqual(report["totals"]["lexemes_repaired"], 1)
+        self.lexeme.refresh_from_db()
+        self.assertEqual(self.lexeme.normalized_term, "sahne")
+        self.assertTrue(KeywordLexeme.objects.filter(pk=glob.pk).exists())
@@ -0,0 +1,160 @@
+# core/tests/test_public_menu.py
+"""
+Tests for materialized public-menu snapshots (core/services/public_menu.py):
+- publish builds the snapshot, guests are served from it without queries
+- missing snapshot is built on first request; unpublish removes it
+- edits of published menus queue a coalesced rebuild, drafts do not
+- conditional GETs (ETag / Last-Modified → 304) and Cache-Control
+"""
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils.http import http_date
+from rest_framework.test import APIClient
+
+from core import signals
+from core.dictionary_models import KeywordLexeme
+from core.models import Allergen, Dish, DishPrice, Menu, Section, User
+from core.services import public_menu
+from core.services.allergen_rules import generate_for_dishes
+from core.utils.jobs import job_manager
+
+
+class PublicMenuSnapshotTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp(prefix="ibla-snapshots-")
+        self.addCleanup(shutil.rmtree, tmp, True)
+        patcher = mock.patch.object(public_menu, "SNAPSHOT_DIR", tmp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+
+        self.user = User.objects.create_user(username="owner", password="x")
+        self.menu = Menu.objects.create(user=self.user, name="Karte")
+        section = Section.objects.create(name="Suppen", menu=self.menu, user=self.user)
+        self.dish = Dish.objects.create(section=section, name="Linsensuppe", codes="A")
+        Dish.objects.filter(pk=self.dish.pk).update(image="dishes/suppe.jpg")
+        DishPrice.objects.create(dish=self.dish, price="5.50", is_default=True)
+        self.owner = APIClient()
+        self.owner.force_authenticate(self.user)
+        self.guest = APIClient()
+
+    def _publish(self):
+        res = self.owner.post(f"/api/menus/{self.menu.id}/publish/")
+        self.assertEqual(res.status_code, 200)
+        self.menu.refresh_from_db()
+        return self.menu.public_slug
+
+    def test_publish_builds_snapshot_served_without_queries(self):
+        slug = self._publish()
+        self.assertTrue(os.path.exists(public_menu.snapshot_path(slug)))
+
+        with self.assertNumQueries(0):
+            res = self.guest.get(f"/api/public/menus/{slug}/", HTTP_HOST="menu.example.com")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res["Content-Type"], "application/json")
+        dish = res.json()["sections"][0]["dishes"][0]
+        self.assertEqual(dish["name"], "Linsensuppe")
+        self.assertEqual(dish["price"], "5.50")
+        self.assertEqual(dish["image_url"], "http://menu.example.com/media/dishes/suppe.jpg")
+        self.assertEqual(dish["image"], "http://menu.example.com/media/dishes/suppe.jpg")
+
+    def test_missing_snapshot_is_built_and_unpublish_removes_it(self):
+        slug = self._publish()
+        public_menu.remove_snapshot(slug)
+        res = self.guest.get(f"/api/public/menus/{slug}/")
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(os.path.exists(public_menu.snapshot_path(slug)))
+
+        self.owner.post(f"/api/menus/{self.menu.id}/unpublish/")
+        self.assertFalse(os.path.exists(public_menu.snapshot_path(slug)))
+        self.assertEqual(self.guest.get(f"/api/public/menus/{slug}/").status_code, 404)
+        self.assertEqual(self.guest.get("/api/public/menus/unknown/").status_code, 404)
+
+    def test_edits_queue_rebuild_and_other_process_build_is_picked_up(self):
+        with mock.patch.object(job_manager, "spawn_coalesced") as spawn:
+            with self.captureOnCommitCallbacks(execute=True):
+                Dish.objects.create(section=self.dish.section, name="Draft")
+            spawn.assert_not_called()  # not published yet
+
+            slug = self._publish()
+            spawn.reset_mock()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.dish.name = "Tomatensuppe"
+                self.dish.save()
+                DishPrice.objects.create(dish=self.dish, label="groß", price="7.00")
+        self.assertEqual(spawn.call_count, 2)
+        self.assertEqual(spawn.call_args.args[:2], (public_menu.rebuild_public_snapshots, [self.menu.id]))
+        self.assertEqual(spawn.call_args.kwargs["owner"], "public-menu")
+
+        # another process rebuilt the file: this process' cached copy is stale (mtime differs)
+        stale = public_menu.load_snapshot(slug)
+        job = job_manager.create()
+        with mock.patch.object(public_menu.cache, "set"):
+            self.assertEqual(public_menu.rebuild_public_snapshots(job, [self.menu.id]),
+                             {"menus": 1, "built": 1, "removed": 0})
+        os.utime(public_menu.snapshot_path(slug), ns=(1, 1))
+        self.assertNotIn(b"Tomatensuppe", stale.body)
+        names = [d["name"] for d in self.guest.get(f"/api/public/menus/{slug}/").json()["sections"][0]["dishes"]]
+        self.assertIn("Tomatensuppe", names)
+
+    def test_conditional_get_answers_304(self):
+        slug = self._publish()
+        url = f"/api/public/menus/{slug}/"
+        res = self.guest.get(url)
+        etag, last_modified = res["ETag"], res["Last-Modified"]
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertIn("public", res["Cache-Control"])
+        self.assertIn("max-age=0", res["Cache-Control"])  # revalidated on every request
+        self.assertNotIn("stale-while-revalidate", res["Cache-Control"])
+
+        with self.assertNumQueries(0):
+            res = self.guest.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.content, b"")
+        self.assertEqual(res["ETag"], etag)
+        self.assertEqual(self.guest.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertEqual(self.guest.get(url, HTTP_IF_MODIFIED_SINCE=http_date(0)).status_code, 200)
+
+        # a rebuild with new content changes the validator
+        self.dish.name = "Tomatensuppe"
+        self.dish.save()
+        public_menu.build_snapshot(self.menu.id)
+        res = self.guest.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res["ETag"], etag)
+
+    def test_rules_batch_queues_one_rebuild_without_per_row_lookups(self):
+        self._publish()
+        milk = Allergen.objects.create(code="G", label_de="Milch")
+        KeywordLexeme.objects.create(term="Sahne", lang="de", is_active=True, owner=self.user).allergens.add(milk)
+        for i in range(4):
+            Dish.objects.create(section=self.dish.section, name=f"Sahnesuppe {i}")
+        dishes = list(Dish.objects.filter(name__startswith="Sahnesuppe").select_related("section"))
+
+        with mock.patch.object(job_manager, "spawn_coalesced") as spawn, \
+                mock.patch.object(signals, "_published_menu_id", wraps=signals._published_menu_id) as lookup:
+            with self.captureOnCommitCallbacks(execute=True):
+                res = generate_for_dishes(dishes, owner_id=self.user.id, dry_run=False)
+        self.assertEqual(res["changed"], 4)
+        lookup.assert_not_called()
+        spawn.assert_called_once()
+        self.assertEqual(spawn.call_args.args[:2], (public_menu.rebuild_public_snapshots, [self.menu.id]))
+
+    def test_allergen_label_change_rebuilds_published_snapshots(self):
+        self._publish()
+        with mock.patch.object(job_manager, "spawn_coalesced") as spawn:
+            with self.captureOnCommitCallbacks(execute=True):
+                Allergen.objects.create(code="A", label_de="Gluten")
+        self.assertEqual(spawn.call_args.args[:2], (public_menu.rebuild_public_snapshots, [self.menu.id]))
+
+        public_menu.build_snapshot(self.menu.id)
+        Allergen.objects.filter(code="A").update(label_de="Glutenhaltiges Getreide")  # seen by another process
+        public_menu.rebuild_public_snapshots(job_manager.create(), [self.menu.id])
+        dish = self.guest.get(f"/api/public/menus/{self.menu.public_slug}/").json()["sections"][0]["dishes"][0]
+        self.assertEqual(dish["allergen_explanation_de"], "Enthält Glutenhaltiges Getreide.")
+
@@ -0,0 +1,89 @@
+# core/tests/test_query_counts.py
+"""
+Query-count regression tests: listing views cost the same number of queries
+however many dishes a menu has (prefetched prices/allergen rows/ingredients are
+used, nothing is loaded per dish):
+- PublicMenuView (snapshot build on first request)
+- MenuAggregateView
+- DishListCreateView
+"""
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from core.models import Allergen, Dish, DishAllergen, DishPrice, Ingredient, Menu, Section, User
+from core.services import public_menu
+
+
+class ListingQueryCountTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp(prefix="ibla-snapshots-")
+        self.addCleanup(shutil.rmtree, tmp, True)
+        patcher = mock.patch.object(public_menu, "SNAPSHOT_DIR", tmp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+
+        self.user = User.objects.create_user(username="owner", password="x")
+        self.menu = Menu.objects.create(user=self.user, name="Karte", is_published=True, public_slug="karte")
+        self.section = Section.objects.create(name="Suppen", menu=self.menu, user=self.user)
+        self.milk = Allergen.objects.create(code="G", label_de="Milch")
+        self.gluten = Allergen.objects.create(code="A", label_de="Glutenhaltiges Getreide")
+        self.ingredient = Ingredient.objects.create(name="Sahne", owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self._add_dishes(2)
+
+    def _add_dishes(self, n):
+        for i in range(n):
+            # codes empty on purpose: display_codes falls back to the DishAllergen rows
+            dish = Dish.objects.create(section=self.section, name=f"Suppe {i}", codes="")
+            DishPrice.objects.create(dish=dish, label="klein", price="4.50")
+            DishPrice.objects.create(dish=dish, label="groß", price="6.50", is_default=True)
+            DishAllergen.objects.create(dish=dish, allergen=self.milk, source=DishAllergen.Source.MANUAL)
+            DishAllergen.objects.create(dish=dish, allergen=self.gluten, source=DishAllergen.Source.REGEX)
+            dish.ingredients.add(self.ingredient)
+
+    def _count(self, fetch):
+        fetch()  # warm-up: Allergen registry, sessions, ...
+        with CaptureQueriesContext(connection) as ctx:
+            res = fetch()
+        self.assertEqual(res.status_code, 200, res.content)
+        return len(ctx), res.json()
+
+    def _assert_constant(self, fetch):
+        small, _ = self._count(fetch)
+        self._add_dishes(8)
+        large, data = self._count(fetch)
+        self.assertEqual(small, large, "query count grows with the number of dishes")
+        return data
+
+    def test_public_menu_snapshot_build(self):
+        def fetch():
+            public_menu.remove_snapshot("karte")
+            return APIClient().get("/api/public/menus/karte/")
+
+        data = self._assert_constant(fetch)
+        dish = data["sections"][0]["dishes"][0]
+        self.assertEqual(dish["display_codes"], "A,G")
+        self.assertEqual(dish["price"], "6.50")
+        self.assertEqual(dish["allergen_explanation_de"], "Enthält Glutenhaltiges Getreide und Milch.")
+
+    def test_menu_aggregate(self):
+        data = self._assert_constant(lambda: self.client.get(f"/api/menu/?menu={self.menu.id}"))
+        dish = data["sections"][0]["dishes"][0]
+        self.assertEqual(dish["display_codes"], "A,G")
+        self.assertEqual(len(dish["allergen_rows"]), 2)
+
+    def test_dish_list(self):
+        data = self._assert_constant(lambda: self.client.get(f"/api/dishes/?section={self.section.id}"))
+        rows = data["results"] if isinstance(data, dict) else data
+        self.assertEqual(rows[0]["display_codes"], "A,G")
+        self.assertEqual(rows[0]["price"], "6.50")
+        self.assertEqual(rows[0]["ingredients"], [self.ingredient.id])
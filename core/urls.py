@@ -132,13 +132,17 @@ urlpatterns = [
     re_path(r"^lexicon/llm-add/?$",
             views.llm_add_terms_to_lexicon, name="lexicon_llm_add"),
     re_path(r"^llm-direct-codes/?$", views.llm_direct_codes, name="llm_direct_codes"),
+    re_path(r"^llm-direct-codes/batch/?$", views.llm_direct_codes_batch, name="llm_direct_codes_batch"),
     # LLM helper endpoints (ETA / Limits)
     re_path(r"^llm/eta/?$", views.llm_eta, name="llm_eta"),
     re_path(r"^llm/limits/?$", views.llm_limits, name="llm_limits"),
     # LLM async jobs
     re_path(r"^llm/jobs/start-batch-generate/?$", views.llm_jobs_start_batch_generate, name="llm_jobs_start_batch_generate"),
     re_path(r"^llm/jobs/(?P<job_id>[a-f0-9\-]+)/status/?$", views.llm_jobs_status, name="llm_jobs_status"),
+    re_path(r"^llm/jobs/(?P<job_id>[a-f0-9\-]+)/events/?$", views.llm_jobs_events, name="llm_jobs_events"),
+    re_path(r"^llm/jobs/(?P<job_id>[a-f0-9\-]+)/results/?$", views.llm_jobs_results, name="llm_jobs_results"),
     re_path(r"^llm/jobs/(?P<job_id>[a-f0-9\-]+)/cancel/?$", views.llm_jobs_cancel, name="llm_jobs_cancel"),
+    re_path(r"^llm/jobs/(?P<job_id>[a-f0-9\-]+)/resume/?$", views.llm_jobs_resume, name="llm_jobs_resume"),
 
     # ---------- v2: dishes + nested prices/allergens ----------
     re_path(r"^v2/dishes/?$",                   dish_list,   name="v2_dish_list"),
@@ -1,14 +1,94 @@
+"""
+Background jobs behind one facade (`job_manager`), backend chosen by env JOB_BACKEND:
+- memory (default): per-process dict + daemon thread (dev / single process)
+- db:     core.models.BackgroundJob rows; `manage.py run_job_worker` claims queued jobs
+          with a lease, renews it by heartbeat and retries failures (JOB_MAX_ATTEMPTS).
+          Status / cancel work from any process (gunicorn workers, worker, shell).
+
+Job targets are plain functions `target(job: JobState, *args, **kwargs)`; to run in the
+worker they must be registered in JOB_TASKS (dotted path) and take JSON-able args.
+Targets may save_checkpoint()/load_checkpoint() so a retry or resume() continues
+where the previous run stopped; append_checkpoint() adds only the new part (merged into
+checkpoint[key] on load) instead of rewriting everything saved so far.
+
+Scheduling: every job has an owner and a priority (interactive < bulk). Queued jobs start
+in fair order — lower priority value first, then the owner with the fewest running jobs,
+then the oldest — with at most JOB_MAX_PER_OWNER running per owner and JOB_MAX_BULK_RUNNING
+bulk jobs overall (so a slot stays free for small interactive jobs).
+
+Sharding: spawn_sharded() splits one job into child jobs (BackgroundJob.parent) that run
+in parallel; the parent only aggregates their progress, merges their results when the last
+one finishes, and cancel()/resume() on the parent apply to all shards. For fairness a sharded
+job counts as one job; up to JOB_SHARD_PARALLEL of its shards may run at once.
+
+Coalescing: spawn_coalesced() queues `target(job, ids, **kwargs)` to start after `delay`
+seconds without new calls; further calls for the same target/owner/kwargs before it starts
+merge their ids into that job and push the start back (at most `max_delay` after the first).
+
+Retention: finished jobs are dropped after JOB_RESULT_TTL_SEC (memory backend also keeps
+at most JOB_MAX_JOBS, evicting the least recently read finished ones). Results bigger than
+JOB_RESULT_SPILL_BYTES are stored gzip-compressed (file / BackgroundJob.result_blob) and
+JobState.result keeps only result_summary(); load_result() returns the full one.
+"""
+import asyncio
+import copy
+import gzip
+import itertools
+import json
+import logging
+import os
+import socket
+import tempfile
 import threading
 import time
 import uuid
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from typing import Any, Callable, Dict, Optional
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger("core.jobs")
+
+# task name → dotted path of the target (resolved lazily in the worker)
+JOB_TASKS: Dict[str, str] = {
+    "llm_batch_generate": "core.views._run_batch_generate_job",
+    "dish_auto_regen": "core.services.auto_regen.run_dish_auto_regen",
+    "public_menu_snapshot": "core.services.public_menu.rebuild_public_snapshots",
+}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)).strip())
+    except Exception:
+        return default
+
+
+JOB_LEASE_SEC = _env_float("JOB_LEASE_SEC", 60.0)
+JOB_HEARTBEAT_SEC = _env_float("JOB_HEARTBEAT_SEC", 5.0)
+JOB_MAX_ATTEMPTS = max(1, int(_env_float("JOB_MAX_ATTEMPTS", 3)))
+JOB_RETRY_BACKOFF_SEC = _env_float("JOB_RETRY_BACKOFF_SEC", 10.0)
+# priorities (same values as BackgroundJob.PRIORITY_*): smaller runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+JOB_MAX_PER_OWNER = max(0, int(_env_float("JOB_MAX_PER_OWNER", 2)))  # 0 = no cap
+JOB_MEMORY_CONCURRENCY = max(1, int(_env_float("JOB_MEMORY_CONCURRENCY", 4)))
+JOB_SHARD_PARALLEL = max(1, int(_env_float("JOB_SHARD_PARALLEL", 4)))
+# bulk jobs running at once (all owners); unset → memory: concurrency-1, db: no cap
+JOB_MAX_BULK_RUNNING: Optional[int] = (
+    max(0, int(_env_float("JOB_MAX_BULK_RUNNING", 0))) if os.getenv("JOB_MAX_BULK_RUNNING") else None
+)
+JOB_RESULT_TTL_SEC = _env_float("JOB_RESULT_TTL_SEC", 3600.0)
+JOB_MAX_JOBS = max(1, int(_env_float("JOB_MAX_JOBS", 200)))
+JOB_RESULT_SPILL_BYTES = int(_env_float("JOB_RESULT_SPILL_BYTES", 64 * 1024))
+JOB_RESULT_DIR = os.getenv("JOB_RESULT_DIR") or os.path.join(tempfile.gettempdir(), "ibla-job-results")
 
 
 @dataclass
 class JobState:
     id: str
-    status: str = "queued"  # queued | running | done | error
+    status: str = "queued"  # queued | running | done | error | cancelled
     message: str = ""
     created_at: float = field(default_factory=lambda: time.time())
     started_at: Optional[float] = None
@@ -21,28 +101,279 @@ class JobState:
     error: Optional[str] = None
     cancel_requested: bool = False
     cancelled_at: Optional[float] = None
+    attempts: int = 0
+    owner: str = ""
+    priority: int = PRIORITY_INTERACTIVE
+    parent_id: str = ""
 
 
-class JobManager:
+_FINAL = {"done", "error", "cancelled"}
+
+
+# إشعار التغيّر لمستمعي SSE: رقم مراجعة لكل مهمة في الكاش يرفعه كل ما يغيّر ما تقرؤه
+# get()/checkpoint_deltas() (في العملية التي كتبت)؛ المستمع يقرأ المهمة فقط حين يتغيّر.
+# الكاش الافتراضي locmem محلي لكل عملية: مع JOB_BACKEND=db و job_worker منفصل لا يصل الإشعار
+# إلا بكاش مشترك (CACHES)، ويبقى عندها polling المتباطئ (JOB_EVENTS_POLL_MAX_SEC) هو المرجع.
+JOB_REVISION_KEY = "jobs:rev:{}"
+
+
+def _notify(*job_ids: str) -> None:
+    from django.core.cache import cache
+
+    for job_id in job_ids:
+        if not job_id:
+            continue
+        key = JOB_REVISION_KEY.format(job_id)
+        try:
+            try:
+                cache.incr(key)
+            except ValueError:
+                if not cache.add(key, 1, JOB_RESULT_TTL_SEC + 3600):
+                    cache.incr(key)
+        except Exception:
+            logger.debug("job %s: revision bump failed", job_id, exc_info=True)
+
+
+def _apply_deltas(data: Optional[Dict[str, Any]], deltas: Iterable[Tuple[str, Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+    """checkpoint الأساسي + الإضافات بالترتيب: كل إضافة تُدمج (dict.update) في checkpoint[key] (يعدّل data)."""
+    for key, delta in deltas:
+        data = {} if data is None else data
+        part = data.get(key)
+        if not isinstance(part, dict):
+            part = data[key] = {}
+        part.update(delta)
+    return data
+
+
+def _calc_percent(completed: int, total: int) -> float:
+    if total <= 0:
+        return 0.0
+    return max(0.0, min(100.0, (completed / max(1, total)) * 100.0))
+
+
+def fair_order(
+    candidates: Iterable[Tuple[str, str, int, float, str]],
+    running: Iterable[Tuple[str, str, int]],
+    *,
+    max_per_owner: int,
+    max_bulk: Optional[int],
+    max_shards: Optional[int] = None,
+) -> List[str]:
+    """
+    candidates: (job_id, owner, priority, created_at, family) للمهام المنتظرة؛
+    running: (family, owner, priority) للجارية. family = parent_id للشظية وإلا id المهمة.
+    يعيد ids المؤهلة بترتيب البدء: priority ثم المالك الأقل مهامًا جارية ثم الأقدم.
+    مالك بلغ max_per_owner، أو bulk وقد بلغت الدفعات max_bulk → ينتظر. العدّ بالعائلات:
+    شظية عائلتها جارية لا تحتاج مكانًا جديدًا، فقط أقل من max_shards شظية معًا.
+    """
+    max_shards = JOB_SHARD_PARALLEL if max_shards is None else max_shards
+    by_family: Dict[str, int] = {}
+    owners: Dict[str, set] = {}
+    bulk = set()
+    for family, owner, priority in running:
+        by_family[family] = by_family.get(family, 0) + 1
+        if owner:
+            owners.setdefault(owner, set()).add(family)
+        if priority >= PRIORITY_BULK:
+            bulk.add(family)
+
+    eligible = []
+    for job_id, owner, priority, created_at, family in candidates:
+        owner_running = len(owners.get(owner, ())) if owner else 0
+        if by_family.get(family):
+            if by_family[family] >= max_shards:
+                continue
+        else:
+            if owner and max_per_owner and owner_running >= max_per_owner:
+                continue
+            if priority >= PRIORITY_BULK and max_bulk is not None and len(bulk) >= max_bulk:
+                continue
+        eligible.append((priority, owner_running, created_at, job_id))
+    eligible.sort()
+    return [job_id for *_, job_id in eligible]
+
+
+def _aggregate_shards(st: JobState, shards: List[JobState]) -> None:
+    """تقدّم الأب = مجموع شظاياه (يُحسب عند القراءة، لا يُخزَّن)."""
+    if not shards:
+        return
+    st.total = sum(x.total for x in shards)
+    st.completed = sum(x.completed for x in shards)
+    st.percent = _calc_percent(st.completed, st.total)
+    etas = [x.eta_minutes for x in shards if x.status not in _FINAL and x.eta_minutes is not None]
+    st.eta_minutes = max(etas) if etas else st.eta_minutes
+    finished = sum(1 for x in shards if x.status in _FINAL)
+    running = sum(1 for x in shards if x.status == "running")
+    st.message = f"shards: {finished}/{len(shards)} finished, {running} running"
+
+
+def _shards_outcome(shards: List[JobState]) -> Optional[str]:
+    """الحالة النهائية للأب حين تنتهي كل الشظايا (وإلا None)."""
+    if not shards or any(x.status not in _FINAL for x in shards):
+        return None
+    if any(x.status == "cancelled" for x in shards):
+        return "cancelled"
+    if any(x.status == "error" for x in shards):
+        return "error"
+    return "done"
+
+
+def _shards_error(shards: List[JobState]) -> str:
+    failed = [x for x in shards if x.status == "error"]
+    first = failed[0].error if failed else ""
+    return f"{len(failed)}/{len(shards)} shards failed: {first}"
+
+
+def callable_path(fn: Callable[..., Any]) -> str:
+    return f"{getattr(fn, '__module__', '')}.{getattr(fn, '__qualname__', '')}"
+
+
+def result_summary(result: Any) -> Any:
+    """
+    نسخة خفيفة من نتيجة مهمة: كل قسم فيه قائمة items (rules / llm ...) يُستبدل بعدّاده
+    items_total، والعناصر نفسها تُقرأ صفحةً صفحة. تطبيقها مرتين لا يغيّر شيئًا.
+    """
+    if not isinstance(result, dict):
+        return result
+    out: Dict[str, Any] = {}
+    for key, value in result.items():
+        if isinstance(value, dict) and isinstance(value.get("items"), list):
+            section = {k: v for k, v in value.items() if k != "items"}
+            section["items_total"] = len(value["items"])
+            out[key] = section
+        else:
+            out[key] = value
+    return out
+
+
+def pack_result(result: Any) -> Optional[bytes]:
+    """gzip(JSON) إذا تجاوزت النتيجة JOB_RESULT_SPILL_BYTES، وإلا None (تبقى كما هي)."""
+    if not isinstance(result, dict):
+        return None
+    raw = json.dumps(result, ensure_ascii=False, default=str).encode("utf-8")
+    if len(raw) < JOB_RESULT_SPILL_BYTES:
+        return None
+    return gzip.compress(raw, compresslevel=6)
+
+
+def unpack_result(blob: bytes) -> Dict[str, Any]:
+    return json.loads(gzip.decompress(bytes(blob)).decode("utf-8"))
+
+
+# ============================================================
+# memory backend (per process)
+# ============================================================
+class _MemoryJobs:
     def __init__(self) -> None:
-        self._jobs: Dict[str, JobState] = {}
+        self._jobs: "OrderedDict[str, JobState]" = OrderedDict()  # LRU: آخر قراءة في النهاية
+        self._checkpoints: Dict[str, Dict[str, Any]] = {}
+        self._deltas: Dict[str, List[Tuple[int, str, Dict[str, Any]]]] = {}  # job_id → [(seq, key, data)]
+        self._delta_seq = itertools.count(1)
+        self._spawned: Dict[str, tuple] = {}  # job_id → (target, args, kwargs) for resume()
+        self._spilled: Dict[str, str] = {}  # job_id → gzip file with the full result
+        self._waiting: List[str] = []  # spawned, waiting for a slot (fair_order)
+        self._running: set = set()
+        self._shards: Dict[str, List[str]] = {}  # parent id → shard ids
+        self._mergers: Dict[str, Callable[[List[Optional[Dict[str, Any]]]], Dict[str, Any]]] = {}
+        self._finishing: set = set()  # parents being merged right now
+        self._coalescing: Dict[tuple, str] = {}  # (target, owner, kwargs) → job still in its delay
+        self._delayed: Dict[str, Tuple[tuple, float, threading.Timer]] = {}  # job_id → (key, first, timer)
         self._lock = threading.Lock()
 
-    def _calc_percent(self, completed: int, total: int) -> float:
-        if total <= 0:
-            return 0.0
-        return max(0.0, min(100.0, (completed / max(1, total)) * 100.0))
-
-    def create(self, *, total: int = 0, message: str = "") -> JobState:
+    def create(self, *, total: int = 0, message: str = "", owner: str = "",
+               priority: int = PRIORITY_INTERACTIVE, parent_id: str = "") -> JobState:
         job_id = str(uuid.uuid4())
-        st = JobState(id=job_id, total=max(0, int(total)), message=message)
+        st = JobState(
+            id=job_id, total=max(0, int(total)), message=message, owner=owner or "", priority=priority,
+            parent_id=parent_id or "",
+        )
         with self._lock:
             self._jobs[job_id] = st
+            self._evict_locked()
         return st
 
     def get(self, job_id: str) -> Optional[JobState]:
         with self._lock:
-            return self._jobs.get(job_id)
+            st = self._jobs.get(job_id)
+            if st is not None:
+                self._jobs.move_to_end(job_id)
+                if job_id in self._shards and st.status not in _FINAL:
+                    _aggregate_shards(st, [self._jobs[c] for c in self._shards[job_id] if c in self._jobs])
+            return st
+
+    # ---------- retention ----------
+    def _drop_locked(self, job_id: str) -> None:
+        self._jobs.pop(job_id, None)
+        self._checkpoints.pop(job_id, None)
+        self._deltas.pop(job_id, None)
+        self._spawned.pop(job_id, None)
+        self._shards.pop(job_id, None)
+        self._mergers.pop(job_id, None)
+        path = self._spilled.pop(job_id, None)
+        if path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _evict_locked(self, ttl_sec: Optional[float] = None, max_jobs: Optional[int] = None) -> int:
+        """
+        المنتهية بعد TTL، ثم الأقدم قراءةً حتى max_jobs. المهام الجارية لا تُحذف أبدًا،
+        ولا شظايا أبٍ لم ينتهِ بعد (دمج نتيجة الأب يحتاجها كلها).
+        """
+        ttl_sec = JOB_RESULT_TTL_SEC if ttl_sec is None else ttl_sec
+        max_jobs = JOB_MAX_JOBS if max_jobs is None else max_jobs
+        cutoff = time.time() - ttl_sec
+        finished = [
+            jid for jid, st in self._jobs.items()
+            if st.status in _FINAL and not self._pinned_shard_locked(st)
+        ]
+        dropped = 0
+        for jid in finished:
+            st = self._jobs[jid]
+            if (st.finished_at or 0) < cutoff or len(self._jobs) > max_jobs:
+                self._drop_locked(jid)
+                dropped += 1
+        return dropped
+
+    def _pinned_shard_locked(self, st: JobState) -> bool:
+        if not st.parent_id:
+            return False
+        parent = self._jobs.get(st.parent_id)
+        return parent is not None and (parent.status not in _FINAL or parent.id in self._finishing)
+
+    def purge(self, ttl_sec: Optional[float] = None, max_jobs: Optional[int] = None) -> int:
+        with self._lock:
+            return self._evict_locked(ttl_sec, max_jobs)
+
+    def _store_result_locked(self, st: JobState, result: Optional[Dict[str, Any]]) -> None:
+        blob = pack_result(result)
+        old = self._spilled.pop(st.id, None)
+        if blob is None:
+            if old:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+            st.result = result
+            return
+        os.makedirs(JOB_RESULT_DIR, exist_ok=True)
+        path = os.path.join(JOB_RESULT_DIR, f"{st.id}.json.gz")
+        with open(path, "wb") as fh:
+            fh.write(blob)
+        self._spilled[st.id] = path
+        st.result = result_summary(result)
+
+    def load_result(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            st = self._jobs.get(job_id)
+            path = self._spilled.get(job_id)
+            if st is None:
+                return None
+            if not path:
+                return st.result
+        with open(path, "rb") as fh:
+            return unpack_result(fh.read())
 
     def start(self, job_id: str, message: str = "") -> None:
         with self._lock:
@@ -53,6 +384,7 @@ class JobManager:
             st.started_at = time.time()
             if message:
                 st.message = message
+        _notify(job_id, st.parent_id)
 
     def update(self, job_id: str, *, completed: Optional[int] = None, total: Optional[int] = None,
                message: Optional[str] = None, eta_minutes: Optional[float] = None) -> None:
@@ -68,7 +400,8 @@ class JobManager:
                 st.message = message
             if eta_minutes is not None:
                 st.eta_minutes = float(eta_minutes)
-            st.percent = self._calc_percent(st.completed, st.total)
+            st.percent = _calc_percent(st.completed, st.total)
+        _notify(job_id, st.parent_id)
 
     def done(self, job_id: str, result: Dict[str, Any]) -> None:
         with self._lock:
@@ -77,8 +410,13 @@ class JobManager:
                 return
             st.status = "done"
             st.finished_at = time.time()
-            st.result = result
-            st.percent = self._calc_percent(st.completed, st.total)
+            self._store_result_locked(st, result)
+            st.percent = _calc_percent(st.completed, st.total)
+            self._checkpoints.pop(job_id, None)
+            self._deltas.pop(job_id, None)
+            self._spawned.pop(job_id, None)
+        _notify(job_id, st.parent_id)
+        self._shard_finished(job_id)
 
     def fail(self, job_id: str, error: str) -> None:
         with self._lock:
@@ -88,16 +426,30 @@ class JobManager:
             st.status = "error"
             st.finished_at = time.time()
             st.error = error
+        _notify(job_id, st.parent_id)
+        self._shard_finished(job_id)
 
-    # -------- cancellation support --------
     def cancel(self, job_id: str) -> None:
-        """Mark a job as cancel requested. The running worker should check and stop ASAP."""
         with self._lock:
             st = self._jobs.get(job_id)
             if not st:
                 return
             st.cancel_requested = True
             st.message = st.message or "cancel requested"
+            shards = list(self._shards.get(job_id, ()))
+            dropped = job_id in self._waiting or job_id in self._delayed
+            if dropped:
+                # لم تحصل على مكان بعد (أو ما زالت في مهلة التجميع) → تُلغى فورًا
+                if job_id in self._waiting:
+                    self._waiting.remove(job_id)
+                self._undelay_locked(job_id)
+                st.status, st.message, st.error = "cancelled", "cancelled before start", "Cancelled by user"
+                st.cancelled_at = st.finished_at = time.time()
+        for shard_id in shards:
+            self.cancel(shard_id)
+        _notify(job_id, st.parent_id)
+        if dropped:
+            self._shard_finished(job_id)
 
     def is_cancel_requested(self, job_id: str) -> bool:
         with self._lock:
@@ -113,25 +465,970 @@ class JobManager:
             st.cancelled_at = time.time()
             st.finished_at = st.cancelled_at
             if partial_result is not None:
-                st.result = partial_result
+                self._store_result_locked(st, partial_result)
             st.error = (st.error or "Cancelled by user")
+        _notify(job_id, st.parent_id)
+        self._shard_finished(job_id)
+
+    def save_checkpoint(self, job_id: str, data: Dict[str, Any]) -> None:
+        with self._lock:
+            self._checkpoints[job_id] = copy.deepcopy(data)
+            self._deltas.pop(job_id, None)
+        _notify(job_id)
+
+    def append_checkpoint(self, job_id: str, key: str, delta: Dict[str, Any]) -> None:
+        if not delta:
+            return
+        with self._lock:
+            self._deltas.setdefault(job_id, []).append((next(self._delta_seq), key, copy.deepcopy(delta)))
+        _notify(job_id)
+
+    def load_checkpoint(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            data = self._checkpoints.get(job_id)
+            deltas = [(key, delta) for _, key, delta in self._deltas.get(job_id, ())]
+            return _apply_deltas(copy.deepcopy(data), copy.deepcopy(deltas))
+
+    def checkpoint_deltas(self, job_id: str, after: int = 0,
+                          key: Optional[str] = None) -> List[Tuple[int, str, Dict[str, Any]]]:
+        with self._lock:
+            deltas = self._deltas.get(job_id, ())
+            return copy.deepcopy([d for d in deltas if d[0] > after and (key is None or d[1] == key)])
+
+    def resume(self, job_id: str) -> bool:
+        with self._lock:
+            shards = list(self._shards.get(job_id, ()))
+        if shards:
+            return self._resume_parent(job_id, shards)
+        with self._lock:
+            st = self._jobs.get(job_id)
+            spawned = self._spawned.get(job_id)
+            if not st or not spawned or st.status not in ("cancelled", "error"):
+                return False
+            st.status, st.message = "queued", "resume from checkpoint"
+            st.cancel_requested, st.error = False, None
+            st.finished_at = st.cancelled_at = None
+        target, args, kwargs = spawned
+        self.spawn(st, target, *args, **kwargs)
+        return True
+
+    # ---------- shards ----------
+    def spawn_sharded(self, parent: JobState, target: Callable[..., Any], shards, merge) -> List[JobState]:
+        children = [
+            self.create(total=total, message="queued", owner=parent.owner, priority=parent.priority,
+                        parent_id=parent.id)
+            for total, _, _ in shards
+        ]
+        with self._lock:
+            self._shards[parent.id] = [c.id for c in children]
+            self._mergers[parent.id] = merge
+            parent.status, parent.started_at = "running", time.time()
+        for child, (_, args, kwargs) in zip(children, shards):
+            self.spawn(child, target, *args, **kwargs)
+        return children
+
+    def _shard_finished(self, job_id: str) -> None:
+        """آخر شظية انتهت → الأب done بنتيجة merge (أو cancelled/error)."""
+        with self._lock:
+            st = self._jobs.get(job_id)
+            parent = self._jobs.get(st.parent_id) if st and st.parent_id else None
+            if parent is None or parent.status in _FINAL or parent.id in self._finishing:
+                return
+            shards = [self._jobs[c] for c in self._shards.get(parent.id, ()) if c in self._jobs]
+            outcome = _shards_outcome(shards)
+            if outcome is None:
+                return
+            self._finishing.add(parent.id)
+            merge = self._mergers.get(parent.id)
+        try:
+            _aggregate_shards(parent, shards)
+            if outcome == "error":
+                self.fail(parent.id, _shards_error(shards))
+                return
+            merged = merge([self.load_result(x.id) for x in shards]) if merge else None
+            if outcome == "done":
+                self.done(parent.id, merged or {})
+            else:
+                self.cancelled(parent.id, partial_result=merged)
+        finally:
+            with self._lock:
+                self._finishing.discard(parent.id)
+
+    def _resume_parent(self, job_id: str, shards: List[str]) -> bool:
+        resumed = [sid for sid in shards if self.resume(sid)]
+        if not resumed:
+            return False
+        with self._lock:
+            st = self._jobs.get(job_id)
+            if st is not None:
+                st.status, st.message = "running", "resume shards"
+                st.cancel_requested, st.error, st.result = False, None, None
+                st.finished_at = st.cancelled_at = None
+        return True
+
+    # ---------- coalescing ----------
+    def spawn_coalesced(self, target: Callable[..., Any], ids: List[Any], *, owner: str, delay: float,
+                        max_delay: float, priority: int, kwargs: Dict[str, Any]) -> JobState:
+        key = (callable_path(target), owner or "", json.dumps(kwargs, sort_keys=True, default=str))
+        now = time.monotonic()
+        with self._lock:
+            job_id = self._coalescing.get(key)
+            if job_id in self._delayed and job_id in self._jobs:
+                st = self._jobs[job_id]
+                _, args, kw = self._spawned[job_id]
+                merged = list(dict.fromkeys([*args[0], *ids]))
+                self._spawned[job_id] = (target, (merged,), kw)
+                st.total = len(merged)
+                _, first, timer = self._delayed[job_id]
+                timer.cancel()
+                self._arm_locked(st.id, key, first, min(delay, first + max_delay - now))
+                return st
+        st = self.create(total=len(ids), message=f"waiting {delay:g}s for more edits", owner=owner,
+                         priority=priority)
+        with self._lock:
+            self._spawned[st.id] = (target, (list(dict.fromkeys(ids)),), dict(kwargs))
+            self._coalescing[key] = st.id
+            self._arm_locked(st.id, key, now, delay)
+        return st
+
+    def _arm_locked(self, job_id: str, key: tuple, first: float, wait: float) -> None:
+        timer = threading.Timer(max(0.0, wait), self._release_delayed, args=(job_id,))
+        timer.daemon = True
+        self._delayed[job_id] = (key, first, timer)
+        timer.start()
+
+    def _undelay_locked(self, job_id: str) -> None:
+        entry = self._delayed.pop(job_id, None)
+        if entry is None:
+            return
+        key, _, timer = entry
+        timer.cancel()
+        if self._coalescing.get(key) == job_id:
+            del self._coalescing[key]
+
+    def _release_delayed(self, job_id: str) -> None:
+        """انتهت مهلة التجميع → تدخل طابور fair_order كأي مهمة أخرى."""
+        with self._lock:
+            if job_id not in self._delayed:
+                return
+            self._undelay_locked(job_id)
+            if job_id not in self._jobs:
+                return
+            self._waiting.append(job_id)
+        self._dispatch()
+
+    def spawn(self, job: JobState, target: Callable[..., Any], *args: Any, **kwargs: Any) -> None:
+        with self._lock:
+            self._spawned[job.id] = (target, args, kwargs)
+            if job.id not in self._waiting:
+                self._waiting.append(job.id)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """يبدأ المنتظرة حسب fair_order ما دام هناك مكان (JOB_MEMORY_CONCURRENCY)."""
+        max_bulk = JOB_MAX_BULK_RUNNING if JOB_MAX_BULK_RUNNING is not None else max(1, JOB_MEMORY_CONCURRENCY - 1)
+        starting = []
+        with self._lock:
+            while self._waiting and len(self._running) < JOB_MEMORY_CONCURRENCY:
+                running = [self._jobs[j] for j in self._running if j in self._jobs]
+                waiting = [self._jobs[j] for j in self._waiting if j in self._jobs]
+                order = fair_order(
+                    ((st.id, st.owner, st.priority, st.created_at, st.parent_id or st.id) for st in waiting),
+                    ((st.parent_id or st.id, st.owner, st.priority) for st in running),
+                    max_per_owner=JOB_MAX_PER_OWNER,
+                    max_bulk=max_bulk,
+                )
+                if not order:
+                    break
+                job_id = order[0]
+                self._waiting.remove(job_id)
+                self._running.add(job_id)
+                starting.append((self._jobs[job_id], self._spawned.get(job_id)))
+        for job, spawned in starting:
+            threading.Thread(target=self._runner, args=(job, spawned), daemon=True).start()
+
+    def _runner(self, job: JobState, spawned: Optional[tuple]) -> None:
+        try:
+            if spawned is None:
+                raise RuntimeError("job target missing")
+            target, args, kwargs = spawned
+            self.start(job.id, message="running")
+            result = target(job, *args, **kwargs)
+            # target may already mark as cancelled; only set done if still active
+            with self._lock:
+                st = self._jobs.get(job.id)
+                already_final = st and st.status in _FINAL
+            if not already_final:
+                self.done(job.id, result=result if isinstance(result, dict) else {"result": result})
+        except Exception as e:
+            self.fail(job.id, error=str(e))
+        finally:
+            with self._lock:
+                self._running.discard(job.id)
+            self._dispatch()
+
+
+# ============================================================
+# db backend (BackgroundJob rows)
+# ============================================================
+def _ts(dt: Optional[datetime]) -> Optional[float]:
+    return dt.timestamp() if dt else None
+
+
+def _now() -> datetime:
+    from django.utils import timezone
+
+    return timezone.now()
+
+
+def _state_from_row(row) -> JobState:
+    return JobState(
+        id=row.id,
+        status=row.status,
+        message=row.message,
+        created_at=_ts(row.created_at) or time.time(),
+        started_at=_ts(row.started_at),
+        finished_at=_ts(row.finished_at),
+        total=row.total,
+        completed=row.completed,
+        percent=row.percent,
+        eta_minutes=row.eta_minutes,
+        result=row.result,
+        error=row.error,
+        cancel_requested=row.cancel_requested,
+        cancelled_at=_ts(row.cancelled_at),
+        attempts=row.attempts,
+        owner=row.owner,
+        priority=row.priority,
+        parent_id=row.parent_id or "",
+    )
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class _DBJobs:
+    """
+    الحالة في BackgroundJob. المهام التي تعمل داخل هذه العملية لها JobState محلي:
+    update()/is_cancel_requested() تعمل على الذاكرة فقط (تصلح داخل حلقة asyncio)،
+    و heartbeat يكتب التقدّم إلى DB ويجدّد الـlease ويقرأ cancel_requested.
+    """
+
+    def __init__(self) -> None:
+        self._local: Dict[str, JobState] = {}
+        self._owner: Dict[str, str] = {}  # job_id → lease owner (this process)
+        self._pending_checkpoint: Dict[str, Dict[str, Any]] = {}  # saved inside an event loop
+        self._pending_deltas: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}  # appended inside an event loop
+        self._beat_progress: Dict[str, Dict[str, Any]] = {}  # last progress written by heartbeat
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _model():
+        from core.models import BackgroundJob
+
+        return BackgroundJob
+
+    @staticmethod
+    def _delta_model():
+        from core.models import BackgroundJobCheckpointDelta
+
+        return BackgroundJobCheckpointDelta
+
+    def _rows(self, job_id: str):
+        q = self._model().objects.filter(pk=job_id)
+        owner = self._owner.get(job_id)
+        # كتابات مهمة جارية هنا مشروطة بأننا ما زلنا نملك الـlease
+        return q.filter(lease_owner=owner) if owner else q
+
+    # ---------- API ----------
+    def create(self, *, total: int = 0, message: str = "", owner: str = "",
+               priority: int = PRIORITY_INTERACTIVE, parent_id: str = "") -> JobState:
+        row = self._model().objects.create(
+            id=str(uuid.uuid4()), total=max(0, int(total)), message=message, max_attempts=JOB_MAX_ATTEMPTS,
+            owner=(owner or "")[:64], priority=priority, parent_id=parent_id or None,
+        )
+        return _state_from_row(row)
+
+    def get(self, job_id: str) -> Optional[JobState]:
+        row = self._model().objects.filter(pk=job_id).defer("checkpoint", "result_blob").first()
+        if row is None:
+            return None
+        st = _state_from_row(row)
+        if st.status not in _FINAL and (row.kwargs or {}).get("shards"):
+            _aggregate_shards(st, self._shard_states(job_id))
+            return st
+        with self._lock:
+            local = self._local.get(job_id)
+            if local is not None and st.status == "running":
+                # التقدّم المحلي أحدث من آخر heartbeat
+                st.total, st.completed, st.percent = local.total, local.completed, local.percent
+                st.message, st.eta_minutes = local.message, local.eta_minutes
+        return st
+
+    def _shard_states(self, parent_id: str) -> List[JobState]:
+        rows = self._model().objects.filter(parent_id=parent_id).defer("checkpoint", "result", "result_blob")
+        return [_state_from_row(r) for r in rows.order_by("created_at", "pk")]
+
+    def start(self, job_id: str, message: str = "") -> None:
+        with self._lock:
+            local = self._local.get(job_id)
+            if local is not None:
+                local.status = "running"
+                local.started_at = local.started_at or time.time()
+                if message:
+                    local.message = message
+        fields = {"status": "running"}
+        if message:
+            fields["message"] = message
+        self._rows(job_id).update(**fields)
+        _notify(job_id, local.parent_id if local is not None else "")
+
+    def update(self, job_id: str, *, completed: Optional[int] = None, total: Optional[int] = None,
+               message: Optional[str] = None, eta_minutes: Optional[float] = None) -> None:
+        with self._lock:
+            st = self._local.get(job_id)
+            if st is not None:
+                if total is not None:
+                    st.total = max(0, int(total))
+                if completed is not None:
+                    st.completed = max(0, int(completed))
+                if message is not None:
+                    st.message = message
+                if eta_minutes is not None:
+                    st.eta_minutes = float(eta_minutes)
+                st.percent = _calc_percent(st.completed, st.total)
+                return  # يُكتب مع heartbeat التالي
+        row = self._model().objects.filter(pk=job_id).first()
+        if row is None:
+            return
+        if total is not None:
+            row.total = max(0, int(total))
+        if completed is not None:
+            row.completed = max(0, int(completed))
+        if message is not None:
+            row.message = message[:255]
+        if eta_minutes is not None:
+            row.eta_minutes = float(eta_minutes)
+        row.percent = _calc_percent(row.completed, row.total)
+        row.save(update_fields=["total", "completed", "message", "eta_minutes", "percent"])
+        _notify(job_id, row.parent_id or "")
+
+    def _finish(self, job_id: str, status: str, **fields) -> None:
+        now = _now()
+        with self._lock:
+            pending = self._pending_checkpoint.pop(job_id, None)
+            deltas = self._pending_deltas.pop(job_id, None)
+        if status == "done":
+            fields["checkpoint"] = None  # لا حاجة للاستئناف بعد النجاح
+        elif pending is not None:
+            fields["checkpoint"] = pending
+        if "result" in fields:
+            blob = pack_result(fields["result"])
+            fields["result_blob"] = blob
+            if blob is not None:
+                fields["result"] = result_summary(fields["result"])
+        with self._lock:
+            st = self._local.get(job_id)
+            if st is not None:
+                st.status = status
+                st.finished_at = now.timestamp()
+                for k, v in fields.items():
+                    if hasattr(st, k) and k != "cancelled_at":
+                        setattr(st, k, v)
+                progress = {
+                    "total": st.total, "completed": st.completed, "percent": _calc_percent(st.completed, st.total),
+                    "message": (st.message or "")[:255], "eta_minutes": st.eta_minutes,
+                }
+            else:
+                progress = {}
+        kept = self._rows(job_id).update(
+            status=status, finished_at=now, lease_expires_at=None, **progress, **fields,
+        )
+        if kept:
+            finished = status == "done"
+            self._write_deltas(job_id, None if finished else deltas, replace=finished or pending is not None)
+            _notify(job_id, st.parent_id if st is not None else "")
+        self._shard_finished(job_id)
+
+    def done(self, job_id: str, result: Dict[str, Any]) -> None:
+        self._finish(job_id, "done", result=result)
+
+    def fail(self, job_id: str, error: str) -> None:
+        self._finish(job_id, "error", error=error)
+
+    def cancel(self, job_id: str) -> None:
+        BackgroundJob = self._model()
+        with self._lock:
+            st = self._local.get(job_id)
+            if st is not None:
+                st.cancel_requested = True
+        BackgroundJob.objects.filter(pk=job_id).update(cancel_requested=True)
+        # لم يلتقطها أي عامل بعد → تُلغى فورًا
+        now = _now()
+        dropped = BackgroundJob.objects.filter(pk=job_id, status=BackgroundJob.STATUS_QUEUED).update(
+            status=BackgroundJob.STATUS_CANCELLED, cancelled_at=now, finished_at=now,
+            error="Cancelled by user", message="cancelled before start",
+        )
+        for shard_id in BackgroundJob.objects.filter(parent_id=job_id).values_list("pk", flat=True):
+            self.cancel(shard_id)
+        _notify(job_id)
+        if dropped:
+            self._shard_finished(job_id)
+
+    def is_cancel_requested(self, job_id: str) -> bool:
+        with self._lock:
+            st = self._local.get(job_id)
+            if st is not None:
+                return st.cancel_requested
+        return self._model().objects.filter(pk=job_id, cancel_requested=True).exists()
+
+    def cancelled(self, job_id: str, partial_result: Optional[Dict[str, Any]] = None) -> None:
+        fields: Dict[str, Any] = {"cancelled_at": _now(), "error": "Cancelled by user"}
+        if partial_result is not None:
+            fields["result"] = partial_result
+        self._finish(job_id, "cancelled", **fields)
+
+    def save_checkpoint(self, job_id: str, data: Dict[str, Any]) -> None:
+        """يُكتب فورًا؛ داخل حلقة asyncio (لا ORM هناك) يُؤجَّل إلى heartbeat/نهاية المهمة."""
+        snap = json.loads(json.dumps(data, default=str))
+        with self._lock:
+            self._pending_checkpoint[job_id] = snap
+            self._pending_deltas.pop(job_id, None)  # checkpoint كامل يحلّ محلها
+        if not _in_event_loop():
+            self._flush_pending(job_id)
+
+    def append_checkpoint(self, job_id: str, key: str, delta: Dict[str, Any]) -> None:
+        """صف BackgroundJobCheckpointDelta بالجديد فقط؛ داخل حلقة asyncio يُؤجَّل مثل save_checkpoint."""
+        if not delta:
+            return
+        snap = json.loads(json.dumps(delta, default=str))
+        with self._lock:
+            self._pending_deltas.setdefault(job_id, []).append((key, snap))
+        if not _in_event_loop():
+            self._flush_pending(job_id)
+
+    def _flush_pending(self, job_id: str) -> None:
+        with self._lock:
+            pending = self._pending_checkpoint.pop(job_id, None)
+            deltas = self._pending_deltas.pop(job_id, None)
+        if pending is not None and not self._rows(job_id).update(checkpoint=pending):
+            return  # فقدنا الـlease
+        self._write_deltas(job_id, deltas, replace=pending is not None)
+        if pending is not None or deltas:
+            _notify(job_id)
+
+    def _write_deltas(self, job_id: str, deltas, *, replace: bool) -> None:
+        Delta = self._delta_model()
+        if replace:
+            Delta.objects.filter(job_id=job_id).delete()
+        if deltas:
+            Delta.objects.bulk_create([Delta(job_id=job_id, key=key, data=data) for key, data in deltas])
+
+    def load_checkpoint(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            pending = copy.deepcopy(self._pending_checkpoint.get(job_id))
+            local = copy.deepcopy(self._pending_deltas.get(job_id, []))
+        if pending is not None:
+            return _apply_deltas(pending, local)  # صفوف الإضافات في DB أقدم منه
+        data = self._model().objects.filter(pk=job_id).values_list("checkpoint", flat=True).first()
+        rows = self._delta_model().objects.filter(job_id=job_id).order_by("pk").values_list("key", "data")
+        return _apply_deltas(data, [*rows, *local])
+
+    def checkpoint_deltas(self, job_id: str, after: int = 0,
+                          key: Optional[str] = None) -> List[Tuple[int, str, Dict[str, Any]]]:
+        rows = self._delta_model().objects.filter(job_id=job_id, pk__gt=after).order_by("pk")
+        if key is not None:
+            rows = rows.filter(key=key)
+        return list(rows.values_list("pk", "key", "data"))
+
+    def load_result(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._model().objects.filter(pk=job_id).values_list("result", "result_blob").first()
+        if row is None:
+            return None
+        result, blob = row
+        return unpack_result(blob) if blob else result
+
+    def purge(self, ttl_sec: Optional[float] = None, max_jobs: int = 0) -> int:
+        """
+        يحذف المهام المنتهية الأقدم من TTL (و، إن حُدّد max_jobs، الأقدم فوق السقف).
+        شظايا أبٍ لم ينتهِ بعد تبقى حتى يدمجها الأب.
+        """
+        ttl_sec = JOB_RESULT_TTL_SEC if ttl_sec is None else ttl_sec
+        BackgroundJob = self._model()
+        finished = BackgroundJob.objects.filter(status__in=BackgroundJob.FINAL_STATUSES).exclude(
+            parent__isnull=False, parent__status__in=[
+                s for s, _ in BackgroundJob.STATUS_CHOICES if s not in BackgroundJob.FINAL_STATUSES
+            ],
+        )
+        n, _ = finished.filter(finished_at__lt=_now() - timedelta(seconds=ttl_sec)).delete()
+        if max_jobs > 0:
+            extra = list(finished.order_by("-finished_at").values_list("pk", flat=True)[max_jobs:])
+            if extra:
+                n += BackgroundJob.objects.filter(pk__in=extra).delete()[0]
+        return n
+
+    def resume(self, job_id: str) -> bool:
+        """cancelled/error → queued من جديد (نفس id ونفس checkpoint) للعامل."""
+        BackgroundJob = self._model()
+        shard_ids = list(BackgroundJob.objects.filter(parent_id=job_id).values_list("pk", flat=True))
+        if shard_ids:
+            if not [sid for sid in shard_ids if self.resume(sid)]:
+                return False
+            BackgroundJob.objects.filter(pk=job_id).update(
+                status=BackgroundJob.STATUS_RUNNING, cancel_requested=False, error=None, result=None,
+                result_blob=None, finished_at=None, cancelled_at=None, lease_owner="", message="resume shards",
+            )
+            return True
+        return bool(
+            BackgroundJob.objects.filter(
+                pk=job_id, status__in=[BackgroundJob.STATUS_CANCELLED, BackgroundJob.STATUS_ERROR],
+            ).exclude(task="").update(
+                status=BackgroundJob.STATUS_QUEUED, cancel_requested=False, attempts=0, run_after=_now(),
+                error=None, finished_at=None, cancelled_at=None, lease_owner="", lease_expires_at=None,
+                message="resume from checkpoint",
+            )
+        )
+
+    def spawn_sharded(self, parent: JobState, target: Callable[..., Any], shards, merge) -> List[JobState]:
+        """الأب: running بلا task ولا lease (لا يلتقطه عامل)؛ merge يُحفظ كمسار لاستدعائه من أي عملية."""
+        self._model().objects.filter(pk=parent.id).update(
+            status="running", started_at=_now(), task="", lease_owner="", lease_expires_at=None,
+            kwargs={"merge": callable_path(merge), "shards": len(shards)},
+        )
+        children = []
+        for total, args, kwargs in shards:
+            child = self.create(total=total, message="queued", owner=parent.owner, priority=parent.priority,
+                                parent_id=parent.id)
+            self.spawn(child, target, *args, **kwargs)
+            children.append(child)
+        return children
+
+    def _shard_finished(self, job_id: str) -> None:
+        """
+        آخر شظية انتهت → الأب done بنتيجة merge (أو cancelled/error). قد تنتهي شظيتان في
+        عمليتين معًا: UPDATE مشروط على lease_owner يجعل واحدة فقط تُنهي الأب.
+        """
+        from django.utils.module_loading import import_string
+
+        BackgroundJob = self._model()
+        parent_id = BackgroundJob.objects.filter(pk=job_id).values_list("parent_id", flat=True).first()
+        if not parent_id:
+            return
+        shards = self._shard_states(parent_id)
+        outcome = _shards_outcome(shards)
+        if outcome is None:
+            return
+        won = BackgroundJob.objects.filter(
+            pk=parent_id, status=BackgroundJob.STATUS_RUNNING, lease_owner="",
+        ).update(lease_owner="merging")
+        if not won:
+            return
+        parent = _state_from_row(BackgroundJob.objects.defer("checkpoint", "result_blob").get(pk=parent_id))
+        _aggregate_shards(parent, shards)
+        BackgroundJob.objects.filter(pk=parent_id).update(
+            total=parent.total, completed=parent.completed, percent=parent.percent,
+        )
+        if outcome == "error":
+            self.fail(parent_id, _shards_error(shards))
+            return
+        path = (BackgroundJob.objects.filter(pk=parent_id).values_list("kwargs", flat=True).first() or {}).get("merge")
+        merged = import_string(path)([self.load_result(x.id) for x in shards]) if path else None
+        if outcome == "done":
+            self.done(parent_id, merged or {})
+        else:
+            self.cancelled(parent_id, partial_result=merged)
 
     def spawn(self, job: JobState, target: Callable[..., Any], *args: Any, **kwargs: Any) -> None:
-        def _runner():
+        """Registered targets go to the worker queue; anything else runs on a local thread."""
+        name = task_name(target)
+        if name is not None:
             try:
-                self.start(job.id, message="running")
-                result = target(job, *args, **kwargs)
-                # target may already mark as cancelled; only set done if still active
-                with self._lock:
-                    st = self._jobs.get(job.id)
-                    already_final = st and st.status in {"done", "error", "cancelled"}
-                if not already_final:
-                    self.done(job.id, result=result if isinstance(result, dict) else {"result": result})
-            except Exception as e:
-                self.fail(job.id, error=str(e))
-
-        t = threading.Thread(target=_runner, daemon=True)
+                self._model().objects.filter(pk=job.id).update(
+                    task=name, args=list(args), kwargs=dict(kwargs), status="queued", run_after=_now(),
+                )
+                return
+            except (TypeError, ValueError):
+                logger.warning("job %s: args are not JSON-serializable; running %s in-process", job.id, name)
+        owner = f"thread:{default_worker_id()}"
+        self._model().objects.filter(pk=job.id).update(
+            status="running", lease_owner=owner, attempts=1, max_attempts=1,
+            started_at=_now(), heartbeat_at=_now(), lease_expires_at=_now() + timedelta(seconds=JOB_LEASE_SEC),
+        )
+        t = threading.Thread(
+            target=self._run_in_thread, args=(job.id, owner, target, args, kwargs), daemon=True,
+        )
         t.start()
 
+    def spawn_coalesced(self, target: Callable[..., Any], ids: List[Any], *, owner: str, delay: float,
+                        max_delay: float, priority: int, kwargs: Dict[str, Any]) -> JobState:
+        """
+        الصف queued نفسه (attempts=0) هو مجموعة الانتظار: ندمج فيه ids ونؤخّر run_after بتحديث
+        مشروط (status/attempts)، فإن التقطه عامل في هذه اللحظة ننشئ مهمة جديدة. عمليتان تنشئان
+        في اللحظة نفسها → مهمتان على الأكثر، لا ids ضائعة.
+        """
+        name = task_name(target)
+        if name is None:
+            raise ValueError(f"{callable_path(target)} is not registered in JOB_TASKS")
+        BackgroundJob = self._model()
+        now = _now()
+        pending = BackgroundJob.objects.filter(
+            task=name, owner=(owner or "")[:64], status=BackgroundJob.STATUS_QUEUED, attempts=0, parent__isnull=True,
+        ).only("id", "args", "kwargs", "created_at").order_by("created_at")
+        for row in pending:
+            if row.kwargs != kwargs or not row.args:
+                continue
+            merged = list(dict.fromkeys([*row.args[0], *ids]))
+            run_after = min(now + timedelta(seconds=delay), row.created_at + timedelta(seconds=max_delay))
+            if BackgroundJob.objects.filter(pk=row.pk, status=BackgroundJob.STATUS_QUEUED, attempts=0).update(
+                args=[merged], total=len(merged), run_after=run_after,
+            ):
+                return self.get(row.pk)
+        st = self.create(total=len(ids), message=f"waiting {delay:g}s for more edits", owner=owner,
+                         priority=priority)
+        self._rows(st.id).update(
+            task=name, args=[list(dict.fromkeys(ids))], kwargs=dict(kwargs),
+            run_after=now + timedelta(seconds=delay),
+        )
+        return self.get(st.id)
+
+    def _run_in_thread(self, job_id, owner, target, args, kwargs) -> None:
+        from django.db import connection
+
+        try:
+            self.execute(job_id, owner, target, args, kwargs, heartbeat_sec=JOB_HEARTBEAT_SEC)
+        finally:
+            connection.close()
+
+    # ---------- worker side ----------
+    def claim(self, worker_id: str, lease_sec: float = JOB_LEASE_SEC):
+        """
+        يلتقط المهمة الجاهزة التالية (queued وحان run_after، أو running بـlease منتهٍ) حسب
+        fair_order: المالكون الذين بلغوا JOB_MAX_PER_OWNER والدفعات فوق JOB_MAX_BULK_RUNNING
+        يُستبعدون من الاستعلام نفسه فلا تحجب مهامهم مهام الآخرين.
+        الالتقاط UPDATE مشروط (نفس status/lease/attempts) → عامل واحد فقط يربح.
+        السقوف مرنة: عاملان يلتقطان في اللحظة نفسها قد يتجاوزانها بواحدة.
+        """
+        from django.db.models import F, Q
+
+        BackgroundJob = self._model()
+        now = _now()
+        self._reap_expired(now)
+        ready = (
+            Q(status=BackgroundJob.STATUS_QUEUED, run_after__lte=now)
+            | Q(status=BackgroundJob.STATUS_RUNNING, lease_expires_at__lt=now)
+        )
+        running = [
+            (parent or pk, owner, priority)
+            for pk, parent, owner, priority in BackgroundJob.objects.filter(
+                status=BackgroundJob.STATUS_RUNNING, lease_expires_at__gte=now,
+            ).values_list("pk", "parent_id", "owner", "priority")
+        ]
+        families = {family for family, _, _ in running}
+        owners: Dict[str, set] = {}
+        for family, owner, _ in running:
+            if owner:
+                owners.setdefault(owner, set()).add(family)
+        qs = BackgroundJob.objects.filter(ready).exclude(task="")
+        # شظايا عائلة جارية لا تخضع لسقف المالك/الدفعات (fair_order يطبّق JOB_SHARD_PARALLEL)
+        in_family = Q(parent_id__in=families)
+        if JOB_MAX_PER_OWNER:
+            capped = [o for o, fams in owners.items() if len(fams) >= JOB_MAX_PER_OWNER]
+            qs = qs.exclude(Q(owner__in=capped) & ~in_family)
+        bulk = {family for family, _, priority in running if priority >= PRIORITY_BULK}
+        if JOB_MAX_BULK_RUNNING is not None and len(bulk) >= JOB_MAX_BULK_RUNNING:
+            qs = qs.filter(Q(priority__lt=PRIORITY_BULK) | in_family)
+        cands = {c.pk: c for c in qs.order_by("priority", "created_at")[:50]}
+        order = fair_order(
+            ((c.pk, c.owner, c.priority, c.created_at.timestamp(), c.parent_id or c.pk) for c in cands.values()),
+            running,
+            max_per_owner=JOB_MAX_PER_OWNER,
+            max_bulk=JOB_MAX_BULK_RUNNING,
+        )
+        for pk in order:
+            cand = cands[pk]
+            won = BackgroundJob.objects.filter(
+                pk=cand.pk, status=cand.status, lease_owner=cand.lease_owner, attempts=cand.attempts,
+            ).update(
+                status=BackgroundJob.STATUS_RUNNING,
+                lease_owner=worker_id,
+                lease_expires_at=now + timedelta(seconds=lease_sec),
+                heartbeat_at=now,
+                started_at=now,
+                attempts=F("attempts") + 1,
+                message="running",
+            )
+            if won:
+                return BackgroundJob.objects.get(pk=cand.pk)
+        return None
+
+    def _reap_expired(self, now: datetime) -> None:
+        """lease منتهٍ واستُنفدت المحاولات → error (وإلا يُعاد التقاطها في claim)."""
+        from django.db.models import F
+
+        BackgroundJob = self._model()
+        dead = BackgroundJob.objects.filter(
+            status=BackgroundJob.STATUS_RUNNING, lease_expires_at__lt=now, attempts__gte=F("max_attempts"),
+        )
+        ids = list(dead.values_list("pk", flat=True))
+        if not ids:
+            return
+        BackgroundJob.objects.filter(pk__in=ids, status=BackgroundJob.STATUS_RUNNING).update(
+            status=BackgroundJob.STATUS_ERROR, finished_at=now, lease_expires_at=None,
+            error="lease expired (worker died or timed out)",
+        )
+        for job_id in ids:
+            self._shard_finished(job_id)
+
+    def heartbeat(self, job_id: str, lease_sec: float = JOB_LEASE_SEC) -> bool:
+        """يكتب التقدّم المحلي، يجدّد الـlease ويقرأ cancel_requested. False = فقدنا الـlease."""
+        BackgroundJob = self._model()
+        with self._lock:
+            st = self._local.get(job_id)
+            owner = self._owner.get(job_id)
+            if st is None or owner is None:
+                return False
+            progress = {
+                "total": st.total, "completed": st.completed, "percent": st.percent,
+                "message": (st.message or "")[:255], "eta_minutes": st.eta_minutes,
+            }
+        self._flush_pending(job_id)
+        now = _now()
+        kept = BackgroundJob.objects.filter(
+            pk=job_id, lease_owner=owner, status=BackgroundJob.STATUS_RUNNING,
+        ).update(heartbeat_at=now, lease_expires_at=now + timedelta(seconds=lease_sec), **progress)
+        flag = BackgroundJob.objects.filter(pk=job_id).values_list("cancel_requested", flat=True).first()
+        with self._lock:
+            if st is not None and (flag or not kept):
+                # lease مفقود: عامل آخر التقط المهمة → نتوقف بأسرع ما يمكن
+                st.cancel_requested = True
+            changed = kept and self._beat_progress.get(job_id) != progress
+            if changed:
+                self._beat_progress[job_id] = progress
+        if changed:
+            _notify(job_id, st.parent_id)
+        return bool(kept)
+
+    def execute(
+        self,
+        job_id: str,
+        worker_id: str,
+        target: Callable[..., Any],
+        args=(),
+        kwargs=None,
+        *,
+        heartbeat_sec: float = JOB_HEARTBEAT_SEC,
+        lease_sec: float = JOB_LEASE_SEC,
+    ) -> str:
+        """يشغّل target لمهمة مملوكة (claimed) ويعيد الحالة النهائية."""
+        BackgroundJob = self._model()
+        row = BackgroundJob.objects.get(pk=job_id)
+        st = _state_from_row(row)
+        st.status = "running"
+        with self._lock:
+            self._local[job_id] = st
+            self._owner[job_id] = worker_id
+
+        stop = threading.Event()
+        beat = None
+        if heartbeat_sec > 0:
+            def _beat():
+                from django.db import connection
+
+                try:
+                    while not stop.wait(heartbeat_sec):
+                        try:
+                            self.heartbeat(job_id, lease_sec)
+                        except Exception:
+                            logger.debug("job %s: heartbeat failed", job_id, exc_info=True)
+                finally:
+                    connection.close()
+
+            beat = threading.Thread(target=_beat, daemon=True, name=f"job-heartbeat-{job_id[:8]}")
+            beat.start()
+
+        try:
+            result = target(st, *(args or ()), **(kwargs or {}))
+            if st.status not in _FINAL:
+                self.done(job_id, result=result if isinstance(result, dict) else {"result": result})
+        except Exception as e:
+            logger.exception("job %s failed (attempt %d/%d)", job_id, row.attempts, row.max_attempts)
+            if row.attempts < row.max_attempts and not st.cancel_requested:
+                delay = min(600.0, JOB_RETRY_BACKOFF_SEC * (2 ** max(0, row.attempts - 1)))
+                self._flush_pending(job_id)
+                self._rows(job_id).update(
+                    status=BackgroundJob.STATUS_QUEUED, lease_owner="", lease_expires_at=None,
+                    run_after=_now() + timedelta(seconds=delay), error=str(e),
+                    message=f"retry {row.attempts + 1}/{row.max_attempts} in {int(delay)}s",
+                )
+                st.status = "queued"
+            else:
+                self.fail(job_id, error=str(e))
+        finally:
+            stop.set()
+            if beat is not None:
+                beat.join(timeout=5)
+            with self._lock:
+                self._local.pop(job_id, None)
+                self._owner.pop(job_id, None)
+                self._beat_progress.pop(job_id, None)
+        return st.status
+
+    def run_claimed(self, row, worker_id: str, **opts) -> str:
+        from django.utils.module_loading import import_string
+
+        path = JOB_TASKS.get(row.task)
+        if path is None:
+            self._owner[row.id] = worker_id
+            self._finish(row.id, "error", error=f"unknown task {row.task!r}")
+            self._owner.pop(row.id, None)
+            return "error"
+        return self.execute(row.id, worker_id, import_string(path), row.args, row.kwargs, **opts)
+
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def task_name(target: Callable[..., Any]) -> Optional[str]:
+    path = callable_path(target)
+    for name, dotted in JOB_TASKS.items():
+        if dotted == path:
+            return name
+    return None
+
+
+# ============================================================
+# facade
+# ============================================================
+class JobManager:
+    """Same API for both backends (views / jobs only talk to this)."""
+
+    def __init__(self, backend: Optional[str] = None) -> None:
+        self.set_backend(backend)
+
+    def set_backend(self, backend: Optional[str] = None) -> str:
+        name = (backend or os.getenv("JOB_BACKEND", "memory")).strip().lower()
+        self.backend = "db" if name == "db" else "memory"
+        self._impl = _DBJobs() if self.backend == "db" else _MemoryJobs()
+        return self.backend
+
+    @property
+    def store(self):
+        return self._impl
+
+    def create(self, *, total: int = 0, message: str = "", owner: str = "",
+               priority: int = PRIORITY_INTERACTIVE) -> JobState:
+        return self._impl.create(total=total, message=message, owner=owner, priority=priority)
+
+    def get(self, job_id: str) -> Optional[JobState]:
+        return self._impl.get(job_id)
+
+    def start(self, job_id: str, message: str = "") -> None:
+        self._impl.start(job_id, message=message)
+
+    def update(self, job_id: str, *, completed: Optional[int] = None, total: Optional[int] = None,
+               message: Optional[str] = None, eta_minutes: Optional[float] = None) -> None:
+        self._impl.update(job_id, completed=completed, total=total, message=message, eta_minutes=eta_minutes)
+
+    def done(self, job_id: str, result: Dict[str, Any]) -> None:
+        self._impl.done(job_id, result)
+
+    def fail(self, job_id: str, error: str) -> None:
+        self._impl.fail(job_id, error)
+
+    # -------- cancellation support --------
+    def cancel(self, job_id: str) -> None:
+        """Mark a job as cancel requested. The running worker should check and stop ASAP."""
+        self._impl.cancel(job_id)
+
+    def is_cancel_requested(self, job_id: str) -> bool:
+        return self._impl.is_cancel_requested(job_id)
+
+    def cancelled(self, job_id: str, partial_result: Optional[Dict[str, Any]] = None) -> None:
+        self._impl.cancelled(job_id, partial_result=partial_result)
+
+    def spawn(self, job: JobState, target: Callable[..., Any], *args: Any, **kwargs: Any) -> None:
+        self._impl.spawn(job, target, *args, **kwargs)
+
+    def spawn_sharded(
+        self,
+        parent: JobState,
+        target: Callable[..., Any],
+        shards: List[Tuple[int, tuple, Dict[str, Any]]],
+        merge: Callable[[List[Optional[Dict[str, Any]]]], Dict[str, Any]],
+    ) -> List[JobState]:
+        """
+        Run `target` once per shard (total, args, kwargs) as child jobs of `parent`.
+        The parent reports the summed progress and, when the last shard ends, finishes with
+        merge([shard results in order]). merge must be importable (module-level function).
+        """
+        return self._impl.spawn_sharded(parent, target, shards, merge)
+
+    def spawn_coalesced(
+        self,
+        target: Callable[..., Any],
+        ids: Iterable[Any],
+        *,
+        owner: str = "",
+        delay: float = 5.0,
+        max_delay: Optional[float] = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        **kwargs: Any,
+    ) -> JobState:
+        """
+        Debounced `target(job, ids, **kwargs)`: starts once no call for the same target/owner/kwargs
+        came in for `delay` seconds (but at most `max_delay`, default 10×delay, after the first);
+        calls before that only add their ids to the waiting job. ids must be JSON-able; the db
+        backend needs target in JOB_TASKS.
+        """
+        delay = max(0.0, float(delay))
+        max_delay = max(delay, float(max_delay) if max_delay is not None else delay * 10)
+        return self._impl.spawn_coalesced(
+            target, list(ids), owner=owner, delay=delay, max_delay=max_delay, priority=priority, kwargs=kwargs,
+        )
+
+    # -------- checkpoints / resume --------
+    def save_checkpoint(self, job_id: str, data: Dict[str, Any]) -> None:
+        self._impl.save_checkpoint(job_id, data)
+
+    def append_checkpoint(self, job_id: str, key: str, delta: Dict[str, Any]) -> None:
+        """Add `delta` to checkpoint[key] (dict.update on load) without rewriting the rest."""
+        self._impl.append_checkpoint(job_id, key, delta)
+
+    def load_checkpoint(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self._impl.load_checkpoint(job_id)
+
+    def checkpoint_deltas(self, job_id: str, after: int = 0,
+                          key: Optional[str] = None) -> List[Tuple[int, str, Dict[str, Any]]]:
+        """[(seq, key, delta)] appended after seq `after`, oldest first (seq grows; 0 = all)."""
+        return self._impl.checkpoint_deltas(job_id, after, key)
+
+    def revision(self, job_id: str) -> int:
+        """Change counter of a job, bumped by every write another reader could see (0 = unknown)."""
+        from django.core.cache import cache
+
+        try:
+            return int(cache.get(JOB_REVISION_KEY.format(job_id)) or 0)
+        except Exception:
+            return 0
+
+    def resume(self, job_id: str) -> bool:
+        """Re-run a cancelled/failed job from its last checkpoint. False if not resumable."""
+        return self._impl.resume(job_id)
+
+    # -------- results / retention --------
+    def load_result(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Full result (JobState.result may only be its result_summary when it was spilled)."""
+        return self._impl.load_result(job_id)
+
+    def purge(self, ttl_sec: Optional[float] = None) -> int:
+        """Drop finished jobs older than ttl_sec (JOB_RESULT_TTL_SEC); returns how many were removed."""
+        return self._impl.purge(ttl_sec)
+
 
 job_manager = JobManager()
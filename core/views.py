@@ -3,21 +3,32 @@
 # واجهات REST الخاصة بالتطبيق
 # ============================================================
 
-from typing import Iterable, List, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterable, List, Dict, Optional, Tuple
+import asyncio
+import json
+import hashlib
+import os
 import re
+import threading
 import time
 import logging
 
+from django.core.cache import cache
 from django.db import transaction, IntegrityError
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.db.models import Prefetch, Q
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError as DjangoValidationError
 from django.contrib.auth import get_user_model
 
 from rest_framework import generics, status, viewsets, permissions
-from rest_framework.decorators import api_view, permission_classes, action, throttle_classes
+from rest_framework.decorators import api_view, permission_classes, action, throttle_classes, renderer_classes
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 from rest_framework.throttling import ScopedRateThrottle
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from rest_framework.permissions import IsAuthenticated, AllowAny
@@ -38,6 +49,7 @@ from .models import (
     DishPrice,
     Profile,
     DishAllergen,
+    IngredientSuggestion,
     ExtraGroup, Extra,    # ✅ NEW: Extras
 )
 
@@ -60,6 +72,8 @@ from .serializers import (
 
 # محرك القواعد
 from core.services.allergen_rules import generate_for_dishes as rule_generate_for_dishes
+from core.services import public_menu
+from core.services.allergen_registry import registry as allergen_registry
 from core.services.allergen_rules import normalize_text as _norm
 
 # LLM
@@ -68,11 +82,18 @@ from core.services.llm_ingest import (
     llm_extract_terms,
     llm_map_terms_to_codes,
     llm_map_dish_to_codes,   # LLM مباشر للأكواد
+    llm_map_dishes_to_codes, # LLM مباشر: عدة أطباق في برومبت واحد
+    allm_process_dishes,     # async: عدة أطباق بالتوازي
+    dish_fingerprint,        # dedup أطباق متطابقة قبل LLM
+    DIRECT_CODES_PROMPT_VERSION,
+    PACKED_CODES_PROMPT_VERSION,
+    TERMS_PROMPT_VERSION,
 )
-from core.llm_clients.openai_client import openai_caller
+from core.llm_clients.backends import llm_caller, async_llm_caller, current_backend as _llm_backend  # LLM_BACKEND=openai|fake|record|replay
 from core.llm_clients.limiter import estimate_eta as _llm_estimate_eta
 from core.llm_clients.limiter import global_limiter as _llm_limiter
-from core.utils.jobs import job_manager, JobState
+from core.llm_clients.limiter import global_async_limiter as _llm_async_limiter
+from core.utils.jobs import job_manager, JobState, result_summary, PRIORITY_BULK, PRIORITY_INTERACTIVE
 
 logger = logging.getLogger("core.llm")
 
@@ -257,25 +278,32 @@ def ping(request):
 @permission_classes([IsAuthenticated])
 def llm_eta(request):
     """
-    GET /api/llm/eta?count=100&avg_tokens=1500&calls_per_item=2.0&p95_latency_sec=2.5
+    GET /api/llm/eta?count=100&model=gpt-4o-mini&calls_per_item=2.0&p95_latency_sec=2.5
     Returns an ETA estimate (in minutes) and the effective throughput.
+    avg_tokens defaults to the observed per-model average (resp.usage) and
+    p95_latency_sec to the limiter's rolling p95; query params override both.
     """
     try:
         count = int(request.query_params.get("count", 0))
     except Exception:
         count = 0
+    model = request.query_params.get("model") or None
+    avg_tokens_source = "observed" if _llm_limiter.usage_stats() else "default"
     try:
-        avg_tokens = int(request.query_params.get("avg_tokens", 1500))
+        avg_tokens = int(request.query_params["avg_tokens"])
+        avg_tokens_source = "query"
     except Exception:
-        avg_tokens = 1500
+        avg_tokens = _llm_limiter.avg_tokens_per_call(model)
     try:
         calls_per_item = float(request.query_params.get("calls_per_item", 2.0))
     except Exception:
         calls_per_item = 2.0
+    p95_source = "observed" if _llm_limiter.latency_stats() else "default"
     try:
-        p95_latency = float(request.query_params.get("p95_latency_sec", 2.5))
+        p95_latency = float(request.query_params["p95_latency_sec"])
+        p95_source = "query"
     except Exception:
-        p95_latency = 2.5
+        p95_latency = _llm_limiter.latency_p95(model)
 
     rate, minutes = _llm_estimate_eta(
         items=count,
@@ -292,9 +320,12 @@ def llm_eta(request):
         pass
     return Response({
         "count": count,
+        "model": model,
         "avg_tokens_per_call": avg_tokens,
+        "avg_tokens_source": avg_tokens_source,
         "calls_per_item": calls_per_item,
-        "p95_latency_sec": p95_latency,
+        "p95_latency_sec": round(p95_latency, 3),
+        "p95_latency_source": p95_source,
         "effective_rate_req_per_min": round(rate, 2),
         "estimated_minutes": round(minutes, 2),
     })
@@ -306,9 +337,11 @@ def llm_limits(request):
     """
     GET /api/llm/limits -> current limiter config + runtime budgets & simple throughput.
     Useful to show the user remaining capacity and a live-progress ticker.
+    With a shared limiter backend (config.shared=true) the remaining budgets are
+    aggregate for all workers, and stats.completed_all_processes counts every call.
     """
     data = {
-        "config": _llm_limiter.config(),
+        "config": {**_llm_limiter.config(), "llm_backend": _llm_backend()},
         "stats": _llm_limiter.stats(),
     }
     return Response(data, status=status.HTTP_200_OK)
@@ -318,6 +351,386 @@ def llm_limits(request):
 # LLM Batch Jobs (async): start + status
 # ============================================================
 
+# Async LLM phase is on by default; LLM_ASYNC_BATCH=0 (or payload llm_async=false) keeps the sequential loop
+_LLM_ASYNC_BATCH = os.getenv("LLM_ASYNC_BATCH", "1").strip() not in {"0", "false", "False", "no"}
+
+
+def _allergen_prompt_labels() -> Dict[str, str]:
+    """code → label_de من سجلّ Allergen (الحساسيّات فقط) لبرومبت compact."""
+    return allergen_registry.labels("de", kind=Allergen.Kind.ALLERGEN)
+
+
+def _llm_prompt_options(style: Optional[str]) -> Dict:
+    """kwargs لـ LLMConfig: prompt_style (payload ثم env LLM_PROMPT_STYLE) + أكواد جدول Allergen لـ compact."""
+    style = str(style or os.getenv("LLM_PROMPT_STYLE", "full")).strip().lower()
+    if style != "compact":
+        return {"prompt_style": "full"}
+    return {"prompt_style": "compact", "allergen_labels": _allergen_prompt_labels() or None}
+
+
+def _lexeme_ingredient_ids(terms: Iterable[str], lang: str) -> Dict[str, Optional[int]]:
+    """
+    normalized_term → ingredient_id لأول lexeme مطابق بترتيب KeywordLexeme.Meta.ordering
+    (-priority ثم -weight) — نفس الفائز كما كان .first() لكل term.
+    استعلام normalized_term__in واحد لكل الدفعة بدل استعلام لكل term.
+    """
+    norms = sorted({_norm(t) for t in terms if t} - {""})
+    out: Dict[str, Optional[int]] = {}
+    for i in range(0, len(norms), 500):  # حدود متغيرات SQLite
+        rows = (
+            KeywordLexeme.objects
+            .filter(lang=lang, normalized_term__in=norms[i:i + 500])
+            .values_list("normalized_term", "ingredient_id")
+        )
+        for norm, ingredient_id in rows:
+            out.setdefault(norm, ingredient_id)
+    return out
+
+
+def _llm_candidates(
+    terms: List[str],
+    codes_lookup: Dict,
+    lang: str,
+    lexemes: Optional[Dict[str, Optional[int]]] = None,
+) -> List[Dict]:
+    """
+    يبني قائمة candidates لكل term مع guess_codes وربط Ingredient إن وُجد lexeme.
+    lexemes: ناتج _lexeme_ingredient_ids محسوب مسبقًا للدفعة كلها (وإلا يُحسب هنا).
+    """
+    if lexemes is None:
+        lexemes = _lexeme_ingredient_ids(terms, lang)
+    candidates = []
+    for term in terms:
+        lk = codes_lookup.get(term.lower(), {}) if isinstance(codes_lookup, dict) else {}
+        cand = {
+            "term": term,
+            "guess_codes": lk.get("codes", ""),
+            "confidence": lk.get("confidence", 0.0),
+            "reason": lk.get("reason", ""),
+        }
+        ingredient_id = lexemes.get(_norm(term))
+        if ingredient_id:
+            cand["mapped_ingredient_id"] = ingredient_id
+        candidates.append(cand)
+    return candidates
+
+
+def _fill_llm_candidates(pending: List[Tuple[Dict, List[str], Dict]], lang: str) -> None:
+    """يملأ item["candidates"] لكل (item, terms, codes_lookup) باستعلام lexemes واحد."""
+    if not pending:
+        return
+    lexemes = _lexeme_ingredient_ids((t for _, terms, _ in pending for t in terms), lang)
+    for item, terms, codes_lookup in pending:
+        item["candidates"] = _llm_candidates(terms, codes_lookup, lang, lexemes)
+
+
+def _group_llm_dishes(by_id: Dict[int, Dish], dish_ids: List[int]) -> Dict[int, List[int]]:
+    """
+    يجمع الأطباق المتطابقة (نفس بصمة الاسم+الوصف) قبل مرحلة LLM.
+    يعيد {representative_id: [member ids...]} بترتيب الظهور؛ الممثّل أول عضو.
+    """
+    by_fp: Dict[str, int] = {}
+    groups: Dict[int, List[int]] = {}
+    for did in dish_ids:
+        d = by_id.get(did)
+        if d is None:
+            continue
+        fp = dish_fingerprint(d.name or "", d.description or "")
+        rep = by_fp.setdefault(fp, did)
+        groups.setdefault(rep, []).append(did)
+    return groups
+
+
+def _fan_out_llm_items(items: List[Dict], groups: Dict[int, List[int]]) -> List[Dict]:
+    """ينسخ نتيجة الممثّل لكل أعضاء مجموعته (dedup_of = id الممثّل)."""
+    out: List[Dict] = []
+    for item in items:
+        rep = item.get("dish_id")
+        for did in groups.get(rep, [rep]):
+            if did == rep:
+                out.append(item)
+                continue
+            clone = dict(item, dish_id=did, dedup_of=rep)
+            clone["candidates"] = [dict(c) for c in item.get("candidates", [])]
+            out.append(clone)
+    return out
+
+
+def _llm_dedup_stats(groups: Dict[int, List[int]]) -> Dict:
+    dishes = sum(len(m) for m in groups.values())
+    unique = len(groups)
+    return {
+        "dishes": dishes,
+        "unique": unique,
+        "llm_calls_saved": dishes - unique,
+        # share of dishes answered from another dish's LLM call
+        "dedup_ratio": round(1.0 - unique / dishes, 3) if dishes else 0.0,
+    }
+
+
+def _suggestion_snapshot(name: str, description: str) -> str:
+    return f"{(name or '').strip()}\n{(description or '').strip()}".strip()
+
+
+def _suggestion_prompt_hash(d: Dish, cfg: LLMConfig, guess_codes: bool) -> str:
+    """
+    prompt_hash = بصمة نص الطبق + البرومبت الذي ولّد الاقتراح (نسخة/أسلوب full|compact/guess_codes/max_terms).
+    تغيير أي منها = hash جديد → لا يُعاد استخدام اقتراح قديم ولا يُسقط الجديد بـuniq_suggestion_per_prompt.
+    """
+    prompt = f"{TERMS_PROMPT_VERSION}:{cfg.prompt_style}:{int(bool(guess_codes))}:{cfg.max_terms}"
+    key = f"{dish_fingerprint(d.name or '', d.description or '')}\n{prompt}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def _reusable_suggestions(
+    by_id: Dict[int, Dish], dish_ids: List[int], cfg: LLMConfig, guess_codes: bool = True
+) -> Dict[int, IngredientSuggestion]:
+    """
+    dish_id → أحدث اقتراح pending (نفس lang/model/prompt) لم يتغيّر نص طبقه منذ توليده.
+    هذه الأطباق لا تحتاج نداء LLM جديدًا. الصفوف بلا prompt_hash (برومبت مجهول) لا يُعاد استخدامها.
+    """
+    fps = {did: _suggestion_prompt_hash(by_id[did], cfg, guess_codes) for did in dish_ids if did in by_id}
+    ids = list(fps)
+    out: Dict[int, IngredientSuggestion] = {}
+    for i in range(0, len(ids), 500):
+        rows = IngredientSuggestion.objects.filter(
+            dish_id__in=ids[i:i + 500],
+            status=IngredientSuggestion.STATUS_PENDING,
+            lang=cfg.lang,
+            model_name=cfg.model_name,
+        ).order_by("-created_at", "-id")
+        for s in rows:
+            if s.dish_id not in out and s.prompt_hash == fps[s.dish_id]:
+                out[s.dish_id] = s
+    return out
+
+
+def _reused_llm_item(s: IngredientSuggestion) -> Dict:
+    candidates = s.candidates if isinstance(s.candidates, list) else []
+    return {
+        "dish_id": s.dish_id,
+        "status": "ok" if candidates else "empty",
+        "reused": True,
+        "suggestion_id": s.id,
+        "candidates": candidates,
+    }
+
+
+def _persist_llm_suggestions(
+    items: List[Dict], by_id: Dict[int, Dish], cfg: LLMConfig, guess_codes: bool = True
+) -> int:
+    """
+    يحفظ نتائج LLM الجديدة كـ IngredientSuggestion (pending) بـ bulk_create واحد.
+    الأخطاء والعناصر المعاد استخدامها لا تُحفظ؛ التكرار (نفس prompt_hash) يُتجاهل.
+    """
+    rows = []
+    for item in items:
+        d = by_id.get(item.get("dish_id"))
+        if d is None or item.get("reused") or item.get("status") not in ("ok", "empty"):
+            continue
+        rows.append(IngredientSuggestion(
+            dish=d,
+            lang=cfg.lang,
+            text_snapshot=_suggestion_snapshot(d.name, d.description),
+            candidates=item.get("candidates") or [],
+            model_name=cfg.model_name,
+            prompt_hash=_suggestion_prompt_hash(d, cfg, guess_codes),
+        ))
+    if rows:
+        IngredientSuggestion.objects.bulk_create(rows, batch_size=500, ignore_conflicts=True)
+    return len(rows)
+
+
+# batch-generate job checkpoints: rules per chunk of dishes, LLM results every N dishes;
+# a retry (worker) or resume continues from the last checkpoint without redoing that work.
+# Each checkpoint appends only what is new (append_checkpoint), so its cost does not grow with the job.
+_JOB_RULES_CHUNK = max(1, int(os.getenv("JOB_RULES_CHUNK", "200")))
+_JOB_CHECKPOINT_EVERY = max(1, int(os.getenv("JOB_CHECKPOINT_EVERY", "20")))
+# scheduling: jobs up to N dishes are "interactive"; bulk jobs keep at most N dishes in the LLM at once
+_JOB_INTERACTIVE_MAX_DISHES = max(0, int(os.getenv("JOB_INTERACTIVE_MAX_DISHES", "50")))
+_JOB_BULK_LLM_CONCURRENCY = max(1, int(os.getenv("JOB_BULK_LLM_CONCURRENCY", "8")))
+# sharding: jobs above the threshold are split into shards of ~N dishes that run in parallel
+_JOB_SHARD_THRESHOLD = max(1, int(os.getenv("JOB_SHARD_THRESHOLD", "1000")))
+_JOB_SHARD_SIZE = max(1, int(os.getenv("JOB_SHARD_SIZE", "250")))
+_JOB_SHARD_MODES = ("section", "menu", "chunk")
+
+
+def _merge_rules_chunk(acc: Dict, part: Dict) -> None:
+    """يضم ناتج generate_for_dishes لدفعة إلى المجموع: items كاملة، والعدّادات تُجمع."""
+    for key, value in (part or {}).items():
+        if key == "items":
+            acc.setdefault("items", []).extend(value or [])
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            acc[key] = acc.get(key, 0) + value
+        else:
+            acc.setdefault(key, value)
+
+
+def _batch_shards(qs, shard_by: str, size: int) -> List[List[int]]:
+    """
+    dish ids مقسّمة إلى شظايا: chunk = دفعات ثابتة بالترتيب؛ section/menu = لا يُقسم قسم/منيو
+    بين شظيتين (إلا إن تجاوز size)، والمجموعات الصغيرة تُضم معًا حتى size.
+    الأطباق المتطابقة (dish_fingerprint) تلحق بأول نسخة منها في نفس الشظية حتى يبقى dedup
+    (LLM مرة لكل بصمة) فعّالًا؛ الشظية قد تتجاوز size قليلًا بسبب ذلك.
+    """
+    rows = qs.order_by("section__menu_id", "section_id", "id").values_list(
+        "id", "section_id", "section__menu_id", "name", "description"
+    )
+    groups: Dict[object, List[List[int]]] = {}
+    units: Dict[str, List[int]] = {}  # fingerprint → ids (أول نسخة + المكرّرات)
+    for did, section_id, menu_id, name, description in rows:
+        fp = dish_fingerprint(name or "", description or "")
+        if fp in units:
+            units[fp].append(did)
+            continue
+        key = section_id if shard_by == "section" else menu_id if shard_by == "menu" else None
+        units[fp] = [did]
+        groups.setdefault(key, []).append(units[fp])
+    shards: List[List[int]] = []
+    current: List[int] = []
+    for group in groups.values():
+        if current and len(current) + sum(map(len, group)) > size:
+            shards.append(current)
+            current = []
+        part: List[int] = []
+        for unit in group:
+            if part and len(part) + len(unit) > size:
+                shards.append(part)
+                part = []
+            part.extend(unit)
+        if len(part) >= size:
+            shards.append(part)
+        else:
+            current.extend(part)
+    if current:
+        shards.append(current)
+    return shards
+
+
+def _merge_batch_generate_results(results: List[Optional[Dict]]) -> Dict:
+    """نتيجة المهمة الأم من نتائج الشظايا بالترتيب: items تُضم، العدّادات تُجمع."""
+    rules: Dict = {}
+    llm: Optional[Dict] = None
+    for res in results:
+        if not isinstance(res, dict):
+            continue  # شظية أُلغيت قبل أن تبدأ
+        _merge_rules_chunk(rules, res.get("rules") or {})
+        part = res.get("llm")
+        if isinstance(part, dict):
+            llm = {} if llm is None else llm
+            _merge_rules_chunk(llm, {k: v for k, v in part.items() if k not in ("dedup", "suggestions")})
+            for key in ("dedup", "suggestions"):
+                sub = llm.setdefault(key, {})
+                for k, v in (part.get(key) or {}).items():
+                    if isinstance(v, (int, float)) and not isinstance(v, bool):
+                        sub[k] = sub.get(k, 0) + v
+    if llm and llm.get("dedup"):
+        d = llm["dedup"]
+        d["dedup_ratio"] = round(1.0 - d.get("unique", 0) / d["dishes"], 3) if d.get("dishes") else 0.0
+    return {
+        "rules": rules,
+        "llm": llm,
+        "shards": {"count": len(results), "with_result": sum(1 for r in results if isinstance(r, dict))},
+    }
+
+
+def _llm_raw_result(terms: List[str], codes_lookup: Optional[Dict], raw: str = "", error: str = "") -> Dict:
+    """نتيجة LLM خام لطبق (كما تُحفظ في checkpoint)؛ candidates تُبنى في النهاية."""
+    if error:
+        return {"status": "error", "error": error}
+    return {
+        "status": "ok" if terms else "empty",
+        "terms": list(terms or []),
+        "codes_lookup": codes_lookup or {},
+        "raw": raw or "",
+    }
+
+
+def _llm_items_from_results(llm_ids: List[int], results: Dict[str, Dict], lang: str, debug: bool) -> List[Dict]:
+    """items بترتيب llm_ids من النتائج الخام (الجديدة + المستعادة) مع candidates باستعلام lexemes واحد."""
+    items: List[Dict] = []
+    pending: List[Tuple[Dict, List[str], Dict]] = []
+    for did in llm_ids:
+        res = results.get(str(did))
+        if res is None:
+            continue
+        if res.get("status") == "error":
+            items.append({
+                "dish_id": did,
+                "status": "error",
+                "error": res.get("error", ""),
+                "reused": False,
+                "candidates": [],
+            })
+            continue
+        item = {"dish_id": did, "status": res.get("status", "empty"), "reused": False, "candidates": []}
+        if debug:
+            item["raw"] = res.get("raw", "")
+        items.append(item)
+        pending.append((item, res.get("terms") or [], res.get("codes_lookup") or {}))
+    _fill_llm_candidates(pending, lang)
+    return items
+
+
+def _run_llm_phase_async(
+    job: JobState,
+    cfg: LLMConfig,
+    by_id: Dict[int, Dish],
+    missing_ids: List[int],
+    *,
+    record: Callable[[str, Dict], None],
+    checkpoint: Callable[[], None],
+    base_completed: int,
+    guess_codes: bool,
+    debug: bool,
+    calls_per_item: float,
+) -> bool:
+    """
+    مرحلة LLM عبر asyncio: كل الأطباق الناقصة تُرسل معًا ويضبط التوازي
+    global_async_limiter، بدل حجز خيط لكل نداء.
+    النتائج الخام تُسلَّم إلى record(dish_id, raw) (checkpoint كل _JOB_CHECKPOINT_EVERY طبق).
+    يعيد cancelled. استعلامات القاموس (ORM) تتم بعد انتهاء الحلقة.
+    """
+    total_llm = len(missing_ids)
+    processed = 0
+    max_in_flight = _JOB_BULK_LLM_CONCURRENCY if job.priority >= PRIORITY_BULK else None
+    in_flight = min(max_in_flight or _llm_async_limiter.concurrency, _llm_async_limiter.concurrency)
+
+    def _on_result(res) -> None:
+        nonlocal processed
+        processed += 1
+        record(str(res.key), _llm_raw_result(res.terms, res.codes_lookup, res.raw, res.error))
+        if processed % _JOB_CHECKPOINT_EVERY == 0:
+            checkpoint()
+        remain = max(0, total_llm - processed)
+        _, eta_min = _llm_estimate_eta(
+            remain, calls_per_item=calls_per_item, model=cfg.model_name, concurrency=in_flight,
+        )
+        job_manager.update(job.id, completed=base_completed + processed, eta_minutes=eta_min)
+
+    work = [
+        (did, by_id[did].name or "", by_id[did].description or "")
+        for did in missing_ids if did in by_id
+    ]
+    t0 = time.monotonic()
+    done = asyncio.run(allm_process_dishes(
+        async_llm_caller,  # type: ignore[arg-type]
+        cfg,
+        work,
+        guess_codes=guess_codes,
+        return_raw=debug,
+        should_cancel=lambda: job_manager.is_cancel_requested(job.id),
+        on_result=_on_result,
+        max_in_flight=max_in_flight,
+    ))
+    try:
+        logger.info("llm_phase_async: dishes=%d done=%d sec=%.3f", len(work), len(done), time.monotonic() - t0)
+    except Exception:
+        pass
+
+    return len(done) < len(work) or job_manager.is_cancel_requested(job.id)
+
+
 def _run_batch_generate_job(job: JobState, user_id: int, payload: dict) -> Dict:
     t_job_start = time.monotonic()
     # Reuse logic from batch_generate_allergen_codes while updating job progress
@@ -346,6 +759,14 @@ def _run_batch_generate_job(job: JobState, user_id: int, payload: dict) -> Dict:
         llm_temperature = 0.2
     llm_debug = bool(payload.get("llm_debug", False))
     llm_guess_codes = bool(payload.get("llm_guess_codes", True))
+    llm_async = bool(payload.get("llm_async", _LLM_ASYNC_BATCH))
+    # IngredientSuggestion: reuse pending rows for unchanged dishes, persist new candidates
+    llm_reuse = bool(payload.get("llm_reuse", True))
+    llm_persist = bool(payload.get("llm_persist", True))
+
+    # previous attempt / cancelled run of this job: continue from its checkpoint
+    ckpt = job_manager.load_checkpoint(job.id) or {}
+    resumed = bool(ckpt)
 
     # Query dishes with same permission constraints
     base = Dish.objects.select_related("section__menu__user")
@@ -353,7 +774,7 @@ def _run_batch_generate_job(job: JobState, user_id: int, payload: dict) -> Dict:
     dish_ids_param = payload.get("dish_ids")
     if isinstance(dish_ids_param, list) and dish_ids_param:
         qs = qs.filter(id__in=dish_ids_param)
-    dishes = list(qs)
+    dishes = list(qs.order_by("id"))
 
     total_units = len(dishes)
     job_manager.update(job.id, total=total_units, completed=0, message="rules phase")
@@ -374,58 +795,87 @@ def _run_batch_generate_job(job: JobState, user_id: int, payload: dict) -> Dict:
             owner_ids.discard(None)
             owner_id = next(iter(owner_ids)) if len(owner_ids) == 1 else None
 
-    # timing: rules phase
-    t_rules_start = time.monotonic()
+    if "missing_ids" in ckpt:
+        # rules phase finished in an earlier run
+        rules_res = ckpt.get("rules") or {}
+        missing_ids = [int(x) for x in ckpt["missing_ids"]]
+        job_manager.update(job.id, completed=len(dishes), message="rules restored from checkpoint")
+    else:
+        # 1) Rules — in chunks of dishes, checkpoint after each chunk (only that chunk's
+        # result is appended, keyed by its first dish id; a resume merges them back in order).
+        # Always include the caller's private lexicon along with owner's/global
+        acc = ckpt.get("rules_partial") or {
+            "processed": 0, "skipped": 0, "changed": 0, "missing_after_rules": 0,
+            "items": [], "dry_run": dry_run, "lang": lang, "count": 0,
+        }
+        for part in (ckpt.get("rules_chunks") or {}).values():
+            _merge_rules_chunk(acc, part)
+        done_ids = {it.get("dish_id") for it in acc.get("items", [])}
+        todo = [d for d in dishes if d.id not in done_ids]
+        base_done = len(dishes) - len(todo)
+        job_manager.update(job.id, completed=base_done)
+        for i in range(0, len(todo), _JOB_RULES_CHUNK):
+            if job_manager.is_cancel_requested(job.id):
+                partial = {"rules": dict(acc, items=acc["items"][:1000]), "llm": None}
+                job_manager.cancelled(job.id, partial_result=partial)
+                return partial
+            chunk = todo[i:i + _JOB_RULES_CHUNK]
+            part = rule_generate_for_dishes(
+                chunk,
+                owner_id=owner_id,
+                lang=lang,
+                force=force,
+                dry_run=dry_run,
+                include_details=include_details,
+                extra_owner_ids=[user.id],
+            )
 
-    # 1) Rules — always include the caller's private lexicon along with owner's/global
-    rules_res = rule_generate_for_dishes(
-        dishes,
-        owner_id=owner_id,
-        lang=lang,
-        force=force,
-        dry_run=dry_run,
-        include_details=include_details,
-        extra_owner_ids=[user.id],
-    )
+            # 1.b) Persist DishAllergen rows if not dry_run
+            if not dry_run and isinstance(part, dict):
+                chunk_by_id = {d.id: d for d in chunk}
+                created_rows = 0
+                for it in part.get("items", []) or []:
+                    try:
+                        did = int(it.get("dish_id"))
+                    except Exception:
+                        continue
+                    dish = chunk_by_id.get(did)
+                    if not dish or bool(it.get("skipped")):
+                        continue
+                    after = (it.get("after") or "").strip()
+                    if not after:
+                        continue
+                    created_rows += _sync_dish_allergen_rows_from_codes(
+                        dish, after, source=DishAllergen.Source.REGEX, force=force
+                    )
+                part["dish_allergen_rows_created"] = created_rows
 
-    # 1.b) Persist DishAllergen rows if not dry_run
-    if not dry_run and isinstance(rules_res, dict):
-        items = rules_res.get("items", []) or []
-        by_id = {d.id: d for d in dishes}
-        created_rows = 0
-        for it in items:
-            try:
-                did = int(it.get("dish_id"))
-            except Exception:
-                continue
-            dish = by_id.get(did)
-            if not dish or bool(it.get("skipped")):
-                continue
-            after = (it.get("after") or "").strip()
-            if not after:
-                continue
-            created_rows += _sync_dish_allergen_rows_from_codes(
-                dish, after, source=DishAllergen.Source.REGEX, force=force
-            )
-        rules_res["dish_allergen_rows_created"] = created_rows
+            _merge_rules_chunk(acc, part)
+            job_manager.append_checkpoint(job.id, "rules_chunks", {str(chunk[0].id): part})
+            job_manager.update(job.id, completed=base_done + i + len(chunk))
 
-    # Mark phase 1 progress
-    job_manager.update(job.id, completed=len(dishes), message="rules done")
+        # Mark phase 1 progress
+        job_manager.update(job.id, completed=len(dishes), message="rules done")
 
-    # 2) LLM fallback
-    missing_ids: List[int] = []
-    for it in rules_res.get("items", []):
-        after = (it.get("after") or "").strip()
-        before = (it.get("before") or "").strip()
-        if bool(it.get("skipped")):
-            continue
-        if after == "" or ((after == before) and (before == "")):
-            try:
-                missing_ids.append(int(it["dish_id"]))
-            except Exception:
+        # 2) LLM fallback candidates (from the full item list, not the truncated one)
+        missing_ids = []
+        for it in acc.get("items", []):
+            after = (it.get("after") or "").strip()
+            before = (it.get("before") or "").strip()
+            if bool(it.get("skipped")):
                 continue
+            if after == "" or ((after == before) and (before == "")):
+                try:
+                    missing_ids.append(int(it["dish_id"]))
+                except Exception:
+                    continue
+        rules_res = dict(acc, items=acc["items"][:1000])
+        ckpt = {"rules": rules_res, "missing_ids": missing_ids, "llm": {}}
+        job_manager.save_checkpoint(job.id, ckpt)
 
     llm_payload = None
+    llm_results: Dict[str, Dict] = dict(ckpt.get("llm") or {})  # representative dish_id → raw result
+    restored = len(llm_results)
     if use_llm and missing_ids:
         by_id = {d.id: d for d in dishes}
         cfg = LLMConfig(
@@ -435,133 +885,143 @@ def _run_batch_generate_job(job: JobState, user_id: int, payload: dict) -> Dict:
             temperature=llm_temperature,
             dry_run=llm_dry_run,
             max_output_tokens=512,
+            **_llm_prompt_options(payload.get("llm_prompt_style")),
         )
 
+        # dishes with an unchanged pending suggestion → no new LLM call
+        reused = _reusable_suggestions(by_id, missing_ids, cfg, llm_guess_codes) if llm_reuse else {}
+        reused_items = [_reused_llm_item(reused[did]) for did in missing_ids if did in reused]
+
+        # identical dishes (chains / branches) → one LLM call per fingerprint
+        groups = _group_llm_dishes(by_id, [did for did in missing_ids if did not in reused])
+        llm_ids = list(groups)
+        dedup = _llm_dedup_stats(groups)
+        todo_ids = [did for did in llm_ids if str(did) not in llm_results]
+
+        unsaved: Dict[str, Dict] = {}  # ok results since the last checkpoint
+
+        def _record(key: str, res: Dict) -> None:
+            llm_results[key] = res
+            if res.get("status") != "error":  # errors are not checkpointed: a resume retries them
+                unsaved[key] = res
+
+        def _checkpoint() -> None:
+            # only the new results are appended; earlier ones are not rewritten
+            if unsaved:
+                job_manager.append_checkpoint(job.id, "llm", dict(unsaved))
+                unsaved.clear()
+
+        def _llm_result(note: str) -> Dict:
+            items = _llm_items_from_results(llm_ids, llm_results, lang, llm_debug)
+            items = reused_items + _fan_out_llm_items(items, groups)
+            created = _persist_llm_suggestions(items, by_id, cfg, llm_guess_codes) if llm_persist else 0
+            return {
+                "count": len(items),
+                "items": items[:1000],
+                "dry_run": llm_dry_run,
+                "model_name": cfg.model_name,
+                "lang": cfg.lang,
+                "dedup": dedup,
+                "suggestions": {"reused": len(reused_items), "created": created},
+                "note": note,
+            }
+
+        def _cancel() -> Dict:
+            _checkpoint()
+            partial = {"rules": rules_res, "llm": _llm_result("Cancelled by user; partial items included.")}
+            job_manager.cancelled(job.id, partial_result=partial)
+            return partial
+
         # Increase total units by remaining LLM work
-        total_units2 = len(dishes) + len(missing_ids)
-        job_manager.update(job.id, total=total_units2, message="llm phase")
+        base_completed = len(dishes) + (len(llm_ids) - len(todo_ids))
+        total_units2 = len(dishes) + len(llm_ids)
+        job_manager.update(job.id, total=total_units2, completed=base_completed, message="llm phase")
 
-        items = []
-        total_llm = len(missing_ids)
+        total_llm = len(todo_ids)
         processed_llm = 0
         calls_per_item = 1.0 + (1.0 if llm_guess_codes else 0.0)
 
-        for did in missing_ids:
-            # cooperative cancellation: bail out with partial results
-            if job_manager.is_cancel_requested(job.id):
-                partial = {
-                    "rules": rules_res,
-                    "llm": {
-                        "count": len(items),
-                        "items": items[:1000],
-                        "dry_run": llm_dry_run,
-                        "model_name": cfg.model_name,
-                        "lang": cfg.lang,
-                        "note": "Cancelled by user; partial items included.",
-                    },
-                }
-                job_manager.cancelled(job.id, partial_result=partial)
-                return partial
-            d = by_id.get(did)
-            if not d:
-                continue
-            try:
-                t_extr_start = time.monotonic()
-                if llm_debug:
-                    terms, raw = llm_extract_terms(openai_caller, cfg, d.name or "", d.description or "", return_raw=True)  # type: ignore
-                else:
-                    terms = llm_extract_terms(openai_caller, cfg, d.name or "", d.description or "")  # type: ignore
-                    raw = ""
-                t_extr_end = time.monotonic()
-                try:
-                    logger.info(
-                        "llm_extract_terms: dish_id=%s name_len=%d desc_len=%d terms=%d sec=%.3f",
-                        did,
-                        len(d.name or ""),
-                        len(d.description or ""),
-                        len(terms) if isinstance(terms, list) else 0,
-                        (t_extr_end - t_extr_start),
-                    )
-                except Exception:
-                    pass
-            except Exception as e:
-                items.append({
-                    "dish_id": did,
-                    "status": "error",
-                    "error": str(e),
-                    "reused": False,
-                    "candidates": [],
-                })
-                processed_llm += 1
-                job_manager.update(job.id, completed=len(dishes) + processed_llm)
-                # update ETA for remaining llm items
-                remain = max(0, total_llm - processed_llm)
-                _, eta_min = _llm_estimate_eta(remain, avg_tokens_per_call=1500, calls_per_item=calls_per_item)
-                job_manager.update(job.id, eta_minutes=eta_min)
-                continue
-
-            codes_lookup = {}
-            if llm_guess_codes and terms:
+        if llm_async and todo_ids:
+            was_cancelled = _run_llm_phase_async(
+                job, cfg, by_id, todo_ids,
+                record=_record,
+                checkpoint=_checkpoint,
+                base_completed=base_completed,
+                guess_codes=llm_guess_codes,
+                debug=llm_debug,
+                calls_per_item=calls_per_item,
+            )
+            if was_cancelled:
+                return _cancel()
+        else:
+            for did in todo_ids:
+                # cooperative cancellation: bail out with partial results
+                if job_manager.is_cancel_requested(job.id):
+                    return _cancel()
+                d = by_id.get(did)
+                if not d:
+                    continue
                 try:
-                    t_map_start = time.monotonic()
-                    codes_lookup = llm_map_terms_to_codes(openai_caller, cfg, terms, lang=lang)
-                    t_map_end = time.monotonic()
+                    t_extr_start = time.monotonic()
+                    if llm_debug:
+                        terms, raw = llm_extract_terms(llm_caller, cfg, d.name or "", d.description or "", return_raw=True)  # type: ignore
+                    else:
+                        terms = llm_extract_terms(llm_caller, cfg, d.name or "", d.description or "")  # type: ignore
+                        raw = ""
+                    t_extr_end = time.monotonic()
                     try:
                         logger.info(
-                            "llm_map_terms_to_codes: dish_id=%s term_count=%d sec=%.3f",
+                            "llm_extract_terms: dish_id=%s name_len=%d desc_len=%d terms=%d sec=%.3f",
                             did,
+                            len(d.name or ""),
+                            len(d.description or ""),
                             len(terms) if isinstance(terms, list) else 0,
-                            (t_map_end - t_map_start),
+                            (t_extr_end - t_extr_start),
                         )
                     except Exception:
                         pass
-                except Exception:
-                    codes_lookup = {}
-
-            candidates = []
-            for term in terms:
-                lk = codes_lookup.get(term.lower(), {}) if isinstance(codes_lookup, dict) else {}
-                cand = {
-                    "term": term,
-                    "guess_codes": lk.get("codes", ""),
-                    "confidence": lk.get("confidence", 0.0),
-                    "reason": lk.get("reason", ""),
-                }
-                norm = _norm(term)
-                lx = (
-                    KeywordLexeme.objects
-                    .filter(lang=lang, normalized_term=norm)
-                    .select_related("ingredient")
-                    .first()
-                )
-                if lx and lx.ingredient_id:
-                    cand["mapped_ingredient_id"] = lx.ingredient_id
-                candidates.append(cand)
+                except Exception as e:
+                    _record(str(did), _llm_raw_result([], None, error=str(e)))
+                    processed_llm += 1
+                    job_manager.update(job.id, completed=base_completed + processed_llm)
+                    # update ETA for remaining llm items
+                    remain = max(0, total_llm - processed_llm)
+                    _, eta_min = _llm_estimate_eta(remain, calls_per_item=calls_per_item, model=cfg.model_name)
+                    job_manager.update(job.id, eta_minutes=eta_min)
+                    continue
+
+                codes_lookup = {}
+                if llm_guess_codes and terms:
+                    try:
+                        t_map_start = time.monotonic()
+                        codes_lookup = llm_map_terms_to_codes(llm_caller, cfg, terms, lang=lang)
+                        t_map_end = time.monotonic()
+                        try:
+                            logger.info(
+                                "llm_map_terms_to_codes: dish_id=%s term_count=%d sec=%.3f",
+                                did,
+                                len(terms) if isinstance(terms, list) else 0,
+                                (t_map_end - t_map_start),
+                            )
+                        except Exception:
+                            pass
+                    except Exception:
+                        codes_lookup = {}
 
-            item = {
-                "dish_id": did,
-                "status": "ok" if terms else "empty",
-                "reused": False,
-                "candidates": candidates,
-            }
-            if llm_debug:
-                item["raw"] = raw
-            items.append(item)
+                _record(str(did), _llm_raw_result(terms, codes_lookup, raw))
 
-            processed_llm += 1
-            job_manager.update(job.id, completed=len(dishes) + processed_llm)
-            remain = max(0, total_llm - processed_llm)
-            _, eta_min = _llm_estimate_eta(remain, avg_tokens_per_call=1500, calls_per_item=calls_per_item)
-            job_manager.update(job.id, eta_minutes=eta_min)
+                processed_llm += 1
+                if processed_llm % _JOB_CHECKPOINT_EVERY == 0:
+                    _checkpoint()
+                job_manager.update(job.id, completed=base_completed + processed_llm)
+                remain = max(0, total_llm - processed_llm)
+                _, eta_min = _llm_estimate_eta(remain, calls_per_item=calls_per_item, model=cfg.model_name)
+                job_manager.update(job.id, eta_minutes=eta_min)
 
-        llm_payload = {
-            "count": len(items),
-            "items": items[:1000],
-            "dry_run": llm_dry_run,
-            "model_name": cfg.model_name,
-            "lang": cfg.lang,
-            "note": "LLM candidates only; review & add lexemes to map terms → ingredients. Includes guess_codes.",
-        }
+        _checkpoint()
+        llm_payload = _llm_result(
+            "LLM candidates only; review & add lexemes to map terms → ingredients. Includes guess_codes.",
+        )
 
     # total timing
     t_job_end = time.monotonic()
@@ -572,7 +1032,10 @@ def _run_batch_generate_job(job: JobState, user_id: int, payload: dict) -> Dict:
         )
     except Exception:
         pass
-    return {"rules": rules_res, "llm": llm_payload}
+    result = {"rules": rules_res, "llm": llm_payload}
+    if resumed:
+        result["resumed"] = {"from_checkpoint": True, "llm_results_restored": restored}
+    return result
 
 
 @api_view(["POST"])
@@ -590,29 +1053,74 @@ def llm_jobs_start_batch_generate(request):
         qs = qs.filter(id__in=dish_ids_param)
     initial_count = qs.count()
 
-    job = job_manager.create(total=initial_count, message="queued")
-    job_manager.spawn(job, _run_batch_generate_job, user.id, payload)
+    # أطباق قليلة = تفاعلية (تسبق الدفعات في الطابور)؛ payload.priority يتجاوز التصنيف
+    prio = str(payload.get("priority") or "").lower()
+    if prio not in ("interactive", "bulk"):
+        prio = "interactive" if initial_count <= _JOB_INTERACTIVE_MAX_DISHES else "bulk"
+    # كبيرة → شظايا تعمل بالتوازي (shard_by: section | menu | chunk | none)
+    shard_by = str(payload.get("shard_by") or "").lower()
+    if not shard_by:
+        shard_by = "chunk" if initial_count > _JOB_SHARD_THRESHOLD else "none"
+    if shard_by != "none" and shard_by not in _JOB_SHARD_MODES:
+        return Response({"detail": f"shard_by must be one of: none, {', '.join(_JOB_SHARD_MODES)}"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    try:
+        shard_size = max(1, int(payload.get("shard_size") or _JOB_SHARD_SIZE))
+    except (TypeError, ValueError):
+        shard_size = _JOB_SHARD_SIZE
+    shards = _batch_shards(qs, shard_by, shard_size) if shard_by != "none" else []
+
+    job = job_manager.create(
+        total=initial_count,
+        message="queued",
+        owner=str(user.pk),
+        priority=PRIORITY_BULK if prio == "bulk" else PRIORITY_INTERACTIVE,
+    )
+    if len(shards) > 1:
+        job_manager.spawn_sharded(
+            job,
+            _run_batch_generate_job,
+            [(len(ids), (user.id, dict(payload, dish_ids=ids, shard_by="none")), {}) for ids in shards],
+            merge=_merge_batch_generate_results,
+        )
+    else:
+        job_manager.spawn(job, _run_batch_generate_job, user.id, payload)
 
     # rough ETA (LLM-only), assume at most 2 calls/item if llm enabled
     use_llm = bool(payload.get("use_llm", False))
     calls_per_item = 2.0 if use_llm else 0.0
-    _, eta_min = _llm_estimate_eta(initial_count, avg_tokens_per_call=1500, calls_per_item=calls_per_item)
+    _, eta_min = _llm_estimate_eta(
+        initial_count, calls_per_item=calls_per_item, model=payload.get("llm_model") or "gpt-4o-mini"
+    )
 
     return Response({
         "job_id": job.id,
         "queued": True,
+        "priority": prio,
+        "shards": len(shards) if len(shards) > 1 else 0,
         "initial_total": initial_count,
         "initial_eta_minutes": round(eta_min, 2) if eta_min else 0.0,
     }, status=status.HTTP_202_ACCEPTED)
 
 
+def _own_job(request, job_id: str) -> Optional[JobState]:
+    """المهمة إن كانت لصاحب الطلب (JobState.owner = user pk) أو كان أدمن؛ وإلا None (= 404، لا نكشف وجودها)."""
+    st = job_manager.get(job_id)
+    if st is None or is_admin(request.user) or st.owner == str(request.user.pk):
+        return st
+    return None
+
+
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def llm_jobs_status(request, job_id: str):
-    st = job_manager.get(job_id)
+    st = _own_job(request, job_id)
     if not st:
         return Response({"detail": "job not found"}, status=status.HTTP_404_NOT_FOUND)
+    return Response(_job_status_data(st), status=status.HTTP_200_OK)
+
 
+def _job_status_data(st: JobState, *, with_result: bool = True) -> Dict:
     def _ts(x):
         import datetime
         return datetime.datetime.utcfromtimestamp(x).isoformat() + "Z" if x else None
@@ -629,9 +1137,287 @@ def llm_jobs_status(request, job_id: str):
         "percent": round(st.percent, 2),
         "eta_minutes": round(st.eta_minutes, 2) if st.eta_minutes is not None else None,
         "error": st.error,
-        "result": st.result if st.status == "done" else None,
+        "attempts": st.attempts,
+        "priority": "bulk" if st.priority >= PRIORITY_BULK else "interactive",
     }
-    return Response(data, status=status.HTTP_200_OK)
+    if with_result:
+        # القوائم الكبيرة (items) عبر /results صفحةً صفحة، هنا ملخّص فقط
+        data["result"] = result_summary(st.result) if st.status == "done" else None
+    return data
+
+
+# SSE: كم ثانية بين فحصين لرقم مراجعة المهمة (كاش، بلا DB)، وأقصى مهلة بين قراءتين للمهمة
+# حين لا يصل إشعار (تتضاعف من POLL_SEC ما دام لا شيء يتغيّر)، ومتى نرسل keep-alive، وأقصى عمر
+# للاتصال (بعده يعيد العميل الاتصال فلا يبقى خيط gunicorn محجوزًا بلا نهاية؛ أقل من --timeout)
+_JOB_EVENTS_POLL_SEC = float(os.getenv("JOB_EVENTS_POLL_SEC", "0.5"))
+_JOB_EVENTS_POLL_MAX_SEC = float(os.getenv("JOB_EVENTS_POLL_MAX_SEC", "5"))
+_JOB_EVENTS_KEEPALIVE_SEC = float(os.getenv("JOB_EVENTS_KEEPALIVE_SEC", "15"))
+_JOB_EVENTS_MAX_SEC = float(os.getenv("JOB_EVENTS_MAX_SEC", "30"))
+# كل بثّ مفتوح يحجز خيط gthread كاملًا (3 workers × 8 threads = 24 في docker-compose):
+# حدّ لكل عملية (يترك بقية الخيوط لطلبات API العادية) وحدّ لكل مستخدم (عبر الكاش، مشترك بين
+# العمليات إن كان الكاش مشتركًا)؛ بعده 429 والعميل يرجع إلى polling /status/
+_JOB_EVENTS_MAX_STREAMS = max(0, int(os.getenv("JOB_EVENTS_MAX_STREAMS", "4")))
+_JOB_EVENTS_MAX_PER_USER = max(0, int(os.getenv("JOB_EVENTS_MAX_PER_USER", "2")))
+_job_event_slots = threading.BoundedSemaphore(_JOB_EVENTS_MAX_STREAMS or 1)
+_JOB_EVENTS_USER_KEY = "jobs:sse:{}"
+
+
+def _acquire_job_event_slot(user_pk) -> Optional[Callable[[], None]]:
+    """
+    يحجز مكان بثّ SSE (للعملية ثم للمستخدم)؛ يعيد دالة تحرير (تُستدعى مرة واحدة فقط)
+    أو None إن امتلأ أحد الحدّين. 0 = بلا حدّ.
+    """
+    if _JOB_EVENTS_MAX_STREAMS and not _job_event_slots.acquire(blocking=False):
+        return None
+    key = _JOB_EVENTS_USER_KEY.format(user_pk)
+    counted = False
+    if _JOB_EVENTS_MAX_PER_USER:
+        try:
+            # TTL: عدّاد عملية ماتت دون تحرير لا يحجب المستخدم للأبد
+            cache.add(key, 0, int(_JOB_EVENTS_MAX_SEC * 2) + 60)
+            try:
+                count = cache.incr(key)
+            except ValueError:  # انتهت صلاحيته بين add و incr
+                cache.set(key, 1, int(_JOB_EVENTS_MAX_SEC * 2) + 60)
+                count = 1
+            counted = True
+        except Exception:
+            count = 0  # الكاش غير متاح: يبقى حدّ العملية فقط
+        if count > _JOB_EVENTS_MAX_PER_USER:
+            _release_user_slot(key)
+            if _JOB_EVENTS_MAX_STREAMS:
+                _job_event_slots.release()
+            return None
+
+    released = threading.Event()
+
+    def release() -> None:
+        if released.is_set():
+            return
+        released.set()
+        if counted:
+            _release_user_slot(key)
+        if _JOB_EVENTS_MAX_STREAMS:
+            _job_event_slots.release()
+
+    return release
+
+
+def _release_user_slot(key: str) -> None:
+    try:
+        cache.decr(key)
+    except Exception:
+        pass
+
+
+class _ClosingStream:
+    """streaming_content يحرّر مكان البثّ عند إغلاق الاستجابة — حتى لو لم يبدأ المولّد أبدًا."""
+
+    def __init__(self, stream: Iterable[str], on_close: Callable[[], None]):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def close(self) -> None:
+        try:
+            close = getattr(self._stream, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self._on_close()
+
+
+def _sse(event: str, data, event_id: Optional[str] = None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append("data: " + json.dumps(data, ensure_ascii=False, default=str))
+    return "\n".join(lines) + "\n\n"
+
+
+def _job_item_event(dish_id: str, res: Dict) -> Dict:
+    """نتيجة طبق واحد من checkpoint["llm"] بشكل items النهائية (بدون ربط Ingredient)."""
+    try:
+        did = int(dish_id)
+    except (TypeError, ValueError):
+        did = dish_id
+    if res.get("status") == "error":
+        return {"dish_id": did, "status": "error", "error": res.get("error", ""), "candidates": []}
+    terms = res.get("terms") or []
+    return {
+        "dish_id": did,
+        "status": res.get("status", "empty"),
+        "candidates": _llm_candidates(terms, res.get("codes_lookup") or {}, "", lexemes={}),
+    }
+
+
+def _job_event_stream(job_id: str, *, with_items: bool = True, last_event_id: Optional[int] = None) -> Iterable[str]:
+    """
+    يولّد أحداث SSE لمهمة: progress عند كل تغيّر، item لكل طبق أنهته مرحلة LLM
+    (من إضافات checkpoint الجديدة فقط)، ثم done|cancelled|error بالنتيجة.
+    المهمة تُقرأ فقط حين يتغيّر رقم مراجعتها (job_manager.revision) أو بعد مهلة تتباطأ حتى
+    _JOB_EVENTS_POLL_MAX_SEC ما دام لا شيء يتغيّر؛ القراءة من job_manager مباشرة فلا تمر كل
+    دورة عبر JWT/throttle كما في polling.
+    id آخر item في كل إضافة = رقمها؛ بعد إعادة الاتصال بـ Last-Event-ID تُرسل الأحدث منه فقط.
+    """
+    yield "retry: 3000\n\n"
+    cursor = last_event_id or 0
+    last_progress = None
+    last_completed = None
+    revision = None
+    delay = _JOB_EVENTS_POLL_SEC
+    next_read = 0.0
+    started = last_beat = time.monotonic()
+    while True:
+        now = time.monotonic()
+        current = job_manager.revision(job_id)
+        if current != revision or now >= next_read:
+            revision = current
+            st = job_manager.get(job_id)
+            if st is None:
+                yield _sse("error", {"detail": "job not found"})
+                return
+            final = st.status in ("done", "error", "cancelled")
+            changed = False
+
+            progress = _job_status_data(st, with_result=False)
+            if progress != last_progress:
+                last_progress, changed = progress, True
+                last_beat = time.monotonic()
+                yield _sse("progress", progress)
+
+            if with_items and (st.completed != last_completed or final):
+                last_completed = st.completed
+                for seq, _, delta in job_manager.checkpoint_deltas(job_id, after=cursor, key="llm"):
+                    cursor, changed = seq, True
+                    results = [(did, res) for did, res in delta.items() if isinstance(res, dict)]
+                    for n, (did, res) in enumerate(results, 1):
+                        yield _sse("item", _job_item_event(did, res), event_id=str(seq) if n == len(results) else None)
+
+            if final:
+                yield _sse(st.status, {
+                    "id": st.id,
+                    "status": st.status,
+                    "error": st.error,
+                    "result": result_summary(st.result),
+                })
+                return
+            delay = _JOB_EVENTS_POLL_SEC if changed else min(_JOB_EVENTS_POLL_MAX_SEC, delay * 2)
+            next_read = time.monotonic() + delay
+
+        now = time.monotonic()
+        if now - started >= _JOB_EVENTS_MAX_SEC:
+            # العميل يعيد الاتصال بعد retry ويتابع من Last-Event-ID
+            return
+        if now - last_beat >= _JOB_EVENTS_KEEPALIVE_SEC:
+            last_beat = now
+            yield ": keep-alive\n\n"
+        time.sleep(_JOB_EVENTS_POLL_SEC)
+
+
+class _EventStreamRenderer(BaseRenderer):
+    """يسمح بـ Accept: text/event-stream (EventSource)؛ أخطاء DRF تُرسل كحدث error."""
+    media_type = "text/event-stream"
+    format = "sse"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return _sse("error", data).encode(self.charset)
+
+
+@api_view(["GET"])
+@renderer_classes([JSONRenderer, _EventStreamRenderer])
+@permission_classes([IsAuthenticated])
+def llm_jobs_events(request, job_id: str):
+    """
+    GET /api/llm/jobs/{job_id}/events
+    Server-Sent Events stream replacing the status polling loop:
+      event: progress   {status, completed, total, percent, eta_minutes, message, ...}
+      event: item       {dish_id, status, candidates}   (one per dish; id: <checkpoint seq> on the last of a batch)
+      event: done | cancelled | error   {status, error, result}
+    Query: items=0 to skip per-dish events. Auth + throttle run once per stream.
+    Reconnect with the Last-Event-ID header (or ?last_event_id=) to get only newer items.
+    429 when this process (JOB_EVENTS_MAX_STREAMS) or this user (JOB_EVENTS_MAX_PER_USER) already
+    holds its share of streams: the client polls /status/ instead.
+    """
+    st = _own_job(request, job_id)
+    if not st:
+        return Response({"detail": "job not found"}, status=status.HTTP_404_NOT_FOUND)
+    release = _acquire_job_event_slot(request.user.pk)
+    if release is None:
+        resp = Response({"detail": "too many open job streams; poll /status/."},
+                        status=status.HTTP_429_TOO_MANY_REQUESTS)
+        resp["Retry-After"] = str(int(_JOB_EVENTS_MAX_SEC))
+        return resp
+    with_items = str(request.query_params.get("items", "1")).lower() not in ("0", "false", "no")
+    try:
+        last_event_id = int(request.META.get("HTTP_LAST_EVENT_ID") or request.query_params.get("last_event_id") or 0)
+    except (TypeError, ValueError):
+        last_event_id = 0
+    resp = StreamingHttpResponse(
+        _ClosingStream(_job_event_stream(job_id, with_items=with_items, last_event_id=last_event_id), release),
+        content_type="text/event-stream",
+    )
+    resp["Cache-Control"] = "no-cache"
+    resp["X-Accel-Buffering"] = "no"  # nginx: لا تخزّن الأحداث مؤقتًا
+    return resp
+
+
+_JOB_RESULTS_PAGE_MAX = 1000
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def llm_jobs_results(request, job_id: str):
+    """
+    GET /api/llm/jobs/{job_id}/results
+      → {"sections": {"rules": <items_total>, "llm": ...}, "summary": {...}}
+    GET /api/llm/jobs/{job_id}/results?section=rules&offset=0&limit=200
+      → {"section", "offset", "limit", "total", "items": [...], "next_offset"}
+    Available once the job is finished (done, or cancelled with partial results).
+    """
+    st = _own_job(request, job_id)
+    if not st:
+        return Response({"detail": "job not found"}, status=status.HTTP_404_NOT_FOUND)
+    result = job_manager.load_result(job_id) if st.status in ("done", "cancelled") else None
+    if not isinstance(result, dict):
+        return Response({"detail": f"job is {st.status}; no result available"}, status=status.HTTP_409_CONFLICT)
+
+    sections = {
+        key: len(value["items"])
+        for key, value in result.items()
+        if isinstance(value, dict) and isinstance(value.get("items"), list)
+    }
+    section = (request.query_params.get("section") or "").strip()
+    if not section:
+        return Response({
+            "id": st.id,
+            "status": st.status,
+            "sections": sections,
+            "summary": result_summary(result),
+        }, status=status.HTTP_200_OK)
+    if section not in sections:
+        return Response({"detail": f"unknown section {section!r}", "sections": list(sections)},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        offset = max(0, int(request.query_params.get("offset", 0)))
+        limit = max(1, min(_JOB_RESULTS_PAGE_MAX, int(request.query_params.get("limit", 200))))
+    except (TypeError, ValueError):
+        return Response({"detail": "offset/limit must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+    items = result[section]["items"]
+    total = len(items)
+    return Response({
+        "section": section,
+        "offset": offset,
+        "limit": limit,
+        "total": total,
+        "items": items[offset:offset + limit],
+        "next_offset": offset + limit if offset + limit < total else None,
+    }, status=status.HTTP_200_OK)
 
 
 @api_view(["POST"])
@@ -642,13 +1428,32 @@ def llm_jobs_cancel(request, job_id: str):
     Cooperative cancellation: marks the job as cancel_requested; the worker
     loop will terminate ASAP, returning partial results if possible.
     """
-    st = job_manager.get(job_id)
+    st = _own_job(request, job_id)
     if not st:
         return Response({"detail": "job not found"}, status=status.HTTP_404_NOT_FOUND)
     job_manager.cancel(job_id)
     return Response({"ok": True, "job_id": job_id, "cancel_requested": True}, status=status.HTTP_202_ACCEPTED)
 
 
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def llm_jobs_resume(request, job_id: str):
+    """
+    POST /api/llm/jobs/{job_id}/resume
+    Re-queues a cancelled/failed job under the same id; it continues from its last
+    checkpoint (finished rules chunks and LLM results are not redone).
+    """
+    st = _own_job(request, job_id)
+    if not st:
+        return Response({"detail": "job not found"}, status=status.HTTP_404_NOT_FOUND)
+    if not job_manager.resume(job_id):
+        return Response(
+            {"detail": f"job is {st.status}; only cancelled or failed jobs can be resumed"},
+            status=status.HTTP_409_CONFLICT,
+        )
+    return Response({"ok": True, "job_id": job_id, "resumed": True}, status=status.HTTP_202_ACCEPTED)
+
+
 class UserListAdminView(generics.ListAPIView):
     serializer_class = UserSerializer
     permission_classes = [IsAdmin]
@@ -840,6 +1645,8 @@ class MenuPublishView(generics.GenericAPIView):
             menu.save(update_fields=["is_published", "public_slug"])
         else:
             menu.save(update_fields=["is_published"])
+        # اللقطة العامة جاهزة قبل أن يمسح أول ضيف رمز QR
+        public_menu.build_snapshot(menu.pk)
         return Response(MenuSerializer(menu).data, status=status.HTTP_200_OK)
 
 
@@ -995,7 +1802,7 @@ class DishListCreateView(generics.ListCreateAPIView):
         base = (
             Dish.objects
             .select_related("section__menu__user__profile")
-            .prefetch_related("prices", "allergen_rows__allergen")
+            .prefetch_related("prices", "allergen_rows__allergen", "ingredients")
             .order_by("sort_order", "id")
         )
         qs = base if is_admin(user) else base.filter(section__menu__user=user)
@@ -1172,22 +1979,35 @@ class DishManualAllergensView(APIView):
 # ============================================================
 
 class PublicMenuView(generics.RetrieveAPIView):
+    """
+    يُقدَّم من اللقطة الجاهزة (core/services/public_menu.py): بلا استعلامات عند وجودها،
+    وتُبنى مرة واحدة إن لم توجد بعد. ETag/Last-Modified من اللقطة نفسها → 304 للضيف العائد.
+    """
     permission_classes = [AllowAny]
     serializer_class = PublicMenuSerializer
     lookup_field = "public_slug"
 
     def get_queryset(self):
-        dishes_qs = (
-            Dish.objects
-            .select_related("section__menu__user__profile")
-            .prefetch_related("prices", "allergen_rows__allergen")
-            .order_by("sort_order", "id")
-        )
-        sections_qs = Section.objects.order_by('sort_order', 'id')
-        return Menu.objects.filter(is_published=True).prefetch_related(
-            Prefetch("sections", queryset=sections_qs),
-            Prefetch("sections__dishes", queryset=dishes_qs),
-        )
+        return public_menu.public_menu_queryset()
+
+    def retrieve(self, request, *args, **kwargs):
+        slug = kwargs.get(self.lookup_field) or ""
+        snap = public_menu.load_snapshot(slug)
+        if snap is None:
+            menu_id = get_object_or_404(Menu.objects.filter(is_published=True).only("id"), public_slug=slug).pk
+            snap = public_menu.build_snapshot(menu_id)
+            if snap is None:
+                raise Http404
+        # If-None-Match / If-Modified-Since → 304 بلا جسم (ولا serializer ولا ORM)
+        resp = get_conditional_response(request, etag=snap.etag, last_modified=snap.last_modified)
+        if resp is None:
+            resp = HttpResponse(public_menu.render_snapshot(snap.body, request), content_type="application/json")
+        resp["ETag"] = snap.etag
+        resp["Last-Modified"] = http_date(snap.last_modified)
+        # max-age=0: الضيف/nginx يخزّنان لكن يتحقّقان بـETag في كل طلب (304 = stat() واحد)،
+        # فلا تبقى قائمة أُلغي نشرها أو تعديل قديم ظاهرًا بعد حذف/إعادة بناء اللقطة
+        patch_cache_control(resp, public=True, max_age=0)
+        return resp
 
 
 # ============================================================
@@ -1216,7 +2036,8 @@ class MenuAggregateView(APIView):
         dishes_qs = (
             Dish.objects
             .filter(section__menu=menu)
-            .only("id", "name", "description", "price", "image", "allergy_info", "section_id", "generated_codes", "has_manual_codes", "manual_codes")
+            .only("id", "name", "description", "price", "image", "allergy_info", "section_id", "sort_order", "is_favorite",
+                  "codes", "generated_codes", "has_manual_codes", "manual_codes")
             .select_related("section__menu__user__profile")
             .prefetch_related(
                 "prices",
@@ -1448,9 +2269,11 @@ def batch_generate_allergen_codes(request):
             temperature=llm_temperature,
             dry_run=llm_dry_run,
             max_output_tokens=512,
+            **_llm_prompt_options(request.data.get("llm_prompt_style")),
         )
 
         items = []
+        pending: List[Tuple[Dict, List[str], Dict]] = []
         for did in missing_ids:
             d = by_id.get(did)
             if not d:
@@ -1459,10 +2282,10 @@ def batch_generate_allergen_codes(request):
             try:
                 if llm_debug:
                     terms, raw = llm_extract_terms(
-                        openai_caller, cfg, d.name or "", d.description or "", return_raw=True  # type: ignore
+                        llm_caller, cfg, d.name or "", d.description or "", return_raw=True  # type: ignore
                     )
                 else:
-                    terms = llm_extract_terms(openai_caller, cfg, d.name or "", d.description or "")  # type: ignore
+                    terms = llm_extract_terms(llm_caller, cfg, d.name or "", d.description or "")  # type: ignore
                     raw = ""
             except Exception as e:
                 items.append({
@@ -1478,42 +2301,23 @@ def batch_generate_allergen_codes(request):
             codes_lookup = {}
             if llm_guess_codes and terms:
                 try:
-                    codes_lookup = llm_map_terms_to_codes(openai_caller, cfg, terms, lang=lang)
+                    codes_lookup = llm_map_terms_to_codes(llm_caller, cfg, terms, lang=lang)
                 except Exception:
                     codes_lookup = {}
 
-            candidates = []
-            for term in terms:
-                lk = codes_lookup.get(term.lower(), {}) if isinstance(codes_lookup, dict) else {}
-                cand = {
-                    "term": term,
-                    "guess_codes": lk.get("codes", ""),
-                    "confidence": lk.get("confidence", 0.0),
-                    "reason": lk.get("reason", ""),
-                }
-
-                # ربط بمكوّن معروف إن وُجد
-                norm = _norm(term)
-                lx = (
-                    KeywordLexeme.objects
-                    .filter(lang=lang, normalized_term=norm)
-                    .select_related("ingredient")
-                    .first()
-                )
-                if lx and lx.ingredient_id:
-                    cand["mapped_ingredient_id"] = lx.ingredient_id
-
-                candidates.append(cand)
-
             item = {
                 "dish_id": did,
                 "status": "ok" if terms else "empty",
                 "reused": False,
-                "candidates": candidates,
+                "candidates": [],
             }
             if llm_debug:
                 item["raw"] = raw
             items.append(item)
+            pending.append((item, terms, codes_lookup))
+
+        # ربط بمكوّن معروف إن وُجد (استعلام lexemes واحد للدفعة)
+        _fill_llm_candidates(pending, lang)
 
         llm_payload = {
             "count": len(items),
@@ -1962,13 +2766,169 @@ def llm_direct_codes(request):
         timeout=60,
     )
 
+    key = _direct_codes_cache_key(cfg, name, description)
+    hit = cache.get(key)
+    if hit is not None:
+        return Response({"ok": True, **hit, "cached": True}, status=status.HTTP_200_OK)
+
     try:
-        res = llm_map_dish_to_codes(openai_caller, cfg, name, description)  # type: ignore
+        res = llm_map_dish_to_codes(llm_caller, cfg, name, description)  # type: ignore
+        _direct_codes_cache_set(key, res)
         return Response({"ok": True, **res}, status=status.HTTP_200_OK)
     except Exception as e:
         return Response({"ok": False, "error": str(e)}, status=status.HTTP_200_OK)
 
 
+# كاش ردود llm-direct-codes (نفس نسخة البرومبت + نفس الموديل/الحرارة + نفس بصمة الطبق)
+# البرومبت المفرد والمجمّع مفتاحان منفصلان: ردودهما ليست متطابقة بالضرورة
+_DIRECT_CODES_CACHE_TTL = int(os.getenv("LLM_DIRECT_CODES_CACHE_TTL", "86400"))
+_DIRECT_CODES_MAX_BATCH = 200
+
+
+def _direct_codes_cache_key(
+    cfg: LLMConfig, name: str, description: str, prompt_version: str = DIRECT_CODES_PROMPT_VERSION
+) -> str:
+    fp = dish_fingerprint(name, description)
+    return f"llm:direct-codes:{prompt_version}:{cfg.model_name}:{cfg.temperature:.2f}:{fp}"
+
+
+def _direct_codes_cache_set(key: str, res: Dict) -> None:
+    # لا نخزّن نتائج الـfallback (breaker مفتوح) حتى يُعاد سؤال النموذج لاحقًا
+    if _DIRECT_CODES_CACHE_TTL > 0 and not res.get("fallback"):
+        cache.set(key, {"codes": res.get("codes", ""), "raw": res.get("raw", "")}, _DIRECT_CODES_CACHE_TTL)
+
+
+def _direct_codes_batch_events(cfg: LLMConfig, dishes: List[Dict], pack_size: int):
+    """
+    يولّد أحداث النتائج (dict لكل سطر NDJSON):
+    1) ما في الكاش فورًا، 2) الأطباق الفريدة الباقية مجمّعة pack_size في كل برومبت،
+    تُرسل بالتوازي وتُعاد كل حزمة فور اكتمالها، 3) سطر ختامي بالإحصاءات.
+    """
+    groups: Dict[str, List[int]] = {}   # cache key → indices (dedup)
+    for i, d in enumerate(dishes):
+        key = _direct_codes_cache_key(cfg, d["name"], d["description"], PACKED_CODES_PROMPT_VERSION)
+        groups.setdefault(key, []).append(i)
+
+    def _event(i: int, res: Dict, cached: bool) -> Dict:
+        ev = {"index": i, "id": dishes[i].get("id"), "codes": res.get("codes", ""), "cached": cached}
+        if res.get("fallback"):
+            ev["fallback"] = res["fallback"]
+        if res.get("error"):
+            ev["error"] = res["error"]
+        return ev
+
+    cached_hits = cache.get_many(list(groups)) if groups else {}
+    misses = [k for k in groups if k not in cached_hits]
+    for key, res in cached_hits.items():
+        for i in groups[key]:
+            yield _event(i, res, True)
+
+    packs = [misses[j:j + pack_size] for j in range(0, len(misses), pack_size)]
+
+    def _run_pack(keys: List[str]) -> List[Tuple[str, Dict]]:
+        first = [dishes[groups[k][0]] for k in keys]
+        try:
+            results = llm_map_dishes_to_codes(llm_caller, cfg, [(d["name"], d["description"]) for d in first])
+        except Exception as e:
+            results = [{"codes": "", "error": str(e)} for _ in keys]
+        # الكاش داخل الخيط: حزمة اكتملت بعد انقطاع العميل لا تضيع كلفتها
+        for key, res in zip(keys, results):
+            if not res.get("error"):
+                _direct_codes_cache_set(key, res)
+        return list(zip(keys, results))
+
+    llm_calls = 0
+    if packs:
+        pool = ThreadPoolExecutor(max_workers=min(4, len(packs)))
+        try:
+            futures = [pool.submit(_run_pack, keys) for keys in packs]
+            for fut in as_completed(futures):
+                llm_calls += 1
+                for key, res in fut.result():
+                    for i in groups[key]:
+                        yield _event(i, res, False)
+        finally:
+            # انقطاع العميل (GeneratorExit عند yield): نلغي الحزم التي لم تبدأ ولا ننتظر الجارية
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    yield {
+        "done": True,
+        "count": len(dishes),
+        "unique": len(groups),
+        "cache_hits": sum(len(groups[k]) for k in cached_hits),
+        "llm_prompts": llm_calls,
+    }
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def llm_direct_codes_batch(request):
+    """
+    POST /api/llm-direct-codes/batch/
+    {"dishes": [{"id": 1, "name": "...", "description": "..."}, ...],
+     "model": "gpt-4o-mini", "temperature": 0.2, "pack_size": 8, "stream": true}
+
+    نسخة دفعية من llm-direct-codes: كاش + إزالة التكرار + عدة أطباق في برومبت واحد.
+    stream=true (افتراضي): application/x-ndjson، سطر لكل طبق فور اكتمال حزمته ثم سطر {"done": true, ...}.
+    stream=false: JSON واحد {"results": [...], "summary": {...}} بنفس ترتيب الإدخال.
+    """
+    data = request.data or {}
+    raw_dishes = data.get("dishes")
+    if not isinstance(raw_dishes, list) or not raw_dishes:
+        return Response({"detail": "dishes must be a non-empty list."}, status=status.HTTP_400_BAD_REQUEST)
+    if len(raw_dishes) > _DIRECT_CODES_MAX_BATCH:
+        return Response(
+            {"detail": f"at most {_DIRECT_CODES_MAX_BATCH} dishes per request."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    dishes = []
+    for d in raw_dishes:
+        d = d if isinstance(d, dict) else {}
+        dishes.append({
+            "id": d.get("id"),
+            "name": str(d.get("name") or "").strip(),
+            "description": str(d.get("description") or "").strip(),
+        })
+
+    model = str(data.get("model") or data.get("llm_model") or "gpt-4o-mini").strip()
+    try:
+        temperature = float(data.get("temperature", data.get("llm_temperature", 0.2)))
+    except Exception:
+        temperature = 0.2
+    try:
+        pack_size = max(1, min(20, int(data.get("pack_size", 8))))
+    except Exception:
+        pack_size = 8
+
+    cfg = LLMConfig(
+        model_name=model,
+        lang="de",
+        temperature=temperature,
+        dry_run=True,
+        max_output_tokens=512,
+        timeout=60,
+    )
+    events = _direct_codes_batch_events(cfg, dishes, pack_size)
+
+    if str(data.get("stream", True)).lower() in ("0", "false", "no"):
+        results: List[Optional[Dict]] = [None] * len(dishes)
+        summary: Dict = {}
+        for ev in events:
+            if ev.get("done"):
+                summary = ev
+            else:
+                results[ev["index"]] = ev
+        return Response({"ok": True, "results": results, "summary": summary}, status=status.HTTP_200_OK)
+
+    resp = StreamingHttpResponse(
+        (json.dumps(ev, ensure_ascii=False) + "\n" for ev in events),
+        content_type="application/x-ndjson",
+    )
+    resp["Cache-Control"] = "no-cache"
+    resp["X-Accel-Buffering"] = "no"  # nginx: لا تجمع السطور
+    return resp
+
+
 # ============================================================
 # Register (نسخة واحدة فقط — تثبيت الدور إلى owner)
 # ============================================================
@@ -2110,6 +3070,9 @@ try:
     llm_direct_codes.throttle_scope = "llm"
     llm_direct_codes = throttle_classes([ScopedRateThrottle])(llm_direct_codes)
 
+    llm_direct_codes_batch.throttle_scope = "llm"
+    llm_direct_codes_batch = throttle_classes([ScopedRateThrottle])(llm_direct_codes_batch)
+
     # Lightweight GET helpers use availability throttle
     llm_eta.throttle_scope = "availability"
     llm_eta = throttle_classes([ScopedRateThrottle])(llm_eta)
@@ -2122,8 +3085,14 @@ try:
 
     llm_jobs_status.throttle_scope = "availability"
     llm_jobs_status = throttle_classes([ScopedRateThrottle])(llm_jobs_status)
+    llm_jobs_events.throttle_scope = "availability"
+    llm_jobs_events = throttle_classes([ScopedRateThrottle])(llm_jobs_events)
+    llm_jobs_results.throttle_scope = "availability"
+    llm_jobs_results = throttle_classes([ScopedRateThrottle])(llm_jobs_results)
     llm_jobs_cancel.throttle_scope = "llm"
     llm_jobs_cancel = throttle_classes([ScopedRateThrottle])(llm_jobs_cancel)
+    llm_jobs_resume.throttle_scope = "llm"
+    llm_jobs_resume = throttle_classes([ScopedRateThrottle])(llm_jobs_resume)
 except Exception:
     # If import order or name lookup fails in some contexts, ignore.
     pass
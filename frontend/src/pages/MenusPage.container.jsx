@@ -3,6 +3,7 @@
 import React, { useEffect, useMemo, useState } from 'react';
 import { useQuery } from '@tanstack/react-query';
 import api from '../services/axios';
+import { waitForLlmJob, fetchJobResult } from '../services/jobEvents';
 import { Link } from 'react-router-dom';
 import {
   Container, Typography, TextField, Button, Stack, Card, CardContent, Box, Alert,
@@ -779,6 +780,15 @@ function MenusPage({ token }) {
     return base;
   };
 
+  // progress من SSE (أو polling كاحتياط) → نسبة + خطوة الـoverlay
+  const applyLlmProgress = (st) => {
+    setLlmPercent(st?.percent ?? 0);
+    const msg = (st?.message || '').toLowerCase();
+    if (msg.includes('rules phase')) setLlmStep(1);
+    else if (msg.includes('rules done')) setLlmStep(2);
+    else if (msg.includes('llm phase')) setLlmStep(3);
+  };
+
   const previewGenerate = async () => {
     setGenBusy(true); setGenCounts(null); setGenLLM(null);
     try {
@@ -791,25 +801,13 @@ function MenusPage({ token }) {
         const { data: start } = await api.post('/llm/jobs/start-batch-generate/', body, { signal: controller.signal });
         const jobId = start?.job_id;
         setLlmJobId(jobId);
-        let rules = null, llm = null;
-        const pollInterval = 1200;
-        while (true) {
-          await new Promise((r) => setTimeout(r, pollInterval));
-          const { data: st } = await api.get(`/llm/jobs/${jobId}/status/`, { signal: controller.signal });
-          setLlmPercent(st?.percent ?? 0);
-          const msg = (st?.message || '').toLowerCase();
-          if (msg.includes('rules phase')) setLlmStep(1);
-          else if (msg.includes('rules done')) setLlmStep(2);
-          else if (msg.includes('llm phase')) setLlmStep(3);
-          if (st?.status === 'done') {
-            rules = st?.result?.rules || null;
-            llm = st?.result?.llm || null;
-            break;
-          }
-          if (st?.status === 'error' || st?.status === 'cancelled') {
-            throw new Error(st?.error || 'LLM job did not complete');
-          }
+        const st = await waitForLlmJob(jobId, { signal: controller.signal, onProgress: applyLlmProgress });
+        if (st?.status !== 'done') {
+          throw new Error(st?.error || st?.detail || 'LLM job did not complete');
         }
+        const full = await fetchJobResult(jobId, { signal: controller.signal });
+        const rules = full?.rules || null;
+        const llm = full?.llm || null;
         setLlmOverlayOpen(false);
         setLlmJobId(null);
         setLlmController(null);
@@ -863,25 +861,13 @@ function MenusPage({ token }) {
         const { data: start } = await api.post('/llm/jobs/start-batch-generate/', body, { signal: controller.signal });
         const jobId = start?.job_id;
         setLlmJobId(jobId);
-        let rules = null, llm = null;
-        const pollInterval = 1200;
-        while (true) {
-          await new Promise((r) => setTimeout(r, pollInterval));
-          const { data: st } = await api.get(`/llm/jobs/${jobId}/status/`, { signal: controller.signal });
-          setLlmPercent(st?.percent ?? 0);
-          const msg = (st?.message || '').toLowerCase();
-          if (msg.includes('rules phase')) setLlmStep(1);
-          else if (msg.includes('rules done')) setLlmStep(2);
-          else if (msg.includes('llm phase')) setLlmStep(3);
-          if (st?.status === 'done') {
-            rules = st?.result?.rules || null;
-            llm = st?.result?.llm || null;
-            break;
-          }
-          if (st?.status === 'error' || st?.status === 'cancelled') {
-            throw new Error(st?.error || 'LLM job did not complete');
-          }
+        const st = await waitForLlmJob(jobId, { signal: controller.signal, onProgress: applyLlmProgress });
+        if (st?.status !== 'done') {
+          throw new Error(st?.error || st?.detail || 'LLM job did not complete');
         }
+        const full = await fetchJobResult(jobId, { signal: controller.signal });
+        const rules = full?.rules || null;
+        const llm = full?.llm || null;
         setLlmOverlayOpen(false);
         setLlmJobId(null);
         setLlmController(null);
@@ -0,0 +1,118 @@
+// src/services/jobEvents.js
+// Follow an LLM job through its SSE stream (/llm/jobs/<id>/events/),
+// falling back to polling /status/ when streaming is not possible.
+
+import api, { getAccess } from './axios';
+
+const FINAL = new Set(['done', 'error', 'cancelled']);
+const sleep = (ms) => new Promise((r) => setTimeout(r, ms));
+
+// يقرأ كتل SSE من ReadableStream ويستدعي onEvent(event, data, id)
+async function readSse(body, onEvent) {
+  const reader = body.getReader();
+  const decoder = new TextDecoder();
+  let buf = '';
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) return;
+    buf += decoder.decode(value, { stream: true });
+    let cut;
+    while ((cut = buf.indexOf('\n\n')) >= 0) {
+      const block = buf.slice(0, cut);
+      buf = buf.slice(cut + 2);
+      let event = 'message', data = '', id = null;
+      for (const line of block.split('\n')) {
+        if (line.startsWith('event: ')) event = line.slice(7);
+        else if (line.startsWith('data: ')) data += line.slice(6);
+        else if (line.startsWith('id: ')) id = line.slice(4);
+      }
+      if (!data) continue; // retry / keep-alive
+      let parsed = null;
+      try { parsed = JSON.parse(data); } catch { continue; }
+      if (onEvent(event, parsed, id) === false) {
+        try { await reader.cancel(); } catch { }
+        return;
+      }
+    }
+  }
+}
+
+async function pollJob(jobId, { signal, onProgress, interval = 1200 }) {
+  while (true) {
+    await sleep(interval);
+    const { data: st } = await api.get(`/llm/jobs/${jobId}/status/`, { signal });
+    onProgress?.(st);
+    if (FINAL.has(st?.status)) return st;
+  }
+}
+
+/**
+ * Resolves with the final job state ({status, result, error}).
+ * onProgress(st): status-like object on every change; onItem(item): per-dish LLM result.
+ * The stream reconnects after the server's max age and resumes after the last item id it saw
+ * (?last_event_id=, like Last-Event-ID but without a CORS allow-list entry); on 401, 429
+ * (too many open streams) or older servers we poll instead (axios handles the token refresh there).
+ */
+export async function waitForLlmJob(jobId, { signal, onProgress, onItem } = {}) {
+  const base = (api.defaults.baseURL || '/api').replace(/\/+$/, '');
+  if (typeof fetch !== 'function' || typeof TextDecoder === 'undefined') {
+    return pollJob(jobId, { signal, onProgress });
+  }
+  let lastEventId = null;
+  while (true) {
+    let final = null;
+    let res;
+    try {
+      const token = getAccess();
+      const query = lastEventId ? `?last_event_id=${encodeURIComponent(lastEventId)}` : '';
+      res = await fetch(`${base}/llm/jobs/${jobId}/events/${query}`, {
+        headers: { Accept: 'text/event-stream', ...(token ? { Authorization: `Bearer ${token}` } : {}) },
+        signal,
+      });
+    } catch (e) {
+      if (signal?.aborted) throw e;
+      return pollJob(jobId, { signal, onProgress });
+    }
+    if (!res.ok || !res.body) return pollJob(jobId, { signal, onProgress });
+
+    await readSse(res.body, (event, data, id) => {
+      if (id) lastEventId = id;
+      if (event === 'progress') onProgress?.(data);
+      else if (event === 'item') onItem?.(data);
+      else if (FINAL.has(event)) {
+        final = data;
+        return false;
+      }
+      return true;
+    });
+    if (final) return final;
+    if (signal?.aborted) throw new DOMException('Aborted', 'AbortError');
+    await sleep(1000); // انتهى عمر الاتصال: نعيد الاشتراك
+  }
+}
+
+/**
+ * Full job result, re-assembled from /results/ pages (status and the SSE "done" event only
+ * carry a summary where every items list is replaced by items_total).
+ */
+export async function fetchJobResult(jobId, { signal, pageSize = 500 } = {}) {
+  const { data: head } = await api.get(`/llm/jobs/${jobId}/results/`, { signal });
+  const out = { ...(head?.summary || {}) };
+  for (const section of Object.keys(head?.sections || {})) {
+    const items = [];
+    let offset = 0;
+    while (offset !== null && offset !== undefined) {
+      const { data: page } = await api.get(`/llm/jobs/${jobId}/results/`, {
+        params: { section, offset, limit: pageSize },
+        signal,
+      });
+      items.push(...(page?.items || []));
+      offset = page?.next_offset;
+    }
+    const { items_total: _total, ...rest } = out[section] || {};
+    out[section] = { ...rest, items };
+  }
+  return out;
+}
+
+export default waitForLlmJob;